@@ -294,3 +294,43 @@ class DifferentStacktraceError(ExpectedException):
         message=self.MESSAGE.format(count=count),
         exit_code=self.EXIT_CODE,
         extras={'signatures': crash_signatures})
+
+
+class DownloadFailedError(ExpectedException):
+  """An exception raised when a file cannot be downloaded."""
+
+  MESSAGE = 'Downloading {url} failed: {reason}'
+  EXIT_CODE = 59
+
+  def __init__(self, url, reason, status_code=None):
+    super(DownloadFailedError, self).__init__(
+        self.MESSAGE.format(url=url, reason=reason), self.EXIT_CODE)
+    self.status_code = status_code
+
+
+class WorktreeDepsNotSyncedError(ExpectedException):
+  """An exception raised when --skip-deps is used with a worktree whose
+    dependencies have never been synced."""
+
+  MESSAGE = (
+      'The worktree at {source_dir} has never been synced, so it has none of '
+      'the repositories of DEPS. Please re-run without --skip-deps.')
+  EXIT_CODE = 60
+
+  def __init__(self, source_dir):
+    super(WorktreeDepsNotSyncedError, self).__init__(
+        self.MESSAGE.format(source_dir=source_dir), self.EXIT_CODE)
+
+
+class PdfiumRevisionNotFoundError(ExpectedException):
+  """An exception raised when Chromium's DEPS doesn't pin a Pdfium
+    revision."""
+
+  MESSAGE = (
+      "Chromium's DEPS at {chromium_sha} has no pdfium_revision, so the "
+      'Pdfium revision of the testcase is unknown.')
+  EXIT_CODE = 61
+
+  def __init__(self, chromium_sha):
+    super(PdfiumRevisionNotFoundError, self).__init__(
+        self.MESSAGE.format(chromium_sha=chromium_sha), self.EXIT_CODE)
@@ -0,0 +1,210 @@
+"""A cache of the binaries built locally, keyed by what they're built from."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from clusterfuzz import common
+from clusterfuzz import dedup
+from clusterfuzz import disk_cache
+
+
+ARTIFACTS_DIR = os.path.join(common.CLUSTERFUZZ_CACHE_DIR, 'artifacts')
+QUOTA_VARIABLE = 'CF_ARTIFACT_CACHE_QUOTA_GB'
+DEFAULT_QUOTA_GB = 50
+# The args that don't change what is built.
+IGNORED_GN_ARGS = ['concurrent_links', 'goma_dir', 'use_goma']
+# The args.gn is kept with the build, since it describes the build.
+ARGS_GN_FILENAME = 'args.gn'
+# The metadata file with the source files that a build was built from.
+INPUTS_EXTENSION = 'inputs'
+
+logger = logging.getLogger('clusterfuzz')
+
+
+def get_cache():
+  """Return the cache of built binaries."""
+  return disk_cache.DiskCache(
+      'artifact', ARTIFACTS_DIR,
+      disk_cache.get_quota(QUOTA_VARIABLE, DEFAULT_QUOTA_GB))
+
+
+def get_args(gn_args):
+  """Return args.gn without the args that don't change the outputs."""
+  return sorted((k, v) for k, v in gn_args.iteritems()
+                if k not in IGNORED_GN_ARGS)
+
+
+def get_key(sha, gn_args, target, sanitizer):
+  """Return the key of a build: its source sha, args.gn, target and
+    sanitizer."""
+  return hashlib.sha1(
+      json.dumps([sha, get_args(gn_args), target, sanitizer])).hexdigest()
+
+
+def get_variant(gn_args, target, sanitizer):
+  """Return what the builds of a target at different revisions have in
+    common: args.gn, target and sanitizer."""
+  return hashlib.sha1(
+      json.dumps([get_args(gn_args), target, sanitizer])).hexdigest()
+
+
+def get_nearest(variant, revision, max_distance):
+  """Return the keys and metadata of the cached builds of the variant
+    within max_distance of revision, nearest first."""
+  builds = [
+      (key, meta) for key, meta in get_cache().get_entries().iteritems()
+      if meta.get('variant') == variant and 'revision' in meta and
+      abs(meta['revision'] - revision) <= max_distance]
+  return sorted(builds, key=lambda (_, meta): abs(meta['revision'] - revision))
+
+
+def read_inputs(key):
+  """Return the source files that a cached build was built from, or None
+    if they weren't recorded."""
+  path = get_cache().get_meta_path(key, INPUTS_EXTENSION)
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    return set(f.read().splitlines())
+
+
+def get_labels(build_dir, target, source_dir):
+  """Return the GN labels of the default toolchain that are named after
+    the ninja target (e.g. //v8:d8 for d8)."""
+  returncode, output = common.execute(
+      'gn', 'ls %s --as=label' % build_dir, source_dir, print_command=False,
+      print_output=False, exit_on_error=False)
+  if returncode != 0:
+    return []
+  return [label for label in output.split()
+          if label.startswith('//') and label.split(':')[-1] == target]
+
+
+def get_runtime_paths(build_dir, target, source_dir):
+  """Return the paths, relative to build_dir, that the target needs at run
+    time according to GN's runtime_deps (e.g. the binary, its shared
+    libraries and its data), along with args.gn. The runtime deps in the
+    source tree aren't part of the build, and are left out. Returns None if
+    GN can't tell, in which case the build isn't cached."""
+  labels = get_labels(build_dir, target, source_dir)
+  if not labels:
+    logger.debug('No GN label is named after %s.', target)
+    return None
+
+  lines = [ARGS_GN_FILENAME]
+  for label in labels:
+    returncode, output = common.execute(
+        'gn', 'desc %s %s runtime_deps' % (build_dir, label), source_dir,
+        print_command=False, print_output=False, exit_on_error=False)
+    if returncode != 0:
+      logger.debug('Cannot get the runtime deps of %s:\n%s', label, output)
+      return None
+    lines.extend(line.strip() for line in output.splitlines())
+
+  paths = set()
+  for line in lines:
+    path = os.path.normpath(line)
+    if (line and not os.path.isabs(path) and not path.startswith(os.pardir)
+        and os.path.lexists(os.path.join(build_dir, path))):
+      paths.add(path)
+  return sorted(paths)
+
+
+def copy_file(source, dest):
+  """Copy a file, sharing its blocks if the filesystem can. It's never
+    hardlinked, because ninja might overwrite the source in place."""
+  try:
+    dedup.reflink(source, dest)
+  except (IOError, OSError):
+    shutil.copy2(source, dest)
+
+
+def copy_paths(build_dir, paths, dest):
+  """Copy the files and directories at paths from build_dir to dest. The
+    paths in a directory that is copied are skipped, so paths must be
+    sorted."""
+  copied_dirs = []
+  for path in paths:
+    if any(path.startswith(d + os.sep) for d in copied_dirs):
+      continue
+
+    source = os.path.join(build_dir, path)
+    common.ensure_dir(os.path.dirname(os.path.join(dest, path)))
+    if os.path.isdir(source) and not os.path.islink(source):
+      shutil.copytree(source, os.path.join(dest, path), symlinks=True)
+      copied_dirs.append(path)
+    else:
+      copy_file(source, os.path.join(dest, path))
+
+
+def restore(key):
+  """Return the directory of a cached build and its pin, or (None, None) if
+    it isn't cached. The build stays pinned until the pin is closed."""
+  cache = get_cache()
+  pin = cache.pin(key)
+  # The build might have been evicted before it was pinned.
+  if not (os.path.exists(cache.get_meta_path(key, 'json')) and
+          os.path.exists(cache.get_path(key))):
+    pin.close()
+    return None, None
+
+  cache.use(key, True)
+  cache.log_stats()
+  return cache.get_path(key), pin
+
+
+def store(key, build_dir, target, source_dir, get_inputs=None, **info):
+  """Copy what the target in build_dir needs at run time into the cache,
+    unless it's there already. get_inputs is only called for a new build,
+    and returns the source files that it was built from (or None). info is
+    stored in the build's metadata."""
+  cache = get_cache()
+  dest = cache.get_path(key)
+  if os.path.exists(dest):
+    return
+
+  paths = get_runtime_paths(build_dir, target, source_dir)
+  if paths is None:
+    logger.info('GN cannot list what %s needs at run time. Not caching the '
+                'build.', target)
+    return
+
+  common.ensure_dir(ARTIFACTS_DIR)
+  # Copy into a temporary directory, so that an interrupted copy is never
+  # restored.
+  tmp_dir = tempfile.mkdtemp(dir=ARTIFACTS_DIR, prefix='.tmp-')
+  try:
+    copy_paths(build_dir, paths, tmp_dir)
+    os.rename(tmp_dir, dest)
+  except (IOError, OSError, shutil.Error) as e:
+    # Another process might have stored the same build in the meantime.
+    logger.debug('Cannot store the build of %s: %s', build_dir, e)
+    return
+  finally:
+    common.delete_if_exists(tmp_dir)
+
+  cache.use(key, False, **info)
+  dedup.dedupe_in_background(cache, key)
+  inputs = get_inputs() if get_inputs else None
+  if inputs is not None:
+    with open(cache.get_meta_path(key, INPUTS_EXTENSION), 'w') as f:
+      f.write(''.join('%s\n' % path for path in sorted(inputs)))
+  cache.evict()
+  cache.log_stats()
@@ -13,19 +13,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ast
 import base64
+import contextlib
+import hashlib
 import json
 import logging
-import multiprocessing
 import os
 import stat
-import string
-import urllib
+import tempfile
+import time
 
 import urlfetch
 
+from clusterfuzz import artifacts
+from clusterfuzz import build_profile
+from clusterfuzz import build_queue
 from clusterfuzz import common
+from clusterfuzz import concurrency
+from clusterfuzz import dedup
+from clusterfuzz import disk_cache
+from clusterfuzz import downloader
+from clusterfuzz import elf
+from clusterfuzz import fetch
+from clusterfuzz import git_batch
+from clusterfuzz import goma
+from clusterfuzz import nearest
+from clusterfuzz import ninja
 from clusterfuzz import output_transformer
+from clusterfuzz import remote_zip
+from clusterfuzz import revisions
+from clusterfuzz import tasks
+from clusterfuzz import worktrees
 from error import error
 
 
@@ -36,69 +55,144 @@ CHECKOUT_MESSAGE = (
     'Shall we proceed with the following command:\n'
     '{cmd} in {source_dir}?')
 ARGS_GN_FILENAME = 'args.gn'
+BUILD_NINJA_FILENAME = 'build.ninja'
+CONCURRENT_LINKS_ARG = 'concurrent_links'
+CONCURRENT_LINKS_GNI = 'build/toolchain/concurrent_links.gni'
+PARTIAL_BUILD_STAMP = '.clusterfuzz_partial_build'
+NEEDED_RESOURCE_EXTENSIONS = ['.bin', '.dat', '.dict', '.options']
+BUILD_CACHE_QUOTA_VARIABLE = 'CF_BUILD_CACHE_QUOTA_GB'
+DEFAULT_BUILD_CACHE_QUOTA_GB = 50
+OUT_DIR_QUOTA_VARIABLE = 'CF_OUT_DIR_QUOTA_GB'
+DEFAULT_OUT_DIR_QUOTA_GB = 200
+DEPS_STAMPS_DIR = os.path.join(common.CLUSTERFUZZ_CACHE_DIR, 'deps_stamps')
+# The files that decide what gclient sync, gclient runhooks and install_deps
+# do, relative to the source directory.
+DEPS_STAMP_FILES = ['DEPS', 'tools/clang/scripts/update.py',
+                    'build/install-build-deps.sh']
+# The overrides of --fast-build. They only make the build faster:
+# line-table symbols are enough to symbolize a stack trace, and NaCl and the
+# real LASTCHANGE aren't needed to run the target.
+FAST_BUILD_GN_ARGS = {
+    'enable_nacl': 'false',
+    'symbol_level': '1',
+    'use_dummy_lastchange': 'true',
+}
+# The sanitizers whose reports have been checked to be the same with the
+# overrides. Others are built with the testcase's args.gn.
+FAST_BUILD_SANITIZERS = ['ASAN', 'CFI', 'LSAN', 'MSAN', 'TSAN', 'UBSAN']
+# The args that change the instrumentation, which are never overridden.
+SANITIZER_GN_ARG_PREFIXES = (
+    'is_asan', 'is_cfi', 'is_lsan', 'is_msan', 'is_tsan', 'is_ubsan', 'msan_',
+    'sanitizer_', 'use_afl', 'use_cfi', 'use_libfuzzer', 'use_sanitizer')
+CHROMIUM_SOURCE_VARIABLE = 'CHROMIUM_SRC'
+PDFIUM_SHAS_FILE = os.path.join(
+    common.CLUSTERFUZZ_CACHE_DIR, 'pdfium_shas.json')
 
 
 logger = logging.getLogger('clusterfuzz')
 
 
-def build_revision_to_sha_url(revision, repo):
-  return ('https://cr-rev.appspot.com/_ah/api/crrev/v1/get_numbering?%s' %
-          urllib.urlencode({
-              'number': revision,
-              'numbering_identifier': 'refs/heads/master',
-              'numbering_type': 'COMMIT_POSITION',
-              'project': 'chromium',
-              'repo': repo}))
+class OutDirBusyError(Exception):
+  """Raised when another process uses the out dir that a build needs."""
 
+  def __init__(self, key):
+    super(OutDirBusyError, self).__init__('%s is in use.' % key)
+    self.key = key
 
-def sha_from_revision(revision, repo):
-  """Converts a chrome revision number to it corresponding git sha."""
 
-  response = urlfetch.fetch(build_revision_to_sha_url(revision, repo))
-  return json.loads(response.body)['git_sha']
+def get_deps_value(node):
+  """Evaluate a value in the vars of a DEPS file, where Str('...') is a plain
+    string."""
+  if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+      node.func.id == 'Str' and len(node.args) == 1):
+    return get_deps_value(node.args[0])
+  return ast.literal_eval(node)
 
 
-def get_pdfium_sha(chromium_sha):
-  """Gets the correct Pdfium sha using the Chromium sha."""
+def parse_deps_vars(content):
+  """Return the vars of a DEPS file. The vars that aren't literals are
+    skipped."""
+  for node in ast.parse(content).body:
+    if (not isinstance(node, ast.Assign) or
+        not isinstance(node.value, ast.Dict) or
+        'vars' not in [getattr(target, 'id', None) for target in node.targets]):
+      continue
+
+    deps_vars = {}
+    for key, value in zip(node.value.keys, node.value.values):
+      try:
+        deps_vars[ast.literal_eval(key)] = get_deps_value(value)
+      except ValueError:
+        continue
+    return deps_vars
+  return {}
+
+
+def read_chromium_deps(chromium_sha):
+  """Read Chromium's DEPS at a sha from the local checkout or, if it doesn't
+    have the sha, from googlesource."""
+  source_dir = os.environ.get(CHROMIUM_SOURCE_VARIABLE)
+  if source_dir:
+    content = git_batch.read_file(source_dir, chromium_sha, 'DEPS')
+    if content is not None:
+      return content
+
   response = urlfetch.fetch(
       ('https://chromium.googlesource.com/chromium/src.git/+/%s/DEPS?'
        'format=TEXT' % chromium_sha))
-  body = base64.b64decode(response.body)
-  sha_line = [l for l in body.split('\n') if "'pdfium_revision':" in l][0]
-  sha_line = sha_line.translate(None, string.punctuation).replace(
-      'pdfiumrevision', '')
-  return sha_line.strip()
+  return base64.b64decode(response.body)
+
+
+def get_pdfium_sha(chromium_sha):
+  """Gets the correct Pdfium sha using the Chromium sha. The answers are
+    stored, since a Chromium sha always pins the same Pdfium sha."""
+  pdfium_shas = common.read_json(PDFIUM_SHAS_FILE, {})
+  if chromium_sha in pdfium_shas:
+    return pdfium_shas[chromium_sha]
 
+  sha = parse_deps_vars(read_chromium_deps(chromium_sha)).get(
+      'pdfium_revision')
+  if not sha:
+    raise error.PdfiumRevisionNotFoundError(chromium_sha)
 
-def sha_exists(sha, source_dir):
-  """Check if sha exists."""
-  returncode, _ = common.execute(
-      'git', 'cat-file -e %s' % sha, cwd=source_dir, exit_on_error=False)
-  return returncode == 0
+  pdfium_shas = common.read_json(PDFIUM_SHAS_FILE, {})
+  pdfium_shas[chromium_sha] = sha
+  common.write_json(PDFIUM_SHAS_FILE, pdfium_shas)
+  return sha
 
 
 def ensure_sha(sha, source_dir):
   """Ensure the sha exists."""
-  if sha_exists(sha, source_dir):
-    return
+  fetch.ensure(sha, source_dir)
 
-  common.execute('git', 'fetch origin %s' % sha, source_dir)
 
+def setup_concurrent_links(source_dir, gn_args):
+  """Size the link pool for the available memory, unless it's set already
+    or the checkout doesn't have the arg."""
+  if (CONCURRENT_LINKS_ARG in gn_args or
+      not os.path.exists(os.path.join(source_dir, CONCURRENT_LINKS_GNI))):
+    return gn_args
+
+  links = concurrency.choose_links()
+  if links:
+    gn_args[CONCURRENT_LINKS_ARG] = str(links)
+  return gn_args
 
-def is_repo_dirty(path):
-  """Returns true if the source dir has uncommitted changes."""
-  # `git diff` always return 0 (even when there's change).
-  _, diff_result = common.execute(
-      'git', 'diff', path, print_command=False, print_output=False)
-  return bool(diff_result)
 
+def setup_fast_build(gn_args, sanitizer):
+  """Apply the overrides of --fast-build for the sanitizer. Returns the
+    original value (None if unset) of every arg that has been changed."""
+  overrides = {}
+  if sanitizer not in FAST_BUILD_SANITIZERS:
+    logger.debug('No fast build overrides for %s.', sanitizer)
+    return overrides
 
-def get_current_sha(source_dir):
-  """Return the current sha."""
-  _, current_sha = common.execute(
-      'git', 'rev-parse HEAD', source_dir, print_command=False,
-      print_output=False)
-  return current_sha.strip()
+  for key, value in sorted(FAST_BUILD_GN_ARGS.iteritems()):
+    if key.startswith(SANITIZER_GN_ARG_PREFIXES) or gn_args.get(key) == value:
+      continue
+    overrides[key] = gn_args.get(key)
+    gn_args[key] = value
+  return overrides
 
 
 def setup_debug_symbol_if_needed(gn_args, sanitizer, enable_debug):
@@ -160,6 +254,34 @@ def deserialize_gn_args(args):
   return args_hash
 
 
+def read_file(path):
+  """Return the content of a file, or None if it doesn't exist."""
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    return f.read()
+
+
+def hash_file(path):
+  """Return the sha1 of a file, or None if it doesn't exist."""
+  content = read_file(path)
+  return hashlib.sha1(content).hexdigest() if content is not None else None
+
+
+def get_deps_stamp_path(source_dir):
+  """Return the stamp of the dependencies installed in a source directory."""
+  return os.path.join(
+      DEPS_STAMPS_DIR,
+      '%s.json' % hashlib.sha1(os.path.abspath(source_dir)).hexdigest())
+
+
+def get_gn_gen_lines(content):
+  """Return the lines of args.gn that gn gen depends on. The link pool
+    doesn't change the outputs, so it's left out, as in get_out_dir_key."""
+  return [line for line in content.splitlines()
+          if line.split('=')[0].strip() != CONCURRENT_LINKS_ARG]
+
+
 def serialize_gn_args(args_hash):
   """Serialize the gn args (in the dict form) to raw string."""
   args = []
@@ -168,35 +290,231 @@ def serialize_gn_args(args_hash):
   return '\n'.join(args)
 
 
-def download_build(dest, url, binary_name):
-  """Download and extract a build (if it's not already there)."""
-  if os.path.exists(dest):
-    return dest
+def is_extracted(path, info):
+  """Check if a member has been completely extracted to path."""
+  if os.path.islink(path) or info.filename.endswith('/'):
+    return os.path.lexists(path)
+  return os.path.exists(path) and os.path.getsize(path) == info.file_size
+
+
+def extract_needed_members(archive, dest, binary_name, done):
+  """Extract the binary, the resources next to it (e.g. dictionaries and
+    snapshots) and the shared libraries that it needs, recursively. The
+    paths in done are already there, so they are only inspected. Returns the
+    paths that are needed."""
+  binary_dir = os.path.dirname(binary_name)
+  libraries = {}
+  for path in sorted(archive.members):
+    if (os.path.basename(path) not in libraries or
+        os.path.dirname(path) == binary_dir):
+      libraries[os.path.basename(path)] = path
+
+  needed = [binary_name] + [
+      path for path in archive.members
+      if os.path.dirname(path) == binary_dir and
+      os.path.splitext(path)[1] in NEEDED_RESOURCE_EXTENSIONS]
+  extracted = set()
+  while True:
+    pending = set(path for path in needed
+                  if path in archive.members and path not in extracted)
+    if not pending:
+      return extracted
+
+    archive.extract(pending - done, dest)
+    extracted.update(pending)
+
+    needed = []
+    for path in pending:
+      full_path = os.path.join(dest, path)
+      if os.path.islink(full_path):
+        needed.append(os.path.normpath(os.path.join(
+            os.path.dirname(path), os.readlink(full_path))))
+      elif os.path.isfile(full_path):
+        needed.extend(libraries[name]
+                      for name in elf.get_needed_libraries(full_path)
+                      if name in libraries)
+    pending = needed
+
+
+def extract_build(archive, dest, binary_name, extract_all, pin=None):
+  """Extract a build in place. A stamp marks the build as partial until
+    everything is extracted, so that an interrupted extraction is resumed by
+    the next run. Members that other builds already have are cloned from
+    them instead, and the build is deduplicated in the background once it's
+    complete. Unless extract_all is set, only what the binary needs is
+    extracted before returning, and the rest is extracted in the
+    background. pin is the build's exclusive pin, which is shared once the
+    build is complete."""
+  common.ensure_dir(dest)
+  stamp_path = os.path.join(dest, PARTIAL_BUILD_STAMP)
+  with open(stamp_path, 'w'):
+    pass
 
-  logger.info('Downloading build data...')
-  common.ensure_dir(common.CLUSTERFUZZ_BUILDS_DIR)
+  cache = get_build_cache()
+  key = os.path.basename(dest)
+  index = dedup.Index(cache, key)
+  remaining = set(
+      path for path, info in archive.members.iteritems()
+      if not is_extracted(os.path.join(dest, path), info))
+  reused = dedup.reuse_members(
+      index, {path: archive.members[path] for path in remaining}, dest)
+  remaining -= set(reused)
+
+  def finish():
+    """Mark the build as complete, and deduplicate it."""
+    common.delete_if_exists(stamp_path)
+    if pin:
+      disk_cache.share_pin(pin)
+    dedup.dedupe_in_background(cache, key, index, reused)
+
+  start_time = time.time()
+  if not extract_all:
+    try:
+      needed = extract_needed_members(
+          archive, dest, binary_name, set(archive.members) - remaining)
+    except ValueError as e:
+      # A malformed ELF binary doesn't tell us what it needs.
+      logger.info('Cannot tell what %s needs (%s). Extracting the whole '
+                  'build instead...', binary_name, e)
+    else:
+      logger.info(
+          'Extracted %s in %.1f seconds. The rest of the build is being '
+          'extracted in the background.', binary_name,
+          time.time() - start_time)
+      archive.extract_in_background(remaining - needed, dest, finish)
+      return
 
-  gsutil_path = url.replace(
-      'https://storage.cloud.google.com/', 'gs://')
-  common.gsutil('cp %s .' % gsutil_path, common.CLUSTERFUZZ_CACHE_DIR)
+  size = archive.extract(remaining, dest)
+  downloader.log_throughput(archive.url, size, time.time() - start_time)
+  finish()
 
-  filename = os.path.basename(gsutil_path)
-  saved_file = os.path.join(common.CLUSTERFUZZ_CACHE_DIR, filename)
 
-  common.execute(
-      'unzip', '-q %s -d %s' % (saved_file, common.CLUSTERFUZZ_BUILDS_DIR),
-      cwd=common.CLUSTERFUZZ_DIR)
+def is_build_complete(build_dir):
+  """Check if a build has been completely extracted."""
+  return (os.path.exists(build_dir) and
+          not os.path.exists(os.path.join(build_dir, PARTIAL_BUILD_STAMP)))
+
+
+def get_build_root(url):
+  """Return the directory that a build's zip has its files in."""
+  return os.path.splitext(os.path.basename(url))[0]
 
-  logger.info('Cleaning up...')
-  os.remove(saved_file)
-  os.rename(os.path.join(
-      common.CLUSTERFUZZ_BUILDS_DIR, os.path.splitext(filename)[0]), dest)
+
+def unzip_build(dest, url, gcs_object=None):
+  """Download a build's zip, and unzip it. It's unzipped into a temporary
+    directory, so an interrupted unzip never leaves a partial build at dest,
+    and a partial build that's already there is replaced. gcs_object is the
+    probe of the zip, if it's still valid."""
+  common.delete_if_exists(dest)
+  tmp_dir = tempfile.mkdtemp(dir=common.CLUSTERFUZZ_BUILDS_DIR, prefix='.tmp-')
+  try:
+    remote_zip.download_and_unzip_gcs_object(url, tmp_dir, gcs_object)
+    os.rename(os.path.join(tmp_dir, get_build_root(url)), dest)
+  finally:
+    common.delete_if_exists(tmp_dir)
+
+  dedup.dedupe_in_background(get_build_cache(), os.path.basename(dest))
+
+
+def download_build(dest, url, binary_name, extract_all=True, pin=None):
+  """Download and extract a build (if it's not already there). pin is the
+    build's exclusive pin, if the build is extracted in the background."""
+  if is_build_complete(dest):
+    return dest
+
+  logger.info('Downloading build data...')
+  common.ensure_dir(common.CLUSTERFUZZ_BUILDS_DIR)
+
+  gcs_object = downloader.probe_gcs_object(url)
+  archive = remote_zip.open_gcs_object(gcs_object, get_build_root(url))
+  if not archive:
+    # The probe has told how the zip can be downloaded.
+    unzip_build(dest, url, gcs_object)
+  else:
+    try:
+      extract_build(archive, dest, binary_name, extract_all, pin)
+    except error.DownloadFailedError as e:
+      # The credentials might have expired in the middle of the extraction.
+      # Fresh ones are fetched to download the zip whole, in parallel ranges.
+      if not downloader.should_use_gsutil(e):
+        raise
+      logger.info('Extracting the build was denied (%s). Downloading it '
+                  'whole instead...', e)
+      unzip_build(dest, url)
 
   binary_location = os.path.join(dest, binary_name)
   stats = os.stat(binary_location)
   os.chmod(binary_location, stats.st_mode | stat.S_IEXEC)
 
 
+def pin_build(cache, key):
+  """Pin a build. A build that isn't complete is pinned exclusively until it
+    is, so that a process that is still extracting it (maybe in the
+    background) is waited for, rather than extracted over."""
+  pin = cache.pin(key)
+  if is_build_complete(cache.get_path(key)):
+    return pin
+
+  pin.close()
+  pin = cache.pin(key, exclusive=True, blocking=False)
+  if not pin:
+    logger.info('Waiting for another process to finish extracting the '
+                'build...')
+    pin = cache.pin(key, exclusive=True)
+  return pin
+
+
+def get_build_cache():
+  """Return the cache of downloaded builds, which are shared by all the
+    testcases with the same build url."""
+  return disk_cache.DiskCache(
+      'build', common.CLUSTERFUZZ_BUILDS_DIR,
+      disk_cache.get_quota(
+          BUILD_CACHE_QUOTA_VARIABLE, DEFAULT_BUILD_CACHE_QUOTA_GB))
+
+
+def get_build_key(build_url):
+  """Return the key of a build in the build cache."""
+  return hashlib.sha1(build_url).hexdigest()
+
+
+def get_out_dir_key(sha, gn_args, target):
+  """Return the name of the out dir of a build, which is a fingerprint of
+    its source sha, args.gn and target. The link pool doesn't change the
+    outputs, so it's left out."""
+  args = sorted((k, v) for k, v in gn_args.iteritems()
+                if k != CONCURRENT_LINKS_ARG)
+  fingerprint = hashlib.sha1(json.dumps([sha, args, target])).hexdigest()
+  return 'clusterfuzz_%s' % fingerprint[:16]
+
+
+def get_out_dir_cache(source_dir):
+  """Return the cache of the out dirs in a source directory."""
+  return disk_cache.DiskCache(
+      'out dir', os.path.join(source_dir, 'out'),
+      disk_cache.get_quota(OUT_DIR_QUOTA_VARIABLE, DEFAULT_OUT_DIR_QUOTA_GB))
+
+
+def link_build(reference, build_dir):
+  """Make a testcase's build directory a symlink to a shared build. A
+    directory left by an older version is replaced."""
+  if os.path.islink(reference):
+    if os.readlink(reference) == build_dir:
+      return
+    os.remove(reference)
+  else:
+    common.delete_if_exists(reference)
+  os.symlink(build_dir, reference)
+
+
+def delete_dangling_build_links():
+  """Delete the testcases' build directories that point to evicted builds."""
+  for name in os.listdir(common.CLUSTERFUZZ_BUILDS_DIR):
+    path = os.path.join(common.CLUSTERFUZZ_BUILDS_DIR, name)
+    if os.path.islink(path) and not os.path.exists(path):
+      os.remove(path)
+
+
 class BinaryProvider(object):
   """Downloads/builds and then provides the location of a binary."""
 
@@ -213,6 +531,15 @@ class BinaryProvider(object):
   def get_binary_path(self):
     return '%s/%s' % (self.get_build_directory(), self.binary_name)
 
+  def prefetch(self):
+    """Start getting what the binary needs in the background, while the
+      testcase downloads and the user answers prompts."""
+    pass
+
+  def release(self):
+    """Unpin what the binary uses, once it's no longer run."""
+    pass
+
   def build_dir_name(self):
     """Returns a build number's respective directory."""
     return os.path.join(common.CLUSTERFUZZ_BUILDS_DIR,
@@ -222,19 +549,48 @@ class BinaryProvider(object):
 class DownloadedBinary(BinaryProvider):
   """Uses a downloaded binary."""
 
+  def __init__(self, testcase_id, build_url, binary_name, extract_all=True):
+    super(DownloadedBinary, self).__init__(testcase_id, build_url, binary_name)
+    self.extract_all = extract_all
+    self.build_pin = None
+
   def get_build_directory(self):
     """Returns the location of the correct build to use for reproduction."""
 
     if self.build_directory:
       return self.build_directory
 
-    download_build(self.build_dir_name(), self.build_url, self.binary_name)
+    cache = get_build_cache()
+    key = get_build_key(self.build_url)
+    build_dir = cache.get_path(key)
+    # The build stays pinned until the process exits, so that other processes
+    # cannot evict it while it's in use.
+    self.build_pin = pin_build(cache, key)
+
+    hit = is_build_complete(build_dir)
+    download_build(build_dir, self.build_url, self.binary_name,
+                   self.extract_all, self.build_pin)
+    complete = is_build_complete(build_dir)
+    if complete:
+      disk_cache.share_pin(self.build_pin)
+    cache.use(key, hit, complete)
+    if cache.evict():
+      delete_dangling_build_links()
+    cache.log_stats()
+    link_build(self.build_dir_name(), build_dir)
+
     # We need the source dir so we can use asan_symbolize.py from the
     # chromium source directory.
     self.source_directory = common.get_source_directory('chromium')
-    self.build_directory = self.build_dir_name()
+    self.build_directory = build_dir
     return self.build_directory
 
+  def release(self):
+    """Unpin the build."""
+    if self.build_pin:
+      self.build_pin.close()
+      self.build_pin = None
+
 
 class GenericBuilder(BinaryProvider):
   """Provides a base for binary builders."""
@@ -259,76 +615,194 @@ class GenericBuilder(BinaryProvider):
     self.gn_args_options = {}
     self.gn_flags = '--check'
     self.definition = definition
+    self.worktree_pin = None
+    self.out_dir_pin = None
+    self.out_dir_key = None
+    self.out_dir_hit = False
+    self.artifact_pin = None
+    self.fast_build_overrides = {}
+    self.checkout_confirmed = False
 
   def out_dir_name(self):
     """Returns the correct out dir in which to build the revision.
-      Directory name is of the format clusterfuzz_<testcase_id>_<git_sha>."""
-
-    dir_name = os.path.join(
+      Testcases with the same sha, args.gn and target share it, so that
+      they only need an incremental build."""
+    return os.path.join(
         self.source_directory, 'out',
-        'clusterfuzz_%s' % self.options.testcase_id)
-    return dir_name
+        get_out_dir_key(git_batch.get_current_sha(self.source_directory),
+                        self.gn_args, self.target))
+
+  def acquire_out_dir(self):
+    """Choose the out dir, and pin it so that no other process builds in
+      it, or evicts it, while it's in use. Raises OutDirBusyError if another
+      process uses it, because waiting for it here would hold up the
+      processes queued for the source directory."""
+    self.build_directory = self.out_dir_name()
+    key = os.path.basename(self.build_directory)
+    if self.out_dir_key != key:
+      self.release_out_dir()
+      self.out_dir_pin = get_out_dir_cache(self.source_directory).pin(
+          key, exclusive=True, blocking=False)
+      if not self.out_dir_pin:
+        raise OutDirBusyError(key)
+      self.out_dir_key = key
+
+    self.out_dir_hit = os.path.exists(self.build_directory)
+    if self.out_dir_hit:
+      logger.info('Reusing %s, so the build is incremental.',
+                  self.build_directory)
+
+  def wait_for_out_dir(self, key):
+    """Wait for the other process to finish with the out dir, and keep it
+      pinned for the next attempt. The source directory isn't locked
+      meanwhile."""
+    cache = get_out_dir_cache(self.source_directory)
+    logger.info('Waiting for another process to finish with %s.',
+                cache.get_path(key))
+    self.release_out_dir()
+    self.out_dir_pin = cache.pin(key, exclusive=True)
+    self.out_dir_key = key
+
+  def release_out_dir(self):
+    """Unpin the out dir, if any."""
+    if self.out_dir_pin:
+      self.out_dir_pin.close()
+    self.out_dir_pin = None
+    self.out_dir_key = None
+
+  def release(self):
+    """Unpin the out dir, the restored build and the worktree."""
+    self.release_out_dir()
+    for pin in [self.artifact_pin, self.worktree_pin]:
+      if pin:
+        pin.close()
+    self.artifact_pin = None
+    self.worktree_pin = None
+
+  def update_out_dir_cache(self):
+    """Record the use of the out dir, and evict the least recently used
+      ones if they take too much space."""
+    cache = get_out_dir_cache(self.source_directory)
+    cache.use(os.path.basename(self.build_directory), self.out_dir_hit,
+              changed=True)
+    cache.evict()
+    cache.log_stats()
+
+  def prefetch(self):
+    """Start fetching the revision, unless the current one is used."""
+    if not self.options.current:
+      fetch.prefetch(self.git_sha, self.source_directory)
+
+  def confirm_checkout(self):
+    """Ask the user to confirm the checkout of the revision, once."""
+    if self.checkout_confirmed:
+      return
+
+    common.check_confirm(CHECKOUT_MESSAGE.format(
+        revision=self.testcase.revision,
+        cmd='git checkout %s' % self.git_sha,
+        source_dir=self.source_directory))
+    self.checkout_confirmed = True
 
   def checkout_source_by_sha(self):
-    """Checks out the correct revision."""
-    if get_current_sha(self.source_directory) == self.git_sha:
+    """Checks out the correct revision. The confirmation is usually asked
+      for before waiting for the source directory, but other processes might
+      have changed it in the meantime, so its state is checked again."""
+    if git_batch.get_current_sha(self.source_directory) == self.git_sha:
       logger.info(
           'The current state of %s is already on the revision %s (commit=%s). '
           'No action needed.', self.source_directory, self.testcase.revision,
           self.git_sha)
       return
 
-    binary = 'git'
-    args = 'checkout %s' % self.git_sha
-    common.check_confirm(CHECKOUT_MESSAGE.format(
-        revision=self.testcase.revision,
-        cmd='%s %s' % (binary, args),
-        source_dir=self.source_directory))
-
-    if is_repo_dirty(self.source_directory):
+    self.confirm_checkout()
+    if git_batch.is_repo_dirty(self.source_directory):
       raise error.DirtyRepoError(self.source_directory)
 
     ensure_sha(self.git_sha, self.source_directory)
-    common.execute(binary, args, self.source_directory)
+    common.execute('git', 'checkout %s' % self.git_sha, self.source_directory)
 
-  def setup_gn_args(self):
-    """Ensures that args.gn is set up properly."""
+  def checkout_worktree(self):
+    """Checks out the correct revision in a managed worktree, and builds
+      there instead of in the source directory. A worktree syncs its own
+      dependencies, so --skip-deps only works once they have been synced."""
+    ensure_sha(self.git_sha, self.source_directory)
+    self.source_directory, self.worktree_pin = worktrees.checkout(
+        self.source_directory, self.git_sha, self.testcase.revision)
+    if (self.options.skip_deps and
+        not os.path.exists(get_deps_stamp_path(self.source_directory))):
+      raise error.WorktreeDepsNotSyncedError(self.source_directory)
+
+  def get_gn_args(self):
+    """Return the args.gn of the build, before the user edits it."""
     args_hash = deserialize_gn_args(self.gn_args)
 
     # Add additional options to existing gn args.
     for k, v in self.gn_args_options.iteritems():
       args_hash[k] = v
 
+    overrides = {}
+    if self.options.fast_build:
+      overrides = setup_fast_build(args_hash, self.definition.sanitizer)
+
     args_hash = setup_gn_goma_params(self.options.goma_dir, args_hash)
     args_hash = setup_debug_symbol_if_needed(
         args_hash, self.definition.sanitizer, self.options.enable_debug)
+    # The symbols of --enable-debug win over the overrides.
+    self.fast_build_overrides = {
+        key: value for key, value in overrides.iteritems()
+        if args_hash[key] == FAST_BUILD_GN_ARGS[key]}
+    return setup_concurrent_links(self.source_directory, args_hash)
 
-    self.gn_args = args_hash
+  def setup_gn_args(self):
+    """Ensures that args.gn is set up properly."""
+    self.gn_args = self.get_gn_args()
+    if self.fast_build_overrides:
+      logger.info('Fast build overrides: %s.', ', '.join(
+          '%s = %s (was %s)' % (key, self.gn_args[key],
+                                self.fast_build_overrides[key] or 'unset')
+          for key in sorted(self.fast_build_overrides)))
+
+  def edit_gn_args(self):
+    """Let users edit the current args."""
+    content = common.edit_if_needed(
+        serialize_gn_args(self.gn_args), prefix='edit-args-gn-',
+        comment='Edit %s before building.' % ARGS_GN_FILENAME,
+        should_edit=self.options.edit_mode)
+    self.gn_args = deserialize_gn_args(content)
 
   def gn_gen(self):
-    """Finalize args.gn and run `gn gen`."""
+    """Finalize args.gn and run `gn gen`, unless the out dir has already been
+      generated with the same args.gn (apart from the link pool). In that
+      case, ninja regenerates build.ninja by itself if any .gn file has
+      changed."""
     args_gn_path = os.path.join(self.build_directory, ARGS_GN_FILENAME)
+    build_ninja_path = os.path.join(self.build_directory, BUILD_NINJA_FILENAME)
+    content = serialize_gn_args(self.gn_args)
+
+    flags = self.gn_flags.split()
+    if os.path.exists(build_ninja_path):
+      existing = read_file(args_gn_path)
+      if (existing is not None and
+          get_gn_gen_lines(existing) == get_gn_gen_lines(content) and
+          os.path.getmtime(build_ninja_path) >= os.path.getmtime(args_gn_path)):
+        logger.info('%s is unchanged. No need to run gn gen.', args_gn_path)
+        return
+      # The checks have already passed when the out dir was first generated.
+      flags = [flag for flag in flags if flag != '--check']
 
     common.ensure_dir(self.build_directory)
     common.delete_if_exists(args_gn_path)
 
-    # Let users edit the current args.
-    content = serialize_gn_args(self.gn_args)
-    content = common.edit_if_needed(
-        content, prefix='edit-args-gn-',
-        comment='Edit %s before building.' % ARGS_GN_FILENAME,
-        should_edit=self.options.edit_mode)
-
-    # Write args to file and store.
+    # Write args to file.
     with open(args_gn_path, 'w') as f:
       f.write(content)
-    self.gn_args = deserialize_gn_args(content)
 
     logger.info(
         common.colorize('\nGenerating %s:\n%s\n', common.BASH_GREEN_MARKER),
         args_gn_path, content)
 
-    common.execute('gn', 'gen %s %s' % (self.gn_flags, self.build_directory),
+    common.execute('gn', ' '.join(['gen'] + flags + [self.build_directory]),
                    self.source_directory)
 
   def install_deps(self):
@@ -348,60 +822,266 @@ class GenericBuilder(BinaryProvider):
       needed in every build, yet the arguments might differ."""
     pass
 
+  def get_deps_stamp(self):
+    """Return what the installed dependencies depend on: the builder (whose
+      hooks might differ) and the content of DEPS and of the scripts."""
+    return {
+        'builder': type(self).__name__,
+        'files': {
+            path: hash_file(os.path.join(self.source_directory, path))
+            for path in DEPS_STAMP_FILES}}
+
+  def get_deps_tasks(self):
+    """Return the tasks that setup all dependencies, unless they have
+      already been set up with the same DEPS, scripts and builder. The steps
+      run one after the other: install_deps might run the same scripts as
+      the hooks (e.g. the clang update), and might prompt for a sudo
+      password."""
+    if self.options.skip_deps:
+      return []
+
+    stamp_path = get_deps_stamp_path(self.source_directory)
+    stamp = self.get_deps_stamp()
+    if common.read_json(stamp_path) == stamp:
+      logger.info('The dependencies of %s are up to date. No need to sync.',
+                  self.source_directory)
+      return []
+
+    sync = tasks.Task('gclient sync', self.gclient_sync)
+    runhooks = tasks.Task('gclient runhooks', self.gclient_runhooks, [sync])
+    steps = [
+        sync, runhooks,
+        tasks.Task('install deps', self.install_deps, [runhooks])]
+    return steps + [tasks.Task(
+        'deps stamp', lambda: common.write_json(stamp_path, stamp), steps)]
+
   def setup_all_deps(self):
     """Setup all dependencies."""
-    if self.options.skip_deps:
-      return
-    self.gclient_sync()
-    self.gclient_runhooks()
-    self.install_deps()
+    tasks.run(self.get_deps_tasks())
 
   def get_goma_cores(self):
     """Choose the correct amount of GOMA cores for a build."""
     if self.options.goma_threads:
       return self.options.goma_threads
-    else:
-      cpu_count = multiprocessing.cpu_count()
-      return 50 * cpu_count if self.options.goma_dir else (3 * cpu_count) / 4
+    return concurrency.choose_jobs(bool(self.options.goma_dir))
 
   def get_goma_load(self):
     """Choose the correct amount of GOMA load for a build."""
     if self.options.goma_load:
       return self.options.goma_load
-    return multiprocessing.cpu_count() * 2
+    return concurrency.choose_load(bool(self.options.goma_dir))
+
+  def ninja_is_needed(self, jobs):
+    """Report how much ninja has to build with `jobs` in parallel. Returns
+      False if the target is already up to date."""
+    plan = ninja.plan(
+        self.build_directory, self.target, self.source_directory, jobs)
+    if not plan:
+      return True
+    if not plan.edges:
+      logger.info('%s is up to date in %s. No need to run ninja.',
+                  self.target or 'The build', self.build_directory)
+      return False
+
+    logger.info('ninja has %d edges to build, which should take about %.0fs.',
+                plan.edges, plan.estimate)
+    return True
+
+  def disable_goma(self):
+    """Build locally from now on, with the concurrency of local builds."""
+    logger.info(common.colorize(
+        'Switching to a local build without goma.', common.BASH_YELLOW_MARKER))
+    self.options.goma_dir = None
+    self.gn_args = setup_gn_goma_params(None, self.gn_args)
+    self.release_out_dir()
+
+  def check_goma(self):
+    """Build locally if goma is unhealthy before the build starts."""
+    if self.options.goma_dir and not goma.check():
+      self.disable_goma()
 
   def build_target(self):
-    """Build the correct revision in the source directory."""
+    """Build the correct revision in the source directory. If goma is
+      unhealthy before the build, or stays unhealthy during it, the target
+      is built locally instead."""
     self.setup_gn_args()
-    self.setup_all_deps()
+    self.edit_gn_args()
+    if not self.build_out_dir():
+      self.disable_goma()
+      self.build_out_dir()
+
+  def build_out_dir(self):
+    """Set up the out dir and run ninja in it. Returns False if the build
+      has been stopped because goma was unhealthy."""
+    # Checking goma takes a few seconds, so it overlaps the sync. The out dir
+    # is chosen after it, because a local build has other gn args.
+    tasks.run([tasks.Task('check goma', self.check_goma)] +
+              self.get_deps_tasks())
+    self.acquire_out_dir()
     self.gn_gen()
 
-    common.execute(
+    goma_cores = self.get_goma_cores()
+    if not self.ninja_is_needed(goma_cores):
+      self.update_out_dir_cache()
+      return True
+
+    succeeded = False
+    log_position = ninja.get_log_position(self.build_directory)
+    proc = common.start_execute(
         'ninja',
-        ("-w 'dupbuild=err' -C {build_dir} -j {goma_cores} -l {goma_load} "
-         '{target}'.format(
+        ("-w 'dupbuild=err' -C {build_dir} -j {goma_cores} "
+         '-l {goma_load} {target}'.format(
              build_dir=self.build_directory,
-             goma_cores=self.get_goma_cores(),
+             goma_cores=goma_cores,
              goma_load=self.get_goma_load(),
              target=self.target)),
-        self.source_directory,
-        capture_output=False,
-        stdout_transformer=output_transformer.Ninja())
+        self.source_directory)
+    with concurrency.Sampler(
+        goma_enabled=bool(self.options.goma_dir)) as sampler, goma.Monitor(
+            proc, enabled=bool(self.options.goma_dir)) as monitor:
+      try:
+        common.wait_execute(
+            proc, exit_on_error=True, capture_output=False,
+            stdout_transformer=output_transformer.Ninja())
+        succeeded = True
+      except error.CommandFailedError:
+        if not monitor.tripped:
+          raise
+      finally:
+        # A build stopped because goma was unhealthy says nothing about how
+        # many jobs the host can take.
+        if not self.options.goma_threads and not monitor.tripped:
+          concurrency.record(
+              bool(self.options.goma_dir), goma_cores, sampler, succeeded)
+        build_profile.report(self.build_directory, log_position, goma_cores,
+                             bool(self.options.goma_dir), self.target,
+                             bool(self.fast_build_overrides))
+    if not succeeded:
+      return False
+    self.update_out_dir_cache()
+    return True
+
+  def get_artifact_key(self, gn_args):
+    """Return the key of the build in the artifact cache."""
+    return artifacts.get_key(
+        self.git_sha, gn_args, self.target, self.definition.sanitizer)
+
+  def get_artifact_variant(self, gn_args):
+    """Return what the builds of the target at any revision share."""
+    return artifacts.get_variant(
+        gn_args, self.target, self.definition.sanitizer)
+
+  def restore_artifacts(self):
+    """Use the cached build of the same sha, args.gn, target and sanitizer,
+      if there is one, or with --reuse-nearest the nearest one that is built
+      from the same files. The source directory isn't touched. Returns
+      whether the build has been restored."""
+    # With --current, the source directory might not be at the sha. With
+    # --edit-mode, args.gn isn't known until it's edited.
+    if self.options.current or self.options.edit_mode:
+      return False
+
+    gn_args = self.get_gn_args()
+    build_dir, self.artifact_pin = artifacts.restore(
+        self.get_artifact_key(gn_args))
+    if build_dir:
+      logger.info('Reusing the build of r%s from %s. No need to build.',
+                  self.testcase.revision, build_dir)
+    elif self.options.reuse_nearest:
+      build_dir, self.artifact_pin = self.restore_nearest_artifacts(gn_args)
+    if not build_dir:
+      return False
+
+    self.build_directory = build_dir
+    return True
+
+  def restore_nearest_artifacts(self, gn_args):
+    """Restore the cached build of the nearest revision whose target is
+      built from the same files. Returns its directory and pin, or (None,
+      None)."""
+    # The diff needs the sha.
+    ensure_sha(self.git_sha, self.source_directory)
+    key = nearest.find(
+        self.source_directory, self.git_sha, int(self.testcase.revision),
+        self.get_artifact_variant(gn_args))
+    if not key:
+      return None, None
+    return artifacts.restore(key)
+
+  def store_artifacts(self):
+    """Cache what the target needs at run time. With --reuse-nearest, the
+      files that the target is built from are recorded as well, so that
+      nearby revisions can reuse the build."""
+    if self.options.current:
+      return
+
+    get_inputs = None
+    if self.options.reuse_nearest:
+      get_inputs = lambda: ninja.get_inputs(
+          self.build_directory, self.target, self.source_directory)
+    artifacts.store(
+        self.get_artifact_key(self.gn_args), self.build_directory,
+        self.target, self.source_directory, get_inputs=get_inputs,
+        variant=self.get_artifact_variant(self.gn_args), sha=self.git_sha,
+        revision=int(self.testcase.revision))
+
+  @contextlib.contextmanager
+  def lock_source_directory(self):
+    """Wait in line behind the other processes that use the source
+      directory, since their checkout, sync or build would change it
+      underneath this one. Yields whether this process had to wait. A
+      worktree is already reserved for this process, so it doesn't wait."""
+    if self.options.worktree:
+      yield False
+      return
+
+    # Only a build that is cached can be reused by those waiting for it.
+    key = None
+    if not self.options.current and not self.options.edit_mode:
+      key = self.get_artifact_key(self.get_gn_args())
+    description = 'r%s of %s' % (self.testcase.revision, self.target)
+    with build_queue.acquire(self.source_directory, key=key,
+                             description=description) as waited:
+      yield waited
 
   def get_build_directory(self):
     """Returns the location of the correct build to use for reproduction."""
     if self.build_directory:
       return self.build_directory
 
-    self.build_directory = self.build_dir_name()
-
-    if not self.options.current:
-      self.checkout_source_by_sha()
-
-    self.build_directory = self.out_dir_name()
-    self.build_target()
+    if self.restore_artifacts():
+      return self.build_directory
 
-    return self.build_directory
+    # The prompt must not hold up the processes behind this one.
+    if (not self.options.current and not self.options.worktree and
+        git_batch.get_current_sha(self.source_directory) != self.git_sha):
+      self.confirm_checkout()
+
+    while True:
+      try:
+        with self.lock_source_directory() as waited:
+          # The processes ahead in the queue might have built the same thing.
+          if waited and self.restore_artifacts():
+            self.release_out_dir()
+            return self.build_directory
+
+          self.build_directory = self.build_dir_name()
+
+          if not self.options.current:
+            if self.options.worktree:
+              self.checkout_worktree()
+            else:
+              self.checkout_source_by_sha()
+
+          self.build_target()
+          self.store_artifacts()
+      except OutDirBusyError as e:
+        self.wait_for_out_dir(e.key)
+        continue
+
+      # Other processes may run the build too, but not build in the out dir.
+      disk_cache.share_pin(self.out_dir_pin)
+      return self.build_directory
 
 
 class PdfiumBuilder(GenericBuilder):
@@ -415,7 +1095,11 @@ class PdfiumBuilder(GenericBuilder):
         binary_name='pdfium_test',
         target=None,
         options=options)
-    self.chromium_sha = sha_from_revision(testcase.revision, 'chromium/src')
+    # The source directory is Pdfium's, so a Chromium checkout is only
+    # searched if there is one already.
+    self.chromium_sha = revisions.get_sha(
+        testcase.revision, 'chromium/src',
+        os.environ.get(CHROMIUM_SOURCE_VARIABLE))
     self.git_sha = get_pdfium_sha(self.chromium_sha)
     self.gn_args = testcase.gn_args
     self.gn_args_options = {'pdf_is_standalone': 'true'}
@@ -440,7 +1124,8 @@ class ChromiumBuilder(GenericBuilder):
         binary_name=binary_name,
         target=target_name,
         options=options)
-    self.git_sha = sha_from_revision(self.testcase.revision, 'chromium/src')
+    self.git_sha = revisions.get_sha(
+        self.testcase.revision, 'chromium/src', self.source_directory)
     self.gn_args = testcase.gn_args
 
   def install_deps(self):
@@ -467,7 +1152,8 @@ class V8Builder(GenericBuilder):
         binary_name='d8',
         target=None,
         options=options)
-    self.git_sha = sha_from_revision(testcase.revision, 'v8/v8')
+    self.git_sha = revisions.get_sha(
+        testcase.revision, 'v8/v8', self.source_directory)
     self.gn_args = testcase.gn_args
 
   def install_deps(self):
@@ -503,6 +1189,12 @@ class MsanChromiumBuilder(ChromiumBuilder):
     gclient_runhooks_msan(
         self.source_directory, self.gn_args.get('msan_track_origins'))
 
+  def get_deps_stamp(self):
+    """Add msan_track_origins, which the hooks depend on."""
+    stamp = super(MsanChromiumBuilder, self).get_deps_stamp()
+    stamp['msan_track_origins'] = self.gn_args.get('msan_track_origins')
+    return stamp
+
 
 class MsanV8Builder(V8Builder):
   """Build a MSAN V8 build."""
@@ -512,6 +1204,12 @@ class MsanV8Builder(V8Builder):
     gclient_runhooks_msan(
         self.source_directory, self.gn_args.get('msan_track_origins'))
 
+  def get_deps_stamp(self):
+    """Add msan_track_origins, which the hooks depend on."""
+    stamp = super(MsanV8Builder, self).get_deps_stamp()
+    stamp['msan_track_origins'] = self.gn_args.get('msan_track_origins')
+    return stamp
+
 
 class ChromiumBuilder32Bit(ChromiumBuilder):
   """Build a 32-bit chromium build."""
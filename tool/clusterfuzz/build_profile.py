@@ -0,0 +1,212 @@
+"""Summarize where the time of a ninja build went, from its .ninja_log."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import heapq
+import logging
+import os
+
+from clusterfuzz import common
+from clusterfuzz import ninja
+
+
+TRACE_VARIABLE = 'CF_BUILD_TRACE'
+# The work per edge of the builds of every target, with and without
+# --fast-build, to measure what the overrides save.
+PROFILES_FILE = os.path.join(
+    common.CLUSTERFUZZ_CACHE_DIR, 'build_profiles.json')
+SLOWEST_EDGES = 5
+TIMELINE_BUCKETS = 10
+COMPILE_EXTENSIONS = ['.o', '.obj']
+LINK_EXTENSIONS = ['', '.so', '.a', '.dylib', '.exe', '.dll']
+
+logger = logging.getLogger('clusterfuzz')
+
+# An edge with its first output. Edges with several outputs appear once per
+# output in .ninja_log.
+Edge = collections.namedtuple('Edge', ['start', 'end', 'output', 'kind'])
+
+
+def get_kind(output):
+  """Classify an edge by its output: compile, link or other."""
+  extension = os.path.splitext(output)[1]
+  if extension in COMPILE_EXTENSIONS:
+    return 'compile'
+  if extension in LINK_EXTENSIONS:
+    return 'link'
+  return 'other'
+
+
+def get_edges(entries):
+  """Merge the outputs of every edge, and order the edges by start."""
+  edges = collections.OrderedDict()
+  for entry in entries:
+    key = (entry.start, entry.end)
+    if key not in edges:
+      edges[key] = Edge(entry.start, entry.end, entry.output,
+                        get_kind(entry.output))
+  return sorted(edges.itervalues(), key=lambda edge: (edge.start, edge.end))
+
+
+def get_critical_path(edges):
+  """Estimate the critical path: the edge that ended last, the edge that
+    ended last before it started, and so on. .ninja_log has no
+    dependencies, but an edge usually waits for the one that ended just
+    before it started."""
+  path = []
+  candidates = edges
+  while candidates:
+    edge = max(candidates, key=lambda edge: edge.end)
+    path.append(edge)
+    candidates = [other for other in candidates if other.end <= edge.start]
+  return list(reversed(path))
+
+
+def get_timeline(edges, start, end, buckets=TIMELINE_BUCKETS):
+  """Return the average number of edges running in each of `buckets` equal
+    slices of the build."""
+  width = (end - start) / float(buckets)
+  if width <= 0:
+    return []
+
+  timeline = []
+  for i in xrange(buckets):
+    bucket_start = start + i * width
+    bucket_end = bucket_start + width
+    busy = sum(
+        max(0, min(edge.end, bucket_end) - max(edge.start, bucket_start))
+        for edge in edges)
+    timeline.append(busy / width)
+  return timeline
+
+
+def get_lanes(edges):
+  """Assign every edge to a lane that is free when it starts, so that a
+    trace shows one row per job slot."""
+  # The end of the last edge of each lane, soonest first.
+  lane_ends = []
+  lanes = []
+  for edge in edges:
+    if lane_ends and lane_ends[0][0] <= edge.start:
+      _, lane = heapq.heappop(lane_ends)
+    else:
+      lane = len(lane_ends)
+    heapq.heappush(lane_ends, (edge.end, lane))
+    lanes.append(lane)
+  return lanes
+
+
+def write_trace(path, edges):
+  """Write the edges in the Chrome trace format, for chrome://tracing."""
+  events = []
+  for edge, lane in zip(edges, get_lanes(edges)):
+    events.append({
+        'name': edge.output, 'cat': edge.kind, 'ph': 'X', 'pid': 0,
+        'tid': lane, 'ts': int(edge.start * 1000000),
+        'dur': int((edge.end - edge.start) * 1000000)})
+  common.write_json(path, {'traceEvents': events})
+  logger.info('Wrote the trace of the build to %s.', path)
+
+
+def format_edges(edges):
+  return ', '.join(
+      '%s (%.1fs)' % (edge.output, edge.end - edge.start) for edge in edges)
+
+
+def get_profile_name(fast_build):
+  return 'fast' if fast_build else 'default'
+
+
+def compare_profiles(target, fast_build, edges, busy):
+  """Add the build to the totals of its profile, and return a line that
+    compares the work per edge of the fast and default builds of the target,
+    or None if it hasn't been built with both yet. Builds are incremental,
+    so the total time of two builds can't be compared, but the time per edge
+    can."""
+  profiles = common.read_json(PROFILES_FILE, {})
+  totals = profiles.setdefault(get_profile_name(fast_build), {}).setdefault(
+      target or '', {'edges': 0, 'seconds': 0.0})
+  totals['edges'] += edges
+  totals['seconds'] += busy
+  common.write_json(PROFILES_FILE, profiles)
+
+  per_edge = {}
+  for name in [get_profile_name(True), get_profile_name(False)]:
+    totals = profiles.get(name, {}).get(target or '')
+    if not totals or not totals['edges']:
+      return None
+    per_edge[name] = totals['seconds'] / totals['edges']
+  return ('Fast builds of %s took %.2fs of work per edge, and default builds '
+          '%.2fs.' % (target or 'the default target', per_edge['fast'],
+                      per_edge['default']))
+
+
+def report(build_dir, position, jobs, goma, target=None, fast_build=False):
+  """Log where the time of the build went, using the entries appended to
+    .ninja_log since position, and write a trace if CF_BUILD_TRACE is set."""
+  try:
+    entries = ninja.read_new_log_entries(build_dir, position)
+  except (IOError, OSError) as e:
+    logger.debug('Cannot read the ninja log in %s: %s', build_dir, e)
+    return
+  if entries is None:
+    logger.debug('The ninja log in %s was rewritten. No build profile.',
+                 build_dir)
+    return
+
+  edges = get_edges(entries)
+  if not edges:
+    return
+
+  start = min(edge.start for edge in edges)
+  end = max(edge.end for edge in edges)
+  busy = sum(edge.end - edge.start for edge in edges)
+  path = get_critical_path(edges)
+  lines = [
+      'Built %d edges in %.1fs (%.1fs of work). Critical path: %.1fs in %d '
+      'edges.' % (len(edges), end - start, busy,
+                  sum(edge.end - edge.start for edge in path), len(path))]
+
+  for kind in ['compile', 'link']:
+    slowest = sorted((edge for edge in edges if edge.kind == kind),
+                     key=lambda edge: edge.start - edge.end)[:SLOWEST_EDGES]
+    if slowest:
+      lines.append('Slowest %ss: %s' % (kind, format_edges(slowest)))
+
+  timeline = get_timeline(edges, start, end)
+  if timeline:
+    lines.append(
+        'Parallelism: %.1f of -j %d on average (%s over time).' % (
+            busy / (end - start), jobs,
+            ' '.join('%.0f' % running for running in timeline)))
+  # .ninja_log doesn't say where a command ran. With goma, compiles run
+  # remotely and everything else runs locally.
+  compile_time = sum(
+      edge.end - edge.start for edge in edges if edge.kind == 'compile')
+  lines.append('%s compiles took %.1fs, and other edges took %.1fs.' % (
+      'Goma' if goma else 'Local', compile_time, busy - compile_time))
+  comparison = compare_profiles(target, fast_build, len(edges), busy)
+  if comparison:
+    lines.append(comparison)
+
+  logger.info('\n'.join(lines))
+
+  trace_path = os.environ.get(TRACE_VARIABLE)
+  if trace_path:
+    try:
+      write_trace(trace_path, edges)
+    except (IOError, OSError) as e:
+      logger.info('Cannot write the trace of the build to %s: %s',
+                  trace_path, e)
@@ -0,0 +1,150 @@
+"""Queue the processes that build in the same directory, in arrival order."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import time
+
+from clusterfuzz import common
+
+
+LOCKS_DIR = os.path.join(common.CLUSTERFUZZ_CACHE_DIR, 'locks')
+LOCK_FILE_NAME = 'lock'
+HOLDER_FILE_NAME = 'holder.json'
+TICKET_EXTENSION = '.ticket'
+POLL_INTERVAL = 2
+
+logger = logging.getLogger('clusterfuzz')
+
+
+def get_queue_dir(path):
+  """Return the directory of the lock and the queue of path."""
+  return os.path.join(
+      LOCKS_DIR, hashlib.sha1(os.path.abspath(path)).hexdigest()[:16])
+
+
+def try_flock(lock_file):
+  """Flock a file exclusively without waiting. Returns whether it's been
+    locked."""
+  try:
+    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except IOError:
+    return False
+  return True
+
+
+def take_ticket(queue_dir):
+  """Join the queue. A ticket is named after the time it's taken, and stays
+    flocked while its process waits, so that the tickets of processes that
+    have died are ignored. It's only named as a ticket once it's flocked.
+    Returns its path and file."""
+  name = '%.6f-%d' % (time.time(), os.getpid())
+  tmp_path = os.path.join(queue_dir, name + '.tmp')
+  path = os.path.join(queue_dir, name + TICKET_EXTENSION)
+  ticket = open(tmp_path, 'w')
+  fcntl.flock(ticket, fcntl.LOCK_EX)
+  os.rename(tmp_path, path)
+  return path, ticket
+
+
+def count_tickets_ahead(queue_dir, ticket_path=None):
+  """Return how many processes wait ahead of a ticket, or in total if there
+    is no ticket. The tickets of dead processes are removed."""
+  count = 0
+  for path in sorted(
+      glob.glob(os.path.join(queue_dir, '*' + TICKET_EXTENSION))):
+    if path == ticket_path:
+      break
+    try:
+      ticket = open(path)
+    except IOError:
+      continue
+    with ticket:
+      if try_flock(ticket):
+        common.delete_if_exists(path)
+        continue
+    count += 1
+  return count
+
+
+def log_position(path, position, holder, info):
+  """Tell the user why and behind whom they wait."""
+  if info.get('key') and holder.get('key') == info['key']:
+    logger.info(
+        'Another process (pid %s) is already building %s in %s. Waiting to '
+        'reuse its build (position %d in the queue).', holder.get('pid'),
+        holder.get('description'), path, position)
+    return
+
+  logger.info(
+      'Waiting for another process (pid %s, building %s) to finish with %s '
+      '(position %d in the queue).', holder.get('pid', 'unknown'),
+      holder.get('description', 'something'), path, position)
+
+
+def wait(queue_dir, lock_file, path, info):
+  """Wait in the queue until the lock is ours. The position is logged
+    whenever it, or the holder, changes."""
+  ticket_path, ticket = take_ticket(queue_dir)
+  try:
+    last_state = None
+    while True:
+      ahead = count_tickets_ahead(queue_dir, ticket_path)
+      if not ahead and try_flock(lock_file):
+        return
+
+      holder = common.read_json(
+          os.path.join(queue_dir, HOLDER_FILE_NAME), {})
+      state = (ahead, holder.get('pid'))
+      if state != last_state:
+        log_position(path, ahead + 1, holder, info)
+        last_state = state
+      time.sleep(POLL_INTERVAL)
+  finally:
+    # The ticket is removed while it's still flocked, so that it's never
+    # mistaken for the ticket of a dead process.
+    os.remove(ticket_path)
+    ticket.close()
+
+
+@contextlib.contextmanager
+def acquire(path, **info):
+  """Hold the lock of path (e.g. a source directory) across processes,
+    after the processes that hold it or already wait for it. info describes
+    what this process does (a description and, if it builds something that
+    others can reuse, a key), so that those behind know what they wait for.
+    Yields whether this process had to wait, in which case what it was
+    about to do might have been done in the meantime."""
+  queue_dir = get_queue_dir(path)
+  common.ensure_dir(queue_dir)
+  holder_path = os.path.join(queue_dir, HOLDER_FILE_NAME)
+  lock_file = open(os.path.join(queue_dir, LOCK_FILE_NAME), 'w')
+  acquired = False
+  try:
+    waited = not (count_tickets_ahead(queue_dir) == 0 and
+                  try_flock(lock_file))
+    if waited:
+      wait(queue_dir, lock_file, path, info)
+    acquired = True
+    common.write_json(holder_path, dict(info, pid=os.getpid()))
+    yield waited
+  finally:
+    if acquired:
+      common.delete_if_exists(holder_path)
+    lock_file.close()
@@ -174,7 +174,8 @@ def build_definition(job_definition, presets):
       binary_name=result.get('binary'),
       sanitizer=result.get('sanitizer'),
       target=result.get('target'),
-      require_user_data_dir=result.get('require_user_data_dir', False))
+      require_user_data_dir=result.get('require_user_data_dir', False),
+      require_full_build=result.get('require_full_build', False))
 
 
 def get_supported_jobs():
@@ -230,7 +231,8 @@ def warn_unreproducible_if_needed(current_testcase):
 @stackdriver_logging.log
 def execute(testcase_id, current, build, disable_goma, goma_threads, goma_load,
             iterations, disable_xvfb, target_args, edit_mode, skip_deps,
-            enable_debug, goma_dir=None):
+            enable_debug, goma_dir=None, worktree=False, fast_build=False,
+            reuse_nearest=False):
   """Execute the reproduce command."""
   options = common.Options(
       testcase_id=testcase_id,
@@ -245,7 +247,10 @@ def execute(testcase_id, current, build, disable_goma, goma_threads, goma_load,
       edit_mode=edit_mode,
       skip_deps=skip_deps,
       enable_debug=enable_debug,
-      goma_dir=goma_dir)
+      goma_dir=goma_dir,
+      worktree=worktree,
+      fast_build=fast_build,
+      reuse_nearest=reuse_nearest)
 
   logger.info('Reproducing testcase %s', testcase_id)
   logger.debug('%s', str(options))
@@ -258,7 +263,17 @@ def execute(testcase_id, current, build, disable_goma, goma_threads, goma_load,
 
   warn_unreproducible_if_needed(current_testcase)
 
-  if build == 'download':
+  try:
+    reproduce(current_testcase, definition, options)
+  finally:
+    warn_unreproducible_if_needed(current_testcase)
+
+
+def reproduce(current_testcase, definition, options):
+  """Get the binary and reproduce the testcase with it. A fast build that
+    doesn't reproduce the crash is rebuilt with the original args.gn, because
+    the overrides might be the cause."""
+  if options.build == 'download':
     if definition.binary_name:
       binary_name = definition.binary_name
     else:
@@ -266,13 +281,15 @@ def execute(testcase_id, current, build, disable_goma, goma_threads, goma_load,
     binary_provider = binary_providers.DownloadedBinary(
         testcase_id=current_testcase.id,
         build_url=current_testcase.build_url,
-        binary_name=binary_name)
+        binary_name=binary_name,
+        extract_all=definition.require_full_build)
   else:
     options.goma_dir = None if options.disable_goma else ensure_goma()
     binary_provider = definition.builder(
         testcase=current_testcase,
         definition=definition,
         options=options)
+  binary_provider.prefetch()
 
   reproducer = definition.reproducer(
       definition=definition,
@@ -281,6 +298,15 @@ def execute(testcase_id, current, build, disable_goma, goma_threads, goma_load,
       sanitizer=definition.sanitizer,
       options=options)
   try:
-    reproducer.reproduce(iterations)
-  finally:
-    warn_unreproducible_if_needed(current_testcase)
+    reproducer.reproduce(options.iterations)
+  except (error.UnreproducibleError, error.DifferentStacktraceError):
+    if not getattr(binary_provider, 'fast_build_overrides', None):
+      raise
+    logger.info(
+        'The fast build did not reproduce the crash. Rebuilding without the '
+        'overrides of %s.', ', '.join(sorted(
+            binary_provider.fast_build_overrides)))
+    # The rebuild must not wait for what the fast build still pins.
+    binary_provider.release()
+    options.fast_build = False
+    reproduce(current_testcase, definition, options)
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 import sys
 import stat
@@ -32,6 +33,7 @@ from backports.shutil_get_terminal_size import get_terminal_size
 from cmd_editor import editor
 from clusterfuzz import local_logging
 from clusterfuzz import output_transformer
+from clusterfuzz import tasks
 from error import error
 
 
@@ -61,7 +63,8 @@ Options = namedlist.namedlist(
     'Options',
     ['testcase_id', 'current', 'build', 'disable_goma', 'goma_threads',
      'goma_load', 'iterations', 'disable_xvfb', 'target_args', 'edit_mode',
-     'skip_deps', 'enable_debug', 'goma_dir']
+     'skip_deps', 'enable_debug', 'goma_dir', 'worktree',
+     'fast_build', 'reuse_nearest']
 )
 
 
@@ -82,6 +85,11 @@ def post(*args, **kwargs):  # pragma: no cover
   return http.post(*args, **kwargs)
 
 
+def get(*args, **kwargs):  # pragma: no cover
+  """Make a get request. This method is needed for mocking."""
+  return http.get(*args, **kwargs)
+
+
 class CrashSignature(object):
   """Represents a crash signature (including output)."""
 
@@ -145,7 +153,8 @@ class Definition(object):
   """Holds all the necessary information to initialize a job's builder."""
 
   def __init__(self, builder, source_var, reproducer, binary_name,
-               sanitizer, target, require_user_data_dir):
+               sanitizer, target, require_user_data_dir,
+               require_full_build=False):
     if not sanitizer:
       raise error.SanitizerNotProvidedError()
     self.builder = builder
@@ -155,6 +164,7 @@ class Definition(object):
     self.reproducer = reproducer
     self.target = target
     self.require_user_data_dir = require_user_data_dir
+    self.require_full_build = require_full_build
 
 
 def store_auth_header(auth_header):
@@ -336,19 +346,36 @@ def start_execute(
       preexec_fn=preexec_fn)
 
   setattr(proc, 'args', command)
+  tasks.add_process(proc)
   return proc
 
 
+def get_transformers(stdout_transformer, stderr_transformer):
+  """Return the transformers of a command's stdout and stderr. In a task,
+    other tasks might be printing at the same time, so lines are prefixed
+    with the task's name, and hidden output doesn't print dots."""
+  task = tasks.get_current()
+  if not task:
+    return (
+        stdout_transformer if stdout_transformer is not None
+        else output_transformer.Hidden(),
+        stderr_transformer if stderr_transformer is not None
+        else output_transformer.Identity())
+
+  prefix = '[%s] ' % task.name
+  if (stdout_transformer is None or
+      isinstance(stdout_transformer, output_transformer.Hidden)):
+    return output_transformer.Silent(), output_transformer.Prefix(prefix)
+  return output_transformer.Prefix(prefix), output_transformer.Prefix(prefix)
+
+
 def wait_execute(proc, exit_on_error, capture_output=True, print_output=True,
                  timeout=None, stdout_transformer=None,
                  stderr_transformer=None,
                  read_buffer_length=DEFAULT_READ_BUFFER_LENGTH):
   """Looks after a command as it runs, and prints/returns its output after."""
-  if stdout_transformer is None:
-    stdout_transformer = output_transformer.Hidden()
-
-  if stderr_transformer is None:
-    stderr_transformer = output_transformer.Identity()
+  stdout_transformer, stderr_transformer = get_transformers(
+      stdout_transformer, stderr_transformer)
 
   logger.debug('---------------------------------------')
   wait_timeout(proc, timeout)
@@ -483,6 +510,25 @@ def ensure_dir(path):
   os.makedirs(path)
 
 
+def read_json(path, default=None):
+  """Read a JSON file, or return default if it's missing or corrupted."""
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return default
+
+
+def write_json(path, value):
+  """Write a JSON file atomically, so that readers never see a partial
+    file."""
+  ensure_dir(os.path.dirname(path))
+  fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+  with os.fdopen(fd, 'w') as f:
+    json.dump(value, f)
+  os.rename(tmp_path, path)
+
+
 def get_valid_abs_dir(path):
   """Return true if path is a valid dir."""
   if not path:
@@ -0,0 +1,190 @@
+"""Choose ninja's -j, -l and link pool from the host and from past builds."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import multiprocessing
+import os
+import threading
+
+from clusterfuzz import common
+from clusterfuzz import goma
+
+
+HISTORY_FILE = os.path.join(common.CLUSTERFUZZ_CACHE_DIR, 'concurrency.json')
+MEMINFO_FILE = '/proc/meminfo'
+SAMPLE_INTERVAL = 5
+# A build overloads the host when the load average per CPU goes above this,
+# or when the available memory goes below LOW_MEMORY_GB. A goma build also
+# overloads compiler_proxy when it answers slower than goma's threshold.
+OVERLOAD_PER_CPU = 2.0
+LOW_MEMORY_GB = 2.0
+# Memory needed by a local compile and by a link.
+COMPILE_MEMORY_GB = 1.0
+LINK_MEMORY_GB = 8.0
+MIN_JOBS = 2
+GROWTH = 1.5
+
+logger = logging.getLogger('clusterfuzz')
+
+
+def get_available_memory_gb():
+  """Return the memory that can be used without swapping, or None if it's
+    unknown."""
+  if not os.path.exists(MEMINFO_FILE):
+    return None
+  with open(MEMINFO_FILE) as f:
+    for line in f:
+      if line.startswith('MemAvailable:'):
+        return int(line.split()[1]) / 1024.0 / 1024.0
+  return None
+
+
+def get_load():
+  """Return the load average of the last minute per CPU."""
+  return os.getloadavg()[0] / multiprocessing.cpu_count()
+
+
+class Sampler(object):
+  """Sample the load and the available memory in the background while a
+    build runs, and keep the worst of each. With goma, the time that
+    compiler_proxy takes to answer is sampled as well, since its queue grows
+    when it's given more compiles than it can dispatch (it has no stable
+    API for the queue itself)."""
+
+  def __init__(self, goma_enabled=False, interval=SAMPLE_INTERVAL):
+    self.goma_enabled = goma_enabled
+    self.interval = interval
+    self.peak_load = None
+    self.min_memory_gb = None
+    self.peak_goma_latency = None
+    self.stopped = threading.Event()
+    self.thread = None
+
+  def sample(self):
+    """Take one sample."""
+    load = get_load()
+    memory_gb = get_available_memory_gb()
+    self.peak_load = max(self.peak_load, load)
+    if memory_gb is not None:
+      self.min_memory_gb = min(self.min_memory_gb or memory_gb, memory_gb)
+    if self.goma_enabled:
+      self.peak_goma_latency = max(
+          self.peak_goma_latency, goma.probe().latency)
+
+  def run(self):
+    """Sample until stopped."""
+    while True:
+      self.sample()
+      if self.stopped.wait(self.interval):
+        return
+
+  def __enter__(self):
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def __exit__(self, *_):
+    self.stopped.set()
+    self.thread.join()
+
+  def is_overloaded(self):
+    """Whether the host ran out of CPU or memory, or compiler_proxy fell
+      behind."""
+    return ((self.peak_load or 0) > OVERLOAD_PER_CPU or
+            (self.min_memory_gb is not None and
+             self.min_memory_gb < LOW_MEMORY_GB) or
+            (self.peak_goma_latency or 0) > goma.SLOW_PROBE_SECONDS)
+
+
+def get_history_key(use_goma):
+  """Builds with and without goma are tuned separately."""
+  return 'goma' if use_goma else 'local'
+
+
+def get_default_jobs(use_goma):
+  """Return the -j to start from: many remote compiles with goma, and fewer
+    local ones than there are CPUs without it."""
+  cpu_count = multiprocessing.cpu_count()
+  return 50 * cpu_count if use_goma else (3 * cpu_count) / 4
+
+
+def choose_jobs(use_goma):
+  """Return the -j of the next build. It starts from the default, is halved
+    after a build that overloaded the host, and grows back towards the
+    default after one that succeeded without overloading it. A failed build
+    might have run out of memory between two samples, so it doesn't grow.
+    Local compiles are also limited by the available memory."""
+  default = get_default_jobs(use_goma)
+  last = common.read_json(HISTORY_FILE, {}).get(get_history_key(use_goma))
+
+  jobs = default
+  if last:
+    if last['overloaded']:
+      jobs = last['jobs'] / 2
+    elif not last.get('succeeded', True):
+      jobs = last['jobs']
+    else:
+      jobs = int(last['jobs'] * GROWTH)
+  jobs = min(jobs, default)
+
+  memory_gb = get_available_memory_gb()
+  if not use_goma and memory_gb is not None:
+    jobs = min(jobs, int(memory_gb / COMPILE_MEMORY_GB))
+  return max(jobs, MIN_JOBS)
+
+
+def choose_load(use_goma):
+  """Return the -l of the next build, which is lower after a build that
+    overloaded the host."""
+  cpu_count = multiprocessing.cpu_count()
+  last = common.read_json(HISTORY_FILE, {}).get(get_history_key(use_goma))
+  if last and last['overloaded']:
+    return cpu_count
+  return cpu_count * 2
+
+
+def choose_links():
+  """Return the depth of the link pool. Every link gets LINK_MEMORY_GB of
+    the available memory, and it's rounded down to a power of two so that
+    args.gn doesn't change with every small change in free memory. Returns
+    None if the memory is unknown."""
+  memory_gb = get_available_memory_gb()
+  if memory_gb is None:
+    return None
+
+  links = 1
+  while links * 2 <= min(memory_gb / LINK_MEMORY_GB,
+                         multiprocessing.cpu_count()):
+    links *= 2
+  return links
+
+
+def record(use_goma, jobs, sampler, succeeded):
+  """Remember how a build went, so that the next one can adjust."""
+  overloaded = sampler.is_overloaded()
+  logger.debug(
+      'The build with -j %d peaked at a load of %.1f per CPU with %s GB '
+      'available and goma answering in %s s (overloaded: %s, succeeded: '
+      '%s).', jobs, sampler.peak_load or 0, sampler.min_memory_gb,
+      sampler.peak_goma_latency, overloaded, succeeded)
+  if overloaded:
+    logger.info('The build overloaded this machine. The next build will use '
+                'fewer jobs.')
+
+  history = common.read_json(HISTORY_FILE, {})
+  history[get_history_key(use_goma)] = {
+      'jobs': jobs, 'overloaded': overloaded, 'succeeded': succeeded}
+  common.write_json(HISTORY_FILE, history)
@@ -0,0 +1,187 @@
+"""Deduplicate identical files across cached builds."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import zlib
+
+from clusterfuzz import common
+
+
+# Smaller files aren't worth a link.
+MIN_SIZE = 4096
+READ_SIZE = 1024 * 1024
+# The ioctl that makes a reflink (_IOW(0x94, 9, int)).
+FICLONE = 0x40049409
+INDEX_EXTENSION = 'index'
+TMP_SUFFIX = '.dedup.tmp'
+
+logger = logging.getLogger('clusterfuzz')
+
+
+def hash_file(path):
+  """Return the crc32 (as stored in zips) and the sha256 of a file."""
+  crc = 0
+  sha = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(READ_SIZE), b''):
+      crc = zlib.crc32(chunk, crc)
+      sha.update(chunk)
+  return crc & 0xffffffff, sha.hexdigest()
+
+
+def reflink(source, dest):
+  """Make dest a copy of source that shares its blocks."""
+  with open(source, 'rb') as source_file:
+    with open(dest, 'wb') as dest_file:
+      fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+  shutil.copymode(source, dest)
+
+
+def clone_file(source, dest):
+  """Replace dest with a reflink to source or, if the filesystem doesn't
+    support reflinks, a hardlink."""
+  tmp_path = dest + TMP_SUFFIX
+  try:
+    reflink(source, tmp_path)
+  except (IOError, OSError):
+    common.delete_if_exists(tmp_path)
+    os.link(source, tmp_path)
+  os.rename(tmp_path, dest)
+
+
+class Index(object):
+  """The content of the files in a cache's entries. Each entry's files are
+    kept in .meta/<key>.index as {path: [size, crc32, sha256]}."""
+
+  def __init__(self, cache, exclude_key=None):
+    self.by_hash = {}
+    self.by_member = {}
+
+    for key in cache.get_entries():
+      if key == exclude_key:
+        continue
+
+      files = common.read_json(cache.get_meta_path(key, INDEX_EXTENSION), {})
+      for path, (size, crc, sha) in files.iteritems():
+        full_path = os.path.join(cache.get_path(key), path)
+        self.by_hash.setdefault(sha, full_path)
+        self.by_member.setdefault((path, size, crc), (full_path, sha))
+
+
+def reuse_members(index, members, dest_dir):
+  """Clone the zip members that another entry already has (with the same
+    path, size and crc32) instead of extracting them. Returns the records of
+    the cloned members, keyed by their paths."""
+  records = {}
+  for path, info in members.iteritems():
+    if info.file_size < MIN_SIZE:
+      continue
+
+    found = index.by_member.get((path, info.file_size, info.CRC))
+    if not found:
+      continue
+
+    source, sha = found
+    dest = os.path.join(dest_dir, path)
+    common.ensure_dir(os.path.dirname(dest))
+    try:
+      clone_file(source, dest)
+    except OSError as e:
+      # The other entry might have been evicted in the meantime.
+      logger.debug('Cannot reuse %s: %s', source, e)
+      continue
+    records[path] = [info.file_size, info.CRC, sha]
+  return records
+
+
+def dedupe(index, dest_dir, records):
+  """Hash the files in dest_dir that aren't in records yet, and replace the
+    ones that another entry (or dest_dir itself) already has with clones.
+    records is updated to cover all the files. Returns the number of files
+    and bytes that have been deduplicated."""
+  count = 0
+  saved = 0
+  for root, _, files in os.walk(dest_dir):
+    for name in files:
+      path = os.path.join(root, name)
+      relative_path = os.path.relpath(path, dest_dir)
+      if relative_path in records or os.path.islink(path):
+        continue
+
+      size = os.path.getsize(path)
+      crc, sha = hash_file(path)
+      records[relative_path] = [size, crc, sha]
+      if size < MIN_SIZE:
+        continue
+
+      source = index.by_hash.setdefault(sha, path)
+      if source == path:
+        continue
+      try:
+        if os.path.samefile(source, path):
+          continue
+        clone_file(source, path)
+      except OSError as e:
+        logger.debug('Cannot deduplicate %s: %s', path, e)
+        continue
+      count += 1
+      saved += size
+  return count, saved
+
+
+def dedupe_entry(cache, key, index, reused):
+  """Deduplicate an entry of a cache, and write its index so that later
+    entries can be deduplicated against it. reused are the records of the
+    members that reuse_members has cloned. Returns the number of files and
+    bytes that have been deduplicated, including reused."""
+  records = dict(reused)
+  count, saved = dedupe(index, cache.get_path(key), records)
+  count += len(reused)
+  saved += sum(size for size, _, _ in reused.itervalues())
+  with cache.lock():
+    common.write_json(cache.get_meta_path(key, INDEX_EXTENSION), records)
+
+  logger.debug(
+      'Deduplicated %d files against other %ss, saving %.1f MB.',
+      count, cache.name, saved / 1024.0 / 1024.0)
+  return count, saved
+
+
+def dedupe_in_background(cache, key, index=None, reused=None):
+  """Run dedupe_entry in a daemon thread, so that the entry can be used
+    while its files are hashed. The entry stays pinned meanwhile. If the
+    process exits first, the entry is left without an index, and is neither
+    deduplicated nor used to deduplicate later entries."""
+
+  def run():
+    """Deduplicate the entry."""
+    pin = cache.pin(key)
+    try:
+      dedupe_entry(cache, key, index or Index(cache, key), reused or {})
+    except (IOError, OSError) as e:
+      # Another process might have evicted the entry in the meantime.
+      logger.debug('Cannot deduplicate %s: %s', cache.get_path(key), e)
+    finally:
+      pin.close()
+
+  thread = threading.Thread(target=run)
+  thread.daemon = True
+  thread.start()
+  return thread
@@ -0,0 +1,197 @@
+"""A directory of cached entries with a disk quota and LRU eviction."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import fcntl
+import logging
+import os
+import time
+
+from clusterfuzz import common
+
+
+META_DIR_NAME = '.meta'
+STATS_KEYS = ['hits', 'misses', 'evictions', 'evicted_bytes']
+
+logger = logging.getLogger('clusterfuzz')
+
+
+def get_quota(variable, default_gb):
+  """Read a quota in GB from an environment variable."""
+  return int(float(os.environ.get(variable, default_gb)) * 1024 ** 3)
+
+
+def get_size(path):
+  """Return the disk usage of a directory. Hardlinked files are counted
+    once."""
+  size = 0
+  seen = set()
+  for root, dirs, files in os.walk(path):
+    for name in dirs + files:
+      stats = os.lstat(os.path.join(root, name))
+      if (stats.st_dev, stats.st_ino) in seen:
+        continue
+      seen.add((stats.st_dev, stats.st_ino))
+      size += stats.st_blocks * 512
+  return size
+
+
+def share_pin(pin):
+  """Let other processes pin an entry that is pinned exclusively. The entry
+    stays pinned."""
+  fcntl.flock(pin, fcntl.LOCK_SH)
+
+
+def format_size(size):
+  """Format a size in GB."""
+  return '%.1f GB' % (size / 1024.0 ** 3)
+
+
+class DiskCache(object):
+  """Each entry is a directory at <path>/<key>. Its metadata (size and last
+    use) is kept in <path>/.meta/<key>.json. An entry is pinned while a
+    process holds a shared flock on <path>/.meta/<key>.lock, and pinned
+    entries are never evicted. Entries are measured with get_size, unless
+    another measure is given (e.g. one that counts entries)."""
+
+  def __init__(self, name, path, quota, measure=None):
+    self.name = name
+    self.path = path
+    self.quota = quota
+    self.measure = measure
+    self.meta_dir = os.path.join(path, META_DIR_NAME)
+
+  def get_path(self, key):
+    """Return the directory of an entry."""
+    return os.path.join(self.path, key)
+
+  def get_meta_path(self, key, extension):
+    """Return a metadata file of an entry."""
+    return os.path.join(self.meta_dir, '%s.%s' % (key, extension))
+
+  @contextlib.contextmanager
+  def lock(self):
+    """Serialize metadata updates and evictions across processes."""
+    common.ensure_dir(self.meta_dir)
+    with open(os.path.join(self.meta_dir, 'lock'), 'w') as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      yield
+
+  def pin(self, key, exclusive=False, blocking=True):
+    """Pin an entry, so it isn't evicted. The entry stays pinned until the
+      returned file is closed (or the process exits). An exclusive pin
+      waits for the other processes to unpin the entry or, if it's not
+      blocking, fails and returns None."""
+    common.ensure_dir(self.meta_dir)
+    lock_file = open(self.get_meta_path(key, 'lock'), 'w')
+    operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    if not blocking:
+      operation |= fcntl.LOCK_NB
+    try:
+      fcntl.flock(lock_file, operation)
+    except IOError:
+      lock_file.close()
+      return None
+    return lock_file
+
+  def get_stats(self):
+    """Return the counters of the cache."""
+    stats = common.read_json(os.path.join(self.meta_dir, 'stats.json'), {})
+    return {key: stats.get(key, 0) for key in STATS_KEYS}
+
+  def add_stats(self, **counts):
+    """Add to the counters of the cache. The lock must be held."""
+    stats = self.get_stats()
+    for key, count in counts.iteritems():
+      stats[key] += count
+    common.write_json(os.path.join(self.meta_dir, 'stats.json'), stats)
+
+  def get_entries(self):
+    """Return the metadata of all the entries, keyed by their keys."""
+    entries = {}
+    if not os.path.exists(self.meta_dir):
+      return entries
+
+    for filename in os.listdir(self.meta_dir):
+      key, extension = os.path.splitext(filename)
+      if extension == '.json' and key != 'stats':
+        entries[key] = common.read_json(
+            os.path.join(self.meta_dir, filename), {})
+    return entries
+
+  def use(self, key, hit, complete=True, changed=False, **info):
+    """Record a use of an entry, and measure its size if it's new or has
+      changed. An incomplete entry (e.g. still being extracted) is measured
+      next time. info is stored in the entry's metadata."""
+    with self.lock():
+      meta = common.read_json(self.get_meta_path(key, 'json'), {})
+      if not complete:
+        meta.pop('size', None)
+      elif not hit or changed or 'size' not in meta:
+        meta['size'] = (self.measure or get_size)(self.get_path(key))
+      meta['last_used'] = time.time()
+      meta.update(info)
+      common.write_json(self.get_meta_path(key, 'json'), meta)
+      self.add_stats(**{'hits' if hit else 'misses': 1})
+
+  def remove(self, key):
+    """Remove an entry and its metadata, except for its lock file. The lock
+      must be held."""
+    common.delete_if_exists(self.get_path(key))
+    for filename in os.listdir(self.meta_dir):
+      name, extension = os.path.splitext(filename)
+      if name == key and extension != '.lock':
+        os.remove(os.path.join(self.meta_dir, filename))
+
+  def evict(self):
+    """Evict the least recently used entries that aren't pinned, until the
+      cache fits in its quota. Returns the evicted keys."""
+    evicted = []
+    with self.lock():
+      entries = self.get_entries()
+      total = sum(meta.get('size', 0) for meta in entries.itervalues())
+
+      for key, meta in sorted(entries.iteritems(),
+                              key=lambda item: item[1].get('last_used', 0)):
+        if total <= self.quota:
+          break
+
+        with open(self.get_meta_path(key, 'lock'), 'w') as lock_file:
+          try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+          except IOError:
+            logger.debug('Not evicting %s, which is in use.', key)
+            continue
+          self.remove(key)
+
+        size = meta.get('size', 0)
+        total -= size
+        evicted.append(key)
+        self.add_stats(evictions=1, evicted_bytes=size)
+        logger.info(
+            'Evicted %s (%s) from the %s cache.', key, format_size(size),
+            self.name)
+    return evicted
+
+  def log_stats(self):
+    """Log the usage and the counters of the cache."""
+    entries = self.get_entries()
+    stats = self.get_stats()
+    logger.info(
+        '%s cache: %d entries, %s of %s, %d hits, %d misses, %d evictions '
+        '(%s).', self.name.capitalize(), len(entries),
+        format_size(sum(meta.get('size', 0) for meta in entries.itervalues())),
+        format_size(self.quota), stats['hits'], stats['misses'],
+        stats['evictions'], format_size(stats['evicted_bytes']))
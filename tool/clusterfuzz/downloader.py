@@ -0,0 +1,426 @@
+"""Download files in-process over a pooled HTTP session."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import binascii
+import collections
+import hashlib
+import logging
+import multiprocessing.pool
+import os
+import re
+import time
+
+import requests
+from requests.packages.urllib3.util import retry
+from requests import adapters
+from oauth2client import client
+
+from clusterfuzz import common
+from error import error
+
+
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+DOWNLOAD_TIMEOUT = 100
+MAX_ATTEMPTS = 5
+RETRY_WAIT = 2
+PART_SUFFIX = '.part'
+# Objects at least this big are downloaded in ranges of RANGE_SIZE bytes by
+# RANGE_WORKERS threads.
+PARALLEL_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+RANGE_SIZE = 32 * 1024 * 1024
+RANGE_WORKERS = 8
+GCS_API_URL = 'https://storage.googleapis.com/'
+GCS_URL_PREFIXES = ['https://storage.cloud.google.com/', 'gs://']
+GCS_READ_ONLY_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_only'
+RETRIABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout)
+HTTP_POOL_SIZE = 16
+
+# A probed Google Cloud Storage object. headers is None if the application
+# default credentials cannot be used, and size is None if the server doesn't
+# support ranges.
+GcsObject = collections.namedtuple(
+    'GcsObject', ['url', 'headers', 'size', 'md5'])
+
+logger = logging.getLogger('clusterfuzz')
+
+# Downloads resume interrupted transfers themselves, so their session only
+# retries server errors. It's separate from common.http, so that the requests
+# to ClusterFuzz aren't affected. The last error response is returned rather
+# than raised.
+http = requests.Session()
+http.mount(
+    'https://',
+    adapters.HTTPAdapter(
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=retry.Retry(
+            total=5, backoff_factor=0.5, raise_on_status=False,
+            status_forcelist=[500, 502, 503, 504])))
+
+
+def get(*args, **kwargs):  # pragma: no cover
+  """Make a get request. This method is needed for mocking."""
+  return http.get(*args, **kwargs)
+
+
+def get_gcs_path(url):
+  """Return the bucket/object part of a Google Cloud Storage url."""
+  for prefix in GCS_URL_PREFIXES:
+    if url.startswith(prefix):
+      return url[len(prefix):]
+  return url
+
+
+def get_gcs_auth_headers():
+  """Get the auth header from the application default credentials."""
+  credentials = client.GoogleCredentials.get_application_default()
+  credentials = credentials.create_scoped([GCS_READ_ONLY_SCOPE])
+  return {
+      'Authorization':
+          'Bearer %s' % credentials.get_access_token().access_token}
+
+
+def get_md5(response):
+  """Return the md5 (in hex) of the whole object if the server reports it.
+    GCS reports it in x-goog-hash, e.g. `crc32c=n03x6A==,md5=Ojk9c3dh==`."""
+  for pair in response.headers.get('x-goog-hash', '').split(','):
+    key, _, value = pair.strip().partition('=')
+    if key == 'md5':
+      return binascii.hexlify(base64.b64decode(value))
+
+  # Content-MD5 is the md5 of the body, which is the whole object only when
+  # the response isn't partial.
+  if response.status_code == 200 and response.headers.get('Content-MD5'):
+    return binascii.hexlify(base64.b64decode(response.headers['Content-MD5']))
+  return None
+
+
+def get_file_md5(path):
+  """Return the md5 (in hex) of a file."""
+  md5 = hashlib.md5()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+      md5.update(chunk)
+  return md5.hexdigest()
+
+
+def get_size(path):
+  """Return the size of path, or 0 if it doesn't exist."""
+  if not os.path.exists(path):
+    return 0
+  return os.path.getsize(path)
+
+
+def receive(url, response, part_path, offset):
+  """Write the response body to part_path, appending to it if the server
+    honours our Range request. Returns the size of the whole object if it's
+    known."""
+  if response.status_code == 200:
+    offset = 0
+  elif response.status_code != 206:
+    raise error.DownloadFailedError(
+        url, 'HTTP %d' % response.status_code, response.status_code)
+
+  content_length = response.headers.get('Content-Length')
+  size = offset + int(content_length) if content_length else None
+
+  with open(part_path, 'ab' if offset else 'wb') as f:
+    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+      f.write(chunk)
+
+  if size is not None and get_size(part_path) < size:
+    raise requests.exceptions.ConnectionError(
+        'Got %d out of %d bytes.' % (get_size(part_path), size))
+  return size
+
+
+def verify(url, path, size, md5):
+  """Verify the size and md5 of the downloaded file."""
+  actual_size = get_size(path)
+  if size is not None and actual_size != size:
+    raise error.DownloadFailedError(
+        url, 'expected %d bytes but got %d bytes' % (size, actual_size))
+
+  if md5:
+    actual_md5 = get_file_md5(path)
+    if actual_md5 != md5:
+      raise error.DownloadFailedError(
+          url, 'expected md5=%s but got md5=%s' % (md5, actual_md5))
+
+
+def log_throughput(dest, transferred, elapsed):
+  """Log how fast the download was."""
+  megabytes = transferred / 1024.0 / 1024.0
+  logger.info(
+      'Downloaded %s (%.1f MB) in %.1f seconds (%.1f MB/s).',
+      os.path.basename(dest), megabytes, elapsed,
+      megabytes / max(elapsed, 0.001))
+
+
+def download(url, dest, headers=None, md5=None):
+  """Stream url to dest. An interrupted download resumes from dest.part with
+    a Range request. The result is verified against the size and the md5
+    reported by the server (or the given md5). Returns the response headers,
+    or None if a conditional request says that the object hasn't changed."""
+  part_path = dest + PART_SUFFIX
+  start_time = time.time()
+  start_size = get_size(part_path)
+  size = None
+
+  for attempt in xrange(1, MAX_ATTEMPTS + 1):
+    offset = get_size(part_path)
+    request_headers = dict(headers or {})
+    # We verify the exact bytes, so we don't want transparent decompression.
+    request_headers['Accept-Encoding'] = 'identity'
+    if offset:
+      request_headers['Range'] = 'bytes=%d-' % offset
+
+    try:
+      response = get(
+          url=url, headers=request_headers, allow_redirects=True, stream=True,
+          timeout=DOWNLOAD_TIMEOUT)
+      if response.status_code == 304:
+        # The part (if any) belongs to a version we don't need anymore.
+        response.close()
+        common.delete_if_exists(part_path)
+        return None
+      if response.status_code == 416 and offset:
+        # The part is stale (e.g. the object has changed). Start over.
+        response.close()
+        common.delete_if_exists(part_path)
+        raise requests.exceptions.ConnectionError('Range not satisfiable.')
+
+      md5 = md5 or get_md5(response)
+      size = receive(url, response, part_path, offset)
+      break
+    except RETRIABLE_ERRORS as e:
+      if attempt == MAX_ATTEMPTS:
+        raise error.DownloadFailedError(url, str(e))
+      logger.info(
+          'Downloading %s was interrupted (%s). Resuming (attempt %d/%d)...',
+          url, e, attempt + 1, MAX_ATTEMPTS)
+      time.sleep(RETRY_WAIT * attempt)
+
+  try:
+    verify(url, part_path, size, md5)
+  except error.DownloadFailedError:
+    common.delete_if_exists(part_path)
+    raise
+
+  log_throughput(dest, get_size(part_path) - start_size,
+                 time.time() - start_time)
+  os.rename(part_path, dest)
+  return response.headers
+
+
+def probe(url, headers):
+  """Ask for the first byte to learn the object's size, whether the server
+    supports ranges, and its md5. Returns (None, None) if ranges aren't
+    supported."""
+  request_headers = dict(headers or {})
+  request_headers['Accept-Encoding'] = 'identity'
+  request_headers['Range'] = 'bytes=0-0'
+  response = get(
+      url=url, headers=request_headers, allow_redirects=True, stream=True,
+      timeout=DOWNLOAD_TIMEOUT)
+  response.close()
+
+  if response.status_code not in [200, 206]:
+    raise error.DownloadFailedError(
+        url, 'HTTP %d' % response.status_code, response.status_code)
+
+  match = re.match(
+      r'bytes 0-0/(\d+)', response.headers.get('Content-Range', ''))
+  if response.status_code != 206 or not match:
+    return None, None
+  return int(match.group(1)), get_md5(response)
+
+
+def get_ranges(size, range_size):
+  """Split [0, size) into inclusive (start, end) ranges."""
+  return [(start, min(start + range_size, size) - 1)
+          for start in xrange(0, size, range_size)]
+
+
+def download_range(url, path, headers, byte_range):
+  """Download one range into its place in path. An interrupted range is
+    retried on its own, from the last byte that was written."""
+  start, end = byte_range
+  position = start
+
+  for attempt in xrange(1, MAX_ATTEMPTS + 1):
+    request_headers = dict(headers or {})
+    request_headers['Accept-Encoding'] = 'identity'
+    request_headers['Range'] = 'bytes=%d-%d' % (position, end)
+
+    try:
+      response = get(
+          url=url, headers=request_headers, allow_redirects=True,
+          stream=True, timeout=DOWNLOAD_TIMEOUT)
+      if response.status_code != 206:
+        response.close()
+        raise error.DownloadFailedError(
+            url, 'HTTP %d for the range %d-%d' % (
+                response.status_code, position, end),
+            response.status_code)
+
+      with open(path, 'r+b') as f:
+        f.seek(position)
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+          chunk = chunk[:end + 1 - position]
+          f.write(chunk)
+          position += len(chunk)
+
+      if position <= end:
+        raise requests.exceptions.ConnectionError(
+            'Got %d out of %d bytes of the range %d-%d.' % (
+                position - start, end + 1 - start, start, end))
+      return
+    except RETRIABLE_ERRORS as e:
+      if attempt == MAX_ATTEMPTS:
+        raise error.DownloadFailedError(url, str(e))
+      logger.debug(
+          'Downloading the range %d-%d of %s was interrupted (%s). '
+          'Retrying...', start, end, url, e)
+      time.sleep(RETRY_WAIT * attempt)
+
+
+def read_range(url, headers, start, end):
+  """Return the bytes from start to end (inclusive) of url."""
+  for attempt in xrange(1, MAX_ATTEMPTS + 1):
+    request_headers = dict(headers or {})
+    request_headers['Accept-Encoding'] = 'identity'
+    request_headers['Range'] = 'bytes=%d-%d' % (start, end)
+
+    try:
+      response = get(
+          url=url, headers=request_headers, allow_redirects=True,
+          timeout=DOWNLOAD_TIMEOUT)
+      if response.status_code != 206:
+        raise error.DownloadFailedError(
+            url, 'HTTP %d for the range %d-%d' % (
+                response.status_code, start, end),
+            response.status_code)
+
+      data = response.content
+      if len(data) != end + 1 - start:
+        raise requests.exceptions.ConnectionError(
+            'Got %d out of %d bytes of the range %d-%d.' % (
+                len(data), end + 1 - start, start, end))
+      return data
+    except RETRIABLE_ERRORS as e:
+      if attempt == MAX_ATTEMPTS:
+        raise error.DownloadFailedError(url, str(e))
+      logger.debug(
+          'Reading the range %d-%d of %s was interrupted (%s). Retrying...',
+          start, end, url, e)
+      time.sleep(RETRY_WAIT * attempt)
+
+
+def download_parallel(url, dest, headers=None, md5=None):
+  """Download url to dest in concurrent ranges. The file is preallocated and
+    each range is written in place, so there's no merging step. Small objects
+    and servers without range support use the streaming download."""
+  size, server_md5 = probe(url, headers)
+  return download_probed(url, dest, headers, size, md5 or server_md5)
+
+
+def download_probed(url, dest, headers, size, md5):
+  """Download url, whose size (None without range support) and md5 have been
+    probed already, like download_parallel."""
+  if size is None or size < PARALLEL_DOWNLOAD_THRESHOLD:
+    download(url, dest, headers=headers, md5=md5)
+    return dest
+
+  part_path = dest + PART_SUFFIX
+  start_time = time.time()
+  ranges = get_ranges(size, RANGE_SIZE)
+  logger.info(
+      'Downloading %s (%.1f MB) in %d ranges with %d workers...',
+      os.path.basename(dest), size / 1024.0 / 1024.0, len(ranges),
+      min(RANGE_WORKERS, len(ranges)))
+
+  with open(part_path, 'wb') as f:
+    f.truncate(size)
+
+  pool = multiprocessing.pool.ThreadPool(min(RANGE_WORKERS, len(ranges)))
+  try:
+    for _ in pool.imap_unordered(
+        lambda byte_range: download_range(url, part_path, headers, byte_range),
+        ranges):
+      pass
+    verify(url, part_path, size, md5)
+  except (error.DownloadFailedError, requests.exceptions.RequestException,
+          IOError, OSError, KeyboardInterrupt):
+    # The part has holes, so it cannot be resumed by download().
+    common.delete_if_exists(part_path)
+    raise
+  finally:
+    pool.terminate()
+    pool.join()
+
+  log_throughput(dest, size, time.time() - start_time)
+  os.rename(part_path, dest)
+  return dest
+
+
+def should_use_gsutil(e):
+  """Return true if the exception means that the application default
+    credentials cannot be used to download from Google Cloud Storage."""
+  if isinstance(e, client.Error):
+    return True
+  return (isinstance(e, error.DownloadFailedError) and
+          e.status_code in [401, 403])
+
+
+def probe_gcs_object(url):
+  """Probe a Google Cloud Storage object with the application default
+    credentials. Returns a GcsObject."""
+  gcs_url = GCS_API_URL + get_gcs_path(url)
+  try:
+    headers = get_gcs_auth_headers()
+    size, md5 = probe(gcs_url, headers)
+  except (client.Error, error.DownloadFailedError) as e:
+    if not should_use_gsutil(e):
+      raise
+    logger.info('Cannot access %s with the application default credentials '
+                '(%s).', url, e)
+    return GcsObject(gcs_url, None, None, None)
+  return GcsObject(gcs_url, headers, size, md5)
+
+
+def download_gcs_object(url, dest, gcs_object=None):
+  """Download a Google Cloud Storage object in-process. gsutil is only used
+    when the application default credentials are missing or cannot access
+    the object. gcs_object is the result of probe_gcs_object, if the object
+    has been probed already."""
+  gcs_object = gcs_object or probe_gcs_object(url)
+  if gcs_object.headers is not None:
+    try:
+      return download_probed(gcs_object.url, dest, gcs_object.headers,
+                             gcs_object.size, gcs_object.md5)
+    except error.DownloadFailedError as e:
+      if not should_use_gsutil(e):
+        raise
+      logger.info('Cannot download %s with the application default '
+                  'credentials (%s).', url, e)
+
+  logger.info('Falling back to gsutil.')
+  gcs_path = get_gcs_path(url)
+  common.gsutil('cp gs://%s %s' % (gcs_path, dest), os.path.dirname(dest))
+  return dest
@@ -0,0 +1,113 @@
+"""Read the shared libraries that an ELF binary needs."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+
+ELF_MAGIC = '\x7fELF'
+PT_LOAD = 1
+PT_DYNAMIC = 2
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+
+# The formats of (the rest of the header, a program header, a dynamic entry)
+# for 32-bit and 64-bit binaries.
+FORMATS = {
+    1: ('HHIIIIIHHH', 'IIIIIIII', 'iI'),
+    2: ('HHIQQQIHHH', 'IIQQQQQQ', 'qQ'),
+}
+
+
+def read_struct(f, fmt, offset):
+  """Read a struct at offset."""
+  f.seek(offset)
+  size = struct.calcsize(fmt)
+  data = f.read(size)
+  if len(data) != size:
+    raise ValueError('Truncated ELF binary.')
+  return struct.unpack(fmt, data)
+
+
+def get_program_headers(f, elf_class, endian):
+  """Return (type, offset, vaddr, filesz) of the program headers."""
+  header_format, program_header_format, _ = FORMATS[elf_class]
+  header = read_struct(f, endian + header_format, 16)
+  phoff, phentsize, phnum = header[4], header[8], header[9]
+
+  program_headers = []
+  for i in xrange(phnum):
+    fields = read_struct(
+        f, endian + program_header_format, phoff + i * phentsize)
+    if elf_class == 1:
+      p_type, p_offset, p_vaddr, _, p_filesz = fields[:5]
+    else:
+      p_type, _, p_offset, p_vaddr, _, p_filesz = fields[:6]
+    program_headers.append((p_type, p_offset, p_vaddr, p_filesz))
+  return program_headers
+
+
+def get_file_offset(program_headers, vaddr):
+  """Map a virtual address to a file offset through the loaded segments."""
+  for p_type, p_offset, p_vaddr, p_filesz in program_headers:
+    if p_type == PT_LOAD and p_vaddr <= vaddr < p_vaddr + p_filesz:
+      return vaddr - p_vaddr + p_offset
+  raise ValueError('Address 0x%x is not in a loaded segment.' % vaddr)
+
+
+def get_needed_libraries(path):
+  """Return the DT_NEEDED entries of an ELF binary, or an empty list if path
+    isn't a dynamically linked ELF binary. Only the headers and the dynamic
+    section are read, so this is cheap even for huge binaries."""
+  with open(path, 'rb') as f:
+    ident = f.read(16)
+    if len(ident) != 16 or not ident.startswith(ELF_MAGIC):
+      return []
+    elf_class = ord(ident[4])
+    if elf_class not in FORMATS:
+      return []
+    endian = '>' if ord(ident[5]) == 2 else '<'
+    _, _, dynamic_format = FORMATS[elf_class]
+    dynamic_size = struct.calcsize(dynamic_format)
+
+    program_headers = get_program_headers(f, elf_class, endian)
+    dynamic = [(offset, filesz) for p_type, offset, _, filesz
+               in program_headers if p_type == PT_DYNAMIC]
+    if not dynamic:
+      return []
+
+    offset, filesz = dynamic[0]
+    needed = []
+    strtab = None
+    strsz = 0
+    for i in xrange(filesz / dynamic_size):
+      tag, value = read_struct(
+          f, endian + dynamic_format, offset + i * dynamic_size)
+      if tag == DT_NULL:
+        break
+      elif tag == DT_NEEDED:
+        needed.append(value)
+      elif tag == DT_STRTAB:
+        strtab = value
+      elif tag == DT_STRSZ:
+        strsz = value
+
+    if not needed or strtab is None:
+      return []
+
+    f.seek(get_file_offset(program_headers, strtab))
+    strings = f.read(strsz)
+    return [strings[index:strings.index('\0', index)] for index in needed]
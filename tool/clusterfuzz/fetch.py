@@ -0,0 +1,167 @@
+"""Fetch a commit from origin, starting in the background as early as we can."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import re
+import threading
+import time
+
+from clusterfuzz import common
+from clusterfuzz import git_batch
+
+
+# The args of every strategy. A partial clone only fetches the blobs that a
+# checkout needs, and a shallow clone only the commit itself.
+STRATEGY_ARGS = {
+    'partial': '--filter=blob:none',
+    'shallow': '--depth=1',
+    'full': '',
+}
+# The total of git's progress, e.g.
+# `Receiving objects: 100% (12/12), 3.50 MiB | 1.00 MiB/s, done.`
+RECEIVED_PATTERN = re.compile(
+    r'Receiving objects: [^\r\n]*?, ([\d.]+) (bytes|KiB|MiB|GiB)')
+UNITS = {'bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+logger = logging.getLogger('clusterfuzz')
+
+# The fetches started in the background, keyed by (source_dir, sha).
+FETCHES = {}
+
+
+def get_config(source_dir, name):
+  """Return the value of a git config, or None if it isn't set."""
+  returncode, output = common.execute(
+      'git', 'config --get %s' % name, source_dir, print_command=False,
+      print_output=False, exit_on_error=False)
+  return output.strip() if returncode == 0 else None
+
+
+def choose_strategy(source_dir):
+  """Fetch like the checkout was cloned: blob-less if origin is the remote
+    of a partial clone, with depth 1 if the checkout is shallow, and in full
+    otherwise. A full checkout can't fetch shallow, because it would become
+    shallow."""
+  if (get_config(source_dir, 'extensions.partialClone') == 'origin' or
+      get_config(source_dir, 'remote.origin.promisor') == 'true'):
+    return 'partial'
+
+  _, output = common.execute(
+      'git', 'rev-parse --is-shallow-repository', source_dir,
+      print_command=False, print_output=False, exit_on_error=False)
+  if output.strip() == 'true':
+    return 'shallow'
+  return 'full'
+
+
+def get_received_bytes(output):
+  """Return how much git received according to its progress, or None if it
+    didn't print any (e.g. nothing was received)."""
+  matches = RECEIVED_PATTERN.findall(output)
+  if not matches:
+    return None
+  size, unit = matches[-1]
+  return int(float(size) * UNITS[unit])
+
+
+def format_bytes(size):
+  if size is None:
+    return 'an unknown size'
+  for unit in ['GiB', 'MiB', 'KiB']:
+    if size >= UNITS[unit]:
+      return '%.1f %s' % (float(size) / UNITS[unit], unit)
+  return '%d bytes' % size
+
+
+class Fetch(object):
+  """A fetch of only the commit needed, with the strategy that suits the
+    checkout."""
+
+  def __init__(self, sha, source_dir):
+    self.sha = sha
+    self.source_dir = source_dir
+    self.succeeded = False
+    self.thread = None
+
+  def run(self):
+    """Fetch the commit unless it exists, and report how long it took and
+      how much it received."""
+    # In a partial clone, looking a missing commit up fetches it by itself.
+    if git_batch.sha_exists(self.sha, self.source_dir):
+      self.succeeded = True
+      return
+
+    strategy = choose_strategy(self.source_dir)
+    start_time = time.time()
+    returncode, output = common.execute(
+        'git', ' '.join(
+            arg for arg in ['fetch', '--no-tags', '--progress',
+                            STRATEGY_ARGS[strategy], 'origin', self.sha]
+            if arg),
+        self.source_dir, print_command=False, print_output=False,
+        exit_on_error=False, redirect_stderr_to_stdout=True)
+    self.succeeded = returncode == 0
+
+    if self.succeeded:
+      logger.info('Fetched %s (%s) in %.1fs, receiving %s.', self.sha,
+                  strategy, time.time() - start_time,
+                  format_bytes(get_received_bytes(output)))
+    else:
+      logger.debug('The %s fetch of %s failed:\n%s', strategy, self.sha,
+                   output)
+
+  def start(self):
+    """Run in the background."""
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def wait(self):
+    """Wait for the fetch to finish, running it now if it wasn't started."""
+    if self.thread:
+      if self.thread.is_alive():
+        logger.info('Waiting for %s to be fetched.', self.sha)
+      self.thread.join()
+    else:
+      self.run()
+
+
+def get_key(sha, source_dir):
+  return os.path.abspath(source_dir), sha
+
+
+def prefetch(sha, source_dir):
+  """Start fetching sha in the background, unless it's being fetched."""
+  key = get_key(sha, source_dir)
+  if key in FETCHES:
+    return
+
+  logger.debug('Fetching %s in %s in the background.', sha, source_dir)
+  FETCHES[key] = Fetch(sha, source_dir)
+  FETCHES[key].start()
+
+
+def ensure(sha, source_dir):
+  """Make sure sha exists, waiting for its fetch in the background if there
+    is one. If the fetch fails, it falls back to a plain `git fetch`, which
+    exits on error."""
+  fetch = (FETCHES.pop(get_key(sha, source_dir), None) or
+           Fetch(sha, source_dir))
+  fetch.wait()
+  if fetch.succeeded and git_batch.sha_exists(sha, source_dir):
+    return
+
+  common.execute('git', 'fetch origin %s' % sha, source_dir)
@@ -0,0 +1,140 @@
+"""Read git objects through long-running `git cat-file` processes."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import logging
+import threading
+import time
+
+from clusterfuzz import common
+
+
+logger = logging.getLogger('clusterfuzz')
+
+# The running processes, keyed by (source_dir, option).
+CAT_FILES = {}
+
+
+@contextlib.contextmanager
+def timed(description, source_dir):
+  """Log how long a git query takes."""
+  start_time = time.time()
+  try:
+    yield
+  finally:
+    logger.debug('%s in %s took %.1f ms.', description, source_dir,
+                 (time.time() - start_time) * 1000)
+
+
+class CatFile(object):
+  """A `git cat-file --batch` (or `--batch-check`) process that stays open,
+    so that looking up many objects doesn't start a git process for each."""
+
+  def __init__(self, source_dir, option='--batch'):
+    self.source_dir = source_dir
+    self.option = option
+    self.proc = None
+    self.lock = threading.Lock()
+
+  def start(self):
+    """Start (or restart) the git process. Its stderr is never read, so it's
+      discarded rather than left to fill up its pipe."""
+    self.proc = common.start_execute(
+        'git', 'cat-file %s 2>/dev/null' % self.option, self.source_dir,
+        print_command=False, stdin=common.BlockStdin())
+
+  def request(self, name):
+    """Look up an object. Returns the fields of its header (sha, type and
+      size) and, with --batch, its content. Returns (None, None) if the
+      object doesn't exist."""
+    if not name or '\n' in name:
+      return None, None
+
+    with self.lock, timed('Looking up %s' % name, self.source_dir):
+      if not self.proc or self.proc.poll() is not None:
+        self.start()
+      self.proc.stdin.write(name + '\n')
+      self.proc.stdin.flush()
+
+      fields = self.proc.stdout.readline().split()
+      if len(fields) != 3:
+        # The object is missing, ambiguous, or git has died.
+        return None, None
+      if self.option != '--batch':
+        return fields, None
+
+      content = self.proc.stdout.read(int(fields[2]))
+      self.proc.stdout.read(1)
+      return fields, content
+
+  def read(self, name):
+    """Return the content of an object, or None if it doesn't exist."""
+    return self.request(name)[1]
+
+  def close(self):
+    """Stop the git process."""
+    if self.proc and self.proc.poll() is None:
+      self.proc.stdin.close()
+      self.proc.wait()
+    self.proc = None
+
+
+def get_cat_file(source_dir, option='--batch'):
+  """Return the running CatFile of a checkout."""
+  key = (source_dir, option)
+  if key not in CAT_FILES:
+    CAT_FILES[key] = CatFile(source_dir, option)
+  return CAT_FILES[key]
+
+
+def read_file(source_dir, sha, path):
+  """Return the content of a file at a commit, or None if either the commit
+    or the file doesn't exist."""
+  try:
+    return get_cat_file(source_dir).read('%s:%s' % (sha, path))
+  except (IOError, OSError) as e:
+    logger.debug('Cannot read %s:%s from %s: %s', sha, path, source_dir, e)
+    return None
+
+
+def get_object_sha(name, source_dir):
+  """Return the sha of an object (e.g. a ref, or an abbreviated sha), or None
+    if it doesn't exist."""
+  try:
+    fields, _ = get_cat_file(source_dir, '--batch-check').request(name)
+  except (IOError, OSError) as e:
+    logger.debug('Cannot look up %s in %s: %s', name, source_dir, e)
+    return None
+  return fields[0] if fields else None
+
+
+def sha_exists(sha, source_dir):
+  """Check if sha exists."""
+  return get_object_sha(sha, source_dir) is not None
+
+
+def get_current_sha(source_dir):
+  """Return the current sha."""
+  return get_object_sha('HEAD', source_dir)
+
+
+def is_repo_dirty(source_dir):
+  """Returns true if the source dir has uncommitted changes. git stops at the
+    first change, and uses the fsmonitor if the checkout has one."""
+  with timed('Checking for changes', source_dir):
+    returncode, _ = common.execute(
+        'git', 'diff --quiet', source_dir, print_command=False,
+        print_output=False, exit_on_error=False)
+  return returncode != 0
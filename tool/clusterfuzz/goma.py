@@ -0,0 +1,147 @@
+"""Check that goma is healthy before and while building with it."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import logging
+import os
+import signal
+import threading
+import time
+
+import requests
+
+
+PORT_VARIABLE = 'GOMA_COMPILER_PROXY_PORT'
+DEFAULT_PORT = 8088
+# compiler_proxy answers `ok` when it can reach the backend, and otherwise
+# says what's wrong (e.g. `running: failed to connect to backend servers`).
+HEALTHZ_URL = 'http://127.0.0.1:%d/healthz'
+PROBE_TIMEOUT = 10
+# A probe slower than this means that compiler_proxy is overloaded.
+SLOW_PROBE_SECONDS = 2.0
+# compiler_proxy might take a few seconds to connect after it's started.
+STARTUP_PROBES = 3
+PROBE_INTERVAL = 30
+# How long goma can stay unhealthy during a build before the build is
+# stopped and done locally instead.
+UNHEALTHY_SECONDS_VARIABLE = 'CF_GOMA_UNHEALTHY_SECONDS'
+DEFAULT_UNHEALTHY_SECONDS = 600
+
+logger = logging.getLogger('clusterfuzz')
+
+Probe = collections.namedtuple('Probe', ['healthy', 'latency', 'status'])
+
+
+def probe():
+  """Ask compiler_proxy whether it's healthy, and time its answer."""
+  url = HEALTHZ_URL % int(os.environ.get(PORT_VARIABLE, DEFAULT_PORT))
+  start_time = time.time()
+  try:
+    response = requests.get(url, timeout=PROBE_TIMEOUT)
+    status = response.text.strip()
+    healthy = response.status_code == 200 and status.startswith('ok')
+  except requests.exceptions.RequestException as e:
+    status = str(e)
+    healthy = False
+
+  latency = time.time() - start_time
+  if healthy and latency > SLOW_PROBE_SECONDS:
+    status = 'answering slowly'
+    healthy = False
+  return Probe(healthy, latency, status)
+
+
+def check(probes=STARTUP_PROBES, interval=1):
+  """Return whether goma is healthy before a build. It's probed a few
+    times, because compiler_proxy might have just been started."""
+  for attempt in xrange(probes):
+    if attempt:
+      time.sleep(interval)
+    result = probe()
+    logger.debug('Goma probe: %s in %.2fs.', result.status, result.latency)
+    if result.healthy:
+      return True
+
+  logger.info('Goma is unhealthy (%s, %.1fs to answer).', result.status,
+              result.latency)
+  return False
+
+
+def get_unhealthy_seconds():
+  return float(os.environ.get(
+      UNHEALTHY_SECONDS_VARIABLE, DEFAULT_UNHEALTHY_SECONDS))
+
+
+class Monitor(object):
+  """Probe goma in the background while a build runs, and stop the build
+    if goma stays unhealthy for too long. Does nothing if not enabled (i.e.
+    the build doesn't use goma)."""
+
+  def __init__(self, proc, enabled=True, interval=PROBE_INTERVAL,
+               unhealthy_seconds=None):
+    self.proc = proc
+    self.enabled = enabled
+    self.interval = interval
+    self.unhealthy_seconds = (
+        get_unhealthy_seconds() if unhealthy_seconds is None
+        else unhealthy_seconds)
+    self.unhealthy_since = None
+    self.tripped = False
+    self.stopped = threading.Event()
+    self.thread = None
+
+  def check(self):
+    """Probe goma once, and stop the build if it has been unhealthy for
+      too long."""
+    result = probe()
+    if result.healthy:
+      if self.unhealthy_since is not None:
+        logger.info('Goma is healthy again.')
+      self.unhealthy_since = None
+      return
+
+    now = time.time()
+    if self.unhealthy_since is None:
+      self.unhealthy_since = now
+      logger.info('Goma is unhealthy (%s, %.1fs to answer). The build will '
+                  'be done locally if it stays so for %.0fs.', result.status,
+                  result.latency, self.unhealthy_seconds)
+    elif now - self.unhealthy_since >= self.unhealthy_seconds:
+      logger.info('Goma has been unhealthy for %.0fs. Stopping the build.',
+                  now - self.unhealthy_since)
+      self.tripped = True
+      try:
+        os.killpg(self.proc.pid, signal.SIGTERM)
+      except OSError as e:
+        logger.debug('Cannot stop the build: %s', e)
+
+  def run(self):
+    """Probe until stopped, or until the build is stopped."""
+    while not self.stopped.wait(self.interval):
+      self.check()
+      if self.tripped:
+        return
+
+  def __enter__(self):
+    if self.enabled:
+      self.thread = threading.Thread(target=self.run)
+      self.thread.daemon = True
+      self.thread.start()
+    return self
+
+  def __exit__(self, *_):
+    self.stopped.set()
+    if self.thread:
+      self.thread.join()
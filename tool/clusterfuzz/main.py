@@ -68,14 +68,34 @@ def execute(argv=None):
       help='Edit args.gn before building and target arguments before running.')
   reproduce.add_argument(
       '--skip-deps', action='store_true', default=False,
-      help=('Skip installing dependencies: '
-            'gclient sync, gclient runhooks, install-build-deps.sh, and etc.'))
+      help=('Skip installing dependencies even if DEPS has changed: '
+            'gclient sync, gclient runhooks, install-build-deps.sh, and etc. '
+            'They are skipped anyway when nothing has changed.'))
   reproduce.add_argument(
       '--enable-debug', action='store_true', default=False,
       help=(
           'Build Chrome with full debug symbols by injecting '
           '`sanitizer_keep_symbols = true` and `is_debug = true` to args.gn. '
           'Ready to debug with GDB.'))
+  reproduce.add_argument(
+      '--worktree', action='store_true', default=False,
+      help=('Build in a managed git worktree at the revision specified in the '
+            'testcase, instead of switching the source repository to it. '
+            'Every worktree syncs its own DEPS repositories through a git '
+            'cache that the worktrees share, so --skip-deps only works with '
+            'a worktree that has been synced.'))
+  reproduce.add_argument(
+      '--fast-build', action='store_true', default=False,
+      help=('Build faster by overriding args.gn with line-table symbols and '
+            'without extra targets. The sanitizer args are never changed. If '
+            'the crash does not reproduce, it is rebuilt with the original '
+            'args.gn.'))
+  reproduce.add_argument(
+      '--reuse-nearest', action='store_true', default=False,
+      help=('Reuse the cached build of a nearby revision if none of the files '
+            'changed in between affect the target, instead of building. '
+            'Builds made with it record the files that they are built '
+            'from.'))
 
   args = parser.parse_args(argv)
   command = importlib.import_module('clusterfuzz.commands.%s' % args.command)
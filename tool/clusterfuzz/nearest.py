@@ -0,0 +1,93 @@
+"""Reuse the cached build of a nearby revision if its target is built from
+the same files."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+
+from clusterfuzz import artifacts
+from clusterfuzz import common
+
+
+MAX_DISTANCE = 1000
+MAX_CANDIDATES = 3
+# A change to DEPS (which rolls the dependencies, whose changes don't show
+# in the diff), to a build file or to the toolchain (e.g. a clang roll in
+# update.py, which isn't an input of any target) might change how any
+# target is built, so it always needs a build.
+BUILD_FILE_NAMES = ['DEPS']
+BUILD_FILE_EXTENSIONS = ['.gn', '.gni']
+TOOLCHAIN_DIRS = ('build/toolchain/', 'tools/clang/scripts/')
+EXAMPLE_PATHS = 3
+
+logger = logging.getLogger('clusterfuzz')
+
+
+def get_changed_paths(source_dir, old_sha, new_sha):
+  """Return the files changed between two commits, or None if they can't be
+    compared. A renamed file is listed under both names."""
+  returncode, output = common.execute(
+      'git', 'diff --name-only --no-renames %s %s' % (old_sha, new_sha),
+      source_dir, print_command=False, print_output=False,
+      exit_on_error=False)
+  if returncode != 0:
+    return None
+  return [path for path in output.splitlines() if path]
+
+
+def get_blocking_paths(changed_paths, inputs):
+  """Return the changed paths that prevent reusing a build: the files that
+    it was built from, the build files and the toolchain scripts."""
+  return [
+      path for path in changed_paths
+      if (path in inputs or os.path.basename(path) in BUILD_FILE_NAMES or
+          os.path.splitext(path)[1] in BUILD_FILE_EXTENSIONS or
+          path.startswith(TOOLCHAIN_DIRS))]
+
+
+def find(source_dir, sha, revision, variant):
+  """Return the key of the nearest cached build of the variant that can be
+    used for sha, or None if there is none. Every decision is logged."""
+  candidates = artifacts.get_nearest(variant, revision, MAX_DISTANCE)
+  if not candidates:
+    logger.info('No build within %d revisions of r%s is cached.',
+                MAX_DISTANCE, revision)
+    return None
+
+  for key, meta in candidates[:MAX_CANDIDATES]:
+    inputs = artifacts.read_inputs(key)
+    changed_paths = None
+    if inputs is not None:
+      changed_paths = get_changed_paths(source_dir, meta['sha'], sha)
+    if changed_paths is None:
+      logger.info('Cannot tell what r%s was built from, or what changed '
+                  'since. Not reusing its build.', meta['revision'])
+      continue
+
+    blocking_paths = get_blocking_paths(changed_paths, inputs)
+    if blocking_paths:
+      logger.info(
+          'Not reusing the build of r%s: %d of the %d files changed between '
+          'it and r%s affect it (e.g. %s).', meta['revision'],
+          len(blocking_paths), len(changed_paths), revision,
+          ', '.join(blocking_paths[:EXAMPLE_PATHS]))
+      continue
+
+    logger.info(
+        'Reusing the build of r%s for r%s: none of the %d files changed in '
+        'between affect it. No need to build.', meta['revision'], revision,
+        len(changed_paths))
+    return key
+  return None
@@ -0,0 +1,181 @@
+"""Ask ninja what a build would do, and how long it took before."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import logging
+import os
+import re
+
+from clusterfuzz import common
+
+
+NINJA_LOG_FILENAME = '.ninja_log'
+# The status line of every edge in a dry run, e.g. `[3/120] CXX obj/a.o`.
+STATUS_FORMAT = '[%f/%t] '
+STATUS_PATTERN = re.compile(r'^\[(\d+)/(\d+)\] (.*)$')
+
+logger = logging.getLogger('clusterfuzz')
+
+Plan = collections.namedtuple('Plan', ['edges', 'estimate'])
+# An edge's output in .ninja_log, with times in seconds since ninja started.
+LogEntry = collections.namedtuple('LogEntry', ['start', 'end', 'output'])
+
+
+def parse_log_lines(lines):
+  """Parse lines of .ninja_log (format v5: start and end in ms, mtime,
+    output and command hash) into LogEntry."""
+  entries = []
+  for line in lines:
+    fields = line.rstrip('\n').split('\t')
+    if line.startswith('#') or len(fields) != 5:
+      continue
+    try:
+      entries.append(LogEntry(
+          start=int(fields[0]) / 1000.0, end=int(fields[1]) / 1000.0,
+          output=fields[3]))
+    except ValueError:
+      continue
+  return entries
+
+
+def get_log_path(build_dir):
+  return os.path.join(build_dir, NINJA_LOG_FILENAME)
+
+
+def read_log(build_dir):
+  """Return the duration (in seconds) of the last run of every output in
+    .ninja_log."""
+  path = get_log_path(build_dir)
+  if not os.path.exists(path):
+    return {}
+
+  with open(path) as f:
+    return {entry.output: entry.end - entry.start
+            for entry in parse_log_lines(f)}
+
+
+def get_log_position(build_dir):
+  """Return where the next build starts appending to .ninja_log: the file
+    and its size."""
+  path = get_log_path(build_dir)
+  if not os.path.exists(path):
+    return None, 0
+  stat = os.stat(path)
+  return stat.st_ino, stat.st_size
+
+
+def read_new_log_entries(build_dir, position):
+  """Return the entries appended to .ninja_log since position. Returns None
+    if ninja has rewritten the log (it recompacts it when it has many stale
+    entries), because the new entries can't be told apart then."""
+  inode, size = position
+  path = get_log_path(build_dir)
+  if not os.path.exists(path):
+    return []
+
+  stat = os.stat(path)
+  if inode is not None and (stat.st_ino != inode or stat.st_size < size):
+    return None
+  with open(path) as f:
+    f.seek(size if inode is not None else 0)
+    return parse_log_lines(f)
+
+
+def get_source_path(build_dir, path, source_dir):
+  """Return a path that ninja printed relative to build_dir, relative to
+    source_dir instead. Returns None for a file outside of the source (e.g.
+    a system header) or inside the build dir (e.g. a generated file)."""
+  path = os.path.relpath(os.path.join(build_dir, path), source_dir)
+  build_path = os.path.relpath(build_dir, source_dir)
+  if (path.split(os.sep)[0] == os.pardir or
+      (path + os.sep).startswith(build_path + os.sep)):
+    return None
+  return path
+
+
+def get_inputs(build_dir, target, source_dir):
+  """Return the files of source_dir that the target is built from: the
+    inputs of its edges (`ninja -t inputs`, since ninja 1.11), and the
+    headers that the compiler reported in ninja's deps log. Returns None if
+    ninja can't list them."""
+  returncode, output = common.execute(
+      'ninja', '-C %s -t inputs %s' % (build_dir, target), source_dir,
+      print_command=False, print_output=False, exit_on_error=False)
+  if returncode != 0:
+    logger.debug('Cannot list the inputs of %s in %s.', target, build_dir)
+    return None
+  paths = set(output.splitlines())
+
+  # The deps log of a large build is too big to hold in memory, so it's read
+  # as ninja prints it. The deps of every output are indented.
+  proc = common.start_execute(
+      'ninja', '-C %s -t deps' % build_dir, source_dir, print_command=False,
+      stdin=common.BlockStdin(), redirect_stderr_to_stdout=True)
+  for line in proc.stdout:
+    if line.startswith(' '):
+      paths.add(line.strip())
+  if proc.wait() != 0:
+    logger.debug('Cannot read the deps log in %s.', build_dir)
+    return None
+
+  source_paths = (
+      get_source_path(build_dir, path, source_dir) for path in paths if path)
+  return set(path for path in source_paths if path)
+
+
+def parse_dry_run(output):
+  """Return the descriptions of the edges that a dry run would run."""
+  descriptions = []
+  for line in output.splitlines():
+    match = STATUS_PATTERN.match(line.strip())
+    if match:
+      descriptions.append(match.group(3))
+  return descriptions
+
+
+def estimate(descriptions, durations, jobs):
+  """Estimate how long the edges take with `jobs` running at once. An edge
+    whose description names an output (e.g. `CXX obj/a.o`) takes as long as
+    that output took last time, and any other edge takes the average."""
+  if not descriptions:
+    return 0.0
+  average = 0.0
+  if durations:
+    average = sum(durations.itervalues()) / len(durations)
+
+  edge_durations = []
+  for description in descriptions:
+    tokens = description.split()
+    output = tokens[1] if len(tokens) > 1 else None
+    edge_durations.append(durations.get(output, average))
+  return max(max(edge_durations), sum(edge_durations) / max(jobs, 1))
+
+
+def plan(build_dir, target, source_dir, jobs):
+  """Dry-run ninja, and return the number of dirty edges with an estimate
+    of how long building them takes. Returns None if the dry run fails."""
+  returncode, output = common.execute(
+      'ninja', ('-C %s -n %s' % (build_dir, target or '')).strip(),
+      source_dir, print_command=False, print_output=False,
+      exit_on_error=False,
+      env={'NINJA_STATUS': STATUS_FORMAT})
+  if returncode != 0:
+    logger.debug('Cannot dry-run ninja in %s.', build_dir)
+    return None
+
+  descriptions = parse_dry_run(output)
+  return Plan(
+      edges=len(descriptions),
+      estimate=estimate(descriptions, read_log(build_dir), jobs))
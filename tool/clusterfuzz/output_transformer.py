@@ -59,6 +59,40 @@ class Identity(Base):
     self.write('')
 
 
+class Silent(Base):
+  """Print nothing."""
+
+  def process(self, string):
+    """Process string and send to output_fn."""
+    pass
+
+  def flush(self):
+    """Send the residue to output_fn."""
+    pass
+
+
+class Prefix(Base):
+  """Print whole lines, each with a prefix, so that the output of commands
+    running at the same time can be told apart."""
+
+  def __init__(self, prefix):
+    self.prefix = prefix
+    self.current_line = ''
+
+  def process(self, string):
+    """Process string and send to output_fn."""
+    lines = (self.current_line + string).split('\n')
+    self.current_line = lines.pop()
+    if lines:
+      self.write(''.join('%s%s\n' % (self.prefix, line) for line in lines))
+
+  def flush(self):
+    """Send the residue to output_fn."""
+    if self.current_line:
+      self.write('%s%s\n' % (self.prefix, self.current_line))
+    self.current_line = ''
+
+
 def contains_failure(lines):
   """Check if any line starts with 'FAILED'."""
   for line in lines:
@@ -0,0 +1,270 @@
+"""Extract zip archives while they are being downloaded."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import multiprocessing.pool
+import os
+import shutil
+import stat
+import threading
+import zipfile
+
+from clusterfuzz import common
+from clusterfuzz import downloader
+
+
+READ_AHEAD = 8 * 1024 * 1024
+# The end of central directory record, with room for the longest comment.
+TAIL_SIZE = 64 * 1024 + 22
+
+logger = logging.getLogger('clusterfuzz')
+
+
+class RangeFile(object):
+  """A read-only, seekable file over HTTP ranges, which lets zipfile read an
+    archive without downloading all of it. Reads are served from a read-ahead
+    buffer that never goes past `limit`, and from `tail` (a (start, data)
+    pair) when the central directory has already been fetched."""
+
+  def __init__(self, url, headers, size, tail=None):
+    self.url = url
+    self.headers = headers
+    self.size = size
+    self.limit = size
+    self.position = 0
+    self.buffer_start = 0
+    self.buffer = ''
+    self.tail_start, self.tail = tail or (size, '')
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    """Move the position."""
+    if whence == os.SEEK_CUR:
+      offset += self.position
+    elif whence == os.SEEK_END:
+      offset += self.size
+    self.position = offset
+
+  def tell(self):
+    """Return the position."""
+    return self.position
+
+  def read(self, n=-1):
+    """Read n bytes, or until the end if n is negative."""
+    if n is None or n < 0:
+      n = self.size - self.position
+    n = min(n, self.size - self.position)
+
+    chunks = []
+    while n > 0:
+      data = self.read_buffered(n)
+      chunks.append(data)
+      self.position += len(data)
+      n -= len(data)
+    return ''.join(chunks)
+
+  def read_buffered(self, n):
+    """Read at most n bytes from the tail or the buffer, refilling the buffer
+      if needed."""
+    if self.position >= self.tail_start:
+      offset = self.position - self.tail_start
+      return self.tail[offset:offset + n]
+
+    offset = self.position - self.buffer_start
+    if not 0 <= offset < len(self.buffer):
+      end = max(self.position + n,
+                min(self.position + READ_AHEAD, self.limit))
+      end = min(end, self.tail_start, self.size)
+      self.buffer = downloader.read_range(
+          self.url, self.headers, self.position, end - 1)
+      self.buffer_start = self.position
+      offset = 0
+    return self.buffer[offset:offset + n]
+
+
+def get_relative_path(info, root):
+  """Return a member's path relative to root, or None if it's outside root.
+    Like zipfile, this drops empty and parent components."""
+  components = [c for c in info.filename.split('/')
+                if c not in ['', '.', '..']]
+  root_components = [c for c in root.split('/') if c]
+  if components[:len(root_components)] != root_components:
+    return None
+  return '/'.join(components[len(root_components):]) or None
+
+
+def extract_member(zip_file, info, path):
+  """Extract a member to path and restore its permissions (or make it a
+    symlink), which is what unzip would do and zipfile doesn't."""
+  mode = info.external_attr >> 16
+  if info.filename.endswith('/'):
+    common.ensure_dir(path)
+  elif stat.S_ISLNK(mode):
+    common.delete_if_exists(path)
+    os.symlink(zip_file.read(info), path)
+  else:
+    source = zip_file.open(info)
+    with open(path, 'wb') as f:
+      shutil.copyfileobj(source, f, downloader.DOWNLOAD_CHUNK_SIZE)
+
+  if mode and not stat.S_ISLNK(mode):
+    os.chmod(path, stat.S_IMODE(mode))
+
+
+def get_batches(infos, ends, batch_size):
+  """Group the members (sorted by offset) into batches of about batch_size
+    bytes, which are contiguous in the archive. Returns a list of (members,
+    end offset) pairs. A worker reads its batch sequentially, so read-ahead
+    never fetches anything outside of it."""
+  batches = []
+  batch = []
+  for info in infos:
+    if batch and (
+        info.header_offset != ends[batch[-1].header_offset] or
+        info.header_offset - batch[0].header_offset >= batch_size):
+      batches.append((batch, ends[batch[-1].header_offset]))
+      batch = []
+    batch.append(info)
+
+  if batch:
+    batches.append((batch, ends[batch[-1].header_offset]))
+  return batches
+
+
+class RemoteZip(object):
+  """A zip on a server that supports ranges. Only its central directory is
+    fetched up front, and then any of its members can be extracted without
+    downloading the rest. `members` maps the paths relative to root to the
+    members' infos."""
+
+  def __init__(self, url, headers, size, root=''):
+    self.url = url
+    self.headers = headers
+    self.size = size
+
+    tail_start = max(0, size - TAIL_SIZE)
+    range_file = RangeFile(url, headers, size, (
+        tail_start, downloader.read_range(url, headers, tail_start, size - 1)))
+    zip_file = zipfile.ZipFile(range_file)
+    infos = sorted(zip_file.infolist(), key=lambda info: info.header_offset)
+
+    # A member's data ends where the next member (or the central directory)
+    # starts.
+    offsets = [info.header_offset for info in infos] + [zip_file.start_dir]
+    self.ends = dict(zip(offsets, offsets[1:]))
+
+    self.members = {}
+    for info in infos:
+      path = get_relative_path(info, root)
+      if path:
+        self.members[path] = info
+
+    # The workers share everything fetched so far (the central directory and
+    # the tail) instead of each fetching it again.
+    tail_start = min(tail_start, zip_file.start_dir)
+    range_file.seek(tail_start)
+    self.tail = (tail_start, range_file.read())
+
+  def extract(self, paths, dest_dir):
+    """Extract the members at paths into dest_dir. They are downloaded and
+      extracted concurrently in batches, and never touch the disk as a
+      zip. Returns the number of bytes downloaded."""
+    paths_by_offset = {self.members[path].header_offset: path
+                       for path in paths}
+    infos = sorted((self.members[path] for path in paths),
+                   key=lambda info: info.header_offset)
+
+    # Otherwise, the workers would race with each other to create them.
+    for path in paths:
+      common.ensure_dir(os.path.dirname(os.path.join(dest_dir, path)))
+
+    batches = get_batches(infos, self.ends, downloader.RANGE_SIZE)
+    size = sum(end - batch[0].header_offset for batch, end in batches)
+    logger.debug(
+        'Downloading and extracting %d files (%.1f MB) in %d batches...',
+        len(infos), size / 1024.0 / 1024.0, len(batches))
+
+    local = threading.local()
+
+    def extract_batch(batch):
+      """Extract a batch with this thread's own zip file."""
+      members, end = batch
+      if not hasattr(local, 'zip_file'):
+        # The central directory is served from tail, so this is free.
+        local.range_file = RangeFile(
+            self.url, self.headers, self.size, self.tail)
+        local.zip_file = zipfile.ZipFile(local.range_file)
+      local.range_file.limit = end
+
+      for info in members:
+        extract_member(
+            local.zip_file, info,
+            os.path.join(dest_dir, paths_by_offset[info.header_offset]))
+
+    pool = multiprocessing.pool.ThreadPool(
+        min(downloader.RANGE_WORKERS, len(batches) or 1))
+    try:
+      for _ in pool.imap_unordered(extract_batch, batches):
+        pass
+    finally:
+      pool.terminate()
+      pool.join()
+
+    return size
+
+  def extract_in_background(self, paths, dest_dir, callback):
+    """Extract the members at paths in a daemon thread, and then call
+      callback. Nothing is called if the extraction fails, and what either
+      raises is logged."""
+
+    def run():
+      """Extract and call back."""
+      try:
+        self.extract(paths, dest_dir)
+        callback()
+      except Exception as e:  # pylint: disable=broad-except
+        logger.debug('Background extraction of %s failed: %s', self.url, e)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def unzip(zip_path, dest_dir):
+  """Extract a downloaded zip with unzip. What's already in dest_dir is
+    overwritten without asking."""
+  common.execute(
+      'unzip', '-q -o %s -d %s' % (zip_path, dest_dir),
+      cwd=common.CLUSTERFUZZ_DIR)
+
+
+def open_gcs_object(gcs_object, root=''):
+  """Return a RemoteZip for a probed zip on Google Cloud Storage (see
+    downloader.probe_gcs_object), or None if it has to be downloaded whole (no
+    ranges, or no application default credentials)."""
+  if gcs_object.headers is None or gcs_object.size is None:
+    return None
+  return RemoteZip(gcs_object.url, gcs_object.headers, gcs_object.size, root)
+
+
+def download_and_unzip_gcs_object(url, dest_dir, gcs_object=None):
+  """Download a zip from Google Cloud Storage, and then unzip it into
+    dest_dir. gcs_object is the probe of the zip, if it's been probed
+    already."""
+  saved_file = os.path.join(common.CLUSTERFUZZ_CACHE_DIR, os.path.basename(url))
+  downloader.download_gcs_object(url, saved_file, gcs_object)
+  unzip(saved_file, dest_dir)
+  logger.info('Cleaning up...')
+  os.remove(saved_file)
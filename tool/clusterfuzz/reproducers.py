@@ -13,13 +13,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import HTMLParser
 import json
 import logging
 import os
 import re
 import shutil
+import signal
 import subprocess
+import tempfile
+import threading
 import time
 
 import psutil
@@ -33,8 +37,36 @@ from error import error
 DISABLE_GL_DRAW_ARG = '--disable-gl-drawing-for-tests'
 DEFAULT_GESTURE_TIME = 5
 TEST_TIMEOUT = 30
-USER_DATA_DIR_PATH = '/tmp/clusterfuzz-user-data-dir'
 USER_DATA_DIR_ARG = '--user-data-dir'
+USER_DATA_DIR_PLACEHOLDER = '%USER_DATA_DIR%'
+USER_DATA_DIRS_PATH = '/tmp/clusterfuzz-user-data-dirs'
+USER_DATA_DIR_TEMPLATES_PATH = os.path.join(USER_DATA_DIRS_PATH, 'templates')
+USER_DATA_DIR_CLONES_PATH = os.path.join(USER_DATA_DIRS_PATH, 'clones')
+# The template is the profile of a launch on about:blank, which is stopped
+# once Chrome has written its profile, or after the timeout.
+USER_DATA_DIR_TEMPLATE_ARGS = (
+    '--no-first-run --no-default-browser-check about:blank')
+USER_DATA_DIR_TEMPLATE_TIMEOUT = 10
+# Chrome flushes its profile on SIGTERM, and is killed if it takes longer.
+USER_DATA_DIR_SHUTDOWN_TIMEOUT = 5
+USER_DATA_DIR_POLL_INTERVAL = 0.2
+USER_DATA_DIR_LOCAL_STATE = 'Local State'
+# Only Chrome sets a profile up that is worth a template. Other binaries
+# (e.g. content_shell) never write Local State.
+USER_DATA_DIR_TEMPLATE_BINARIES = ['chrome']
+# Files that tie a profile to the Chrome process that created it. They are
+# removed before a profile becomes a template.
+USER_DATA_DIR_VOLATILE_PATHS = [
+    'SingletonCookie',
+    'SingletonLock',
+    'SingletonSocket',
+    'Crashpad',
+    os.path.join('Default', 'Current Session'),
+    os.path.join('Default', 'Current Tabs'),
+    os.path.join('Default', 'Last Session'),
+    os.path.join('Default', 'Last Tabs'),
+    os.path.join('Default', 'Sessions'),
+]
 
 logger = logging.getLogger('clusterfuzz')
 
@@ -127,19 +159,152 @@ def serialize_sanitizer_options(options):
 
 
 def ensure_user_data_dir_if_needed(args, require_user_data_dir):
-  """Ensure the right user-data-dir."""
+  """Ensure the right user-data-dir. The placeholder is replaced with a fresh
+    profile on every run (see UserDataDir)."""
   if not require_user_data_dir and USER_DATA_DIR_ARG not in args:
     return args
 
   # Remove --user-data-dir-arg if exist.
   args = re.sub('%s[^ ]+' % USER_DATA_DIR_ARG, '', args)
-  common.delete_if_exists(USER_DATA_DIR_PATH)
-  return '%s %s=%s' % (args, USER_DATA_DIR_ARG, USER_DATA_DIR_PATH)
+  return '%s %s=%s' % (args, USER_DATA_DIR_ARG, USER_DATA_DIR_PLACEHOLDER)
+
+
+def get_user_data_dir_template_path(build_directory):
+  """Return the template profile's location for a build. Profiles aren't
+    shared between builds because Chrome refuses to open a profile created by
+    a newer version."""
+  return os.path.join(
+      USER_DATA_DIR_TEMPLATES_PATH, hashlib.sha1(build_directory).hexdigest())
+
+
+def get_user_data_dir_template_meta_path(template_path):
+  """Return the file that records the build of a template, and whether the
+    template couldn't be created."""
+  return template_path + '.json'
+
+
+def clone_user_data_dir(template_path, path):
+  """Copy the template profile into path. Reflinks are used when the
+    filesystem supports them. Hardlinks are not an option because Chrome
+    rewrites its databases in place, which would corrupt the template."""
+  common.execute(
+      'cp', '-a --reflink=auto %s/. %s' % (template_path, path),
+      USER_DATA_DIRS_PATH, print_command=False, print_output=False)
+
+
+def remove_volatile_user_data_files(path):
+  """Remove the files that shouldn't be carried over to the next run."""
+  for volatile_path in USER_DATA_DIR_VOLATILE_PATHS:
+    full_path = os.path.join(path, volatile_path)
+    # SingletonLock is a dangling symlink, so os.path.exists is not enough.
+    if os.path.isdir(full_path) and not os.path.islink(full_path):
+      shutil.rmtree(full_path)
+    elif os.path.lexists(full_path):
+      os.remove(full_path)
+
+
+def stop_user_data_dir_launch(proc, path, stopped):
+  """Ask Chrome to exit as soon as it has written Local State, or after
+    USER_DATA_DIR_TEMPLATE_TIMEOUT seconds, and kill it if it takes too long.
+    Returns early once stopped is set (i.e. Chrome has exited)."""
+  local_state = os.path.join(path, USER_DATA_DIR_LOCAL_STATE)
+  deadline = time.time() + USER_DATA_DIR_TEMPLATE_TIMEOUT
+  while not os.path.exists(local_state) and time.time() < deadline:
+    if stopped.wait(USER_DATA_DIR_POLL_INTERVAL):
+      return
+
+  for sig, timeout in [(signal.SIGTERM, USER_DATA_DIR_SHUTDOWN_TIMEOUT),
+                       (signal.SIGKILL, None)]:
+    try:
+      os.killpg(proc.pid, sig)
+    except OSError:
+      return
+    if stopped.wait(timeout):
+      return
+
+
+def create_user_data_dir_template(binary_path, build_directory, env):
+  """Launch the build once on about:blank with an empty profile, and save
+    the profile as the template. No testcase is ever loaded in it, so that
+    no testcase's storage (e.g. cookies, localStorage, IndexedDB or service
+    workers) is carried over to the next ones. If Chrome doesn't set the
+    profile up (e.g. it crashed on startup), the failure is recorded so that
+    the next runs of the build don't try again."""
+  template_path = get_user_data_dir_template_path(build_directory)
+  meta_path = get_user_data_dir_template_meta_path(template_path)
+  path = tempfile.mkdtemp(
+      prefix='%d-' % os.getpid(), dir=USER_DATA_DIR_CLONES_PATH)
+  try:
+    proc = common.start_execute(
+        binary_path, '%s=%s %s' % (USER_DATA_DIR_ARG, path,
+                                   USER_DATA_DIR_TEMPLATE_ARGS),
+        os.path.dirname(binary_path), env=env, print_command=False,
+        stdin=common.BlockStdin())
+    stopped = threading.Event()
+    thread = threading.Thread(
+        target=stop_user_data_dir_launch, args=(proc, path, stopped))
+    thread.daemon = True
+    thread.start()
+    try:
+      common.wait_execute(
+          proc, exit_on_error=False, capture_output=False, print_output=False)
+    finally:
+      stopped.set()
+      thread.join()
+
+    if not os.path.exists(os.path.join(path, USER_DATA_DIR_LOCAL_STATE)):
+      logger.debug('Chrome has not created a profile in %s. Not saving a '
+                   'template user-data-dir.', path)
+      common.write_json(
+          meta_path, {'build_directory': build_directory, 'failed': True})
+      return
+
+    remove_volatile_user_data_files(path)
+    common.write_json(meta_path, {'build_directory': build_directory})
+    try:
+      os.rename(path, template_path)
+      logger.debug('Saved %s as the template user-data-dir.', path)
+    except OSError:
+      # Another run has saved its template first.
+      pass
+  finally:
+    common.delete_if_exists(path)
+
+
+def delete_evicted_user_data_dir_templates():
+  """Delete the templates, and the records of failures to create one, whose
+    build directory is gone (e.g. it has been evicted from its cache)."""
+  names = set(os.path.splitext(name)[0]
+              for name in os.listdir(USER_DATA_DIR_TEMPLATES_PATH)
+              if not name.startswith('.'))
+  for name in names:
+    template_path = os.path.join(USER_DATA_DIR_TEMPLATES_PATH, name)
+    meta_path = get_user_data_dir_template_meta_path(template_path)
+    build_directory = common.read_json(meta_path, {}).get('build_directory')
+    if build_directory and os.path.isdir(build_directory):
+      continue
+
+    logger.debug('Deleting the template user-data-dir of %s.',
+                 build_directory or name)
+    common.delete_if_exists(template_path)
+    common.delete_if_exists(meta_path)
+
+
+def delete_stale_user_data_dirs():
+  """Delete the profile clones whose owning process is no longer alive."""
+  for name in os.listdir(USER_DATA_DIR_CLONES_PATH):
+    pid = name.split('-')[0]
+    if pid.isdigit() and psutil.pid_exists(int(pid)):
+      continue
+
+    logger.debug('Deleting the stale user-data-dir: %s', name)
+    common.delete_if_exists(os.path.join(USER_DATA_DIR_CLONES_PATH, name))
 
 
 def update_testcase_path_in_layout_test(
     testcase_path, original_testcase_path, source_directory):
-  """Update the testcase path if it's a layout test."""
+  """Update the testcase path if it's a layout test. The testcase is copied
+    because testcase_path belongs to the testcase cache."""
   search_string = '%sLayoutTests%s' % (os.sep, os.sep)
   if search_string not in original_testcase_path:
     return testcase_path
@@ -149,7 +314,7 @@ def update_testcase_path_in_layout_test(
   new_testcase_path = os.path.join(
       source_directory, 'third_party', 'WebKit', 'LayoutTests',
       original_testcase_path[search_index + len(search_string):])
-  shutil.move(testcase_path, new_testcase_path)
+  shutil.copy(testcase_path, new_testcase_path)
   return new_testcase_path
 
 
@@ -183,6 +348,8 @@ class BaseReproducer(object):
     self.environment = testcase.environment
     self.args = testcase.reproduction_args
     self.binary_path = binary_provider.get_binary_path()
+    # binary_path becomes gdb's when debugging.
+    self.original_binary_path = self.binary_path
     self.build_directory = binary_provider.get_build_directory()
     self.source_directory = binary_provider.source_directory
     self.symbolizer_path = common.get_resource(
@@ -407,6 +574,57 @@ class Xvfb(object):
     self.display.stop()
 
 
+class UserDataDir(object):
+  """Provide a fresh Chrome profile for a single run. The profile is cloned
+    from a clean template of the same build, which is created by the first
+    run of Chrome (see create_user_data_dir_template)."""
+
+  def __init__(self, build_directory, binary_path=None, env=None,
+               disable=False):
+    self.disable = disable
+    self.build_directory = build_directory
+    self.template_path = get_user_data_dir_template_path(build_directory)
+    self.binary_path = binary_path
+    self.env = env
+    self.path = None
+
+  def __enter__(self):
+    if self.disable:
+      return None
+
+    common.ensure_dir(USER_DATA_DIR_CLONES_PATH)
+    common.ensure_dir(USER_DATA_DIR_TEMPLATES_PATH)
+    delete_stale_user_data_dirs()
+    delete_evicted_user_data_dir_templates()
+    if self.should_create_template():
+      create_user_data_dir_template(
+          self.binary_path, self.build_directory, self.env)
+
+    # The pid prefix lets other runs know when the clone becomes stale.
+    self.path = tempfile.mkdtemp(
+        prefix='%d-' % os.getpid(), dir=USER_DATA_DIR_CLONES_PATH)
+    if os.path.isdir(self.template_path):
+      clone_user_data_dir(self.template_path, self.path)
+    return self.path
+
+  def should_create_template(self):
+    """Whether the template is missing, and a previous attempt hasn't
+      failed for the build."""
+    if (not self.binary_path or os.path.basename(self.binary_path) not in
+        USER_DATA_DIR_TEMPLATE_BINARIES):
+      return False
+    if os.path.isdir(self.template_path):
+      return False
+    meta = common.read_json(
+        get_user_data_dir_template_meta_path(self.template_path), {})
+    return not meta.get('failed')
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    if self.disable:
+      return
+    common.delete_if_exists(self.path)
+
+
 class LinuxChromeJobReproducer(BaseReproducer):
   """Adds and extre pre-build step to BaseReproducer."""
 
@@ -523,23 +741,30 @@ class LinuxChromeJobReproducer(BaseReproducer):
   def reproduce_crash(self):
     """Reproduce the crash, running gestures if necessary."""
 
+    use_user_data_dir = USER_DATA_DIR_PLACEHOLDER in self.args
     with Xvfb(self.options.disable_xvfb) as display_name:
       self.environment['DISPLAY'] = display_name
-
-      # stdin needs to be UserStdin. Otherwise, it wouldn't work with gdb.
-      process = common.start_execute(
-          self.binary_path, self.args,
-          self.build_directory, env=self.environment,
-          stdin=common.UserStdin(),
-          redirect_stderr_to_stdout=True)
-
-      if self.gestures:
-        self.run_gestures(process, display_name)
-
-      # read_buffer_length needs to be 1. Otherwise, it wouldn't work well with
-      # gdb.
-      err, out = common.wait_execute(
-          process, exit_on_error=False, timeout=self.timeout,
-          stdout_transformer=output_transformer.Identity(),
-          read_buffer_length=1)
-      return err, self.post_run_symbolize(out)
+      with UserDataDir(self.build_directory, self.original_binary_path,
+                       self.environment,
+                       disable=not use_user_data_dir) as user_data_dir:
+        args = self.args
+        if use_user_data_dir:
+          args = args.replace(USER_DATA_DIR_PLACEHOLDER, user_data_dir)
+
+        # stdin needs to be UserStdin. Otherwise, it wouldn't work with gdb.
+        process = common.start_execute(
+            self.binary_path, args,
+            self.build_directory, env=self.environment,
+            stdin=common.UserStdin(),
+            redirect_stderr_to_stdout=True)
+
+        if self.gestures:
+          self.run_gestures(process, display_name)
+
+        # read_buffer_length needs to be 1. Otherwise, it wouldn't work well
+        # with gdb.
+        err, out = common.wait_execute(
+            process, exit_on_error=False, timeout=self.timeout,
+            stdout_transformer=output_transformer.Identity(),
+            read_buffer_length=1)
+        return err, self.post_run_symbolize(out)
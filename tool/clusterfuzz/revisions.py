@@ -0,0 +1,219 @@
+"""Resolve commit positions (revisions) to git shas."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+import urllib
+
+import urlfetch
+
+from clusterfuzz import common
+from clusterfuzz import git_batch
+
+
+REVISIONS_FILE = os.path.join(common.CLUSTERFUZZ_CACHE_DIR, 'revisions.json')
+COMMIT_POSITIONS_DIR = os.path.join(
+    common.CLUSTERFUZZ_CACHE_DIR, 'commit_positions')
+COMMIT_POSITION_PATTERN = re.compile(
+    r'^Cr-Commit-Position: refs/heads/(?:master|main)@\{#(\d+)\}$',
+    re.MULTILINE)
+SCANNED_REFS = ['origin/master', 'origin/main', 'HEAD']
+# A lookup scans at most MAX_SCANNED_COMMITS commits, SCAN_CHUNK_SIZE at a
+# time, before cr-rev is asked instead.
+SCAN_CHUNK_SIZE = 1000
+MAX_SCANNED_COMMITS = 10000
+LOCK_FILE = os.path.join(common.CLUSTERFUZZ_CACHE_DIR, 'revisions.lock')
+
+logger = logging.getLogger('clusterfuzz')
+
+
+@contextlib.contextmanager
+def lock():
+  """Serialize the updates of the revisions and of the commit position
+    indexes across processes."""
+  common.ensure_dir(os.path.dirname(LOCK_FILE))
+  with open(LOCK_FILE, 'w') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    yield
+
+
+def build_revision_to_sha_url(revision, repo):
+  return ('https://cr-rev.appspot.com/_ah/api/crrev/v1/get_numbering?%s' %
+          urllib.urlencode({
+              'number': revision,
+              'numbering_identifier': 'refs/heads/master',
+              'numbering_type': 'COMMIT_POSITION',
+              'project': 'chromium',
+              'repo': repo}))
+
+
+def fetch_sha(revision, repo):
+  """Ask cr-rev for the sha of a revision."""
+  response = urlfetch.fetch(build_revision_to_sha_url(revision, repo))
+  return json.loads(response.body)['git_sha']
+
+
+def git(args, source_dir):
+  """Run a git command quietly. Returns None if it fails."""
+  returncode, output = common.execute(
+      'git', args, source_dir, print_command=False, print_output=False,
+      exit_on_error=False)
+  if returncode != 0:
+    return None
+  return output
+
+
+def get_scanned_ref(source_dir):
+  """Return the sha of the ref whose history is scanned."""
+  for ref in SCANNED_REFS:
+    sha = git_batch.get_object_sha('%s^{commit}' % ref, source_dir)
+    if sha:
+      return sha
+  return None
+
+
+def parse_log(output):
+  """Parse `git log --format=%H%x00%B%x00` into (sha, commit position or
+    None) pairs, newest first."""
+  fields = output.split('\0')
+  commits = []
+  for i in xrange(0, len(fields) - 1, 2):
+    sha = fields[i].strip()
+    match = COMMIT_POSITION_PATTERN.search(fields[i + 1])
+    commits.append((sha, int(match.group(1)) if match else None))
+  return commits
+
+
+def scan(source_dir, revision_range, max_count, skip=0):
+  """Return (sha, commit position) of the first-parent history in
+    revision_range, newest first."""
+  output = git(
+      'log --first-parent --format=%%H%%x00%%B%%x00 -n %d --skip=%d %s' % (
+          max_count, skip, revision_range), source_dir)
+  return parse_log(output or '')
+
+
+def count(source_dir, revision_range):
+  """Return the number of commits in the first-parent history of
+    revision_range, which is much cheaper than scanning them."""
+  output = git(
+      'rev-list --first-parent --count %s' % revision_range, source_dir)
+  return int(output) if output else 0
+
+
+def add_positions(index, commits):
+  """Add the commit positions of commits to index."""
+  for sha, position in commits:
+    if position is not None:
+      index['positions'][str(position)] = sha
+
+
+def get_index_path(repo):
+  """Return the commit position index of a repo."""
+  return os.path.join(COMMIT_POSITIONS_DIR, '%s.json' % repo.replace('/', '_'))
+
+
+def update_index(index, revision, source_dir, head):
+  """Extend the index forwards to head, and then backwards in chunks until
+    it covers revision."""
+  scanned = 0
+  if index['newest'] != head:
+    revision_range = '%s..%s' % (index['newest'], head)
+    new_count = count(source_dir, revision_range) if index['newest'] else 0
+    if not index['newest'] or new_count > MAX_SCANNED_COMMITS:
+      # Too far behind to stay contiguous, so start over from head.
+      index['positions'] = {}
+      index['oldest'] = None
+      revision_range = head
+      new_count = SCAN_CHUNK_SIZE
+
+    for skip in xrange(0, new_count, SCAN_CHUNK_SIZE):
+      commits = scan(source_dir, revision_range, SCAN_CHUNK_SIZE, skip)
+      add_positions(index, commits)
+      scanned += len(commits)
+      if revision_range == head and commits:
+        index['oldest'] = commits[-1][0]
+    index['newest'] = head
+
+  while str(revision) not in index['positions'] and index['oldest']:
+    # The revision is missing from the scanned range (or newer than it).
+    # Positions are contiguous in the first-parent history, so how far back
+    # it is can be told before scanning.
+    positions = [int(position) for position in index['positions']]
+    if positions and (
+        min(positions) < int(revision) or
+        min(positions) - int(revision) > MAX_SCANNED_COMMITS - scanned):
+      break
+    if scanned >= MAX_SCANNED_COMMITS:
+      break
+
+    commits = scan(source_dir, '%s^' % index['oldest'], SCAN_CHUNK_SIZE)
+    if not commits:
+      break
+    add_positions(index, commits)
+    index['oldest'] = commits[-1][0]
+    scanned += len(commits)
+
+
+def find_in_checkout(revision, repo, source_dir):
+  """Find a revision in the checkout's history by its Cr-Commit-Position
+    footer. The index of commit positions covers a contiguous range of the
+    first-parent history, and it's only extended as far as needed."""
+  head = get_scanned_ref(source_dir)
+  if not head:
+    return None
+
+  index_path = get_index_path(repo)
+  with lock():
+    index = common.read_json(index_path)
+    if (not index or not index['oldest'] or
+        not git_batch.sha_exists(index['oldest'], source_dir)):
+      index = {'newest': None, 'oldest': None, 'positions': {}}
+
+    try:
+      update_index(index, revision, source_dir, head)
+    finally:
+      common.write_json(index_path, index)
+  return index['positions'].get(str(revision))
+
+
+def get_sha(revision, repo, source_dir=None):
+  """Return the sha of a revision. Known revisions are read from disk. Then,
+    the checkout at source_dir (if any) is searched, and only then is
+    cr-rev asked. The answer is stored, so that a revision never hits the
+    network twice."""
+  revisions = common.read_json(REVISIONS_FILE, {})
+  sha = revisions.get(repo, {}).get(str(revision))
+  if sha:
+    return sha
+
+  if source_dir:
+    sha = find_in_checkout(revision, repo, source_dir)
+    if sha:
+      logger.debug('Found r%s of %s in %s.', revision, repo, source_dir)
+
+  if not sha:
+    sha = fetch_sha(revision, repo)
+
+  # Re-read, so that revisions stored by other processes aren't lost.
+  with lock():
+    revisions = common.read_json(REVISIONS_FILE, {})
+    revisions.setdefault(repo, {})[str(revision)] = sha
+    common.write_json(REVISIONS_FILE, revisions)
+  return sha
@@ -0,0 +1,195 @@
+"""Run the steps of a build as a graph of tasks, on a pool of threads."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import multiprocessing.pool
+import os
+import Queue
+import signal
+import sys
+import threading
+import time
+
+
+DEFAULT_WORKERS = 4
+# Queue.get() can only be interrupted by Ctrl+C when it has a timeout.
+WAIT_TIMEOUT = 365 * 24 * 60 * 60
+
+logger = logging.getLogger('clusterfuzz')
+
+# The task running in the current thread, if any.
+LOCAL = threading.local()
+
+
+class Task(object):
+  """A step that runs once all the tasks it depends on have succeeded."""
+
+  def __init__(self, name, fn, deps=None):
+    self.name = name
+    self.fn = fn
+    self.deps = list(deps or [])
+    self.start_time = None
+    self.end_time = None
+    self.processes = []
+    self.lock = threading.Lock()
+
+  @property
+  def duration(self):
+    return self.end_time - self.start_time
+
+  def add_process(self, proc):
+    """Remember a process, so that it can be killed on cancellation."""
+    with self.lock:
+      self.processes.append(proc)
+
+  def cancel(self):
+    """Terminate the processes that the task has started."""
+    with self.lock:
+      processes = list(self.processes)
+    for proc in processes:
+      if proc.poll() is None:
+        logger.debug('Cancelling %s: terminating pid=%s.', self.name, proc.pid)
+        try:
+          os.killpg(proc.pid, signal.SIGTERM)
+        except OSError:
+          pass
+
+
+def get_current():
+  """Return the task running in this thread, or None."""
+  return getattr(LOCAL, 'task', None)
+
+
+def add_process(proc):
+  """Attach a process to the task running in this thread, if any."""
+  task = get_current()
+  if task:
+    task.add_process(proc)
+
+
+class PrefixFilter(logging.Filter):
+  """Prefix the log messages of a task with its name, because several
+    tasks might be logging at once."""
+
+  def filter(self, record):
+    task = get_current()
+    if task:
+      record.msg = '[%s] %s' % (task.name, record.msg)
+    return True
+
+
+def run_task(task, done):
+  """Run a task in this thread, and report back to done."""
+  LOCAL.task = task
+  task.start_time = time.time()
+  try:
+    task.fn()
+    exc_info = None
+  except BaseException:  # pylint: disable=broad-except
+    exc_info = sys.exc_info()
+  finally:
+    task.end_time = time.time()
+    LOCAL.task = None
+  done.put((task, exc_info))
+
+
+def get_critical_path(tasks):
+  """Return the chain of tasks that ended last: the last task, the
+    dependency that held it back, and so on."""
+  path = []
+  remaining = [task for task in tasks if task.end_time is not None]
+  while remaining:
+    task = max(remaining, key=lambda task: task.end_time)
+    path.append(task)
+    remaining = [dep for dep in task.deps if dep.end_time is not None]
+  return list(reversed(path))
+
+
+def log_summary(tasks, start_time):
+  """Log the duration of the critical path, which bounds the wall time."""
+  path = get_critical_path(tasks)
+  if not path:
+    return
+  busy_time = sum(task.duration for task in tasks if task.end_time)
+  logger.info(
+      'Ran %d tasks in %.1fs (%.1fs of work). Critical path: %s.',
+      len([task for task in tasks if task.end_time]),
+      time.time() - start_time, busy_time,
+      ' -> '.join('%s (%.1fs)' % (task.name, task.duration) for task in path))
+
+
+def run(tasks, workers=DEFAULT_WORKERS):
+  """Run tasks, starting every task as soon as its dependencies have
+    succeeded. When a task fails, no other task is started, the running ones
+    are cancelled, and the first error is re-raised."""
+  if not tasks:
+    return
+
+  start_time = time.time()
+  pending = list(tasks)
+  running = []
+  finished = set()
+  failure = None
+  done = Queue.Queue()
+  pool = multiprocessing.pool.ThreadPool(min(workers, len(tasks)))
+  log_filter = PrefixFilter()
+  logger.addFilter(log_filter)
+
+  try:
+    while pending or running:
+      if not failure:
+        ready = [task for task in pending
+                 if all(dep in finished for dep in task.deps)]
+        for task in ready:
+          pending.remove(task)
+          running.append(task)
+          pool.apply_async(run_task, (task, done))
+
+        if not running:
+          raise ValueError(
+              'The tasks %s depend on each other or on unknown tasks.' %
+              ', '.join(task.name for task in pending))
+      elif not running:
+        break
+
+      try:
+        task, exc_info = done.get(timeout=WAIT_TIMEOUT)
+      except KeyboardInterrupt:
+        failure = failure or sys.exc_info()
+        for task in running:
+          task.cancel()
+        continue
+
+      running.remove(task)
+      if not exc_info:
+        finished.add(task)
+        logger.debug('%s took %.1fs.', task.name, task.duration)
+        continue
+
+      if not failure:
+        logger.info('%s failed. Cancelling the other tasks.', task.name)
+        # Re-raising below loses the traceback of the worker thread.
+        logger.debug('%s failed with:', task.name, exc_info=exc_info)
+        failure = exc_info
+        for other in running:
+          other.cancel()
+  finally:
+    logger.removeFilter(log_filter)
+    pool.terminate()
+    pool.join()
+
+  log_summary(tasks, start_time)
+  if failure:
+    raise failure[1]
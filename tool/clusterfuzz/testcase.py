@@ -13,20 +13,100 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
+import logging
 import os
+import re
+import tempfile
 import zipfile
-import logging
 
 from clusterfuzz import common
+from clusterfuzz import downloader
 
 
 CLUSTERFUZZ_TESTCASE_URL = (
     'https://%s/v2/testcase-detail/download-testcase?id=%s' %
     (common.DOMAIN_NAME, '%s'))
-DOWNLOAD_TIMEOUT = 100
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Testcase files are stored by the sha256 of their content. A zip testcase is
+# extracted once into <sha256>.d, and so is the link to a non-zip testcase.
+TESTCASE_OBJECTS_DIR = os.path.join(common.CLUSTERFUZZ_TESTCASES_DIR, 'objects')
 logger = logging.getLogger('clusterfuzz')
 
 
+def get_filename_from_headers(headers):
+  """Get the filename from Content-Disposition, which is what wget's
+    --content-disposition used to do."""
+  match = re.search(
+      r'filename="?([^";]+)"?', headers.get('Content-Disposition', ''))
+  if not match:
+    return 'testcase'
+  return os.path.basename(match.group(1))
+
+
+def get_object_path(digest):
+  """Return the location of a testcase object."""
+  return os.path.join(TESTCASE_OBJECTS_DIR, digest)
+
+
+def store_object(path):
+  """Move a downloaded file (in TESTCASE_OBJECTS_DIR) into the object store
+    and return its sha256."""
+  sha = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+      sha.update(chunk)
+  digest = sha.hexdigest()
+  publish(path, get_object_path(digest))
+  return digest
+
+
+def publish(tmp_path, path):
+  """Rename tmp_path to path. If another run has published path first, its
+    content is identical, so we simply discard ours."""
+  try:
+    os.rename(tmp_path, path)
+  except OSError:
+    if not os.path.exists(path):
+      raise
+  finally:
+    common.delete_if_exists(tmp_path)
+
+
+def extract_object_if_needed(digest):
+  """Extract a zip object once and return the extracted directory."""
+  extracted_dir = '%s.d' % get_object_path(digest)
+  if os.path.isdir(extracted_dir):
+    return extracted_dir
+
+  tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=TESTCASE_OBJECTS_DIR)
+  try:
+    with zipfile.ZipFile(get_object_path(digest), 'r') as zipped_file:
+      zipped_file.extractall(tmp_dir)
+    publish(tmp_dir, extracted_dir)
+  finally:
+    common.delete_if_exists(tmp_dir)
+  return extracted_dir
+
+
+def link_object_if_needed(digest, filename):
+  """Hardlink a non-zip object to <sha256>.d/<filename> and return the link.
+    The testcase needs the right extension to run, which the object doesn't
+    have."""
+  link_dir = '%s.d' % get_object_path(digest)
+  link_path = os.path.join(link_dir, filename)
+  if os.path.exists(link_path):
+    return link_path
+
+  common.ensure_dir(link_dir)
+  tmp_path = os.path.join(link_dir, '.tmp-%s-%s' % (os.getpid(), filename))
+  common.delete_if_exists(tmp_path)
+  os.link(get_object_path(digest), tmp_path)
+  publish(tmp_path, link_path)
+  return link_path
+
+
 class Testcase(object):
   """The Testase module, to abstract away logic using the testcase JSON."""
 
@@ -101,48 +181,68 @@ class Testcase(object):
     if self.gn_args:
       self.gn_args = self.gn_args.rstrip('\n')
 
-  def testcase_dir_name(self):
-    """Returns a testcases' respective directory."""
+  def metadata_path(self):
+    """Returns the location of the testcase's download metadata."""
     return os.path.join(common.CLUSTERFUZZ_TESTCASES_DIR,
-                        str(self.id) + '_testcase')
-
-  def get_true_testcase_path(self, filename):
+                        str(self.id) + '_testcase.json')
+
+  def get_metadata(self):
+    """Returns the metadata of the last download, or None if it's missing or
+      corrupted, or if the downloaded object isn't in the object store
+      anymore."""
+    metadata = common.read_json(self.metadata_path())
+    if (not isinstance(metadata, dict) or not metadata.get('sha256') or
+        not metadata.get('filename')):
+      return None
+
+    if not os.path.isfile(get_object_path(metadata['sha256'])):
+      return None
+    return metadata
+
+  def store_metadata(self, metadata):
+    """Atomically stores the metadata of the latest download."""
+    common.ensure_dir(common.CLUSTERFUZZ_TESTCASES_DIR)
+    fd, tmp_path = tempfile.mkstemp(
+        prefix='.tmp-', dir=common.CLUSTERFUZZ_TESTCASES_DIR)
+    with os.fdopen(fd, 'w') as f:
+      json.dump(metadata, f)
+    publish(tmp_path, self.metadata_path())
+
+  def get_true_testcase_path(self, digest, filename):
     """Return actual testcase path, unzips testcase if required."""
-
-    testcase_dir = self.testcase_dir_name()
-
     if filename.endswith('.zip'):
-      zipped_file = zipfile.ZipFile(os.path.join(testcase_dir, filename), 'r')
-      zipped_file.extractall(testcase_dir)
-      zipped_file.close()
-      return os.path.join(testcase_dir, self.absolute_path)
+      return os.path.join(extract_object_if_needed(digest), self.absolute_path)
     else:
-      true_testcase_path = os.path.join(
-          testcase_dir, 'testcase%s' % self.file_extension)
-      current_testcase_path = os.path.join(testcase_dir, filename)
-      os.rename(current_testcase_path, true_testcase_path)
-      return true_testcase_path
+      return link_object_if_needed(digest, 'testcase%s' % self.file_extension)
 
   def get_testcase_path(self):
-    """Downloads & returns the location of the testcase file."""
-
-    testcase_dir = self.testcase_dir_name()
-    filename = os.path.join(testcase_dir, 'testcase%s' % self.file_extension)
-    common.delete_if_exists(testcase_dir)
-    os.makedirs(testcase_dir)
+    """Downloads (if changed) & returns the location of the testcase file."""
+    metadata = self.get_metadata()
+    headers = {
+        'Authorization': common.get_stored_auth_header(),
+        'User-Agent': 'clusterfuzz-tools'}
+    if metadata and metadata.get('etag'):
+      headers['If-None-Match'] = metadata['etag']
+    if metadata and metadata.get('last_modified'):
+      headers['If-Modified-Since'] = metadata['last_modified']
 
     logger.info('Downloading testcase data...')
-
-    auth_header = common.get_stored_auth_header()
-    # Do not use curl because curl doesn't support downloading an empty file.
-    # See: https://github.com/google/clusterfuzz-tools/issues/326
-    args = (
-        '--no-verbose --waitretry=%s --retry-connrefused --content-disposition '
-        '--header="Authorization: %s" "%s"' %
-        (DOWNLOAD_TIMEOUT, auth_header, CLUSTERFUZZ_TESTCASE_URL % self.id))
-    common.execute('wget', args, testcase_dir)
-    downloaded_filename = os.listdir(testcase_dir)[0]
-
-    filename = self.get_true_testcase_path(downloaded_filename)
-
-    return filename
+    common.ensure_dir(TESTCASE_OBJECTS_DIR)
+    # The destination is stable, so that an interrupted download is resumed
+    # by the next run.
+    dest = os.path.join(TESTCASE_OBJECTS_DIR, '.download-%s' % self.id)
+    response_headers = downloader.download(
+        CLUSTERFUZZ_TESTCASE_URL % self.id, dest, headers=headers)
+
+    if response_headers is None:
+      logger.info('The testcase has not changed since the last download.')
+    else:
+      metadata = {
+          'sha256': store_object(dest),
+          'filename': get_filename_from_headers(response_headers),
+          'etag': response_headers.get('ETag'),
+          'last_modified': response_headers.get('Last-Modified')}
+      self.store_metadata(metadata)
+
+    return self.get_true_testcase_path(
+        metadata['sha256'], metadata['filename'])
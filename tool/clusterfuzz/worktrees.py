@@ -0,0 +1,138 @@
+"""A pool of git worktrees, to build revisions outside the user's checkout."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+from clusterfuzz import common
+from clusterfuzz import disk_cache
+from clusterfuzz import git_batch
+
+
+WORKTREES_DIR = os.path.join(common.CLUSTERFUZZ_CACHE_DIR, 'worktrees')
+POOL_SIZE_VARIABLE = 'CF_WORKTREE_POOL_SIZE'
+DEFAULT_POOL_SIZE = 3
+# An idle worktree this close to the requested revision is reused even if
+# the pool has room for another one, because few files need to change.
+NEAR_REVISIONS = 2000
+GCLIENT_FILE = '.gclient'
+# The git cache that gclient shares between the worktrees, unless the
+# .gclient of the checkout already sets one.
+GCLIENT_CACHE_DIR = os.path.join(common.CLUSTERFUZZ_CACHE_DIR, 'gclient_cache')
+CACHE_DIR_PATTERN = re.compile(r'^\s*cache_dir\s*=', re.MULTILINE)
+
+logger = logging.getLogger('clusterfuzz')
+
+
+def count_entry(_):
+  """Measure every worktree as 1, so that the quota is a number of
+    worktrees."""
+  return 1
+
+
+def get_pool(source_dir):
+  """Return the pool of worktrees of a checkout."""
+  path_hash = hashlib.sha1(source_dir).hexdigest()[:16]
+  return disk_cache.DiskCache(
+      'worktree', os.path.join(WORKTREES_DIR, path_hash),
+      int(os.environ.get(POOL_SIZE_VARIABLE, DEFAULT_POOL_SIZE)),
+      measure=count_entry)
+
+
+def acquire(pool, revision):
+  """Pin the idle worktree nearest to revision or, if none is near and the
+    pool has room, a new one. Returns its key and the pinned lock file."""
+  entries = pool.get_entries()
+  candidates = sorted(
+      entries.iteritems(),
+      key=lambda (_, meta): (abs(meta.get('revision', 0) - revision),
+                             meta.get('last_used', 0)))
+
+  for key, meta in candidates:
+    if (abs(meta.get('revision', 0) - revision) > NEAR_REVISIONS and
+        len(entries) < pool.quota):
+      break
+
+    lock_file = pool.pin(key, exclusive=True, blocking=False)
+    if not lock_file:
+      continue
+    # The worktree might have been evicted before it was pinned.
+    if os.path.exists(pool.get_meta_path(key, 'json')):
+      return key, lock_file
+    lock_file.close()
+
+  common.ensure_dir(pool.path)
+  key = os.path.basename(tempfile.mkdtemp(prefix='worktree-', dir=pool.path))
+  return key, pool.pin(key, exclusive=True, blocking=False)
+
+
+def copy_gclient(source_dir, path):
+  """Copy the .gclient of source_dir next to the worktree at path. A
+    worktree has none of the repositories of DEPS, so gclient has to sync
+    them in every worktree. They are synced from a git cache shared by all
+    the worktrees, so that their objects are only fetched and stored once,
+    and each worktree only pays for its own checkouts."""
+  gclient_path = os.path.join(os.path.dirname(source_dir), GCLIENT_FILE)
+  if not os.path.exists(gclient_path):
+    return
+
+  with open(gclient_path) as f:
+    content = f.read()
+  if not CACHE_DIR_PATTERN.search(content):
+    content += '\ncache_dir = %r\n' % GCLIENT_CACHE_DIR
+  with open(os.path.join(os.path.dirname(path), GCLIENT_FILE), 'w') as f:
+    f.write(content)
+
+
+def add_worktree(source_dir, path, sha):
+  """Add a worktree of source_dir at path, along with the .gclient of
+    source_dir, so that gclient can sync it."""
+  common.delete_if_exists(path)
+  common.execute('git', 'worktree prune', source_dir, print_output=False)
+  common.execute(
+      'git', 'worktree add --detach %s %s' % (path, sha), source_dir,
+      print_output=False)
+  copy_gclient(source_dir, path)
+
+
+def checkout(source_dir, sha, revision):
+  """Check out sha in a worktree of source_dir, and return the worktree's
+    source directory. The worktree is reserved for this process until the
+    returned lock file is closed."""
+  source_dir = os.path.abspath(source_dir)
+  pool = get_pool(source_dir)
+  key, lock_file = acquire(pool, int(revision))
+  path = os.path.join(pool.get_path(key), os.path.basename(source_dir))
+
+  if not os.path.exists(os.path.join(path, '.git')):
+    logger.info('Adding a worktree of %s at %s.', source_dir, path)
+    add_worktree(source_dir, path, sha)
+    hit = False
+  elif git_batch.get_current_sha(path) != sha:
+    logger.info('Checking out %s in the worktree at %s.', sha, path)
+    # The worktree is ours, so local changes are discarded.
+    common.execute(
+        'git', 'checkout --force --detach %s' % sha, path, print_output=False)
+    hit = False
+  else:
+    hit = True
+
+  pool.use(key, hit, revision=int(revision), sha=sha)
+  if pool.evict():
+    common.execute('git', 'worktree prune', source_dir, print_output=False)
+  return path, lock_file
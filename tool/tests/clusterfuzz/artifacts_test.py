@@ -0,0 +1,186 @@
+"""Test the artifacts module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import mock
+
+from clusterfuzz import artifacts
+from test_libs import helpers
+
+
+class GetKeyTest(helpers.ExtendedTestCase):
+  """Test get_key."""
+
+  def test_key(self):
+    """Test ignoring the args that don't change the outputs."""
+    key = artifacts.get_key('sha', {'is_asan': 'true'}, 'd8', 'ASAN')
+    self.assertEqual(key, artifacts.get_key(
+        'sha', {'is_asan': 'true', 'use_goma': 'true', 'goma_dir': '"/g"',
+                'concurrent_links': '4'}, 'd8', 'ASAN'))
+    self.assertEqual(5, len(set([
+        key,
+        artifacts.get_key('other', {'is_asan': 'true'}, 'd8', 'ASAN'),
+        artifacts.get_key('sha', {'is_msan': 'true'}, 'd8', 'ASAN'),
+        artifacts.get_key('sha', {'is_asan': 'true'}, 'chrome', 'ASAN'),
+        artifacts.get_key('sha', {'is_asan': 'true'}, 'd8', 'UBSAN')])))
+
+  def test_variant(self):
+    """Test that the variant doesn't depend on the sha."""
+    variant = artifacts.get_variant({'is_asan': 'true'}, 'd8', 'ASAN')
+    self.assertEqual(variant, artifacts.get_variant(
+        {'is_asan': 'true', 'use_goma': 'true'}, 'd8', 'ASAN'))
+    self.assertNotEqual(variant, artifacts.get_variant(
+        {'is_asan': 'true'}, 'd8', 'UBSAN'))
+
+
+class OutDirTest(helpers.ExtendedTestCase):
+  """Base class for the tests with a real out dir."""
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    patcher = mock.patch.object(
+        artifacts, 'ARTIFACTS_DIR', os.path.join(self.tmp_dir, 'artifacts'))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+    self.build_dir = os.path.join(self.tmp_dir, 'out')
+    for path in ['d8', 'snapshot_blob.bin', 'args.gn', 'build.ninja',
+                 '.ninja_log', 'obj/a.o', 'locales/en-US.pak',
+                 'instrumented_libraries/lib/libc++.so', 'gen/a/b.js']:
+      self.write(path, path)
+
+  def write(self, path, content):
+    """Write a file in the out dir."""
+    path = os.path.join(self.build_dir, path)
+    if not os.path.exists(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(content)
+
+
+class GetRuntimePathsTest(OutDirTest):
+  """Test get_runtime_paths."""
+
+  def setUp(self):
+    super(GetRuntimePathsTest, self).setUp()
+    helpers.patch(self, ['clusterfuzz.common.execute'])
+
+  def test_runtime_deps(self):
+    """Test listing GN's runtime deps that are in the out dir."""
+    self.mock.execute.side_effect = [
+        (0, '//v8:d8\n//v8:d8_lib\n//tools:d8\n'
+            '//v8:d8(//build/toolchain/linux:clang_x86)\n'),
+        (0, './d8\nsnapshot_blob.bin\nlocales/\n../../v8/tools/a.js\n'),
+        (0, 'gen/a/b.js\ninstrumented_libraries/lib/\nmissing.so\n')]
+
+    self.assertEqual(
+        ['args.gn', 'd8', 'gen/a/b.js', 'instrumented_libraries/lib',
+         'locales', 'snapshot_blob.bin'],
+        artifacts.get_runtime_paths(self.build_dir, 'd8', '/src'))
+    self.assert_exact_calls(self.mock.execute, [
+        mock.call('gn', 'ls %s --as=label' % self.build_dir, '/src',
+                  print_command=False, print_output=False,
+                  exit_on_error=False),
+        mock.call('gn', 'desc %s //v8:d8 runtime_deps' % self.build_dir,
+                  '/src', print_command=False, print_output=False,
+                  exit_on_error=False),
+        mock.call('gn', 'desc %s //tools:d8 runtime_deps' % self.build_dir,
+                  '/src', print_command=False, print_output=False,
+                  exit_on_error=False)])
+
+  def test_no_label(self):
+    """Test when no label is named after the target."""
+    self.mock.execute.return_value = (0, '//v8:d8_lib\n')
+    self.assertIsNone(
+        artifacts.get_runtime_paths(self.build_dir, 'd8', '/src'))
+
+  def test_gn_fails(self):
+    """Test when GN cannot list the runtime deps."""
+    self.mock.execute.side_effect = [(0, '//v8:d8\n'), (1, 'error')]
+    self.assertIsNone(
+        artifacts.get_runtime_paths(self.build_dir, 'd8', '/src'))
+
+
+class StoreTest(OutDirTest):
+  """Test store and restore."""
+
+  def setUp(self):
+    super(StoreTest, self).setUp()
+    helpers.patch(self, ['clusterfuzz.artifacts.get_runtime_paths',
+                         'clusterfuzz.dedup.dedupe_in_background'])
+    self.mock.get_runtime_paths.return_value = [
+        'args.gn', 'd8', 'gen/a/b.js', 'instrumented_libraries/lib',
+        'instrumented_libraries/lib/libc++.so', 'locales',
+        'snapshot_blob.bin']
+
+  def test_store_and_restore(self):
+    """Test restoring a stored build, which is independent of the out
+      dir."""
+    self.assertEqual((None, None), artifacts.restore('key'))
+    artifacts.store('key', self.build_dir, 'd8', '/src')
+    self.write('d8', 'rebuilt')
+
+    build_dir, pin = artifacts.restore('key')
+    self.addCleanup(pin.close)
+    self.assertEqual(os.path.join(artifacts.ARTIFACTS_DIR, 'key'), build_dir)
+    with open(os.path.join(build_dir, 'd8')) as f:
+      self.assertEqual('d8', f.read())
+    for path in ['locales/en-US.pak', 'gen/a/b.js',
+                 'instrumented_libraries/lib/libc++.so']:
+      self.assertTrue(os.path.exists(os.path.join(build_dir, path)))
+    self.assertFalse(os.path.exists(os.path.join(build_dir, 'obj')))
+    self.assertEqual(['.meta', 'key'], sorted(os.listdir(
+        artifacts.ARTIFACTS_DIR)))
+    self.mock.get_runtime_paths.assert_called_once_with(
+        self.build_dir, 'd8', '/src')
+    self.mock.dedupe_in_background.assert_called_once_with(mock.ANY, 'key')
+
+  def test_unknown_runtime_deps(self):
+    """Test not caching a build whose runtime deps are unknown."""
+    self.mock.get_runtime_paths.return_value = None
+    artifacts.store('key', self.build_dir, 'd8', '/src')
+    self.assertEqual((None, None), artifacts.restore('key'))
+
+  def test_store_twice(self):
+    """Test keeping the build that is already stored."""
+    artifacts.store('key', self.build_dir, 'd8', '/src')
+    self.write('d8', 'rebuilt')
+    artifacts.store('key', self.build_dir, 'd8', '/src')
+
+    with open(os.path.join(artifacts.ARTIFACTS_DIR, 'key', 'd8')) as f:
+      self.assertEqual('d8', f.read())
+
+  def test_nearest(self):
+    """Test finding the builds of nearby revisions, with their inputs."""
+    for key, variant, revision in [('far', 'v', 100), ('near', 'v', 55),
+                                   ('other', 'w', 50), ('nearest', 'v', 48)]:
+      artifacts.store(key, self.build_dir, 'd8', '/src', variant=variant,
+                      sha=key, revision=revision,
+                      get_inputs=lambda key=key: set(['%s.cc' % key, 'a.h']))
+
+    self.assertEqual(
+        [('nearest', 48), ('near', 55)],
+        [(key, meta['revision'])
+         for key, meta in artifacts.get_nearest('v', 50, 10)])
+    self.assertEqual(set(['near.cc', 'a.h']), artifacts.read_inputs('near'))
+
+  def test_no_inputs(self):
+    """Test a build stored without its inputs."""
+    artifacts.store('key', self.build_dir, 'd8', '/src',
+                    get_inputs=lambda: None)
+    self.assertIsNone(artifacts.read_inputs('key'))
@@ -13,72 +13,274 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import os
-import json
+import shutil
+import StringIO
+import tempfile
+import threading
+import zipfile
 import mock
 
+from clusterfuzz import artifacts
 from clusterfuzz import binary_providers
 from clusterfuzz import common
+from clusterfuzz import downloader
+from clusterfuzz import ninja
 from clusterfuzz import output_transformer
 from error import error
 from tests import libs
 from test_libs import helpers
 
 
-class BuildRevisionToShaUrlTest(helpers.ExtendedTestCase):
-  """Tests the build_revision_to_sha_url method."""
-
-  def setUp(self):
-    helpers.patch(self, [
-        'urlfetch.fetch'])
-
-  def test_correct_url_building(self):
-    """Tests if the SHA url is built correctly"""
-
-    result = binary_providers.build_revision_to_sha_url(12345, 'v8/v8')
-    self.assertEqual(result, ('https://cr-rev.appspot.com/_ah/api/crrev/v1'
-                              '/get_numbering?project=chromium&repo=v8%2Fv8'
-                              '&number=12345&numbering_type='
-                              'COMMIT_POSITION&numbering_identifier=refs'
-                              '%2Fheads%2Fmaster'))
-
-
-class ShaFromRevisionTest(helpers.ExtendedTestCase):
-  """Tests the sha_from_revision method."""
-
-  def setUp(self):
-    helpers.patch(self, ['urlfetch.fetch'])
-
-  def test_get_sha_from_response_body(self):
-    """Tests to ensure that the sha is grabbed from the response correctly"""
-
-    self.mock.fetch.return_value = mock.Mock(body=json.dumps({
-        'id': 12345,
-        'git_sha': '1a2s3d4f',
-        'crash_type': 'Bad Crash'}))
+class ParseDepsVarsTest(helpers.ExtendedTestCase):
+  """Tests the parse_deps_vars method."""
+
+  def test_parse(self):
+    """Test reading literal vars, including Str() ones."""
+    content = (
+        'use_relative_paths = True\n'
+        'vars = {\n'
+        '  "checkout_nacl": Str("True"),\n'
+        '  # A comment.\n'
+        "  'pdfium_revision': 'abc' 'def',\n"
+        "  'pdfium_git': Var('chromium_git') + '/pdfium',\n"
+        '  "build": 1,\n'
+        '}\n'
+        "deps = {'src/pdfium': Var('pdfium_git')}\n")
+    self.assertEqual(
+        {'checkout_nacl': 'True', 'pdfium_revision': 'abcdef', 'build': 1},
+        binary_providers.parse_deps_vars(content))
 
-    result = binary_providers.sha_from_revision(123456, 'v8/v8')
-    self.assertEqual(result, '1a2s3d4f')
+  def test_no_vars(self):
+    """Test a DEPS file without vars."""
+    self.assertEqual({}, binary_providers.parse_deps_vars('deps = {}'))
 
 
 class GetPdfiumShaTest(helpers.ExtendedTestCase):
   """Tests the get_pdfium_sha method."""
 
   def setUp(self):
-    helpers.patch(self, ['urlfetch.fetch'])
+    helpers.patch(self, ['urlfetch.fetch',
+                         'clusterfuzz.git_batch.read_file'])
     self.mock.fetch.return_value = mock.Mock(
         body=('dmFycyA9IHsNCiAgJ3BkZml1bV9naXQnOiAnaHR0cHM6Ly9wZGZpdW0uZ29vZ'
               '2xlc291cmNlLmNvbScsDQogICdwZGZpdW1fcmV2aXNpb24nOiAnNDA5MzAzOW'
               'QxOWY4MzIxNzNlYzU4Y2ZkOWYyZThhYzM5M2E3NjA5MScsDQp9DQo='))
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    patcher = mock.patch.object(
+        binary_providers, 'PDFIUM_SHAS_FILE',
+        os.path.join(self.tmp_dir, 'pdfium_shas.json'))
+    patcher.start()
+    self.addCleanup(patcher.stop)
 
   def test_decode_pdfium_sha(self):
     """Tests if the method correctly grabs the sha from the b64 download."""
 
-    result = binary_providers.get_pdfium_sha('chrome_sha')
+    with mock.patch.dict(os.environ, {}, clear=True):
+      result = binary_providers.get_pdfium_sha('chrome_sha')
     self.assert_exact_calls(self.mock.fetch, [mock.call(
         ('https://chromium.googlesource.com/chromium/src.git/+/chrome_sha'
          '/DEPS?format=TEXT'))])
     self.assertEqual(result, '4093039d19f832173ec58cfd9f2e8ac393a76091')
+    self.assert_n_calls(0, [self.mock.read_file])
+
+  def test_local(self):
+    """Test reading DEPS from the local Chromium checkout, and storing the
+      answer."""
+    self.mock.read_file.return_value = "vars = {'pdfium_revision': 'local'}"
+
+    with mock.patch.dict(os.environ, {'CHROMIUM_SRC': '/chromium/src'}):
+      self.assertEqual('local', binary_providers.get_pdfium_sha('chrome_sha'))
+      self.assertEqual('local', binary_providers.get_pdfium_sha('chrome_sha'))
+
+    self.assert_exact_calls(self.mock.read_file, [
+        mock.call('/chromium/src', 'chrome_sha', 'DEPS')])
+    self.assert_n_calls(0, [self.mock.fetch])
+
+  def test_no_pdfium_revision(self):
+    """Test failing clearly when DEPS doesn't pin Pdfium."""
+    self.mock.read_file.return_value = "vars = {'v8_revision': 'abc'}"
+
+    with mock.patch.dict(os.environ, {'CHROMIUM_SRC': '/chromium/src'}):
+      with self.assertRaises(error.PdfiumRevisionNotFoundError):
+        binary_providers.get_pdfium_sha('chrome_sha')
+
+  def test_local_missing(self):
+    """Test downloading DEPS when the local checkout doesn't have the sha."""
+    self.mock.read_file.return_value = None
+
+    with mock.patch.dict(os.environ, {'CHROMIUM_SRC': '/chromium/src'}):
+      self.assertEqual('4093039d19f832173ec58cfd9f2e8ac393a76091',
+                       binary_providers.get_pdfium_sha('chrome_sha'))
+    self.assert_n_calls(1, [self.mock.fetch])
+
+
+class FakeArchive(object):
+  """A fake RemoteZip, whose members are extracted as empty files or
+    symlinks."""
+
+  def __init__(self, members, symlinks=None):
+    self.url = 'https://storage.googleapis.com/bucket/abc.zip'
+    self.members = {path: mock.Mock(filename='abc/' + path, file_size=0)
+                    for path in members}
+    self.symlinks = symlinks or {}
+    self.extracted = []
+    self.background = None
+
+  def extract(self, paths, dest_dir):
+    self.extracted.append(sorted(paths))
+    for path in paths:
+      full_path = os.path.join(dest_dir, path)
+      common.ensure_dir(os.path.dirname(full_path))
+      if path in self.symlinks:
+        os.symlink(self.symlinks[path], full_path)
+      else:
+        open(full_path, 'w').close()
+    return 0
+
+  def extract_in_background(self, paths, unused_dest_dir, callback):
+    self.background = (sorted(paths), callback)
+
+
+class ExtractNeededMembersTest(helpers.ExtendedTestCase):
+  """Test extract_needed_members."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.elf.get_needed_libraries'])
+    self.setup_fake_filesystem()
+    self.needed = {
+        '/build/fuzzer': ['libbase.so', 'libc.so.6'],
+        '/build/lib/libbase.so.1': ['libicu.so'],
+    }
+    self.mock.get_needed_libraries.side_effect = (
+        lambda path: self.needed.get(path, []))
+
+  def test_extract(self):
+    """Test extracting the binary, its resources and libraries."""
+    archive = FakeArchive(
+        ['fuzzer', 'fuzzer.dict', 'fuzzer.options', 'icudtl.dat', 'other',
+         'chrome.pak', 'libbase.so', 'lib/libbase.so.1', 'lib/libicu.so',
+         'other_dir/libicu.so', 'other_dir/x.dict'],
+        symlinks={'libbase.so': 'lib/libbase.so.1'})
+
+    self.assertEqual(
+        set(['fuzzer', 'fuzzer.dict', 'fuzzer.options', 'icudtl.dat',
+             'libbase.so', 'lib/libbase.so.1', 'lib/libicu.so']),
+        binary_providers.extract_needed_members(
+            archive, '/build', 'fuzzer', set()))
+    self.assertEqual([
+        ['fuzzer', 'fuzzer.dict', 'fuzzer.options', 'icudtl.dat'],
+        ['libbase.so'],
+        ['lib/libbase.so.1'],
+        ['lib/libicu.so']], archive.extracted)
+
+  def test_done(self):
+    """Test inspecting, but not extracting, what's already there."""
+    self.needed = {'/build/fuzzer': ['libicu.so']}
+    archive = FakeArchive(['fuzzer', 'lib/libicu.so'])
+    archive.extract(['fuzzer'], '/build')
+
+    self.assertEqual(
+        set(['fuzzer', 'lib/libicu.so']),
+        binary_providers.extract_needed_members(
+            archive, '/build', 'fuzzer', set(['fuzzer'])))
+    self.assertEqual([['fuzzer'], [], ['lib/libicu.so']], archive.extracted)
+
+
+class ExtractBuildTest(helpers.ExtendedTestCase):
+  """Test extract_build."""
+
+  def setUp(self):
+    helpers.patch(self, [
+        'clusterfuzz.binary_providers.extract_needed_members',
+        'clusterfuzz.binary_providers.get_build_cache',
+        'clusterfuzz.dedup.Index',
+        'clusterfuzz.dedup.dedupe_in_background',
+        'clusterfuzz.dedup.reuse_members',
+        'clusterfuzz.disk_cache.share_pin',
+        'clusterfuzz.downloader.log_throughput'])
+    self.setup_fake_filesystem()
+    self.archive = FakeArchive(['d8', 'icudtl.dat', 'gen/a.js'])
+    self.stamp_path = os.path.join(
+        '/build', binary_providers.PARTIAL_BUILD_STAMP)
+    self.cache = self.mock.get_build_cache.return_value
+    self.index = self.mock.Index.return_value
+    self.mock.reuse_members.return_value = {}
+
+  def test_extract_all(self):
+    """Test extracting everything before returning."""
+    binary_providers.extract_build(self.archive, '/build', 'd8', True)
+
+    self.assertEqual([['d8', 'gen/a.js', 'icudtl.dat']], self.archive.extracted)
+    self.assertFalse(os.path.exists(self.stamp_path))
+    self.assertIsNone(self.archive.background)
+    self.mock.Index.assert_called_once_with(self.cache, 'build')
+    self.mock.dedupe_in_background.assert_called_once_with(
+        self.cache, 'build', self.index, {})
+
+  def test_reuse(self):
+    """Test not extracting what's been cloned from other builds."""
+    self.mock.reuse_members.return_value = {'icudtl.dat': [5000, 1, 'abc']}
+
+    binary_providers.extract_build(self.archive, '/build', 'd8', True)
+
+    self.mock.reuse_members.assert_called_once_with(
+        self.index, self.archive.members, '/build')
+    self.assertEqual([['d8', 'gen/a.js']], self.archive.extracted)
+    self.mock.dedupe_in_background.assert_called_once_with(
+        self.cache, 'build', self.index, {'icudtl.dat': [5000, 1, 'abc']})
+
+  def test_extract_needed(self):
+    """Test extracting the rest in the background."""
+    self.mock.reuse_members.return_value = {'icudtl.dat': [5000, 1, 'abc']}
+    self.mock.extract_needed_members.return_value = set(['d8', 'icudtl.dat'])
+
+    binary_providers.extract_build(self.archive, '/build', 'd8', False)
+
+    self.mock.extract_needed_members.assert_called_once_with(
+        self.archive, '/build', 'd8', set(['icudtl.dat']))
+    paths, callback = self.archive.background
+    self.assertEqual(['gen/a.js'], paths)
+    self.assertTrue(os.path.exists(self.stamp_path))
+    self.assert_n_calls(0, [self.mock.dedupe_in_background])
+
+    callback()
+    self.assertFalse(os.path.exists(self.stamp_path))
+    self.assert_n_calls(1, [self.mock.dedupe_in_background])
+
+  def test_malformed_binary(self):
+    """Test extracting everything when the binary cannot be parsed."""
+    self.mock.extract_needed_members.side_effect = ValueError(
+        'Truncated ELF binary.')
+
+    binary_providers.extract_build(self.archive, '/build', 'd8', False)
+
+    self.assertEqual([['d8', 'gen/a.js', 'icudtl.dat']], self.archive.extracted)
+    self.assertIsNone(self.archive.background)
+    self.assertFalse(os.path.exists(self.stamp_path))
+    self.assert_n_calls(1, [self.mock.dedupe_in_background])
+
+  def test_share_pin(self):
+    """Test sharing the build's pin once it's complete."""
+    pin = mock.Mock()
+    binary_providers.extract_build(self.archive, '/build', 'd8', False, pin)
+    self.assert_n_calls(0, [self.mock.share_pin])
+
+    _, callback = self.archive.background
+    callback()
+    self.mock.share_pin.assert_called_once_with(pin)
+
+  def test_resume(self):
+    """Test skipping what a previous run has extracted."""
+    self.fs.CreateFile('/build/d8')
+    self.fs.CreateFile('/build/gen/a.js', contents='partial')
+    self.fs.CreateFile(self.stamp_path)
+
+    binary_providers.extract_build(self.archive, '/build', 'd8', True)
+
+    self.assertEqual([['gen/a.js', 'icudtl.dat']], self.archive.extracted)
 
 
 class DownloadBuildTest(helpers.ExtendedTestCase):
@@ -86,51 +288,173 @@ class DownloadBuildTest(helpers.ExtendedTestCase):
 
   def setUp(self):
     helpers.patch(self, [
-        'clusterfuzz.common.execute',
+        'clusterfuzz.binary_providers.extract_build',
+        'clusterfuzz.binary_providers.get_build_cache',
+        'clusterfuzz.common.delete_if_exists',
+        'clusterfuzz.dedup.dedupe_in_background',
         'clusterfuzz.common.ensure_dir',
-        'clusterfuzz.common.gsutil',
-        'clusterfuzz.common.get_source_directory',
-        'os.remove',
+        'clusterfuzz.downloader.probe_gcs_object',
+        'clusterfuzz.remote_zip.download_and_unzip_gcs_object',
+        'clusterfuzz.remote_zip.open_gcs_object',
         'os.rename',
         'os.chmod',
         'os.stat',
-        'os.path.exists'
+        'os.path.exists',
+        'tempfile.mkdtemp'
     ])
 
     self.dest_path = '/fake/dest'
     self.binary_name = 'binary'
     self.build_url = 'https://storage.cloud.google.com/test/test2/abc.zip'
+    self.tmp_dir = os.path.join(common.CLUSTERFUZZ_BUILDS_DIR, '.tmp-abc')
+    self.mock.mkdtemp.return_value = self.tmp_dir
+    self.mock.stat.return_value = mock.Mock(st_mode=0000)
+    self.mock.exists.return_value = False
 
   def test_already_download(self):
     """Tests the exit when build data is already returned."""
-    self.mock.exists.return_value = True
+    self.mock.exists.side_effect = lambda path: path == self.dest_path
     binary_providers.download_build(
         self.dest_path, self.build_url, self.binary_name)
-    self.assert_n_calls(0, [self.mock.execute])
+    self.assert_n_calls(0, [self.mock.open_gcs_object])
 
-  def test_get_build_data(self):
-    """Tests extracting, moving and renaming the build data.."""
-    self.mock.stat.return_value = mock.Mock(st_mode=0000)
-    self.mock.exists.return_value = False
+  def test_extract(self):
+    """Tests extracting in place, and resuming a partial build."""
+    self.mock.exists.return_value = True
+
+    binary_providers.download_build(
+        self.dest_path, self.build_url, self.binary_name, False)
+
+    self.mock.probe_gcs_object.assert_called_once_with(self.build_url)
+    self.mock.open_gcs_object.assert_called_once_with(
+        self.mock.probe_gcs_object.return_value, 'abc')
+    self.mock.extract_build.assert_called_once_with(
+        self.mock.open_gcs_object.return_value, self.dest_path,
+        self.binary_name, False, None)
+    self.assert_n_calls(0, [self.mock.download_and_unzip_gcs_object])
+    self.mock.chmod.assert_called_once_with(
+        os.path.join(self.dest_path, 'binary'), 64)
+
+  def test_unzip(self):
+    """Tests unzipping, moving and renaming the build data."""
+    self.mock.open_gcs_object.return_value = None
 
     binary_providers.download_build(
         self.dest_path, self.build_url, self.binary_name)
 
-    self.mock.execute.assert_called_once_with(
-        'unzip', '-q %s -d %s' % (
-            os.path.join(common.CLUSTERFUZZ_CACHE_DIR, 'abc.zip'),
-            common.CLUSTERFUZZ_BUILDS_DIR),
-        cwd=common.CLUSTERFUZZ_DIR
-    )
-    self.mock.remove.assert_called_once_with(
-        os.path.join(common.CLUSTERFUZZ_CACHE_DIR, 'abc.zip'))
+    self.mock.mkdtemp.assert_called_once_with(
+        dir=common.CLUSTERFUZZ_BUILDS_DIR, prefix='.tmp-')
+    self.mock.download_and_unzip_gcs_object.assert_called_once_with(
+        self.build_url, self.tmp_dir, self.mock.probe_gcs_object.return_value)
     self.mock.rename.assert_called_once_with(
-        os.path.join(common.CLUSTERFUZZ_BUILDS_DIR, 'abc'), self.dest_path)
-    self.mock.gsutil.assert_called_once_with(
-        'cp gs://test/test2/abc.zip .', common.CLUSTERFUZZ_CACHE_DIR)
+        os.path.join(self.tmp_dir, 'abc'), self.dest_path)
+    self.assert_exact_calls(self.mock.delete_if_exists, [
+        mock.call(self.dest_path), mock.call(self.tmp_dir)])
+    self.mock.dedupe_in_background.assert_called_once_with(
+        self.mock.get_build_cache.return_value, 'dest')
     self.mock.chmod.assert_called_once_with(
         os.path.join(self.dest_path, 'binary'), 64)
 
+  def test_extract_denied(self):
+    """Tests unzipping when the credentials expire during the extraction."""
+    self.mock.extract_build.side_effect = (
+        error.DownloadFailedError(self.build_url, 'HTTP 401', 401))
+
+    binary_providers.download_build(
+        self.dest_path, self.build_url, self.binary_name)
+
+    # The probe is stale, since the credentials have expired.
+    self.mock.download_and_unzip_gcs_object.assert_called_once_with(
+        self.build_url, self.tmp_dir, None)
+    self.assert_exact_calls(self.mock.delete_if_exists, [
+        mock.call(self.dest_path), mock.call(self.tmp_dir)])
+
+  def test_extract_failed(self):
+    """Tests failing when the extraction fails otherwise."""
+    self.mock.extract_build.side_effect = (
+        error.DownloadFailedError(self.build_url, 'HTTP 500', 500))
+
+    with self.assertRaises(error.DownloadFailedError):
+      binary_providers.download_build(
+          self.dest_path, self.build_url, self.binary_name)
+    self.assert_n_calls(0, [self.mock.download_and_unzip_gcs_object])
+
+  def test_unzip_failed(self):
+    """Tests cleaning up after a failed unzip."""
+    self.mock.open_gcs_object.return_value = None
+    self.mock.download_and_unzip_gcs_object.side_effect = (
+        error.DownloadFailedError(self.build_url, 'HTTP 500', 500))
+
+    with self.assertRaises(error.DownloadFailedError):
+      binary_providers.download_build(
+          self.dest_path, self.build_url, self.binary_name)
+
+    self.assert_n_calls(0, [self.mock.rename])
+    self.mock.delete_if_exists.assert_called_with(self.tmp_dir)
+
+
+class DownloadBuildWholeTest(helpers.ExtendedTestCase):
+  """Test download_build when the zip is downloaded whole, against a local
+    HTTP server."""
+
+  def setUp(self):
+    helpers.patch(self, [
+        'clusterfuzz.dedup.dedupe_in_background',
+        'clusterfuzz.downloader.get_gcs_auth_headers'])
+    self.mock.get_gcs_auth_headers.return_value = {}
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    for module, name, value in [
+        (common, 'CLUSTERFUZZ_DIR', self.tmp_dir),
+        (common, 'CLUSTERFUZZ_BUILDS_DIR',
+         os.path.join(self.tmp_dir, 'builds')),
+        (common, 'CLUSTERFUZZ_CACHE_DIR', self.tmp_dir),
+        (downloader, 'PARALLEL_DOWNLOAD_THRESHOLD', 50000),
+        (downloader, 'RANGE_SIZE', 10000)]:
+      patcher = mock.patch.object(module, name, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.dest = os.path.join(common.CLUSTERFUZZ_BUILDS_DIR, 'key')
+    self.binary = ''.join(chr(i % 251) for i in xrange(100000))
+    content = StringIO.StringIO()
+    with zipfile.ZipFile(content, 'w') as zip_file:
+      zip_file.writestr('abc/binary', self.binary)
+    self.content = content.getvalue()
+
+  def download_build(self, server):
+    """Download the build from server."""
+    with mock.patch.object(downloader, 'GCS_API_URL', server.url('/')):
+      binary_providers.download_build(
+          self.dest, 'gs://bucket/abc.zip', 'binary')
+    with open(os.path.join(self.dest, 'binary'), 'rb') as f:
+      self.assertEqual(self.binary, f.read())
+
+  def test_extract_denied(self):
+    """Tests downloading the zip in parallel ranges when the extraction is
+      denied, with fresh credentials."""
+    helpers.patch(self, ['clusterfuzz.binary_providers.extract_build'])
+    self.mock.extract_build.side_effect = (
+        error.DownloadFailedError('url', 'HTTP 401', 401))
+
+    with libs.FakeHttpServer({'/bucket/abc.zip': self.content}) as server:
+      self.download_build(server)
+
+    ranges = [headers.get('range') for _, headers in server.requests]
+    self.assertEqual(2, ranges.count('bytes=0-0'))
+    for start, end in downloader.get_ranges(len(self.content), 10000):
+      self.assertIn('bytes=%d-%d' % (start, end), ranges)
+    self.assert_n_calls(2, [self.mock.get_gcs_auth_headers])
+
+  def test_no_ranges(self):
+    """Tests streaming the zip without probing it again when the server
+      doesn't support ranges."""
+    with libs.FakeHttpServer(
+        {'/bucket/abc.zip': self.content}, ranges=False) as server:
+      self.download_build(server)
+
+    self.assertEqual(['bytes=0-0', None], [
+        headers.get('range') for _, headers in server.requests])
+
 
 class GetBinaryPathTest(helpers.ExtendedTestCase):
   """Tests the get_binary_path method."""
@@ -156,14 +480,27 @@ class BuildTest(helpers.ExtendedTestCase):
 
   def setUp(self):
     helpers.patch(self, [
-        'clusterfuzz.binary_providers.sha_from_revision',
+        'clusterfuzz.revisions.get_sha',
         'clusterfuzz.binary_providers.V8Builder.checkout_source_by_sha',
+        'clusterfuzz.binary_providers.V8Builder.checkout_worktree',
+        'clusterfuzz.binary_providers.V8Builder.confirm_checkout',
         'clusterfuzz.binary_providers.V8Builder.build_target',
-        'clusterfuzz.binary_providers.get_current_sha',
+        'clusterfuzz.binary_providers.V8Builder.restore_artifacts',
+        'clusterfuzz.binary_providers.V8Builder.store_artifacts',
+        'clusterfuzz.binary_providers.V8Builder.get_gn_args',
+        'clusterfuzz.binary_providers.V8Builder.get_artifact_key',
+        'clusterfuzz.binary_providers.V8Builder.wait_for_out_dir',
+        'clusterfuzz.build_queue.acquire',
+        'clusterfuzz.disk_cache.share_pin',
+        'clusterfuzz.git_batch.get_current_sha',
         'clusterfuzz.common.execute',
         'clusterfuzz.common.get_source_directory'])
 
     self.setup_fake_filesystem()
+    self.mock.restore_artifacts.return_value = False
+    self.mock.get_gn_args.return_value = {'is_asan': 'true'}
+    self.mock.get_artifact_key.return_value = 'key'
+    self.mock.acquire.return_value.__enter__.return_value = False
     self.build_url = 'https://storage.cloud.google.com/abc.zip'
     self.mock.get_current_sha.return_value = '1a2s3d4f5g6h'
     self.mock.execute.return_value = [0, '']
@@ -179,12 +516,115 @@ class BuildTest(helpers.ExtendedTestCase):
     provider = binary_providers.V8Builder(
         testcase, definition, libs.make_options(testcase_id=testcase.id))
 
-    result = provider.get_build_directory()
-    self.assertEqual(
-        result, os.path.join(self.chrome_source, 'out', 'clusterfuzz_12345'))
+    pin = mock.Mock()
+    def build_target(builder):
+      builder.build_directory = '/out/dir'
+      builder.out_dir_pin = pin
+    self.mock.build_target.side_effect = build_target
+
+    def acquire(*unused_args, **unused_kwargs):
+      """The checkout is confirmed before the lock is taken."""
+      self.assert_exact_calls(self.mock.confirm_checkout,
+                              [mock.call(provider)])
+      return mock.DEFAULT
+    self.mock.acquire.side_effect = acquire
+
+    self.assertEqual('/out/dir', provider.get_build_directory())
     self.assert_exact_calls(self.mock.build_target, [mock.call(provider)])
     self.assert_exact_calls(self.mock.checkout_source_by_sha,
                             [mock.call(provider)])
+    self.assert_n_calls(1, [self.mock.acquire])
+    self.assert_n_calls(0, [self.mock.checkout_worktree])
+    self.assert_exact_calls(self.mock.store_artifacts, [mock.call(provider)])
+    self.assert_exact_calls(self.mock.acquire, [
+        mock.call(self.chrome_source, key='key', description='r54321 of d8')])
+    self.assert_exact_calls(self.mock.get_artifact_key, [
+        mock.call(provider, {'is_asan': 'true'})])
+    self.assert_n_calls(1, [self.mock.restore_artifacts])
+    self.assert_exact_calls(self.mock.share_pin, [mock.call(pin)])
+    self.assert_n_calls(0, [self.mock.wait_for_out_dir])
+
+  def test_out_dir_busy(self):
+    """Tests waiting for a busy out dir outside of the queue, and queueing
+      again."""
+    self.mock_os_environment({'V8_SRC': self.chrome_source})
+    testcase = mock.Mock(id=12345, build_url=self.build_url, revision=54321,
+                         gn_args=None)
+    provider = binary_providers.V8Builder(
+        testcase, mock.Mock(source_var='V8_SRC'), libs.make_options())
+    self.mock.build_target.side_effect = [
+        binary_providers.OutDirBusyError('clusterfuzz_1234'), None]
+    lock = self.mock.acquire.return_value
+    self.mock.wait_for_out_dir.side_effect = (
+        lambda builder, key: self.assert_n_calls(1, [lock.__exit__]))
+
+    provider.get_build_directory()
+    self.assert_n_calls(2, [
+        self.mock.acquire, self.mock.build_target,
+        self.mock.checkout_source_by_sha])
+    self.assert_exact_calls(self.mock.wait_for_out_dir, [
+        mock.call(provider, 'clusterfuzz_1234')])
+    self.assert_exact_calls(self.mock.store_artifacts, [mock.call(provider)])
+    self.assert_n_calls(1, [self.mock.share_pin])
+
+  def test_queued(self):
+    """Tests reusing the build of a process ahead in the queue."""
+    self.mock_os_environment({'V8_SRC': self.chrome_source})
+    testcase = mock.Mock(id=12345, build_url=self.build_url, revision=54321,
+                         gn_args=None)
+    provider = binary_providers.V8Builder(
+        testcase, mock.Mock(source_var='V8_SRC'),
+        libs.make_options(current=True))
+    self.mock.acquire.return_value.__enter__.return_value = True
+
+    def restore(builder):
+      if self.mock.restore_artifacts.call_count == 1:
+        return False
+      builder.build_directory = '/artifacts/key'
+      return True
+    self.mock.restore_artifacts.side_effect = restore
+
+    self.assertEqual('/artifacts/key', provider.get_build_directory())
+    self.assert_exact_calls(self.mock.acquire, [
+        mock.call(self.chrome_source, key=None, description='r54321 of d8')])
+    self.assert_n_calls(0, [
+        self.mock.checkout_source_by_sha, self.mock.confirm_checkout,
+        self.mock.build_target, self.mock.store_artifacts])
+
+  def test_restore(self):
+    """Tests using a cached build without touching the source."""
+    self.mock_os_environment({'V8_SRC': self.chrome_source})
+    testcase = mock.Mock(id=12345, build_url=self.build_url, revision=54321,
+                         gn_args=None)
+    provider = binary_providers.V8Builder(
+        testcase, mock.Mock(source_var='V8_SRC'), libs.make_options())
+
+    def restore(builder):
+      builder.build_directory = '/artifacts/key'
+      return True
+    self.mock.restore_artifacts.side_effect = restore
+
+    self.assertEqual('/artifacts/key', provider.get_build_directory())
+    self.assert_n_calls(0, [
+        self.mock.checkout_source_by_sha, self.mock.checkout_worktree,
+        self.mock.build_target, self.mock.store_artifacts])
+
+  def test_worktree(self):
+    """Tests building in a worktree."""
+    self.mock_os_environment({'V8_SRC': self.chrome_source})
+    testcase = mock.Mock(id=12345, build_url=self.build_url, revision=54321,
+                         gn_args=None)
+    definition = mock.Mock(source_var='V8_SRC')
+    provider = binary_providers.V8Builder(
+        testcase, definition,
+        libs.make_options(testcase_id=testcase.id, worktree=True))
+
+    provider.get_build_directory()
+    self.assert_exact_calls(self.mock.checkout_worktree, [mock.call(provider)])
+    self.assert_exact_calls(self.mock.build_target, [mock.call(provider)])
+    self.assert_n_calls(0, [
+        self.mock.checkout_source_by_sha, self.mock.confirm_checkout,
+        self.mock.acquire])
 
   def test_parameter_already_set(self):
     """Tests functionality when build_directory parameter is already set."""
@@ -200,17 +640,208 @@ class BuildTest(helpers.ExtendedTestCase):
     self.assertEqual(result, 'dir/already/set')
 
 
+class ArtifactsTest(helpers.ExtendedTestCase):
+  """Tests restore_artifacts and store_artifacts."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+    helpers.patch(self, [
+        'clusterfuzz.revisions.get_sha',
+        'clusterfuzz.artifacts.restore',
+        'clusterfuzz.artifacts.store',
+        'clusterfuzz.binary_providers.ensure_sha',
+        'clusterfuzz.nearest.find',
+        'clusterfuzz.ninja.get_inputs'])
+    self.mock.get_sha.return_value = 'sha'
+    self.mock_os_environment({'V8_SRC': '/src'})
+    self.testcase = mock.Mock(
+        id=1234, build_url='', revision=54321, gn_args='is_asan = true')
+    self.definition = mock.Mock(source_var='V8_SRC', sanitizer='ASAN')
+
+  def make_builder(self, **options):
+    return binary_providers.V8Builder(
+        self.testcase, self.definition,
+        libs.make_options(goma_dir='/goma', **options))
+
+  def test_restore(self):
+    """Tests restoring a cached build."""
+    self.mock.restore.return_value = ('/artifacts/key', 'pin')
+    builder = self.make_builder()
+
+    self.assertTrue(builder.restore_artifacts())
+    self.assertEqual('/artifacts/key', builder.build_directory)
+    self.assertEqual('pin', builder.artifact_pin)
+    self.mock.restore.assert_called_once_with(artifacts.get_key(
+        'sha', {'is_asan': 'true', 'goma_dir': '"/goma"'}, 'd8', 'ASAN'))
+
+  def test_miss(self):
+    """Tests a build that isn't cached."""
+    self.mock.restore.return_value = (None, None)
+    builder = self.make_builder()
+
+    self.assertFalse(builder.restore_artifacts())
+    self.assertIsNone(builder.build_directory)
+    self.assert_n_calls(0, [self.mock.find])
+
+  def test_nearest(self):
+    """Tests restoring the build of a nearby revision."""
+    self.mock.restore.side_effect = [
+        (None, None), ('/artifacts/nearest', 'pin')]
+    self.mock.find.return_value = 'nearest'
+    builder = self.make_builder(reuse_nearest=True)
+
+    self.assertTrue(builder.restore_artifacts())
+    self.assertEqual('/artifacts/nearest', builder.build_directory)
+    self.mock.ensure_sha.assert_called_once_with('sha', '/src')
+    self.mock.find.assert_called_once_with(
+        '/src', 'sha', 54321, artifacts.get_variant(
+            {'is_asan': 'true', 'goma_dir': '"/goma"'}, 'd8', 'ASAN'))
+    self.mock.restore.assert_called_with('nearest')
+
+  def test_no_nearest(self):
+    """Tests building when no nearby build can be reused."""
+    self.mock.restore.return_value = (None, None)
+    self.mock.find.return_value = None
+    builder = self.make_builder(reuse_nearest=True)
+
+    self.assertFalse(builder.restore_artifacts())
+    self.assert_n_calls(1, [self.mock.restore])
+
+  def test_current(self):
+    """Tests that the cache isn't used with --current or --edit-mode."""
+    self.assertFalse(self.make_builder(current=True).restore_artifacts())
+    self.assertFalse(self.make_builder(edit_mode=True).restore_artifacts())
+    self.assert_n_calls(0, [self.mock.restore])
+
+    builder = self.make_builder(current=True)
+    builder.store_artifacts()
+    self.assert_n_calls(0, [self.mock.store])
+
+  def test_store(self):
+    """Tests storing the build with its final args.gn."""
+    builder = self.make_builder(edit_mode=True)
+    builder.gn_args = {'is_asan': 'true', 'is_debug': 'true'}
+    builder.build_directory = '/src/out/dir'
+    builder.store_artifacts()
+
+    self.mock.store.assert_called_once_with(
+        artifacts.get_key('sha', builder.gn_args, 'd8', 'ASAN'),
+        '/src/out/dir', 'd8', '/src', get_inputs=None,
+        variant=artifacts.get_variant(builder.gn_args, 'd8', 'ASAN'),
+        sha='sha', revision=54321)
+
+  def test_store_inputs(self):
+    """Tests recording the inputs with --reuse-nearest."""
+    builder = self.make_builder(reuse_nearest=True)
+    builder.gn_args = {'is_asan': 'true'}
+    builder.build_directory = '/src/out/dir'
+    builder.store_artifacts()
+
+    self.mock.store.call_args[1]['get_inputs']()
+    self.mock.get_inputs.assert_called_once_with('/src/out/dir', 'd8', '/src')
+
+
+class LinkBuildTest(helpers.ExtendedTestCase):
+  """Test link_build."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+    os.makedirs('/builds/abc')
+    os.makedirs('/builds/def')
+
+  def test_link(self):
+    """Test linking a new reference."""
+    binary_providers.link_build('/builds/1_build', '/builds/abc')
+    self.assertEqual('/builds/abc', os.readlink('/builds/1_build'))
+
+  def test_relink(self):
+    """Test pointing a reference at another build."""
+    os.symlink('/builds/def', '/builds/1_build')
+    binary_providers.link_build('/builds/1_build', '/builds/abc')
+    self.assertEqual('/builds/abc', os.readlink('/builds/1_build'))
+
+  def test_old_directory(self):
+    """Test replacing a directory left by an older version."""
+    self.fs.CreateFile('/builds/1_build/d8')
+    binary_providers.link_build('/builds/1_build', '/builds/abc')
+    self.assertEqual('/builds/abc', os.readlink('/builds/1_build'))
+
+
+class DeleteDanglingBuildLinksTest(helpers.ExtendedTestCase):
+  """Test delete_dangling_build_links."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+
+  def test_delete(self):
+    """Test deleting only the dangling links."""
+    builds_dir = common.CLUSTERFUZZ_BUILDS_DIR
+    os.makedirs(os.path.join(builds_dir, 'abc'))
+    os.symlink(os.path.join(builds_dir, 'abc'),
+               os.path.join(builds_dir, '1_build'))
+    os.symlink(os.path.join(builds_dir, 'def'),
+               os.path.join(builds_dir, '2_build'))
+
+    binary_providers.delete_dangling_build_links()
+
+    self.assertEqual(['1_build', 'abc'], sorted(os.listdir(builds_dir)))
+
+
+class PinBuildTest(helpers.ExtendedTestCase):
+  """Test pin_build."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.binary_providers.is_build_complete',
+                         'clusterfuzz.binary_providers.logger'])
+    self.cache = mock.Mock()
+    self.shared = mock.Mock()
+    self.exclusive = mock.Mock()
+
+  def test_complete(self):
+    """Test sharing the pin of a complete build."""
+    self.mock.is_build_complete.return_value = True
+    self.cache.pin.return_value = self.shared
+
+    self.assertEqual(self.shared, binary_providers.pin_build(self.cache, 'k'))
+    self.cache.pin.assert_called_once_with('k')
+
+  def test_partial(self):
+    """Test pinning a partial build exclusively, after the process that is
+      extracting it."""
+    self.mock.is_build_complete.return_value = False
+    self.cache.pin.side_effect = [self.shared, None, self.exclusive]
+
+    self.assertEqual(
+        self.exclusive, binary_providers.pin_build(self.cache, 'k'))
+    self.shared.close.assert_called_once_with()
+    self.assert_exact_calls(self.cache.pin, [
+        mock.call('k'), mock.call('k', exclusive=True, blocking=False),
+        mock.call('k', exclusive=True)])
+    self.assert_n_calls(1, [self.mock.logger.info])
+
+
 class DownloadedBuildGetBinaryDirectoryTest(helpers.ExtendedTestCase):
   """Test get_build_directory inside the V8DownloadedBuild class."""
 
   def setUp(self):
     helpers.patch(self, [
+        'clusterfuzz.binary_providers.delete_dangling_build_links',
         'clusterfuzz.binary_providers.download_build',
-        'clusterfuzz.common.get_source_directory'
+        'clusterfuzz.binary_providers.get_build_cache',
+        'clusterfuzz.binary_providers.is_build_complete',
+        'clusterfuzz.binary_providers.link_build',
+        'clusterfuzz.binary_providers.pin_build',
+        'clusterfuzz.common.get_source_directory',
+        'clusterfuzz.disk_cache.share_pin'
     ])
 
     self.build_url = 'https://storage.cloud.google.com/abc.zip'
-    self.build_dir = os.path.join(common.CLUSTERFUZZ_BUILDS_DIR, '12345_build')
+    self.key = hashlib.sha1(self.build_url).hexdigest()
+    self.build_dir = os.path.join(common.CLUSTERFUZZ_BUILDS_DIR, self.key)
+    self.cache = self.mock.get_build_cache.return_value
+    self.cache.get_path.return_value = self.build_dir
+    self.cache.evict.return_value = []
+    self.mock.is_build_complete.side_effect = [False, True]
     self.provider = binary_providers.DownloadedBinary(
         12345, self.build_url, 'd8')
     self.provider.source_directory = ''
@@ -219,10 +850,25 @@ class DownloadedBuildGetBinaryDirectoryTest(helpers.ExtendedTestCase):
     """Tests functionality when build has never been downloaded."""
     result = self.provider.get_build_directory()
     self.assertEqual(result, self.build_dir)
+    pin = self.mock.pin_build.return_value
+    self.assertEqual(pin, self.provider.build_pin)
+    self.mock.pin_build.assert_called_once_with(self.cache, self.key)
     self.mock.download_build.assert_called_once_with(
-        self.build_dir, self.build_url, 'd8')
+        self.build_dir, self.build_url, 'd8', True, pin)
+    self.mock.share_pin.assert_called_once_with(pin)
+    self.cache.use.assert_called_once_with(self.key, False, True)
+    self.mock.link_build.assert_called_once_with(
+        os.path.join(common.CLUSTERFUZZ_BUILDS_DIR, '12345_build'),
+        self.build_dir)
+    self.assert_n_calls(0, [self.mock.delete_dangling_build_links])
     self.mock.get_source_directory.assert_called_once_with('chromium')
 
+  def test_evicted(self):
+    """Tests deleting the links to evicted builds."""
+    self.cache.evict.return_value = ['abc']
+    self.provider.get_build_directory()
+    self.mock.delete_dangling_build_links.assert_called_once_with()
+
   def test_parameter_already_set(self):
     """Tests functionality when the build_directory parameter is already set."""
     provider = binary_providers.DownloadedBinary(12345, self.build_url, 'd8')
@@ -237,15 +883,23 @@ class BuildTargetTest(helpers.ExtendedTestCase):
   """Tests the build_chrome method."""
 
   def setUp(self):
+    self.setup_fake_filesystem()
     helpers.patch(self, [
         'clusterfuzz.binary_providers.V8Builder.get_goma_cores',
         'clusterfuzz.binary_providers.V8Builder.get_goma_load',
         'clusterfuzz.binary_providers.V8Builder.setup_gn_args',
         'clusterfuzz.binary_providers.V8Builder.gn_gen',
-        'clusterfuzz.binary_providers.sha_from_revision',
-        'clusterfuzz.common.execute'])
+        'clusterfuzz.binary_providers.V8Builder.edit_gn_args',
+        'clusterfuzz.binary_providers.V8Builder.acquire_out_dir',
+        'clusterfuzz.binary_providers.V8Builder.update_out_dir_cache',
+        'clusterfuzz.ninja.plan',
+        'clusterfuzz.revisions.get_sha',
+        'clusterfuzz.common.execute',
+        'clusterfuzz.common.start_execute',
+        'clusterfuzz.common.wait_execute'])
     self.mock.get_goma_cores.return_value = 120
     self.mock.get_goma_load.return_value = 8
+    self.mock.plan.return_value = ninja.Plan(edges=10, estimate=5.0)
 
   def test_correct_calls(self):
     """Tests the correct checks and commands are run to build."""
@@ -261,22 +915,134 @@ class BuildTargetTest(helpers.ExtendedTestCase):
     builder.build_directory = '/chrome/source/out/clusterfuzz_54321'
     builder.build_target()
 
-    self.assert_exact_calls(self.mock.execute, [
+    # The sync, the hooks and install_deps run one after the other.
+    self.assertEqual([
         mock.call('gclient', 'sync --no-history --shallow', chrome_source),
         mock.call('gclient', 'runhooks', chrome_source),
-        mock.call('python', 'tools/clang/scripts/update.py', chrome_source),
-        mock.call(
-            'ninja',
-            ("-w 'dupbuild=err' -C /chrome/source/out/clusterfuzz_54321 "
-             '-j 120 -l 8 d8'),
-            chrome_source,
-            capture_output=False,
-            stdout_transformer=mock.ANY)
-    ])
+        mock.call('python', 'tools/clang/scripts/update.py', chrome_source)
+    ], self.mock.execute.call_args_list[:3])
+    self.mock.start_execute.assert_called_once_with(
+        'ninja',
+        ("-w 'dupbuild=err' -C /chrome/source/out/clusterfuzz_54321 "
+         '-j 120 -l 8 d8'),
+        chrome_source)
+    self.mock.wait_execute.assert_called_once_with(
+        self.mock.start_execute.return_value, exit_on_error=True,
+        capture_output=False, stdout_transformer=mock.ANY)
     self.assertIsInstance(
-        self.mock.execute.call_args[1]['stdout_transformer'],
+        self.mock.wait_execute.call_args[1]['stdout_transformer'],
         output_transformer.Ninja)
     self.assert_exact_calls(self.mock.setup_gn_args, [mock.call(builder)])
+    self.mock.plan.assert_called_once_with(
+        '/chrome/source/out/clusterfuzz_54321', 'd8', chrome_source, 120)
+    self.mock.update_out_dir_cache.assert_called_once_with(builder)
+
+  def test_up_to_date(self):
+    """Tests skipping ninja when no edge is dirty."""
+    self.mock.plan.return_value = ninja.Plan(edges=0, estimate=0.0)
+    self.mock_os_environment({'V8_SRC': '/chrome/source'})
+    builder = binary_providers.V8Builder(
+        mock.Mock(id=54321, build_url='', revision=12345),
+        mock.Mock(source_var='V8_SRC', binary_name='binary'),
+        libs.make_options(skip_deps=True))
+    builder.build_directory = '/chrome/source/out/clusterfuzz_54321'
+    builder.build_target()
+
+    self.assert_n_calls(0, [self.mock.execute, self.mock.start_execute])
+    self.mock.update_out_dir_cache.assert_called_once_with(builder)
+
+  def test_no_plan(self):
+    """Tests running ninja when the dry run fails."""
+    self.mock.plan.return_value = None
+    self.mock_os_environment({'V8_SRC': '/chrome/source'})
+    builder = binary_providers.V8Builder(
+        mock.Mock(id=54321, build_url='', revision=12345),
+        mock.Mock(source_var='V8_SRC', binary_name='binary'),
+        libs.make_options(skip_deps=True))
+    builder.build_directory = '/chrome/source/out/clusterfuzz_54321'
+    builder.build_target()
+
+    self.assertEqual('ninja', self.mock.start_execute.call_args[0][0])
+
+  def make_goma_builder(self):
+    """Return a builder that uses goma."""
+    self.mock_os_environment({'V8_SRC': '/chrome/source'})
+    builder = binary_providers.V8Builder(
+        mock.Mock(id=54321, build_url='', revision=12345),
+        mock.Mock(source_var='V8_SRC', binary_name='binary'),
+        libs.make_options(skip_deps=True, goma_dir='/goma'))
+    builder.gn_args = {'use_goma': 'true', 'goma_dir': '"/goma"'}
+    builder.build_directory = '/chrome/source/out/clusterfuzz_54321'
+    return builder
+
+  def test_goma_unhealthy(self):
+    """Tests building locally when goma is unhealthy before the build."""
+    helpers.patch(self, ['clusterfuzz.goma.check'])
+    self.mock.check.return_value = False
+    builder = self.make_goma_builder()
+    builder.build_target()
+
+    self.assertIsNone(builder.options.goma_dir)
+    self.assertEqual({'use_goma': 'false'}, builder.gn_args)
+    self.assert_n_calls(1, [self.mock.start_execute])
+
+  def test_goma_check_overlaps_sync(self):
+    """Tests that the sync doesn't wait for the goma check, and the out dir
+      does."""
+    helpers.patch(self, ['clusterfuzz.goma.check'])
+    checking = threading.Event()
+    synced = threading.Event()
+    def check():
+      checking.set()
+      return synced.wait(5)
+    self.mock.check.side_effect = check
+    self.mock.acquire_out_dir.side_effect = (
+        lambda unused_self: self.assertTrue(self.mock.check.called))
+    builder = self.make_goma_builder()
+    builder.options.skip_deps = False
+    builder.gclient_sync = lambda: synced.set() if checking.wait(5) else None
+    builder.build_target()
+
+    self.assertTrue(synced.is_set())
+    self.assertEqual('/goma', builder.options.goma_dir)
+
+  def test_goma_stalls(self):
+    """Tests restarting the build locally when goma stays unhealthy. The
+      stopped build isn't recorded."""
+    helpers.patch(self, [
+        'clusterfuzz.goma.check',
+        'clusterfuzz.goma.Monitor',
+        'clusterfuzz.concurrency.record'])
+    self.mock.check.return_value = True
+    monitor = self.mock.Monitor.return_value.__enter__.return_value
+    monitor.tripped = True
+    self.mock.wait_execute.side_effect = [
+        error.CommandFailedError('ninja', -15, ''), None]
+    builder = self.make_goma_builder()
+    builder.build_target()
+
+    self.assertIsNone(builder.options.goma_dir)
+    self.assertEqual({'use_goma': 'false'}, builder.gn_args)
+    self.assert_n_calls(2, [self.mock.start_execute, self.mock.acquire_out_dir])
+    self.assertEqual(
+        [mock.call(self.mock.start_execute.return_value, enabled=True),
+         mock.call(self.mock.start_execute.return_value, enabled=False)],
+        self.mock.Monitor.call_args_list)
+    self.mock.update_out_dir_cache.assert_called_once_with(builder)
+    self.assert_n_calls(0, [self.mock.record])
+
+  def test_build_fails(self):
+    """Tests that a failure with healthy goma isn't retried."""
+    helpers.patch(self, ['clusterfuzz.goma.check', 'clusterfuzz.goma.Monitor'])
+    self.mock.check.return_value = True
+    self.mock.Monitor.return_value.__enter__.return_value.tripped = False
+    self.mock.wait_execute.side_effect = error.CommandFailedError(
+        'ninja', 1, '')
+    builder = self.make_goma_builder()
+
+    with self.assertRaises(error.CommandFailedError):
+      builder.build_target()
+    self.assertEqual('/goma', builder.options.goma_dir)
 
 
 class SetupGnArgsTest(helpers.ExtendedTestCase):
@@ -286,7 +1052,7 @@ class SetupGnArgsTest(helpers.ExtendedTestCase):
     self.setup_fake_filesystem()
     helpers.patch(self, [
         'clusterfuzz.common.execute',
-        'clusterfuzz.binary_providers.sha_from_revision',
+        'clusterfuzz.revisions.get_sha',
         'clusterfuzz.binary_providers.setup_debug_symbol_if_needed',
         'clusterfuzz.binary_providers.setup_gn_goma_params',
     ])
@@ -312,6 +1078,64 @@ class SetupGnArgsTest(helpers.ExtendedTestCase):
         {'random': 'value', 'yes': 'no'}, self.definition.sanitizer, False)
     self.assertEqual(
         {'random': 'value', 'yes': 'no'}, self.builder.gn_args)
+    self.assertEqual({}, self.builder.fast_build_overrides)
+
+  def test_fast_build(self):
+    """Tests applying the fast build overrides."""
+    self.definition.sanitizer = 'ASAN'
+    self.builder.options.fast_build = True
+    self.builder.gn_args = 'is_asan = true\nsymbol_level = 2'
+    self.builder.setup_gn_args()
+
+    self.assertEqual(
+        {'is_asan': 'true', 'symbol_level': '1', 'enable_nacl': 'false',
+         'use_dummy_lastchange': 'true'}, self.builder.gn_args)
+    self.assertEqual(
+        {'symbol_level': '2', 'enable_nacl': None,
+         'use_dummy_lastchange': None}, self.builder.fast_build_overrides)
+
+  def test_fast_build_with_debug(self):
+    """Tests that the symbols of --enable-debug win over the overrides."""
+    self.definition.sanitizer = 'ASAN'
+    self.builder.options.fast_build = True
+    self.builder.gn_args = 'symbol_level = 2'
+    self.mock.setup_debug_symbol_if_needed.side_effect = (
+        lambda v, _1, _2: dict(v, symbol_level='2'))
+    self.builder.setup_gn_args()
+
+    self.assertEqual('2', self.builder.gn_args['symbol_level'])
+    self.assertEqual(
+        {'enable_nacl': None, 'use_dummy_lastchange': None},
+        self.builder.fast_build_overrides)
+
+
+class SetupFastBuildTest(helpers.ExtendedTestCase):
+  """Tests setup_fast_build."""
+
+  def test_unknown_sanitizer(self):
+    """Test that only vetted sanitizers get the overrides."""
+    gn_args = {'symbol_level': '2'}
+    self.assertEqual({}, binary_providers.setup_fast_build(gn_args, None))
+    self.assertEqual({'symbol_level': '2'}, gn_args)
+
+  def test_unchanged(self):
+    """Test that args already at their fast value aren't recorded."""
+    gn_args = {'symbol_level': '1', 'enable_nacl': 'false',
+               'use_dummy_lastchange': 'true', 'is_msan': 'true'}
+    self.assertEqual({}, binary_providers.setup_fast_build(gn_args, 'MSAN'))
+
+  def test_sanitizer_args(self):
+    """Test that the overrides never change the instrumentation."""
+    for key in binary_providers.FAST_BUILD_GN_ARGS:
+      self.assertFalse(
+          key.startswith(binary_providers.SANITIZER_GN_ARG_PREFIXES))
+
+    gn_args = {'msan_track_origins': '2'}
+    with mock.patch.dict(binary_providers.FAST_BUILD_GN_ARGS,
+                         {'msan_track_origins': '0'}):
+      overrides = binary_providers.setup_fast_build(gn_args, 'MSAN')
+    self.assertNotIn('msan_track_origins', overrides)
+    self.assertEqual('2', gn_args['msan_track_origins'])
 
 
 class DeserializeGnArgsTest(helpers.ExtendedTestCase):
@@ -335,7 +1159,7 @@ class SetupAllDepsTest(helpers.ExtendedTestCase):
   def setUp(self):
     self.setup_fake_filesystem()
     helpers.patch(self, [
-        'clusterfuzz.binary_providers.sha_from_revision',
+        'clusterfuzz.revisions.get_sha',
         'clusterfuzz.binary_providers.V8Builder.gclient_sync',
         'clusterfuzz.binary_providers.V8Builder.gclient_runhooks',
         'clusterfuzz.binary_providers.V8Builder.install_deps',
@@ -367,6 +1191,54 @@ class SetupAllDepsTest(helpers.ExtendedTestCase):
     self.mock.gclient_runhooks.assert_called_once_with(builder)
     self.mock.install_deps.assert_called_once_with(builder)
 
+  def test_serial(self):
+    """Test that the steps run one after the other."""
+    builder = binary_providers.V8Builder(
+        self.testcase, self.definition,
+        libs.make_options(goma_dir='/goma/dir', skip_deps=False))
+    sync, runhooks, install_deps, _ = builder.get_deps_tasks()
+    self.assertEqual([sync], runhooks.deps)
+    self.assertEqual([runhooks], install_deps.deps)
+
+  def test_unchanged(self):
+    """Test skipping when DEPS is the same as at the last sync."""
+    self.fs.CreateFile('/chrome/source/dir/DEPS', contents='deps')
+    builder = binary_providers.V8Builder(
+        self.testcase, self.definition,
+        libs.make_options(goma_dir='/goma/dir', skip_deps=False))
+    builder.setup_all_deps()
+    builder.setup_all_deps()
+    self.assert_n_calls(1, [
+        self.mock.gclient_sync,
+        self.mock.gclient_runhooks,
+        self.mock.install_deps])
+
+  def test_changed(self):
+    """Test syncing again when DEPS has changed."""
+    self.fs.CreateFile('/chrome/source/dir/DEPS', contents='deps')
+    builder = binary_providers.V8Builder(
+        self.testcase, self.definition,
+        libs.make_options(goma_dir='/goma/dir', skip_deps=False))
+    builder.setup_all_deps()
+    with open('/chrome/source/dir/DEPS', 'w') as f:
+      f.write('new deps')
+    builder.setup_all_deps()
+    self.assert_n_calls(2, [
+        self.mock.gclient_sync,
+        self.mock.gclient_runhooks,
+        self.mock.install_deps])
+
+  def test_failed(self):
+    """Test not writing the stamp when a step fails."""
+    self.mock.install_deps.side_effect = Exception('failed')
+    builder = binary_providers.V8Builder(
+        self.testcase, self.definition,
+        libs.make_options(goma_dir='/goma/dir', skip_deps=False))
+    with self.assertRaises(Exception):
+      builder.setup_all_deps()
+    self.assertFalse(os.path.exists(
+        binary_providers.get_deps_stamp_path('/chrome/source/dir')))
+
 
 class GnGenTest(helpers.ExtendedTestCase):
   """Test gn_gen."""
@@ -375,7 +1247,7 @@ class GnGenTest(helpers.ExtendedTestCase):
     self.setup_fake_filesystem()
     helpers.patch(self, [
         'clusterfuzz.common.execute',
-        'clusterfuzz.binary_providers.sha_from_revision',
+        'clusterfuzz.revisions.get_sha',
         'clusterfuzz.common.edit_if_needed',
     ])
     self.testcase_dir = os.path.expanduser(os.path.join('~', 'test_dir'))
@@ -399,9 +1271,68 @@ class GnGenTest(helpers.ExtendedTestCase):
 
     self.mock.execute.assert_called_once_with(
         'gn', 'gen --check /test/build_dir', '/chrome/source/dir')
+    self.assert_n_calls(0, [self.mock.edit_if_needed])
+
+  def test_unchanged(self):
+    """Ensure gn gen is skipped when args.gn is unchanged."""
+    self.fs.CreateFile('/test/build_dir/args.gn', contents='random = value')
+    self.fs.CreateFile('/test/build_dir/build.ninja')
+    os.utime('/test/build_dir/args.gn', (1, 1))
+    self.builder.gn_args = {'random': 'value'}
+    self.builder.build_directory = '/test/build_dir'
+    self.builder.gn_gen()
+
+    self.assert_n_calls(0, [self.mock.execute])
+
+  def test_concurrent_links(self):
+    """Ensure gn gen is skipped when only the link pool has changed."""
+    self.fs.CreateFile(
+        '/test/build_dir/args.gn',
+        contents='concurrent_links = 4\nrandom = value')
+    self.fs.CreateFile('/test/build_dir/build.ninja')
+    os.utime('/test/build_dir/args.gn', (1, 1))
+    self.builder.gn_args = {'concurrent_links': '8', 'random': 'value'}
+    self.builder.build_directory = '/test/build_dir'
+    self.builder.gn_gen()
+
+    self.assert_n_calls(0, [self.mock.execute])
+
+  def test_changed(self):
+    """Ensure gn gen runs again, without --check, when args.gn has
+      changed."""
+    self.fs.CreateFile('/test/build_dir/args.gn', contents='random = value')
+    self.fs.CreateFile('/test/build_dir/build.ninja')
+    self.builder.gn_args = {'random': 'other'}
+    self.builder.build_directory = '/test/build_dir'
+    self.builder.gn_gen()
+
+    with open('/test/build_dir/args.gn', 'r') as f:
+      self.assertEqual(f.read(), 'random = other')
+    self.mock.execute.assert_called_once_with(
+        'gn', 'gen /test/build_dir', '/chrome/source/dir')
+
+  def test_stale(self):
+    """Ensure gn gen runs again when build.ninja is older than args.gn."""
+    self.fs.CreateFile('/test/build_dir/args.gn', contents='random = value')
+    self.fs.CreateFile('/test/build_dir/build.ninja')
+    os.utime('/test/build_dir/build.ninja', (1, 1))
+    self.builder.gn_args = {'random': 'value'}
+    self.builder.build_directory = '/test/build_dir'
+    self.builder.gn_gen()
+
+    self.assert_n_calls(1, [self.mock.execute])
+
+  def test_edit_gn_args(self):
+    """Ensure args.gn can be edited."""
+    self.mock.edit_if_needed.side_effect = (
+        lambda content, prefix, comment, should_edit: content + '\nnew = 1')
+    self.builder.gn_args = {'random': 'value'}
+    self.builder.edit_gn_args()
+
+    self.assertEqual({'random': 'value', 'new': '1'}, self.builder.gn_args)
     self.mock.edit_if_needed.assert_called_once_with(
-        'another = value2\nrandom = value', prefix=mock.ANY,
-        comment=mock.ANY, should_edit=False)
+        'random = value', prefix=mock.ANY, comment=mock.ANY,
+        should_edit=False)
 
 
 class CheckoutSourceByShaTest(helpers.ExtendedTestCase):
@@ -412,9 +1343,9 @@ class CheckoutSourceByShaTest(helpers.ExtendedTestCase):
         'clusterfuzz.common.execute',
         'clusterfuzz.common.check_confirm',
         'clusterfuzz.binary_providers.ensure_sha',
-        'clusterfuzz.binary_providers.get_current_sha',
-        'clusterfuzz.binary_providers.sha_from_revision',
-        'clusterfuzz.binary_providers.is_repo_dirty',
+        'clusterfuzz.git_batch.get_current_sha',
+        'clusterfuzz.revisions.get_sha',
+        'clusterfuzz.git_batch.is_repo_dirty',
     ])
     self.chrome_source = '/usr/local/google/home/user/repos/chromium/src'
     self.testcase = mock.Mock(id=12345, build_url='', revision=4567)
@@ -461,72 +1392,245 @@ class CheckoutSourceByShaTest(helpers.ExtendedTestCase):
     self.mock.get_current_sha.assert_called_once_with(self.chrome_source)
     self.assert_n_calls(0, [self.mock.check_confirm, self.mock.execute])
 
+  def test_already_confirmed(self):
+    """Tests not asking again once the lock is held."""
+    self.mock.get_current_sha.return_value = 'aaa'
+    self.mock.is_repo_dirty.return_value = False
+    self.builder.confirm_checkout()
+    self.builder.checkout_source_by_sha()
+
+    self.assert_n_calls(1, [self.mock.check_confirm])
+    self.mock.execute.assert_called_once_with(
+        'git', 'checkout 1a2s3d4f', self.chrome_source)
 
-class EnsureShaTest(helpers.ExtendedTestCase):
-  """Tests ensure_sha."""
+
+class CheckoutWorktreeTest(helpers.ExtendedTestCase):
+  """Tests the checkout_worktree method."""
 
   def setUp(self):
     helpers.patch(self, [
-        'clusterfuzz.common.execute',
-        'clusterfuzz.binary_providers.sha_exists',
+        'clusterfuzz.binary_providers.ensure_sha',
+        'clusterfuzz.revisions.get_sha',
+        'clusterfuzz.worktrees.checkout',
     ])
+    self.mock_os_environment({'V8_SRC': '/chromium/src'})
+    self.mock.get_sha.return_value = '1a2s3d4f'
+    self.mock.checkout.return_value = ('/worktree/src', 'pin')
+    self.builder = binary_providers.ChromiumBuilder(
+        mock.Mock(id=12345, build_url='', revision=4567),
+        mock.Mock(source_var='V8_SRC', binary_name='binary'),
+        libs.make_options(worktree=True))
+
+  def test_checkout(self):
+    """Test switching the source directory to the worktree."""
+    self.builder.checkout_worktree()
+
+    self.mock.ensure_sha.assert_called_once_with('1a2s3d4f', '/chromium/src')
+    self.mock.checkout.assert_called_once_with(
+        '/chromium/src', '1a2s3d4f', 4567)
+    self.assertEqual('/worktree/src', self.builder.source_directory)
+    self.assertEqual('pin', self.builder.worktree_pin)
+
+  def test_skip_deps_not_synced(self):
+    """Test refusing --skip-deps in a worktree that has never been synced."""
+    self.builder.options.skip_deps = True
+    with self.assertRaises(error.WorktreeDepsNotSyncedError):
+      self.builder.checkout_worktree()
+
+  def test_skip_deps_synced(self):
+    """Test --skip-deps in a worktree that has been synced."""
+    self.setup_fake_filesystem()
+    self.fs.CreateFile(
+        binary_providers.get_deps_stamp_path('/worktree/src'), contents='{}')
+    self.builder.options.skip_deps = True
+    self.builder.checkout_worktree()
+    self.assertEqual('/worktree/src', self.builder.source_directory)
 
-  def test_already_exists(self):
-    """Test when sha already exists."""
-    self.mock.sha_exists.return_value = True
-    binary_providers.ensure_sha('sha', 'source')
 
-    self.mock.sha_exists.assert_called_once_with('sha', 'source')
-    self.assertEqual(0, self.mock.execute.call_count)
+class EnsureShaTest(helpers.ExtendedTestCase):
+  """Tests ensure_sha."""
 
-  def test_not_exists(self):
-    """Test when sha doesn't exists."""
-    self.mock.sha_exists.return_value = False
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.fetch.ensure'])
+
+  def test_ensure(self):
+    """Test fetching the sha if needed."""
     binary_providers.ensure_sha('sha', 'source')
+    self.mock.ensure.assert_called_once_with('sha', 'source')
 
-    self.mock.sha_exists.assert_called_once_with('sha', 'source')
-    self.mock.execute.assert_called_once_with(
-        'git', 'fetch origin sha', 'source')
+
+class PrefetchTest(helpers.ExtendedTestCase):
+  """Tests the prefetch method."""
+
+  def setUp(self):
+    helpers.patch(self, [
+        'clusterfuzz.fetch.prefetch',
+        'clusterfuzz.revisions.get_sha',
+    ])
+    self.mock.get_sha.return_value = '1a2s3d4f'
+    self.mock_os_environment({'V8_SRC': '/v8/src'})
+    self.options = libs.make_options()
+    self.builder = binary_providers.V8Builder(
+        mock.Mock(id=1234, build_url='', revision=4567, gn_args=None),
+        mock.Mock(source_var='V8_SRC'), self.options)
+
+  def test_prefetch(self):
+    """Test starting to fetch the revision."""
+    self.builder.prefetch()
+    self.mock.prefetch.assert_called_once_with('1a2s3d4f', '/v8/src')
+
+  def test_current(self):
+    """Test not fetching when the current revision is used."""
+    self.options.current = True
+    self.builder.prefetch()
+    self.assert_n_calls(0, [self.mock.prefetch])
 
 
 class V8BuilderOutDirNameTest(helpers.ExtendedTestCase):
   """Tests the out_dir_name builder method."""
 
   def setUp(self):
-    helpers.patch(self, ['clusterfuzz.binary_providers.sha_from_revision'])
+    helpers.patch(self, ['clusterfuzz.revisions.get_sha',
+                         'clusterfuzz.git_batch.get_current_sha'])
     self.mock_os_environment({'V8_SRC': '/source/dir'})
     testcase = mock.Mock(id=1234, build_url='', revision=54321)
     definition = mock.Mock(source_var='V8_SRC')
     self.builder = binary_providers.V8Builder(
         testcase, definition, libs.make_options(testcase_id=testcase.id))
+    self.builder.gn_args = {'is_asan': 'true'}
+    self.mock.get_current_sha.return_value = 'sha'
 
   def test_dir(self):
-    """Tests when no changes have been made to the dir."""
-    result = self.builder.out_dir_name()
-    self.assertEqual(result, '/source/dir/out/clusterfuzz_1234')
+    """Tests naming the dir by the sha, args.gn and target."""
+    self.assertEqual(
+        '/source/dir/out/%s' % binary_providers.get_out_dir_key(
+            'sha', {'is_asan': 'true'}, 'd8'),
+        self.builder.out_dir_name())
+
+  def test_fingerprint(self):
+    """Tests that any difference makes another out dir."""
+    key = binary_providers.get_out_dir_key('sha', {'a': '1'}, 'd8')
+    self.assertTrue(key.startswith('clusterfuzz_'))
+    self.assertEqual(
+        key, binary_providers.get_out_dir_key('sha', {'a': '1'}, 'd8'))
+    self.assertEqual(4, len(set([
+        key,
+        binary_providers.get_out_dir_key('other', {'a': '1'}, 'd8'),
+        binary_providers.get_out_dir_key('sha', {'a': '2'}, 'd8'),
+        binary_providers.get_out_dir_key('sha', {'a': '1'}, 'chrome')])))
+
+  def test_concurrent_links(self):
+    """Tests that the link pool doesn't make another out dir."""
+    self.assertEqual(
+        binary_providers.get_out_dir_key('sha', {'a': '1'}, 'd8'),
+        binary_providers.get_out_dir_key(
+            'sha', {'a': '1', 'concurrent_links': '4'}, 'd8'))
+
+
+class OutDirCacheTest(helpers.ExtendedTestCase):
+  """Tests acquire_out_dir, wait_for_out_dir and update_out_dir_cache with
+    real flocks."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.revisions.get_sha',
+                         'clusterfuzz.binary_providers.V8Builder.out_dir_name',
+                         'clusterfuzz.disk_cache.get_size'])
+    self.source_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.source_dir)
+    self.mock_os_environment({'V8_SRC': self.source_dir})
+    self.out_dir = os.path.join(self.source_dir, 'out', 'clusterfuzz_abc')
+    self.mock.out_dir_name.return_value = self.out_dir
+    self.mock.get_size.return_value = 100
+    self.builder = binary_providers.V8Builder(
+        mock.Mock(id=1234, build_url='', revision=54321),
+        mock.Mock(source_var='V8_SRC'), libs.make_options())
+
+  def test_new(self):
+    """Tests building in a new out dir, and recording it."""
+    self.builder.acquire_out_dir()
+    self.addCleanup(self.builder.out_dir_pin.close)
+    self.assertEqual(self.out_dir, self.builder.build_directory)
+    self.assertFalse(self.builder.out_dir_hit)
+
+    cache = binary_providers.get_out_dir_cache(self.source_dir)
+    self.assertIsNone(cache.pin('clusterfuzz_abc', blocking=False))
+
+    os.makedirs(self.out_dir)
+    self.builder.update_out_dir_cache()
+    self.assertEqual(100, cache.get_entries()['clusterfuzz_abc']['size'])
+    self.assertEqual(1, cache.get_stats()['misses'])
+
+  def test_reuse(self):
+    """Tests reusing an existing out dir, which is measured again."""
+    os.makedirs(self.out_dir)
+    self.builder.acquire_out_dir()
+    self.addCleanup(self.builder.out_dir_pin.close)
+    self.assertTrue(self.builder.out_dir_hit)
+
+    self.builder.update_out_dir_cache()
+    self.mock.get_size.return_value = 200
+    self.builder.update_out_dir_cache()
+    cache = binary_providers.get_out_dir_cache(self.source_dir)
+    self.assertEqual(200, cache.get_entries()['clusterfuzz_abc']['size'])
+    self.assertEqual(2, cache.get_stats()['hits'])
+
+  def test_busy(self):
+    """Tests failing instead of waiting for an out dir in use, and keeping
+      the pin taken while waiting for it."""
+    cache = binary_providers.get_out_dir_cache(self.source_dir)
+    other = cache.pin('clusterfuzz_abc')
+    with self.assertRaises(binary_providers.OutDirBusyError) as cm:
+      self.builder.acquire_out_dir()
+    self.assertEqual('clusterfuzz_abc', cm.exception.key)
+    self.assertIsNone(self.builder.out_dir_pin)
+
+    other.close()
+    self.builder.wait_for_out_dir('clusterfuzz_abc')
+    pin = self.builder.out_dir_pin
+    self.builder.acquire_out_dir()
+    self.assertIs(pin, self.builder.out_dir_pin)
+
+    self.builder.release()
+    self.assertIsNone(self.builder.out_dir_pin)
+    cache.pin('clusterfuzz_abc', exclusive=True, blocking=False).close()
 
 
 class PdfiumBuildTargetTest(helpers.ExtendedTestCase):
   """Tests the build_target method in PdfiumBuilder."""
 
   def setUp(self):
+    self.setup_fake_filesystem()
     helpers.patch(self, [
         'clusterfuzz.binary_providers.PdfiumBuilder.setup_gn_args',
         'clusterfuzz.binary_providers.PdfiumBuilder.gn_gen',
+        'clusterfuzz.binary_providers.PdfiumBuilder.edit_gn_args',
+        'clusterfuzz.binary_providers.PdfiumBuilder.acquire_out_dir',
+        'clusterfuzz.binary_providers.PdfiumBuilder.update_out_dir_cache',
         'clusterfuzz.common.execute',
+        'clusterfuzz.common.start_execute',
+        'clusterfuzz.common.wait_execute',
         'clusterfuzz.binary_providers.PdfiumBuilder.get_goma_cores',
         'clusterfuzz.binary_providers.PdfiumBuilder.get_goma_load',
-        'clusterfuzz.binary_providers.sha_from_revision',
+        'clusterfuzz.ninja.plan',
+        'clusterfuzz.revisions.get_sha',
         'clusterfuzz.binary_providers.get_pdfium_sha'])
+    self.mock.plan.return_value = ninja.Plan(edges=10, estimate=5.0)
     self.mock.get_goma_cores.return_value = 120
     self.mock.get_goma_load.return_value = 8
-    self.mock.sha_from_revision.return_value = 'chrome_sha'
+    self.mock.get_sha.return_value = 'chrome_sha'
     testcase = mock.Mock(id=1234, build_url='', revision=54321)
-    self.mock_os_environment({'V8_SRC': '/chrome/source/dir'})
+    self.mock_os_environment({'V8_SRC': '/chrome/source/dir',
+                              'CHROMIUM_SRC': '/chromium/src'})
     definition = mock.Mock(source_var='V8_SRC')
     self.builder = binary_providers.PdfiumBuilder(
         testcase, definition, libs.make_options())
 
+  def test_chromium_sha(self):
+    """Ensures that the Chromium checkout is searched for the revision."""
+    self.mock.get_sha.assert_called_once_with(
+        54321, 'chromium/src', '/chromium/src')
+    self.mock.get_pdfium_sha.assert_called_once_with('chrome_sha')
+
   def test_build_target(self):
     """Ensures that all build calls are made correctly."""
     self.builder.build_directory = '/build/dir'
@@ -535,16 +1639,14 @@ class PdfiumBuildTargetTest(helpers.ExtendedTestCase):
     self.builder.build_target()
     self.assert_exact_calls(self.mock.setup_gn_args, [mock.call(self.builder)])
     self.assert_exact_calls(self.mock.execute, [
-        mock.call('gclient', 'sync --no-history --shallow', '/source/dir'),
+        mock.call('gclient', 'sync --no-history --shallow', '/source/dir')])
+    self.assert_exact_calls(self.mock.start_execute, [
         mock.call(
             'ninja',
             "-w 'dupbuild=err' -C /build/dir -j 120 -l 8 pdfium_test",
-            '/source/dir',
-            capture_output=False,
-            stdout_transformer=mock.ANY)
-    ])
+            '/source/dir')])
     self.assertIsInstance(
-        self.mock.execute.call_args[1]['stdout_transformer'],
+        self.mock.wait_execute.call_args[1]['stdout_transformer'],
         output_transformer.Ninja)
 
 
@@ -552,16 +1654,24 @@ class ChromiumBuilderTest(helpers.ExtendedTestCase):
   """Tests the methods in ChromiumBuilder."""
 
   def setUp(self):
+    self.setup_fake_filesystem()
     helpers.patch(self, [
         'clusterfuzz.binary_providers.ChromiumBuilder.get_build_directory',
         'clusterfuzz.binary_providers.ChromiumBuilder.get_goma_cores',
         'clusterfuzz.binary_providers.ChromiumBuilder.get_goma_load',
         'clusterfuzz.binary_providers.ChromiumBuilder.setup_gn_args',
         'clusterfuzz.binary_providers.ChromiumBuilder.gn_gen',
-        'clusterfuzz.binary_providers.sha_from_revision',
+        'clusterfuzz.binary_providers.ChromiumBuilder.edit_gn_args',
+        'clusterfuzz.binary_providers.ChromiumBuilder.acquire_out_dir',
+        'clusterfuzz.binary_providers.ChromiumBuilder.update_out_dir_cache',
+        'clusterfuzz.ninja.plan',
+        'clusterfuzz.revisions.get_sha',
         'clusterfuzz.common.execute',
+        'clusterfuzz.common.start_execute',
+        'clusterfuzz.common.wait_execute',
     ])
-    self.mock.sha_from_revision.return_value = '1a2s3d4f5g'
+    self.mock.plan.return_value = ninja.Plan(edges=10, estimate=5.0)
+    self.mock.get_sha.return_value = '1a2s3d4f5g'
     self.mock.get_build_directory.return_value = '/chromium/build/dir'
     self.testcase = mock.Mock(id=12345, build_url='', revision=4567)
     self.mock_os_environment({'V8_SRC': '/chrome/src'})
@@ -593,20 +1703,20 @@ class ChromiumBuilderTest(helpers.ExtendedTestCase):
 
     self.assert_exact_calls(self.mock.setup_gn_args, [mock.call(self.builder)])
     self.assert_exact_calls(self.mock.get_goma_cores, [mock.call(self.builder)])
-    self.assert_exact_calls(self.mock.execute, [
+    self.assertEqual(
         mock.call('gclient', 'sync --no-history --shallow', '/chrome/src'),
+        self.mock.execute.call_args_list[0])
+    self.assertItemsEqual([
         mock.call('gclient', 'runhooks', '/chrome/src'),
-        mock.call('python', 'tools/clang/scripts/update.py', '/chrome/src'),
-        mock.call(
-            'ninja',
-            ("-w 'dupbuild=err' -C /chrome/src/out/clusterfuzz_builds "
-             '-j 120 -l 8 target'),
-            '/chrome/src',
-            capture_output=False,
-            stdout_transformer=mock.ANY)
-    ])
+        mock.call('python', 'tools/clang/scripts/update.py', '/chrome/src')
+    ], self.mock.execute.call_args_list[1:3])
+    self.mock.start_execute.assert_called_once_with(
+        'ninja',
+        ("-w 'dupbuild=err' -C /chrome/src/out/clusterfuzz_builds "
+         '-j 120 -l 8 target'),
+        '/chrome/src')
     self.assertIsInstance(
-        self.mock.execute.call_args[1]['stdout_transformer'],
+        self.mock.wait_execute.call_args[1]['stdout_transformer'],
         output_transformer.Ninja)
 
   def test_get_binary_path(self):
@@ -621,7 +1731,7 @@ class CfiChromiumBuilderTest(helpers.ExtendedTestCase):
   def setUp(self):
     helpers.patch(self, [
         'clusterfuzz.common.execute',
-        'clusterfuzz.binary_providers.sha_from_revision',
+        'clusterfuzz.revisions.get_sha',
         'clusterfuzz.binary_providers.ChromiumBuilder.install_deps',
         'os.path.exists'
     ])
@@ -658,7 +1768,7 @@ class MsanChromiumBuilderTest(helpers.ExtendedTestCase):
   def setUp(self):
     helpers.patch(self, [
         'clusterfuzz.binary_providers.gclient_runhooks_msan',
-        'clusterfuzz.binary_providers.sha_from_revision'])
+        'clusterfuzz.revisions.get_sha'])
 
     testcase = mock.Mock(id=12345, build_url='', revision=4567, gn_args={})
     self.mock_os_environment({'V8_SRC': '/chrome/src'})
@@ -679,7 +1789,7 @@ class MsanV8BuilderTest(helpers.ExtendedTestCase):
   def setUp(self):
     helpers.patch(self, [
         'clusterfuzz.binary_providers.gclient_runhooks_msan',
-        'clusterfuzz.binary_providers.sha_from_revision'])
+        'clusterfuzz.revisions.get_sha'])
 
     testcase = mock.Mock(id=12345, build_url='', revision=4567,
                          gn_args={'msan_track_origins': '4'})
@@ -701,7 +1811,7 @@ class ChromiumBuilder32BitTest(helpers.ExtendedTestCase):
   def setUp(self):
     helpers.patch(self, [
         'clusterfuzz.binary_providers.install_build_deps_32bit',
-        'clusterfuzz.binary_providers.sha_from_revision',
+        'clusterfuzz.revisions.get_sha',
         'clusterfuzz.binary_providers.ChromiumBuilder.install_deps'])
 
     testcase = mock.Mock(id=12345, build_url='', revision=4567)
@@ -724,7 +1834,7 @@ class V8Builder32BitTest(helpers.ExtendedTestCase):
   def setUp(self):
     helpers.patch(self, [
         'clusterfuzz.binary_providers.install_build_deps_32bit',
-        'clusterfuzz.binary_providers.sha_from_revision',
+        'clusterfuzz.revisions.get_sha',
         'clusterfuzz.binary_providers.V8Builder.install_deps'])
 
     testcase = mock.Mock(id=12345, build_url='', revision=4567)
@@ -740,31 +1850,14 @@ class V8Builder32BitTest(helpers.ExtendedTestCase):
     self.mock.install_deps.assert_called_once_with(self.builder)
 
 
-class GetCurrentShaTest(helpers.ExtendedTestCase):
-  """Tests functionality when the rev-parse command fails."""
-
-  def setUp(self):
-    helpers.patch(self, [
-        'clusterfuzz.common.execute',
-        'clusterfuzz.binary_providers.sha_from_revision'
-    ])
-    self.mock.execute.return_value = (0, 'test\n')
-
-  def test_get(self):
-    """Tests to ensure the method prints before it exits."""
-    self.assertEqual('test', binary_providers.get_current_sha('source'))
-    self.mock.execute.assert_called_once_with(
-        'git', 'rev-parse HEAD', 'source', print_command=False,
-        print_output=False)
-
-
 class GetGomaCoresTest(helpers.ExtendedTestCase):
   """Tests to ensure the correct number of cores is set."""
 
   def setUp(self):
+    self.setup_fake_filesystem()
     helpers.patch(self, [
         'multiprocessing.cpu_count',
-        'clusterfuzz.binary_providers.sha_from_revision',
+        'clusterfuzz.revisions.get_sha',
         'clusterfuzz.common.get_source_directory',
     ])
 
@@ -796,50 +1889,33 @@ class GetGomaCoresTest(helpers.ExtendedTestCase):
     self.assertEqual(self.builder.get_goma_load(), 128)
 
 
-class ShaExistsTest(helpers.ExtendedTestCase):
-  """Tests for sha_exists."""
+class SetupConcurrentLinksTest(helpers.ExtendedTestCase):
+  """Tests setup_concurrent_links."""
 
   def setUp(self):
-    helpers.patch(self, ['clusterfuzz.common.execute'])
-
-  def test_exist(self):
-    """Test exists."""
-    self.mock.execute.return_value = (0, '')
-    self.assertTrue(binary_providers.sha_exists('SHA', '/dir'))
-
-    self.mock.execute.assert_called_once_with(
-        'git', 'cat-file -e SHA', cwd='/dir', exit_on_error=False)
-
-  def test_not_exist(self):
-    """Test not exists."""
-    self.mock.execute.return_value = (1, '')
-    self.assertFalse(binary_providers.sha_exists('SHA', '/dir'))
-
-    self.mock.execute.assert_called_once_with(
-        'git', 'cat-file -e SHA', cwd='/dir', exit_on_error=False)
-
-
-class IsRepoDirtyTest(helpers.ExtendedTestCase):
-  """Tests for is_repo_dirty."""
-
-  def setUp(self):
-    helpers.patch(self, ['clusterfuzz.common.execute'])
-
-  def test_clean(self):
-    """Test exists."""
-    self.mock.execute.return_value = (0, '')
-    self.assertFalse(binary_providers.is_repo_dirty('/dir'))
+    self.setup_fake_filesystem()
+    helpers.patch(self, ['clusterfuzz.concurrency.choose_links'])
+    self.mock.choose_links.return_value = 4
 
-    self.mock.execute.assert_called_once_with(
-        'git', 'diff', '/dir', print_command=False, print_output=False)
+  def test_set(self):
+    """Test sizing the link pool."""
+    self.fs.CreateFile('/src/build/toolchain/concurrent_links.gni')
+    self.assertEqual(
+        {'a': 'b', 'concurrent_links': '4'},
+        binary_providers.setup_concurrent_links('/src', {'a': 'b'}))
 
-  def test_dirty(self):
-    """Test not exists."""
-    self.mock.execute.return_value = (0, 'some change')
-    self.assertTrue(binary_providers.is_repo_dirty('/dir'))
+  def test_already_set(self):
+    """Test keeping the link pool set in args.gn."""
+    self.fs.CreateFile('/src/build/toolchain/concurrent_links.gni')
+    self.assertEqual(
+        {'concurrent_links': '1'},
+        binary_providers.setup_concurrent_links(
+            '/src', {'concurrent_links': '1'}))
 
-    self.mock.execute.assert_called_once_with(
-        'git', 'diff', '/dir', print_command=False, print_output=False)
+  def test_unsupported(self):
+    """Test a checkout without the arg."""
+    self.assertEqual(
+        {'a': 'b'}, binary_providers.setup_concurrent_links('/src', {'a': 'b'}))
 
 
 class SetupDebugSymbolIfNeededTest(helpers.ExtendedTestCase):
@@ -0,0 +1,159 @@
+"""Test the build_profile module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from clusterfuzz import build_profile
+from clusterfuzz import common
+from clusterfuzz import ninja
+from test_libs import helpers
+
+
+def make_edge(start, end, output):
+  return build_profile.Edge(
+      start, end, output, build_profile.get_kind(output))
+
+
+class GetEdgesTest(helpers.ExtendedTestCase):
+  """Test get_edges and get_kind."""
+
+  def test_edges(self):
+    """Test merging the outputs of an edge."""
+    entries = [
+        ninja.LogEntry(2.0, 3.0, './d8'),
+        ninja.LogEntry(0.0, 1.0, 'obj/a.o'),
+        ninja.LogEntry(0.0, 1.0, 'obj/a.d'),
+        ninja.LogEntry(1.0, 2.0, 'gen/a.stamp')]
+    self.assertEqual([
+        build_profile.Edge(0.0, 1.0, 'obj/a.o', 'compile'),
+        build_profile.Edge(1.0, 2.0, 'gen/a.stamp', 'other'),
+        build_profile.Edge(2.0, 3.0, './d8', 'link')
+    ], build_profile.get_edges(entries))
+
+
+class GetCriticalPathTest(helpers.ExtendedTestCase):
+  """Test get_critical_path."""
+
+  def test_path(self):
+    """Test following the edges that ended just before each other."""
+    a = make_edge(0, 10, 'obj/a.o')
+    b = make_edge(0, 4, 'obj/b.o')
+    c = make_edge(5, 12, 'obj/c.o')
+    link = make_edge(12, 20, './d8')
+    self.assertEqual(
+        [b, c, link], build_profile.get_critical_path([a, b, c, link]))
+
+
+class GetTimelineTest(helpers.ExtendedTestCase):
+  """Test get_timeline."""
+
+  def test_timeline(self):
+    """Test the average number of running edges."""
+    edges = [make_edge(0, 10, 'obj/a.o'), make_edge(0, 5, 'obj/b.o')]
+    self.assertEqual(
+        [2.0, 1.0], build_profile.get_timeline(edges, 0, 10, buckets=2))
+
+  def test_empty(self):
+    """Test a build that took no time."""
+    self.assertEqual([], build_profile.get_timeline([], 0, 0))
+
+
+class GetLanesTest(helpers.ExtendedTestCase):
+  """Test get_lanes."""
+
+  def test_lanes(self):
+    """Test reusing lanes once they're free."""
+    edges = [make_edge(0, 5, 'a'), make_edge(0, 2, 'b'),
+             make_edge(2, 3, 'c'), make_edge(4, 6, 'd'),
+             make_edge(4, 6, 'e')]
+    self.assertEqual([0, 1, 1, 1, 2], build_profile.get_lanes(edges))
+
+
+class CompareProfilesTest(helpers.ExtendedTestCase):
+  """Test compare_profiles."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+
+  def test_compare(self):
+    """Test comparing the work per edge of both profiles."""
+    self.assertIsNone(build_profile.compare_profiles('d8', False, 10, 30.0))
+    self.assertIsNone(build_profile.compare_profiles('d8', False, 10, 10.0))
+    self.assertIsNone(build_profile.compare_profiles('other', True, 5, 1.0))
+    self.assertEqual(
+        'Fast builds of d8 took 1.25s of work per edge, and default builds '
+        '2.00s.', build_profile.compare_profiles('d8', True, 4, 5.0))
+    self.assertEqual(
+        {'fast': {'d8': {'edges': 4, 'seconds': 5.0},
+                  'other': {'edges': 5, 'seconds': 1.0}},
+         'default': {'d8': {'edges': 20, 'seconds': 40.0}}},
+        common.read_json(build_profile.PROFILES_FILE))
+
+
+class ReportTest(helpers.ExtendedTestCase):
+  """Test report."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+    helpers.patch(self, ['clusterfuzz.build_profile.logger'])
+    self.fs.CreateFile(
+        '/build/.ninja_log',
+        contents='# ninja log v5\n0\t60000\t1\tobj/old.o\tabc\n')
+    self.position = ninja.get_log_position('/build')
+    with open('/build/.ninja_log', 'a') as f:
+      f.write('0\t1000\t1\tobj/a.o\tabc\n'
+              '0\t3000\t1\tobj/b.o\tabc\n'
+              '3000\t4000\t1\t./d8\tabc\n')
+
+  def test_report(self):
+    """Test summarizing only the entries of this build."""
+    build_profile.report('/build', self.position, 100, True)
+
+    summary = self.mock.logger.info.call_args[0][0]
+    self.assertIn(
+        'Built 3 edges in 4.0s (5.0s of work). Critical path: 4.0s in 2 '
+        'edges.', summary)
+    self.assertIn('Slowest compiles: obj/b.o (3.0s), obj/a.o (1.0s)', summary)
+    self.assertIn('Slowest links: ./d8 (1.0s)', summary)
+    self.assertIn('Parallelism: 1.2 of -j 100 on average', summary)
+    self.assertIn('Goma compiles took 4.0s, and other edges took 1.0s.',
+                  summary)
+    self.assertNotIn('old', summary)
+    self.assertNotIn('Fast builds', summary)
+
+  def test_fast_build(self):
+    """Test comparing a fast build with a default one."""
+    build_profile.compare_profiles('d8', False, 2, 8.0)
+    build_profile.report('/build', self.position, 100, True, 'd8', True)
+
+    self.assertIn(
+        'Fast builds of d8 took 1.67s of work per edge, and default builds '
+        '4.00s.', self.mock.logger.info.call_args[0][0])
+
+  def test_trace(self):
+    """Test writing a Chrome trace."""
+    self.mock_os_environment({'CF_BUILD_TRACE': '/trace.json'})
+    build_profile.report('/build', self.position, 100, False)
+
+    events = common.read_json('/trace.json')['traceEvents']
+    self.assertEqual(
+        [('obj/a.o', 0, 0, 1000000), ('obj/b.o', 1, 0, 3000000),
+         ('./d8', 0, 3000000, 1000000)],
+        [(e['name'], e['tid'], e['ts'], e['dur']) for e in events])
+
+  def test_rewritten(self):
+    """Test skipping the report when ninja has recompacted its log."""
+    self.fs.RemoveObject('/build/.ninja_log')
+    self.fs.CreateFile('/build/.ninja_log', contents='0\t1000\t1\ta.o\tabc\n')
+    build_profile.report('/build', self.position, 100, True)
+    self.assert_n_calls(0, [self.mock.logger.info])
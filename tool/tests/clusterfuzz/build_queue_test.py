@@ -0,0 +1,120 @@
+"""Test the build_queue module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import mock
+
+from clusterfuzz import build_queue
+from test_libs import helpers
+
+
+class AcquireTest(helpers.ExtendedTestCase):
+  """Test acquire with real flocks. The other processes are simulated by
+    files flocked through other descriptors."""
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    patcher = mock.patch.object(build_queue, 'LOCKS_DIR', self.tmp_dir)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    helpers.patch(self, ['clusterfuzz.build_queue.logger', 'time.sleep'])
+
+    self.queue_dir = build_queue.get_queue_dir('/src')
+    os.makedirs(self.queue_dir)
+    self.holder_path = os.path.join(
+        self.queue_dir, build_queue.HOLDER_FILE_NAME)
+
+  def hold_lock(self, **info):
+    """Hold the lock as another process would."""
+    lock_file = open(
+        os.path.join(self.queue_dir, build_queue.LOCK_FILE_NAME), 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    with open(self.holder_path, 'w') as f:
+      json.dump(dict(info, pid=42), f)
+    return lock_file
+
+  def add_ticket(self, name, alive):
+    """Add the ticket of a process that waits, or that has died."""
+    path = os.path.join(self.queue_dir, name + build_queue.TICKET_EXTENSION)
+    ticket = open(path, 'w')
+    if alive:
+      fcntl.flock(ticket, fcntl.LOCK_EX)
+    else:
+      ticket.close()
+    return path, ticket
+
+  def test_free(self):
+    """Test acquiring a free lock without waiting."""
+    with build_queue.acquire('/src', key='k', description='r1') as waited:
+      self.assertFalse(waited)
+      with open(self.holder_path) as f:
+        self.assertEqual(
+            {'key': 'k', 'description': 'r1', 'pid': os.getpid()},
+            json.load(f))
+
+    self.assertFalse(os.path.exists(self.holder_path))
+    self.assert_n_calls(0, [self.mock.sleep, self.mock.logger.info])
+
+  def test_wait(self):
+    """Test waiting behind the holder and the processes ahead in line."""
+    lock_file = self.hold_lock(key='other', description='r1 of d8')
+    dead_path, _ = self.add_ticket('0000000001.000000-1', alive=False)
+    ahead_path, ahead = self.add_ticket('0000000002.000000-2', alive=True)
+
+    def leave(_):
+      """The process ahead leaves the queue, and then the holder releases
+        the lock."""
+      if os.path.exists(ahead_path):
+        os.remove(ahead_path)
+        ahead.close()
+      else:
+        lock_file.close()
+    self.mock.sleep.side_effect = leave
+
+    with build_queue.acquire('/src', key='k', description='r2 of d8') as waited:
+      self.assertTrue(waited)
+      with open(self.holder_path) as f:
+        self.assertEqual(os.getpid(), json.load(f)['pid'])
+
+    self.assert_exact_calls(self.mock.logger.info, [
+        mock.call(
+            'Waiting for another process (pid %s, building %s) to finish '
+            'with %s (position %d in the queue).', 42, 'r1 of d8', '/src', 2),
+        mock.call(
+            'Waiting for another process (pid %s, building %s) to finish '
+            'with %s (position %d in the queue).', 42, 'r1 of d8', '/src', 1)
+    ])
+    self.assertFalse(os.path.exists(dead_path))
+    self.assertEqual([build_queue.LOCK_FILE_NAME],
+                     os.listdir(self.queue_dir))
+
+  def test_same_build(self):
+    """Test waiting for a process that builds the same thing."""
+    lock_file = self.hold_lock(key='k', description='r1 of d8')
+    self.mock.sleep.side_effect = lambda _: lock_file.close()
+
+    with build_queue.acquire('/src', key='k', description='r1 of d8') as waited:
+      self.assertTrue(waited)
+
+    self.assert_exact_calls(self.mock.logger.info, [
+        mock.call(
+            'Another process (pid %s) is already building %s in %s. Waiting '
+            'to reuse its build (position %d in the queue).', 42, 'r1 of d8',
+            '/src', 1)])
@@ -77,7 +77,8 @@ class ExecuteTest(helpers.ExtendedTestCase):
     self.builder.get_binary_path.return_value = '/path/to/binary'
 
     self.definition = mock.Mock(
-        kwargs={}, source_var='V8_SRC', sanitizer='ASAN')
+        kwargs={}, source_var='V8_SRC', sanitizer='ASAN',
+        require_full_build=False)
 
     self.definition.builder.return_value = self.builder
     self.mock.get_definition.return_value = self.definition
@@ -105,7 +106,7 @@ class ExecuteTest(helpers.ExtendedTestCase):
     self.assert_exact_calls(self.mock.Testcase, [mock.call(self.response)])
     self.assert_exact_calls(
         self.mock.DownloadedBinary,
-        [mock.call(1234, 'chrome_build_url', 'stacktrace_binary')])
+        [mock.call(1234, 'chrome_build_url', 'stacktrace_binary', False)])
     self.assert_exact_calls(
         self.definition.reproducer,
         [
@@ -133,7 +134,7 @@ class ExecuteTest(helpers.ExtendedTestCase):
     self.assert_exact_calls(self.mock.Testcase, [mock.call(self.response)])
     self.assert_exact_calls(
         self.mock.DownloadedBinary,
-        [mock.call(1234, 'chrome_build_url', 'defined_binary')])
+        [mock.call(1234, 'chrome_build_url', 'defined_binary', False)])
     self.assert_exact_calls(
         self.definition.reproducer,
         [
@@ -151,6 +152,7 @@ class ExecuteTest(helpers.ExtendedTestCase):
     reproduce.execute(**vars(self.options))
     self.options.goma_dir = '/goma/dir'
 
+    self.builder.prefetch.assert_called_once_with()
     self.assert_exact_calls(self.mock.get_testcase_info, [mock.call('1234')])
     self.assert_exact_calls(self.mock.ensure_goma, [mock.call()])
     self.assert_exact_calls(self.mock.Testcase, [mock.call(self.response)])
@@ -173,6 +175,31 @@ class ExecuteTest(helpers.ExtendedTestCase):
                 options=self.options)
         ])
 
+  def test_fast_build_retry(self):
+    """Ensures a fast build that doesn't reproduce is rebuilt with the
+      original args.gn."""
+    self.options.build = 'standalone'
+    self.options.fast_build = True
+    self.builder.fast_build_overrides = {'symbol_level': '2'}
+    self.definition.reproducer.return_value.reproduce.side_effect = [
+        error.UnreproducibleError(10, []), None]
+    reproduce.execute(**vars(self.options))
+
+    self.assert_n_calls(2, [self.definition.builder])
+    self.assertFalse(self.definition.builder.call_args[1]['options'].fast_build)
+    self.assert_n_calls(1, [self.builder.release])
+
+  def test_not_fast_build(self):
+    """Ensures a default build that doesn't reproduce isn't rebuilt."""
+    self.options.build = 'standalone'
+    self.builder.fast_build_overrides = {}
+    self.definition.reproducer.return_value.reproduce.side_effect = (
+        error.UnreproducibleError(10, []))
+    with self.assertRaises(SystemExit):
+      reproduce.execute(**vars(self.options))
+
+    self.assert_n_calls(1, [self.definition.builder])
+
 
 class SendRequestTest(helpers.ExtendedTestCase):
   """Test send_request."""
@@ -22,6 +22,7 @@ import stat
 import mock
 
 from clusterfuzz import common
+from clusterfuzz import output_transformer
 from error import error
 from test_libs import helpers
 
@@ -375,6 +376,44 @@ class DefinitionTest(helpers.ExtendedTestCase):
           require_user_data_dir=False)
 
 
+class GetTransformersTest(helpers.ExtendedTestCase):
+  """Tests get_transformers."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.tasks.get_current'])
+    self.mock.get_current.return_value = None
+
+  def test_default(self):
+    """Test hiding stdout and printing stderr outside of a task."""
+    stdout, stderr = common.get_transformers(None, None)
+    self.assertIsInstance(stdout, output_transformer.Hidden)
+    self.assertIsInstance(stderr, output_transformer.Identity)
+
+  def test_given(self):
+    """Test keeping the given transformers outside of a task."""
+    stdout = output_transformer.Identity()
+    stderr = output_transformer.Hidden()
+    self.assertEqual(
+        (stdout, stderr), common.get_transformers(stdout, stderr))
+
+  def test_task_hidden(self):
+    """Test not printing dots in a task."""
+    self.mock.get_current.return_value = mock.Mock()
+    self.mock.get_current.return_value.name = 'sync'
+    stdout, stderr = common.get_transformers(None, None)
+    self.assertIsInstance(stdout, output_transformer.Silent)
+    self.assertIsInstance(stderr, output_transformer.Prefix)
+
+  def test_task_printed(self):
+    """Test prefixing the output with the task's name."""
+    self.mock.get_current.return_value = mock.Mock()
+    self.mock.get_current.return_value.name = 'sync'
+    stdout, stderr = common.get_transformers(
+        output_transformer.Identity(), None)
+    self.assertIsInstance(stdout, output_transformer.Prefix)
+    self.assertIsInstance(stderr, output_transformer.Prefix)
+
+
 class WaitTimeoutTest(helpers.ExtendedTestCase):
   """Tests the wait_timeout method."""
 
@@ -509,6 +548,28 @@ class EnsureDirTest(helpers.ExtendedTestCase):
     self.assertTrue(os.path.exists('/test'))
 
 
+class ReadWriteJsonTest(helpers.ExtendedTestCase):
+  """Tests the read_json and write_json methods."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+
+  def test_round_trip(self):
+    """Test writing a file, creating its directory, and reading it back."""
+    common.write_json('/test/a.json', {'a': [1]})
+    self.assertEqual({'a': [1]}, common.read_json('/test/a.json'))
+    self.assertEqual(['a.json'], os.listdir('/test'))
+
+  def test_missing(self):
+    """Test reading a missing file."""
+    self.assertEqual({}, common.read_json('/test/a.json', {}))
+
+  def test_corrupted(self):
+    """Test reading a corrupted file."""
+    self.fs.CreateFile('/test/a.json', contents='{"a"')
+    self.assertIsNone(common.read_json('/test/a.json'))
+
+
 class GetSourceDirectoryTest(helpers.ExtendedTestCase):
   """Tests the get_source_directory method."""
 
@@ -0,0 +1,152 @@
+"""Test the concurrency module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from clusterfuzz import common
+from clusterfuzz import concurrency
+from clusterfuzz import goma
+from test_libs import helpers
+
+
+MEMINFO = (
+    'MemTotal:       65536000 kB\n'
+    'MemFree:         1000000 kB\n'
+    'MemAvailable:   %d kB\n')
+
+
+class ConcurrencyTestCase(helpers.ExtendedTestCase):
+  """A host with 16 CPUs and the given available memory."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+    helpers.patch(self, [
+        'multiprocessing.cpu_count',
+        'os.getloadavg'])
+    self.mock.cpu_count.return_value = 16
+    self.mock.getloadavg.return_value = (8.0, 8.0, 8.0)
+
+  def set_memory_gb(self, memory_gb):
+    """Set the available memory."""
+    content = MEMINFO % (memory_gb * 1024 * 1024)
+    if self.fs.Exists(concurrency.MEMINFO_FILE):
+      with open(concurrency.MEMINFO_FILE, 'w') as f:
+        f.write(content)
+    else:
+      self.fs.CreateFile(concurrency.MEMINFO_FILE, contents=content)
+
+
+class ChooseJobsTest(ConcurrencyTestCase):
+  """Test choose_jobs and choose_load."""
+
+  def test_default(self):
+    """Test the first build, without history or memory info."""
+    self.assertEqual(800, concurrency.choose_jobs(True))
+    self.assertEqual(12, concurrency.choose_jobs(False))
+    self.assertEqual(32, concurrency.choose_load(True))
+
+  def test_local_memory(self):
+    """Test limiting local compiles to the available memory."""
+    self.set_memory_gb(5)
+    self.assertEqual(5, concurrency.choose_jobs(False))
+    self.assertEqual(800, concurrency.choose_jobs(True))
+
+  def test_overloaded(self):
+    """Test backing off after a build that overloaded the host."""
+    common.write_json(concurrency.HISTORY_FILE, {
+        'goma': {'jobs': 800, 'overloaded': True}})
+    self.assertEqual(400, concurrency.choose_jobs(True))
+    self.assertEqual(16, concurrency.choose_load(True))
+    self.assertEqual(12, concurrency.choose_jobs(False))
+
+  def test_failed(self):
+    """Test not growing after a failed build."""
+    common.write_json(concurrency.HISTORY_FILE, {
+        'goma': {'jobs': 400, 'overloaded': False, 'succeeded': False}})
+    self.assertEqual(400, concurrency.choose_jobs(True))
+
+  def test_grow(self):
+    """Test growing back towards the default."""
+    common.write_json(concurrency.HISTORY_FILE, {
+        'goma': {'jobs': 400, 'overloaded': False}})
+    self.assertEqual(600, concurrency.choose_jobs(True))
+    common.write_json(concurrency.HISTORY_FILE, {
+        'goma': {'jobs': 600, 'overloaded': False}})
+    self.assertEqual(800, concurrency.choose_jobs(True))
+
+
+class ChooseLinksTest(ConcurrencyTestCase):
+  """Test choose_links."""
+
+  def test_links(self):
+    """Test a power of two that fits in the available memory."""
+    self.set_memory_gb(50)
+    self.assertEqual(4, concurrency.choose_links())
+    self.set_memory_gb(4)
+    self.assertEqual(1, concurrency.choose_links())
+    self.set_memory_gb(1000)
+    self.assertEqual(16, concurrency.choose_links())
+
+  def test_unknown(self):
+    """Test without memory info."""
+    self.assertIsNone(concurrency.choose_links())
+
+
+class RecordTest(ConcurrencyTestCase):
+  """Test Sampler and record."""
+
+  def test_overloaded(self):
+    """Test recording a build that ran low on memory."""
+    self.set_memory_gb(1)
+    with concurrency.Sampler() as sampler:
+      pass
+    concurrency.record(True, 800, sampler, False)
+
+    self.assertEqual(0.5, sampler.peak_load)
+    self.assertEqual(1, sampler.min_memory_gb)
+    self.assertEqual(
+        {'goma': {'jobs': 800, 'overloaded': True, 'succeeded': False}},
+        common.read_json(concurrency.HISTORY_FILE))
+
+  def test_fine(self):
+    """Test recording a build that the host handled."""
+    self.set_memory_gb(32)
+    sampler = concurrency.Sampler()
+    sampler.sample()
+    self.set_memory_gb(16)
+    sampler.sample()
+    concurrency.record(False, 12, sampler, True)
+
+    self.assertEqual(16, sampler.min_memory_gb)
+    self.assertEqual(
+        {'local': {'jobs': 12, 'overloaded': False, 'succeeded': True}},
+        common.read_json(concurrency.HISTORY_FILE))
+
+  def test_goma_slow(self):
+    """Test that compiler_proxy answering slowly overloads a goma build."""
+    helpers.patch(self, ['clusterfuzz.goma.probe'])
+    self.mock.probe.side_effect = [
+        goma.Probe(True, 0.1, 'ok'), goma.Probe(False, 5.0, 'slow')]
+    self.set_memory_gb(32)
+    sampler = concurrency.Sampler(goma_enabled=True)
+    sampler.sample()
+    self.assertFalse(sampler.is_overloaded())
+    sampler.sample()
+    self.assertTrue(sampler.is_overloaded())
+    self.assertEqual(5.0, sampler.peak_goma_latency)
+
+  def test_local_no_probe(self):
+    """Test that goma isn't probed without goma."""
+    helpers.patch(self, ['clusterfuzz.goma.probe'])
+    concurrency.Sampler().sample()
+    self.assert_n_calls(0, [self.mock.probe])
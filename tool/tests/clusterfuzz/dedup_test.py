@@ -0,0 +1,190 @@
+"""Test the dedup module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import zlib
+import mock
+
+from clusterfuzz import common
+from clusterfuzz import dedup
+from clusterfuzz import disk_cache
+from test_libs import helpers
+
+
+BIG = 'a' * 10000
+OTHER = 'b' * 10000
+
+
+def write(path, content):
+  """Write a file, creating its directory."""
+  if not os.path.exists(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path, 'w') as f:
+    f.write(content)
+
+
+def get_record(content):
+  """Return the index record of a content."""
+  return [len(content), zlib.crc32(content) & 0xffffffff,
+          hashlib.sha256(content).hexdigest()]
+
+
+class DedupTestCase(helpers.ExtendedTestCase):
+  """A cache with a build that has been indexed."""
+
+  def setUp(self):
+    # Whether reflinks work depends on the filesystem, so use hardlinks.
+    helpers.patch(self, ['clusterfuzz.dedup.reflink'])
+    self.mock.reflink.side_effect = IOError(95, 'Not supported')
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    self.cache = disk_cache.DiskCache('build', self.tmp_dir, 1024 ** 3)
+
+    write(os.path.join(self.cache.get_path('old'), 'a.pak'), BIG)
+    write(os.path.join(self.cache.get_path('old'), 'small'), 'abc')
+    with self.cache.lock():
+      common.write_json(self.cache.get_meta_path('old', 'json'), {})
+      common.write_json(
+          self.cache.get_meta_path('old', dedup.INDEX_EXTENSION),
+          {'a.pak': get_record(BIG), 'small': get_record('abc')})
+    self.old_path = os.path.join(self.cache.get_path('old'), 'a.pak')
+    self.new_dir = self.cache.get_path('new')
+
+  def assert_linked(self, path):
+    """Assert that path is the old build's a.pak."""
+    self.assertTrue(os.path.samefile(self.old_path, path))
+
+
+class HashFileTest(DedupTestCase):
+  """Test hash_file."""
+
+  def test_hash(self):
+    """Test returning the crc32 and the sha256."""
+    self.assertEqual(get_record(BIG)[1:], list(dedup.hash_file(self.old_path)))
+
+
+class CloneFileTest(DedupTestCase):
+  """Test clone_file."""
+
+  def test_hardlink(self):
+    """Test falling back to a hardlink."""
+    dest = os.path.join(self.tmp_dir, 'b.pak')
+    write(dest, OTHER)
+
+    dedup.clone_file(self.old_path, dest)
+
+    self.assertTrue(os.path.samefile(self.old_path, dest))
+    self.assertFalse(os.path.exists(dest + dedup.TMP_SUFFIX))
+
+
+class IndexTest(DedupTestCase):
+  """Test Index."""
+
+  def test_load(self):
+    """Test loading the other entries' indexes."""
+    index = dedup.Index(self.cache)
+    self.assertEqual(self.old_path, index.by_hash[get_record(BIG)[2]])
+    self.assertEqual(
+        (self.old_path, get_record(BIG)[2]),
+        index.by_member[tuple(['a.pak'] + get_record(BIG)[:2])])
+
+  def test_exclude(self):
+    """Test excluding an entry."""
+    self.assertEqual({}, dedup.Index(self.cache, 'old').by_hash)
+
+
+class ReuseMembersTest(DedupTestCase):
+  """Test reuse_members."""
+
+  def test_reuse(self):
+    """Test cloning only the members with the same path, size and crc."""
+    size, crc, sha = get_record(BIG)
+    members = {
+        'a.pak': mock.Mock(file_size=size, CRC=crc),
+        'b.pak': mock.Mock(file_size=size, CRC=crc),
+        'small': mock.Mock(file_size=3, CRC=get_record('abc')[1])}
+
+    records = dedup.reuse_members(
+        dedup.Index(self.cache), members, self.new_dir)
+
+    self.assertEqual({'a.pak': [size, crc, sha]}, records)
+    self.assert_linked(os.path.join(self.new_dir, 'a.pak'))
+    self.assertEqual(['a.pak'], os.listdir(self.new_dir))
+
+  def test_evicted(self):
+    """Test skipping a member whose source is gone."""
+    size, crc, _ = get_record(BIG)
+    os.remove(self.old_path)
+
+    self.assertEqual({}, dedup.reuse_members(
+        dedup.Index(self.cache),
+        {'a.pak': mock.Mock(file_size=size, CRC=crc)}, self.new_dir))
+
+
+class DedupeEntryTest(DedupTestCase):
+  """Test dedupe_entry."""
+
+  def test_dedupe(self):
+    """Test deduplicating against other entries and within the entry, and
+      writing the index."""
+    write(os.path.join(self.new_dir, 'renamed.pak'), BIG)
+    write(os.path.join(self.new_dir, 'b.pak'), OTHER)
+    write(os.path.join(self.new_dir, 'locales', 'b.pak'), OTHER)
+    write(os.path.join(self.new_dir, 'small'), 'abc')
+    reused = {'reused.pak': get_record(BIG)}
+
+    self.assertEqual((3, 30000), dedup.dedupe_entry(
+        self.cache, 'new', dedup.Index(self.cache, 'new'), reused))
+
+    self.assert_linked(os.path.join(self.new_dir, 'renamed.pak'))
+    self.assertTrue(os.path.samefile(
+        os.path.join(self.new_dir, 'b.pak'),
+        os.path.join(self.new_dir, 'locales', 'b.pak')))
+    self.assertEqual({
+        'reused.pak': get_record(BIG),
+        'renamed.pak': get_record(BIG),
+        'b.pak': get_record(OTHER),
+        'locales/b.pak': get_record(OTHER),
+        'small': get_record('abc'),
+    }, common.read_json(
+        self.cache.get_meta_path('new', dedup.INDEX_EXTENSION), {}))
+
+
+class DedupeInBackgroundTest(DedupTestCase):
+  """Test dedupe_in_background."""
+
+  def test_dedupe(self):
+    """Test deduplicating an entry in a thread."""
+    write(os.path.join(self.new_dir, 'renamed.pak'), BIG)
+
+    dedup.dedupe_in_background(self.cache, 'new').join()
+
+    self.assert_linked(os.path.join(self.new_dir, 'renamed.pak'))
+    self.assertEqual({'renamed.pak': get_record(BIG)}, common.read_json(
+        self.cache.get_meta_path('new', dedup.INDEX_EXTENSION), {}))
+
+  def test_evicted(self):
+    """Test that an entry evicted in the meantime is ignored."""
+    helpers.patch(self, ['clusterfuzz.dedup.hash_file'])
+    self.mock.hash_file.side_effect = IOError(2, 'No such file')
+    write(os.path.join(self.new_dir, 'renamed.pak'), BIG)
+
+    dedup.dedupe_in_background(self.cache, 'new').join()
+
+    self.assertFalse(os.path.exists(
+        self.cache.get_meta_path('new', dedup.INDEX_EXTENSION)))
@@ -0,0 +1,168 @@
+"""Test the disk_cache module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import mock
+
+from clusterfuzz import common
+from clusterfuzz import disk_cache
+from test_libs import helpers
+
+
+class GetQuotaTest(helpers.ExtendedTestCase):
+  """Test get_quota."""
+
+  def test_default(self):
+    """Test the default quota."""
+    with mock.patch.dict(os.environ, {}, clear=True):
+      self.assertEqual(
+          2 * 1024 ** 3, disk_cache.get_quota('CF_TEST_QUOTA_GB', 2))
+
+  def test_variable(self):
+    """Test reading the quota from the environment."""
+    with mock.patch.dict(os.environ, {'CF_TEST_QUOTA_GB': '0.5'}):
+      self.assertEqual(
+          1024 ** 3 / 2, disk_cache.get_quota('CF_TEST_QUOTA_GB', 2))
+
+
+class DiskCacheTest(helpers.ExtendedTestCase):
+  """Test DiskCache with real flocks."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.disk_cache.get_size', 'time.time'])
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    self.cache = disk_cache.DiskCache('test', self.tmp_dir, 250)
+    self.mock.get_size.return_value = 100
+    self.mock.time.return_value = 1
+
+  def add(self, key, last_used, hit=False):
+    """Add an entry."""
+    os.mkdir(self.cache.get_path(key))
+    self.mock.time.return_value = last_used
+    self.cache.use(key, hit)
+
+  def test_use(self):
+    """Test recording uses and measuring only what has changed."""
+    self.add('a', 1)
+    self.mock.time.return_value = 2
+    self.cache.use('a', True)
+
+    self.assertEqual(
+        {'a': {'size': 100, 'last_used': 2}}, self.cache.get_entries())
+    self.assertEqual(
+        {'hits': 1, 'misses': 1, 'evictions': 0, 'evicted_bytes': 0},
+        self.cache.get_stats())
+    self.assert_n_calls(1, [self.mock.get_size])
+
+  def test_use_incomplete(self):
+    """Test measuring an incomplete entry next time."""
+    os.mkdir(self.cache.get_path('a'))
+    self.cache.use('a', False, False)
+    self.assertNotIn('size', self.cache.get_entries()['a'])
+
+    self.cache.use('a', True)
+    self.assertEqual(100, self.cache.get_entries()['a']['size'])
+
+  def test_evict(self):
+    """Test evicting the least recently used entries."""
+    self.add('a', 3)
+    self.add('b', 1)
+    self.add('c', 2)
+    self.add('d', 4)
+
+    common.write_json(self.cache.get_meta_path('b', 'index'), {})
+
+    self.assertEqual(['b', 'c'], self.cache.evict())
+    self.assertEqual(['a', 'd'], sorted(self.cache.get_entries()))
+    self.assertFalse(os.path.exists(self.cache.get_path('b')))
+    self.assertFalse(os.path.exists(self.cache.get_meta_path('b', 'index')))
+    self.assertTrue(os.path.exists(self.cache.get_meta_path('b', 'lock')))
+    self.assertTrue(os.path.exists(self.cache.get_path('a')))
+    self.assertEqual(2, self.cache.get_stats()['evictions'])
+    self.assertEqual(200, self.cache.get_stats()['evicted_bytes'])
+
+  def test_pinned(self):
+    """Test not evicting pinned entries."""
+    self.add('a', 1)
+    self.add('b', 2)
+    self.add('c', 3)
+    pin = self.cache.pin('a')
+
+    self.assertEqual(['b'], self.cache.evict())
+    pin.close()
+    self.assertEqual([], self.cache.evict())
+
+  def test_pin_exclusive(self):
+    """Test that an exclusive pin fails while the entry is pinned."""
+    self.add('a', 1)
+    pin = self.cache.pin('a', exclusive=True, blocking=False)
+
+    self.assertIsNone(self.cache.pin('a', exclusive=True, blocking=False))
+    self.assertIsNone(self.cache.pin('a', exclusive=True, blocking=False))
+    pin.close()
+    self.cache.pin('a', exclusive=True, blocking=False).close()
+
+  def test_share_pin(self):
+    """Test sharing an exclusive pin."""
+    self.add('a', 1)
+    pin = self.cache.pin('a', exclusive=True)
+    self.assertIsNone(self.cache.pin('a', blocking=False))
+
+    disk_cache.share_pin(pin)
+    self.cache.pin('a', blocking=False).close()
+    self.assertIsNone(self.cache.pin('a', exclusive=True, blocking=False))
+    pin.close()
+
+  def test_measure_and_info(self):
+    """Test a custom measure, and storing info with a use."""
+    self.cache = disk_cache.DiskCache(
+        'test', self.tmp_dir, 2, measure=lambda _: 1)
+    os.mkdir(self.cache.get_path('a'))
+    self.cache.use('a', False, revision=12)
+
+    self.assertEqual({'a': {'size': 1, 'last_used': 1, 'revision': 12}},
+                     self.cache.get_entries())
+    self.assert_n_calls(0, [self.mock.get_size])
+
+  def test_log_stats(self):
+    """Test logging the stats."""
+    self.add('a', 1)
+    with mock.patch.object(disk_cache.logger, 'info') as info:
+      self.cache.log_stats()
+
+    info.assert_called_once_with(
+        '%s cache: %d entries, %s of %s, %d hits, %d misses, %d evictions '
+        '(%s).', 'Test', 1, '0.0 GB', '0.0 GB', 0, 1, 0, '0.0 GB')
+
+
+class GetSizeTest(helpers.ExtendedTestCase):
+  """Test get_size."""
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+  def test_hardlinks(self):
+    """Test counting hardlinked files once."""
+    path = os.path.join(self.tmp_dir, 'a')
+    with open(path, 'w') as f:
+      f.write('a' * 100000)
+    size = disk_cache.get_size(self.tmp_dir)
+
+    os.link(path, os.path.join(self.tmp_dir, 'b'))
+    self.assertEqual(size, disk_cache.get_size(self.tmp_dir))
@@ -0,0 +1,399 @@
+"""Test the downloader module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import mock
+
+from oauth2client import client
+
+from clusterfuzz import downloader
+from error import error
+from tests import libs
+from test_libs import helpers
+
+
+CONTENT = ''.join(chr(i % 256) for i in xrange(100000))
+
+
+class GetGcsPathTest(helpers.ExtendedTestCase):
+  """Test get_gcs_path."""
+
+  def test_get(self):
+    """Test stripping the known prefixes."""
+    self.assertEqual(
+        'bucket/abc.zip',
+        downloader.get_gcs_path(
+            'https://storage.cloud.google.com/bucket/abc.zip'))
+    self.assertEqual(
+        'bucket/abc.zip', downloader.get_gcs_path('gs://bucket/abc.zip'))
+
+
+class GetMd5Test(helpers.ExtendedTestCase):
+  """Test get_md5."""
+
+  def test_goog_hash(self):
+    """Test reading md5 from x-goog-hash."""
+    response = mock.Mock(status_code=206, headers={
+        'x-goog-hash': 'crc32c=n03x6A==,md5=rL0Y20zC+Fzt72VPzMSk2A=='})
+    self.assertEqual(
+        hashlib.md5('foo').hexdigest(), downloader.get_md5(response))
+
+  def test_content_md5(self):
+    """Test reading Content-MD5 of a full response."""
+    response = mock.Mock(status_code=200, headers={
+        'Content-MD5': 'rL0Y20zC+Fzt72VPzMSk2A=='})
+    self.assertEqual(
+        hashlib.md5('foo').hexdigest(), downloader.get_md5(response))
+
+  def test_partial_content_md5(self):
+    """Test ignoring Content-MD5 of a partial response."""
+    response = mock.Mock(status_code=206, headers={
+        'Content-MD5': 'rL0Y20zC+Fzt72VPzMSk2A=='})
+    self.assertIsNone(downloader.get_md5(response))
+
+
+class DownloadTest(helpers.ExtendedTestCase):
+  """Test download against a local HTTP server."""
+
+  def setUp(self):
+    helpers.patch(self, ['time.sleep'])
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    self.dest = os.path.join(self.tmp_dir, 'abc.zip')
+
+  def assert_downloaded(self):
+    """Assert the content of dest."""
+    with open(self.dest, 'rb') as f:
+      self.assertEqual(CONTENT, f.read())
+    self.assertEqual(['abc.zip'], os.listdir(self.tmp_dir))
+
+  def test_download(self):
+    """Test downloading in one go."""
+    with libs.FakeHttpServer(
+        {'/abc.zip': CONTENT}, headers={'ETag': '"etag"'}) as server:
+      headers = downloader.download(
+          server.url('/abc.zip'), self.dest, headers={'X-Test': 'test'},
+          md5=hashlib.md5(CONTENT).hexdigest())
+
+    self.assert_downloaded()
+    self.assertEqual('"etag"', headers['etag'])
+    self.assertEqual(1, len(server.requests))
+    self.assertEqual('test', server.requests[0][1]['x-test'])
+    self.assert_n_calls(0, [self.mock.sleep])
+
+  def test_resume(self):
+    """Test resuming after the connection is dropped."""
+    with libs.FakeHttpServer(
+        {'/abc.zip': CONTENT}, drop_after=30000, drops=2) as server:
+      downloader.download(server.url('/abc.zip'), self.dest)
+
+    self.assert_downloaded()
+    self.assertEqual(
+        [None, 'bytes=30000-', 'bytes=60000-'],
+        [headers.get('range') for _, headers in server.requests])
+    self.assert_n_calls(2, [self.mock.sleep])
+
+  def test_resume_previous_part(self):
+    """Test resuming the part left by a previous run."""
+    with open(self.dest + downloader.PART_SUFFIX, 'wb') as f:
+      f.write(CONTENT[:1000])
+
+    with libs.FakeHttpServer({'/abc.zip': CONTENT}) as server:
+      downloader.download(server.url('/abc.zip'), self.dest)
+
+    self.assert_downloaded()
+    self.assertEqual('bytes=1000-', server.requests[0][1]['range'])
+
+  def test_stale_part(self):
+    """Test starting over when the previous part is longer than the
+      object."""
+    with open(self.dest + downloader.PART_SUFFIX, 'wb') as f:
+      f.write(CONTENT + 'stale')
+
+    with libs.FakeHttpServer({'/abc.zip': CONTENT}) as server:
+      downloader.download(server.url('/abc.zip'), self.dest)
+
+    self.assert_downloaded()
+    self.assertEqual(
+        ['bytes=%d-' % (len(CONTENT) + 5), None],
+        [headers.get('range') for _, headers in server.requests])
+
+  def test_not_modified(self):
+    """Test discarding the previous part when the object hasn't changed."""
+    with open(self.dest + downloader.PART_SUFFIX, 'wb') as f:
+      f.write(CONTENT[:1000])
+
+    with libs.FakeHttpServer(
+        {'/abc.zip': CONTENT}, headers={'ETag': '"etag"'}) as server:
+      self.assertIsNone(downloader.download(
+          server.url('/abc.zip'), self.dest,
+          headers={'If-None-Match': '"etag"'}))
+
+    self.assertEqual([], os.listdir(self.tmp_dir))
+    self.assertEqual(1, len(server.requests))
+
+  def test_give_up(self):
+    """Test giving up after too many interruptions."""
+    with libs.FakeHttpServer(
+        {'/abc.zip': CONTENT}, drop_after=10, drops=100) as server:
+      with self.assertRaises(error.DownloadFailedError):
+        downloader.download(server.url('/abc.zip'), self.dest)
+
+    self.assertEqual(downloader.MAX_ATTEMPTS, len(server.requests))
+    self.assertFalse(os.path.exists(self.dest))
+
+  def test_wrong_md5(self):
+    """Test rejecting a file with a wrong md5."""
+    with libs.FakeHttpServer({'/abc.zip': CONTENT}) as server:
+      with self.assertRaises(error.DownloadFailedError):
+        downloader.download(server.url('/abc.zip'), self.dest, md5='wrong')
+
+    self.assertEqual([], os.listdir(self.tmp_dir))
+
+  def test_not_found(self):
+    """Test failing on 404."""
+    with libs.FakeHttpServer({}) as server:
+      with self.assertRaises(error.DownloadFailedError) as cm:
+        downloader.download(server.url('/abc.zip'), self.dest)
+
+    self.assertEqual(404, cm.exception.status_code)
+
+
+class GetRangesTest(helpers.ExtendedTestCase):
+  """Test get_ranges."""
+
+  def test_get(self):
+    """Test splitting into inclusive ranges."""
+    self.assertEqual(
+        [(0, 3), (4, 7), (8, 9)], downloader.get_ranges(10, 4))
+    self.assertEqual([(0, 3)], downloader.get_ranges(4, 4))
+
+
+class ReadRangeTest(helpers.ExtendedTestCase):
+  """Test read_range against a local HTTP server."""
+
+  def setUp(self):
+    helpers.patch(self, ['time.sleep'])
+
+  def test_read(self):
+    """Test reading a range, retrying when it's cut short."""
+    with libs.FakeHttpServer(
+        {'/abc.zip': CONTENT}, drop_after=500, drops=1) as server:
+      self.assertEqual(
+          CONTENT[1000:2000],
+          downloader.read_range(server.url('/abc.zip'), {}, 1000, 1999))
+
+    self.assertEqual(2, len(server.requests))
+    self.assert_n_calls(1, [self.mock.sleep])
+
+  def test_no_ranges(self):
+    """Test failing when the server doesn't support ranges."""
+    with libs.FakeHttpServer({'/abc.zip': CONTENT}, ranges=False) as server:
+      with self.assertRaises(error.DownloadFailedError) as cm:
+        downloader.read_range(server.url('/abc.zip'), {}, 0, 9)
+
+    self.assertEqual(200, cm.exception.status_code)
+
+
+class DownloadParallelTest(helpers.ExtendedTestCase):
+  """Test download_parallel against a local HTTP server."""
+
+  def setUp(self):
+    helpers.patch(self, ['time.sleep'])
+    for name, value in [('PARALLEL_DOWNLOAD_THRESHOLD', 50000),
+                        ('RANGE_SIZE', 10000), ('RANGE_WORKERS', 4)]:
+      patcher = mock.patch.object(downloader, name, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    self.dest = os.path.join(self.tmp_dir, 'abc.zip')
+
+  def get_ranges(self, server):
+    """Get the sorted Range headers that the server has received."""
+    return sorted(headers.get('range') for _, headers in server.requests)
+
+  def assert_downloaded(self, content=CONTENT):
+    """Assert the content of dest."""
+    with open(self.dest, 'rb') as f:
+      self.assertEqual(content, f.read())
+    self.assertEqual(['abc.zip'], os.listdir(self.tmp_dir))
+
+  def test_download(self):
+    """Test downloading in ranges."""
+    with libs.FakeHttpServer({'/abc.zip': CONTENT}) as server:
+      downloader.download_parallel(server.url('/abc.zip'), self.dest)
+
+    self.assert_downloaded()
+    self.assertEqual(
+        ['bytes=0-0'] + sorted(
+            'bytes=%d-%d' % (start, start + 9999)
+            for start in xrange(0, 100000, 10000)),
+        self.get_ranges(server))
+
+  def test_retry_range(self):
+    """Test retrying only the interrupted range from where it stopped."""
+    helpers.patch(self, ['clusterfuzz.downloader.probe'])
+    self.mock.probe.return_value = (100000, None)
+
+    with libs.FakeHttpServer(
+        {'/abc.zip': CONTENT}, drop_after=4000, drops=1) as server:
+      downloader.download_parallel(server.url('/abc.zip'), self.dest)
+
+    self.assert_downloaded()
+    starts = [int(r[len('bytes='):].split('-')[0])
+              for r in self.get_ranges(server)]
+    self.assertEqual(11, len(starts))
+    self.assertEqual(1, len([start for start in starts if start % 10000]))
+    # The thread pool sleeps too, so we only count our own waits.
+    self.assertEqual(1, self.mock.sleep.call_args_list.count(
+        mock.call(downloader.RETRY_WAIT)))
+
+  def test_verify(self):
+    """Test rejecting the result when the md5 is wrong."""
+    with libs.FakeHttpServer({'/abc.zip': CONTENT}) as server:
+      with self.assertRaises(error.DownloadFailedError):
+        downloader.download_parallel(
+            server.url('/abc.zip'), self.dest, md5='wrong')
+
+    self.assertEqual([], os.listdir(self.tmp_dir))
+
+  def test_small(self):
+    """Test streaming small objects."""
+    with libs.FakeHttpServer({'/abc.zip': CONTENT[:1000]}) as server:
+      downloader.download_parallel(server.url('/abc.zip'), self.dest)
+
+    self.assert_downloaded(CONTENT[:1000])
+    self.assertEqual(['bytes=0-0', None], [
+        headers.get('range') for _, headers in server.requests])
+
+  def test_no_ranges(self):
+    """Test streaming when the server doesn't support ranges."""
+    with libs.FakeHttpServer({'/abc.zip': CONTENT}, ranges=False) as server:
+      downloader.download_parallel(server.url('/abc.zip'), self.dest)
+
+    self.assert_downloaded()
+    self.assertEqual(2, len(server.requests))
+
+
+class ProbeGcsObjectTest(helpers.ExtendedTestCase):
+  """Test probe_gcs_object."""
+
+  def setUp(self):
+    helpers.patch(self, [
+        'clusterfuzz.downloader.get_gcs_auth_headers',
+        'clusterfuzz.downloader.probe'])
+    self.mock.get_gcs_auth_headers.return_value = {'Authorization': 'Bearer a'}
+    self.mock.probe.return_value = (1000, 'md5')
+    self.url = 'https://storage.cloud.google.com/bucket/abc.zip'
+    self.gcs_url = 'https://storage.googleapis.com/bucket/abc.zip'
+
+  def test_probe(self):
+    """Test probing with the application default credentials."""
+    self.assertEqual(
+        downloader.GcsObject(
+            self.gcs_url, {'Authorization': 'Bearer a'}, 1000, 'md5'),
+        downloader.probe_gcs_object(self.url))
+    self.mock.probe.assert_called_once_with(
+        self.gcs_url, {'Authorization': 'Bearer a'})
+
+  def test_no_credentials(self):
+    """Test when there are no credentials."""
+    self.mock.get_gcs_auth_headers.side_effect = (
+        client.ApplicationDefaultCredentialsError())
+
+    self.assertEqual(downloader.GcsObject(self.gcs_url, None, None, None),
+                     downloader.probe_gcs_object(self.url))
+
+  def test_forbidden(self):
+    """Test when the credentials cannot access the object."""
+    self.mock.probe.side_effect = error.DownloadFailedError(
+        self.url, 'HTTP 403', 403)
+
+    self.assertIsNone(downloader.probe_gcs_object(self.url).headers)
+
+  def test_other_error(self):
+    """Test raising other errors."""
+    self.mock.probe.side_effect = error.DownloadFailedError(
+        self.url, 'HTTP 500', 500)
+
+    with self.assertRaises(error.DownloadFailedError):
+      downloader.probe_gcs_object(self.url)
+
+
+class DownloadGcsObjectTest(helpers.ExtendedTestCase):
+  """Test download_gcs_object."""
+
+  def setUp(self):
+    helpers.patch(self, [
+        'clusterfuzz.common.gsutil',
+        'clusterfuzz.downloader.download_probed',
+        'clusterfuzz.downloader.probe_gcs_object'])
+    self.url = 'https://storage.cloud.google.com/bucket/abc.zip'
+    self.gcs_object = downloader.GcsObject(
+        'https://storage.googleapis.com/bucket/abc.zip',
+        {'Authorization': 'Bearer a'}, 1000, 'md5')
+    self.mock.probe_gcs_object.return_value = self.gcs_object
+
+  def test_download(self):
+    """Test downloading in-process."""
+    downloader.download_gcs_object(self.url, '/cache/abc.zip')
+
+    self.mock.download_probed.assert_called_once_with(
+        'https://storage.googleapis.com/bucket/abc.zip', '/cache/abc.zip',
+        {'Authorization': 'Bearer a'}, 1000, 'md5')
+    self.mock.probe_gcs_object.assert_called_once_with(self.url)
+    self.assert_n_calls(0, [self.mock.gsutil])
+
+  def test_probed(self):
+    """Test reusing the probe of the object."""
+    downloader.download_gcs_object(
+        self.url, '/cache/abc.zip', self.gcs_object)
+
+    self.assert_n_calls(1, [self.mock.download_probed])
+    self.assert_n_calls(0, [self.mock.probe_gcs_object])
+
+  def test_no_credentials(self):
+    """Test falling back to gsutil without credentials."""
+    self.mock.probe_gcs_object.return_value = self.gcs_object._replace(
+        headers=None)
+
+    downloader.download_gcs_object(self.url, '/cache/abc.zip')
+
+    self.mock.gsutil.assert_called_once_with(
+        'cp gs://bucket/abc.zip /cache/abc.zip', '/cache')
+    self.assert_n_calls(0, [self.mock.download_probed])
+
+  def test_forbidden(self):
+    """Test falling back to gsutil when the credentials cannot access it."""
+    self.mock.download_probed.side_effect = error.DownloadFailedError(
+        self.url, 'HTTP 403', 403)
+
+    downloader.download_gcs_object(self.url, '/cache/abc.zip')
+
+    self.mock.gsutil.assert_called_once_with(
+        'cp gs://bucket/abc.zip /cache/abc.zip', '/cache')
+
+  def test_other_error(self):
+    """Test raising other errors."""
+    self.mock.download_probed.side_effect = error.DownloadFailedError(
+        self.url, 'HTTP 500', 500)
+
+    with self.assertRaises(error.DownloadFailedError):
+      downloader.download_gcs_object(self.url, '/cache/abc.zip')
+    self.assert_n_calls(0, [self.mock.gsutil])
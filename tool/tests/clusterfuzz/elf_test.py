@@ -0,0 +1,89 @@
+"""Test the elf module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+from clusterfuzz import elf
+from test_libs import helpers
+
+
+def make_elf(elf_class, endian, libraries):
+  """Make a minimal ELF binary with one loaded segment, which holds the
+    dynamic section and its string table."""
+  header_format, program_header_format, dynamic_format = elf.FORMATS[elf_class]
+  header_size = 16 + struct.calcsize(endian + header_format)
+  program_header_size = struct.calcsize(endian + program_header_format)
+  dynamic_size = struct.calcsize(endian + dynamic_format)
+  vaddr = 0x400000
+
+  strings = '\0' + ''.join(library + '\0' for library in libraries)
+  dynamic_offset = header_size + 2 * program_header_size
+  strtab_offset = dynamic_offset + (len(libraries) + 3) * dynamic_size
+
+  dynamic = []
+  index = 1
+  for library in libraries:
+    dynamic.append((elf.DT_NEEDED, index))
+    index += len(library) + 1
+  dynamic += [(elf.DT_STRTAB, vaddr + strtab_offset),
+              (elf.DT_STRSZ, len(strings)), (elf.DT_NULL, 0)]
+  dynamic_data = ''.join(
+      struct.pack(endian + dynamic_format, *entry) for entry in dynamic)
+  file_size = strtab_offset + len(strings)
+
+  def program_header(p_type, offset, size):
+    """Pack a program header."""
+    if elf_class == 1:
+      return struct.pack(endian + program_header_format,
+                         p_type, offset, vaddr + offset, 0, size, size, 0, 0)
+    return struct.pack(endian + program_header_format,
+                       p_type, 0, offset, vaddr + offset, 0, size, size, 0)
+
+  ident = elf.ELF_MAGIC + chr(elf_class) + chr(2 if endian == '>' else 1)
+  ident += '\1' + '\0' * 9
+  header = struct.pack(endian + header_format, 3, 62, 1, 0, header_size, 0, 0,
+                       header_size, program_header_size, 2)
+  return (ident + header + program_header(elf.PT_LOAD, 0, file_size) +
+          program_header(elf.PT_DYNAMIC, dynamic_offset, len(dynamic_data)) +
+          dynamic_data + strings)
+
+
+class GetNeededLibrariesTest(helpers.ExtendedTestCase):
+  """Test get_needed_libraries."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+
+  def test_64_bit(self):
+    """Test reading a 64-bit little-endian binary."""
+    self.fs.CreateFile('/build/d8', contents=make_elf(
+        2, '<', ['libicu.so', 'libc.so.6']))
+    self.assertEqual(
+        ['libicu.so', 'libc.so.6'], elf.get_needed_libraries('/build/d8'))
+
+  def test_32_bit(self):
+    """Test reading a 32-bit big-endian binary."""
+    self.fs.CreateFile('/build/d8', contents=make_elf(1, '>', ['libc.so.6']))
+    self.assertEqual(['libc.so.6'], elf.get_needed_libraries('/build/d8'))
+
+  def test_static(self):
+    """Test a binary that doesn't need anything."""
+    self.fs.CreateFile('/build/d8', contents=make_elf(2, '<', []))
+    self.assertEqual([], elf.get_needed_libraries('/build/d8'))
+
+  def test_not_elf(self):
+    """Test a file that isn't an ELF binary."""
+    self.fs.CreateFile('/build/d8.dict', contents='"abc"\n')
+    self.assertEqual([], elf.get_needed_libraries('/build/d8.dict'))
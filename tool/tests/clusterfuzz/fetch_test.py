@@ -0,0 +1,176 @@
+"""Test the fetch module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import mock
+
+from clusterfuzz import fetch
+from clusterfuzz import git_batch
+from test_libs import helpers
+
+
+class GetReceivedBytesTest(helpers.ExtendedTestCase):
+  """Test get_received_bytes."""
+
+  def test_progress(self):
+    """Test reading the last total of the progress."""
+    self.assertEqual(
+        int(3.5 * 1024 * 1024),
+        fetch.get_received_bytes(
+            'remote: Counting objects: 3\n'
+            'Receiving objects:  50% (6/12), 1.00 MiB | 1.00 MiB/s\r'
+            'Receiving objects: 100% (12/12), 3.50 MiB | 1.00 MiB/s, done.\n'))
+    self.assertEqual(
+        120, fetch.get_received_bytes(
+            'Receiving objects: 100% (3/3), 120 bytes | 0 bytes/s, done.'))
+
+  def test_none(self):
+    """Test when git didn't receive anything."""
+    self.assertIsNone(fetch.get_received_bytes('From /origin\n'))
+
+
+class FormatBytesTest(helpers.ExtendedTestCase):
+  """Test format_bytes."""
+
+  def test_format(self):
+    """Test formatting sizes."""
+    self.assertEqual('an unknown size', fetch.format_bytes(None))
+    self.assertEqual('120 bytes', fetch.format_bytes(120))
+    self.assertEqual('1.5 KiB', fetch.format_bytes(1536))
+    self.assertEqual('2.0 GiB', fetch.format_bytes(2 * 1024 ** 3))
+
+
+class FetchTestCase(helpers.ExtendedTestCase):
+  """An origin with two commits, and a clone that only has the first."""
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    for module_dict in [git_batch.CAT_FILES, fetch.FETCHES]:
+      patcher = mock.patch.dict(module_dict, {}, clear=True)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+    self.origin_dir = os.path.join(self.tmp_dir, 'origin')
+    os.mkdir(self.origin_dir)
+    self.commit(self.origin_dir, 'first')
+    self.git(self.origin_dir, 'config', 'uploadpack.allowAnySHA1InWant',
+             'true')
+    self.git(self.origin_dir, 'config', 'uploadpack.allowFilter', 'true')
+    self.source_dir = os.path.join(self.tmp_dir, 'src')
+
+  def tearDown(self):
+    for cat_file in git_batch.CAT_FILES.itervalues():
+      cat_file.close()
+
+  def git(self, cwd, *args):
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=a', '-c', 'user.email=a@b.c'] + list(args),
+        cwd=cwd, stderr=subprocess.STDOUT).strip()
+
+  def commit(self, cwd, content):
+    """Commit a file, and return the sha."""
+    if not os.path.exists(os.path.join(cwd, '.git')):
+      self.git(cwd, 'init', '-q')
+    with open(os.path.join(cwd, 'file'), 'w') as f:
+      f.write(content)
+    self.git(cwd, 'add', 'file')
+    self.git(cwd, 'commit', '-q', '-m', content)
+    return self.git(cwd, 'rev-parse', 'HEAD')
+
+  def clone(self, *args):
+    """Clone the origin, and add a second commit to it after."""
+    self.git(self.tmp_dir, 'clone', '-q', *(
+        list(args) + ['file://%s' % self.origin_dir, self.source_dir]))
+    return self.commit(self.origin_dir, 'second')
+
+
+class ChooseStrategyTest(FetchTestCase):
+  """Test choose_strategy."""
+
+  def test_full(self):
+    """Test a full clone."""
+    self.clone()
+    self.assertEqual('full', fetch.choose_strategy(self.source_dir))
+
+  def test_shallow(self):
+    """Test a shallow clone."""
+    self.clone('--depth=1')
+    self.assertEqual('shallow', fetch.choose_strategy(self.source_dir))
+
+  def test_partial(self):
+    """Test a blob-less clone."""
+    self.clone('--filter=blob:none')
+    self.assertEqual('partial', fetch.choose_strategy(self.source_dir))
+
+
+class EnsureTest(FetchTestCase):
+  """Test prefetch and ensure."""
+
+  def setUp(self):
+    super(EnsureTest, self).setUp()
+    helpers.patch(self, ['clusterfuzz.fetch.logger'])
+
+  def test_exists(self):
+    """Test not fetching a sha that exists."""
+    self.clone()
+    sha = self.git(self.source_dir, 'rev-parse', 'HEAD')
+    fetch.ensure(sha, self.source_dir)
+    self.assert_n_calls(0, [self.mock.logger.info])
+
+  def test_partial(self):
+    """Test that a partial clone fetches the commit when looking it up."""
+    sha = self.clone('--filter=blob:none')
+    fetch.ensure(sha, self.source_dir)
+
+    self.assertTrue(git_batch.sha_exists(sha, self.source_dir))
+    self.assert_n_calls(0, [self.mock.logger.info])
+
+  def test_prefetch(self):
+    """Test waiting for the fetch in the background."""
+    sha = self.clone('--depth=1')
+    fetch.prefetch(sha, self.source_dir)
+    fetch.ensure(sha, self.source_dir)
+
+    self.assertTrue(git_batch.sha_exists(sha, self.source_dir))
+    self.assertEqual({}, fetch.FETCHES)
+    self.mock.logger.info.assert_any_call(
+        'Fetched %s (%s) in %.1fs, receiving %s.', sha, 'shallow', mock.ANY,
+        mock.ANY)
+
+  def test_no_prefetch(self):
+    """Test fetching when nothing was started in the background."""
+    sha = self.clone()
+    fetch.ensure(sha, self.source_dir)
+
+    self.assertTrue(git_batch.sha_exists(sha, self.source_dir))
+    self.mock.logger.info.assert_called_once_with(
+        'Fetched %s (%s) in %.1fs, receiving %s.', sha, 'full', mock.ANY,
+        mock.ANY)
+
+  def test_fallback(self):
+    """Test falling back to a plain fetch when the optimized one fails."""
+    sha = self.clone()
+    helpers.patch(self, ['clusterfuzz.fetch.choose_strategy',
+                         'clusterfuzz.local_logging.send_output'])
+    self.mock.choose_strategy.return_value = 'full'
+    with mock.patch.dict(fetch.STRATEGY_ARGS, {'full': '--unknown-flag'}):
+      fetch.ensure(sha, self.source_dir)
+
+    self.assertTrue(git_batch.sha_exists(sha, self.source_dir))
+    self.assert_n_calls(0, [self.mock.logger.info])
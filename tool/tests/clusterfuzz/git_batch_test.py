@@ -0,0 +1,144 @@
+"""Test the git_batch module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import mock
+
+from clusterfuzz import git_batch
+from test_libs import helpers
+
+
+class GitBatchTestCase(helpers.ExtendedTestCase):
+  """A real git repository with one commit."""
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    patcher = mock.patch.dict(git_batch.CAT_FILES, {}, clear=True)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+    self.source_dir = os.path.join(self.tmp_dir, 'src')
+    os.mkdir(self.source_dir)
+    with open(os.path.join(self.source_dir, 'DEPS'), 'w') as f:
+      f.write('vars = {}\n\nline\n')
+    self.git('init', '-q')
+    self.git('add', 'DEPS')
+    self.git('commit', '-q', '-m', 'DEPS')
+    self.sha = self.git('rev-parse', 'HEAD')
+
+  def tearDown(self):
+    for cat_file in git_batch.CAT_FILES.itervalues():
+      cat_file.close()
+
+  def git(self, *args):
+    """Run git in the checkout."""
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=a', '-c', 'user.email=a@b.c'] + list(args),
+        cwd=self.source_dir).strip()
+
+
+class CatFileTest(GitBatchTestCase):
+  """Test CatFile."""
+
+  def test_read(self):
+    """Test reading several objects through one process."""
+    cat_file = git_batch.CatFile(self.source_dir)
+    self.addCleanup(cat_file.close)
+
+    self.assertEqual(
+        'vars = {}\n\nline\n', cat_file.read('%s:DEPS' % self.sha))
+    proc = cat_file.proc
+    self.assertIsNone(cat_file.read('%s:missing' % self.sha))
+    self.assertEqual('DEPS', cat_file.read(self.sha).split('\n\n')[-1].strip())
+    self.assertIs(proc, cat_file.proc)
+
+  def test_batch_check(self):
+    """Test looking up an object without its content."""
+    cat_file = git_batch.CatFile(self.source_dir, '--batch-check')
+    self.addCleanup(cat_file.close)
+
+    fields, content = cat_file.request(self.sha)
+    self.assertEqual([self.sha, 'commit'], fields[:2])
+    self.assertIsNone(content)
+
+  def test_restart(self):
+    """Test restarting git after it has died."""
+    cat_file = git_batch.CatFile(self.source_dir)
+    self.addCleanup(cat_file.close)
+    cat_file.read(self.sha)
+    cat_file.close()
+
+    self.assertEqual(
+        'vars = {}\n\nline\n', cat_file.read('%s:DEPS' % self.sha))
+
+
+class ReadFileTest(GitBatchTestCase):
+  """Test read_file."""
+
+  def test_read(self):
+    """Test reading a file at a commit."""
+    self.assertEqual(
+        'vars = {}\n\nline\n',
+        git_batch.read_file(self.source_dir, self.sha, 'DEPS'))
+    self.assertEqual([(self.source_dir, '--batch')], git_batch.CAT_FILES.keys())
+
+  def test_not_a_checkout(self):
+    """Test reading from a directory that isn't a git checkout."""
+    self.assertIsNone(git_batch.read_file(self.tmp_dir, self.sha, 'DEPS'))
+
+
+class GetObjectShaTest(GitBatchTestCase):
+  """Test get_object_sha, sha_exists and get_current_sha."""
+
+  def test_get(self):
+    """Test resolving names through one process."""
+    self.assertEqual(
+        self.sha, git_batch.get_object_sha(self.sha[:10], self.source_dir))
+    self.assertTrue(git_batch.sha_exists(self.sha, self.source_dir))
+    self.assertFalse(git_batch.sha_exists('0' * 40, self.source_dir))
+    self.assertEqual(self.sha, git_batch.get_current_sha(self.source_dir))
+    self.assertEqual(
+        [(self.source_dir, '--batch-check')], git_batch.CAT_FILES.keys())
+
+  def test_head_moves(self):
+    """Test that HEAD is resolved again on every call."""
+    self.assertEqual(self.sha, git_batch.get_current_sha(self.source_dir))
+    self.git('commit', '-q', '--allow-empty', '-m', 'Second')
+    self.assertEqual(self.git('rev-parse', 'HEAD'),
+                     git_batch.get_current_sha(self.source_dir))
+
+  def test_not_a_checkout(self):
+    """Test a directory that isn't a git checkout."""
+    self.assertIsNone(git_batch.get_current_sha(self.tmp_dir))
+
+
+class IsRepoDirtyTest(GitBatchTestCase):
+  """Test is_repo_dirty."""
+
+  def test_clean(self):
+    """Test a clean checkout, where untracked files don't count."""
+    with open(os.path.join(self.source_dir, 'untracked'), 'w') as f:
+      f.write('a')
+    self.assertFalse(git_batch.is_repo_dirty(self.source_dir))
+
+  def test_dirty(self):
+    """Test a checkout with a changed file."""
+    with open(os.path.join(self.source_dir, 'DEPS'), 'w') as f:
+      f.write('vars = {"a": 1}\n')
+    self.assertTrue(git_batch.is_repo_dirty(self.source_dir))
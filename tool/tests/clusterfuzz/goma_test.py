@@ -0,0 +1,123 @@
+"""Test the goma module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import signal
+import mock
+import requests
+
+from clusterfuzz import goma
+from test_libs import helpers
+
+
+class ProbeTest(helpers.ExtendedTestCase):
+  """Test probe."""
+
+  def setUp(self):
+    helpers.patch(self, ['requests.get', 'time.time'])
+    self.mock.time.side_effect = [0.0, 0.1]
+    self.mock_os_environment({'GOMA_COMPILER_PROXY_PORT': '8090'})
+
+  def test_healthy(self):
+    """Test a healthy compiler_proxy."""
+    self.mock.get.return_value = mock.Mock(status_code=200, text='ok\n')
+    self.assertEqual(goma.Probe(True, 0.1, 'ok'), goma.probe())
+    self.mock.get.assert_called_once_with(
+        'http://127.0.0.1:8090/healthz', timeout=goma.PROBE_TIMEOUT)
+
+  def test_unhealthy(self):
+    """Test a compiler_proxy that can't reach the backend."""
+    self.mock.get.return_value = mock.Mock(
+        status_code=200, text='running: failed to connect to backend')
+    self.assertEqual(
+        goma.Probe(False, 0.1, 'running: failed to connect to backend'),
+        goma.probe())
+
+  def test_slow(self):
+    """Test a compiler_proxy that answers too slowly."""
+    self.mock.time.side_effect = [0.0, 5.0]
+    self.mock.get.return_value = mock.Mock(status_code=200, text='ok')
+    self.assertEqual(goma.Probe(False, 5.0, 'answering slowly'), goma.probe())
+
+  def test_not_running(self):
+    """Test when compiler_proxy doesn't answer."""
+    self.mock.get.side_effect = requests.exceptions.ConnectionError('refused')
+    self.assertEqual(goma.Probe(False, 0.1, 'refused'), goma.probe())
+
+
+class CheckTest(helpers.ExtendedTestCase):
+  """Test check."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.goma.probe', 'time.sleep'])
+
+  def test_starting(self):
+    """Test waiting for compiler_proxy to connect."""
+    self.mock.probe.side_effect = [
+        goma.Probe(False, 0.1, 'starting'), goma.Probe(True, 0.1, 'ok')]
+    self.assertTrue(goma.check())
+    self.assert_n_calls(1, [self.mock.sleep])
+
+  def test_unhealthy(self):
+    """Test giving up after a few probes."""
+    self.mock.probe.return_value = goma.Probe(False, 0.1, 'error')
+    self.assertFalse(goma.check())
+    self.assert_n_calls(goma.STARTUP_PROBES, [self.mock.probe])
+
+
+class MonitorTest(helpers.ExtendedTestCase):
+  """Test Monitor."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.goma.probe', 'os.killpg', 'time.time'])
+    self.unhealthy = goma.Probe(False, 10.0, 'timed out')
+    self.monitor = goma.Monitor(mock.Mock(pid=123), unhealthy_seconds=100)
+
+  def test_stalled(self):
+    """Test stopping the build when goma stays unhealthy."""
+    self.mock.probe.return_value = self.unhealthy
+    for now in [0, 50, 99]:
+      self.mock.time.return_value = now
+      self.monitor.check()
+      self.assertFalse(self.monitor.tripped)
+
+    self.mock.time.return_value = 100
+    self.monitor.check()
+    self.assertTrue(self.monitor.tripped)
+    self.mock.killpg.assert_called_once_with(123, signal.SIGTERM)
+
+  def test_recovered(self):
+    """Test that goma recovering resets the clock."""
+    self.mock.probe.side_effect = [
+        self.unhealthy, goma.Probe(True, 0.1, 'ok'), self.unhealthy,
+        self.unhealthy]
+    for now in [0, 60, 120, 200]:
+      self.mock.time.return_value = now
+      self.monitor.check()
+    self.assertFalse(self.monitor.tripped)
+
+  def test_disabled(self):
+    """Test that a disabled monitor doesn't probe."""
+    with goma.Monitor(mock.Mock(pid=123), enabled=False, interval=0):
+      pass
+    self.assert_n_calls(0, [self.mock.probe])
+
+  def test_thread(self):
+    """Test probing in the background until the build stops."""
+    self.mock.probe.return_value = self.unhealthy
+    self.mock.time.return_value = 0
+    with goma.Monitor(mock.Mock(pid=123), interval=0,
+                      unhealthy_seconds=0) as monitor:
+      monitor.thread.join()
+    self.assertTrue(monitor.tripped)
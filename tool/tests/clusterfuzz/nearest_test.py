@@ -0,0 +1,133 @@
+"""Test the nearest module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from clusterfuzz import nearest
+from test_libs import helpers
+
+
+class GetChangedPathsTest(helpers.ExtendedTestCase):
+  """Test get_changed_paths with a real repository."""
+
+  def setUp(self):
+    self.source_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.source_dir)
+    self.git('init', '-q')
+    self.old_sha = self.commit(['a.cc', 'b.cc'])
+    self.git('mv', 'b.cc', 'c.cc')
+    self.new_sha = self.commit(['a.cc'])
+
+  def git(self, *args):
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=a', '-c', 'user.email=a@b.c'] + list(args),
+        cwd=self.source_dir).strip()
+
+  def commit(self, paths):
+    """Change the files and commit, and return the sha."""
+    for path in paths:
+      with open(os.path.join(self.source_dir, path), 'a') as f:
+        f.write('line\n')
+    self.git('add', '-A')
+    self.git('commit', '-q', '-m', 'commit')
+    return self.git('rev-parse', 'HEAD')
+
+  def test_changed(self):
+    """Test listing a renamed file under both names."""
+    self.assertEqual(
+        ['a.cc', 'b.cc', 'c.cc'],
+        nearest.get_changed_paths(self.source_dir, self.old_sha,
+                                  self.new_sha))
+
+  def test_unknown_sha(self):
+    """Test a sha that isn't in the repository."""
+    self.assertIsNone(nearest.get_changed_paths(
+        self.source_dir, 'a' * 40, self.new_sha))
+
+
+class GetBlockingPathsTest(helpers.ExtendedTestCase):
+  """Test get_blocking_paths."""
+
+  def test_blocking(self):
+    """Test the inputs and the build files."""
+    self.assertEqual(
+        ['v8/d8.cc', 'DEPS', 'v8/BUILD.gn', 'build/config.gni'],
+        nearest.get_blocking_paths(
+            ['v8/d8.cc', 'docs/README.md', 'DEPS', 'v8/BUILD.gn',
+             'build/config.gni', 'v8/test/unittest.cc'],
+            set(['v8/d8.cc', 'v8/d8.h'])))
+
+  def test_toolchain(self):
+    """Test the clang update script and the toolchain scripts."""
+    self.assertEqual(
+        ['tools/clang/scripts/update.py',
+         'build/toolchain/gcc_link_wrapper.py'],
+        nearest.get_blocking_paths(
+            ['tools/clang/scripts/update.py', 'tools/metrics/histograms.xml',
+             'build/toolchain/gcc_link_wrapper.py'], set()))
+
+
+class FindTest(helpers.ExtendedTestCase):
+  """Test find."""
+
+  def setUp(self):
+    helpers.patch(self, [
+        'clusterfuzz.artifacts.get_nearest',
+        'clusterfuzz.artifacts.read_inputs',
+        'clusterfuzz.nearest.get_changed_paths',
+        'clusterfuzz.nearest.logger',
+    ])
+    self.mock.get_nearest.return_value = [
+        ('changed', {'sha': 'changed_sha', 'revision': 99}),
+        ('unknown', {'sha': 'unknown_sha', 'revision': 102}),
+        ('same', {'sha': 'same_sha', 'revision': 97}),
+        ('far', {'sha': 'far_sha', 'revision': 90})]
+    self.mock.read_inputs.side_effect = lambda key: (
+        None if key == 'unknown' else set(['d8.cc']))
+    self.mock.get_changed_paths.side_effect = lambda _, old_sha, __: {
+        'changed_sha': ['d8.cc', 'README'],
+        'same_sha': ['README'],
+        'far_sha': ['README']}[old_sha]
+
+  def test_find(self):
+    """Test reusing the nearest build whose inputs haven't changed."""
+    self.assertEqual('same', nearest.find('/src', 'sha', 100, 'variant'))
+    self.mock.get_nearest.assert_called_once_with(
+        'variant', 100, nearest.MAX_DISTANCE)
+    self.mock.logger.info.assert_any_call(
+        'Not reusing the build of r%s: %d of the %d files changed between '
+        'it and r%s affect it (e.g. %s).', 99, 1, 2, 100, 'd8.cc')
+    self.mock.logger.info.assert_called_with(
+        'Reusing the build of r%s for r%s: none of the %d files changed in '
+        'between affect it. No need to build.', 97, 100, 1)
+    self.assert_n_calls(2, [self.mock.get_changed_paths])
+
+  def test_too_far(self):
+    """Test giving up after MAX_CANDIDATES builds."""
+    self.mock.get_nearest.return_value = (
+        self.mock.get_nearest.return_value[:2] * nearest.MAX_CANDIDATES +
+        self.mock.get_nearest.return_value[2:])
+    self.assertIsNone(nearest.find('/src', 'sha', 100, 'variant'))
+
+  def test_no_builds(self):
+    """Test when no build is cached nearby."""
+    self.mock.get_nearest.return_value = []
+    self.assertIsNone(nearest.find('/src', 'sha', 100, 'variant'))
+    self.mock.logger.info.assert_called_once_with(
+        'No build within %d revisions of r%s is cached.',
+        nearest.MAX_DISTANCE, 100)
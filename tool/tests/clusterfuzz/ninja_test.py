@@ -0,0 +1,150 @@
+"""Test the ninja module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from clusterfuzz import ninja
+from test_libs import helpers
+
+
+NINJA_LOG = (
+    '# ninja log v5\n'
+    '0\t1000\t1\tobj/a.o\tabc\n'
+    '0\t3000\t1\tobj/b.o\tdef\n'
+    'invalid line\n'
+    '1000\t3000\t2\tobj/a.o\tghi\n')
+
+
+class ReadLogTest(helpers.ExtendedTestCase):
+  """Test read_log."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+
+  def test_read(self):
+    """Test reading the last duration of every output."""
+    self.fs.CreateFile('/build/.ninja_log', contents=NINJA_LOG)
+    self.assertEqual(
+        {'obj/a.o': 2.0, 'obj/b.o': 3.0}, ninja.read_log('/build'))
+
+  def test_missing(self):
+    """Test an out dir that has never been built."""
+    self.assertEqual({}, ninja.read_log('/build'))
+
+
+class EstimateTest(helpers.ExtendedTestCase):
+  """Test estimate."""
+
+  def test_estimate(self):
+    """Test using the durations of known outputs, and the average for the
+      others."""
+    durations = {'obj/a.o': 2.0, 'obj/b.o': 4.0}
+    self.assertEqual(6.0, ninja.estimate(
+        ['CXX obj/a.o', 'CXX obj/b.o', 'STAMP', 'CXX obj/c.o'], durations, 2))
+
+  def test_longest_edge(self):
+    """Test that nothing is faster than the longest edge."""
+    self.assertEqual(
+        4.0, ninja.estimate(['LINK obj/b.o'], {'obj/b.o': 4.0}, 100))
+
+  def test_empty(self):
+    """Test no edges, and no history."""
+    self.assertEqual(0.0, ninja.estimate([], {}, 10))
+    self.assertEqual(0.0, ninja.estimate(['CXX obj/a.o'], {}, 10))
+
+
+class PlanTest(helpers.ExtendedTestCase):
+  """Test plan."""
+
+  def setUp(self):
+    helpers.patch(self, [
+        'clusterfuzz.common.execute',
+        'clusterfuzz.ninja.read_log'])
+    self.mock.read_log.return_value = {'obj/a.o': 10.0}
+
+  def test_dirty(self):
+    """Test counting the edges of a dry run."""
+    self.mock.execute.return_value = (
+        0, 'ninja: Entering directory `/build\'\n'
+           '[1/2] CXX obj/a.o\n'
+           '[2/2] LINK ./d8\n')
+    self.assertEqual(
+        ninja.Plan(edges=2, estimate=20.0),
+        ninja.plan('/build', 'd8', '/src', 1))
+    self.mock.execute.assert_called_once_with(
+        'ninja', '-C /build -n d8', '/src', print_command=False,
+        print_output=False, exit_on_error=False,
+        env={'NINJA_STATUS': ninja.STATUS_FORMAT})
+
+  def test_no_work(self):
+    """Test a build that is up to date."""
+    self.mock.execute.return_value = (0, 'ninja: no work to do.\n')
+    self.assertEqual(ninja.Plan(edges=0, estimate=0.0),
+                     ninja.plan('/build', None, '/src', 1))
+    self.assertEqual('-C /build -n', self.mock.execute.call_args[0][1])
+
+  def test_error(self):
+    """Test a dry run that fails."""
+    self.mock.execute.return_value = (1, 'ninja: error: unknown target')
+    self.assertIsNone(ninja.plan('/build', 'd8', '/src', 1))
+
+
+class GetSourcePathTest(helpers.ExtendedTestCase):
+  """Test get_source_path."""
+
+  def test_path(self):
+    """Test converting the paths that ninja prints."""
+    for path, expected in [('../../base/a.cc', 'base/a.cc'),
+                           ('../../out_other/a.h', 'out_other/a.h'),
+                           ('gen/a.h', None), ('/usr/include/stdio.h', None),
+                           ('../../../outside.h', None)]:
+      self.assertEqual(
+          expected, ninja.get_source_path('/src/out/dir', path, '/src'))
+
+
+class GetInputsTest(helpers.ExtendedTestCase):
+  """Test get_inputs."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.common.execute',
+                         'clusterfuzz.common.start_execute'])
+    self.mock.execute.return_value = (
+        0, '../../v8/d8.cc\n../../v8/snapshot.js\ngen/torque.cc\n')
+    self.proc = self.mock.start_execute.return_value
+    self.proc.stdout = iter([
+        'obj/d8.o: #deps 3, deps mtime 1 (VALID)\n',
+        '    ../../v8/d8.cc\n',
+        '    ../../v8/d8.h\n',
+        '    /usr/include/stdio.h\n',
+        '\n'])
+    self.proc.wait.return_value = 0
+
+  def test_inputs(self):
+    """Test combining the inputs of the edges with the deps log."""
+    self.assertEqual(
+        set(['v8/d8.cc', 'v8/d8.h', 'v8/snapshot.js']),
+        ninja.get_inputs('/src/out/dir', 'd8', '/src'))
+    self.mock.execute.assert_called_once_with(
+        'ninja', '-C /src/out/dir -t inputs d8', '/src', print_command=False,
+        print_output=False, exit_on_error=False)
+
+  def test_old_ninja(self):
+    """Test a ninja that can't list the inputs."""
+    self.mock.execute.return_value = (1, 'ninja: error: unknown tool')
+    self.assertIsNone(ninja.get_inputs('/src/out/dir', 'd8', '/src'))
+    self.assert_n_calls(0, [self.mock.start_execute])
+
+  def test_no_deps_log(self):
+    """Test failing to read the deps log."""
+    self.proc.wait.return_value = 1
+    self.assertIsNone(ninja.get_inputs('/src/out/dir', 'd8', '/src'))
@@ -38,6 +38,24 @@ class IdentityTest(helpers.ExtendedTestCase):
     self.output.close()
 
 
+class PrefixTest(helpers.ExtendedTestCase):
+  """Test Prefix."""
+
+  def test_print(self):
+    """Test printing whole lines with a prefix."""
+    self.output = StringIO.StringIO()
+
+    transformer = output_transformer.Prefix('[a] ')
+    transformer.set_output(self.output)
+    transformer.process('one\ntw')
+    self.assertEqual('[a] one\n', self.output.getvalue())
+    transformer.process('o\nthree')
+    transformer.flush()
+
+    self.assertEqual('[a] one\n[a] two\n[a] three\n', self.output.getvalue())
+    self.output.close()
+
+
 class NinjaTest(helpers.ExtendedTestCase):
   """Test Ninja."""
 
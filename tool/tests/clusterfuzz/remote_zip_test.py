@@ -0,0 +1,275 @@
+"""Test the remote_zip module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import StringIO
+import tempfile
+import zipfile
+import mock
+
+from clusterfuzz import common
+from clusterfuzz import downloader
+from clusterfuzz import remote_zip
+from tests import libs
+from test_libs import helpers
+
+
+def make_zip():
+  """Make a zip with a directory, an executable, a symlink and enough data
+    for several batches."""
+  output = StringIO.StringIO()
+  archive = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+
+  info = zipfile.ZipInfo('abc/')
+  info.external_attr = (stat.S_IFDIR | 0755) << 16
+  archive.writestr(info, '')
+
+  info = zipfile.ZipInfo('abc/chrome')
+  info.external_attr = (stat.S_IFREG | 0755) << 16
+  archive.writestr(info, 'binary')
+
+  info = zipfile.ZipInfo('abc/lib.so')
+  info.external_attr = (stat.S_IFLNK | 0777) << 16
+  archive.writestr(info, 'chrome')
+
+  for i in xrange(20):
+    # Random-ish data that doesn't compress well.
+    content = ''.join(chr((i * j * 7919) % 251) for j in xrange(5000))
+    archive.writestr('abc/data/%d.pak' % i, content, zipfile.ZIP_STORED)
+
+  archive.close()
+  return output.getvalue()
+
+
+class RangeFileTest(helpers.ExtendedTestCase):
+  """Test RangeFile."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.downloader.read_range'])
+    self.content = ''.join(chr(i % 256) for i in xrange(1000))
+    self.mock.read_range.side_effect = (
+        lambda url, headers, start, end: self.content[start:end + 1])
+
+  def test_read_ahead(self):
+    """Test serving small reads from one request."""
+    with mock.patch.object(remote_zip, 'READ_AHEAD', 100):
+      range_file = remote_zip.RangeFile('url', {}, 1000)
+      range_file.seek(10)
+      self.assertEqual(self.content[10:20], range_file.read(10))
+      self.assertEqual(self.content[20:30], range_file.read(10))
+      self.assertEqual(30, range_file.tell())
+
+    self.mock.read_range.assert_called_once_with('url', {}, 10, 109)
+
+  def test_limit(self):
+    """Test not reading ahead past the limit."""
+    with mock.patch.object(remote_zip, 'READ_AHEAD', 100):
+      range_file = remote_zip.RangeFile('url', {}, 1000)
+      range_file.limit = 50
+      self.assertEqual(self.content[:10], range_file.read(10))
+      self.assertEqual(self.content[10:60], range_file.read(50))
+
+    self.assert_exact_calls(self.mock.read_range, [
+        mock.call('url', {}, 0, 49), mock.call('url', {}, 50, 59)])
+
+  def test_tail(self):
+    """Test serving reads from the tail without requests."""
+    range_file = remote_zip.RangeFile(
+        'url', {}, 1000, (900, self.content[900:]))
+    range_file.seek(-10, os.SEEK_END)
+    self.assertEqual(self.content[990:], range_file.read())
+    self.assertEqual('', range_file.read(10))
+
+    self.assert_n_calls(0, [self.mock.read_range])
+
+
+class GetRelativePathTest(helpers.ExtendedTestCase):
+  """Test get_relative_path."""
+
+  def test_get(self):
+    """Test sanitizing and stripping root."""
+    self.assertEqual('a/b', remote_zip.get_relative_path(
+        mock.Mock(filename='abc/./a/../b'), 'abc'))
+    self.assertEqual('abc/a', remote_zip.get_relative_path(
+        mock.Mock(filename='/abc/a'), ''))
+    self.assertIsNone(remote_zip.get_relative_path(
+        mock.Mock(filename='def/a'), 'abc'))
+    self.assertIsNone(remote_zip.get_relative_path(
+        mock.Mock(filename='abc/'), 'abc'))
+
+
+class GetBatchesTest(helpers.ExtendedTestCase):
+  """Test get_batches."""
+
+  def test_get(self):
+    """Test grouping contiguous members."""
+    infos = [mock.Mock(header_offset=offset) for offset in [0, 10, 50, 60, 90]]
+    ends = {0: 10, 10: 50, 50: 60, 60: 70, 90: 100}
+
+    self.assertEqual(
+        [(infos[:2], 50), (infos[2:4], 70), (infos[4:], 100)],
+        remote_zip.get_batches(infos, ends, 40))
+
+
+class RemoteZipTest(helpers.ExtendedTestCase):
+  """Test RemoteZip against a local HTTP server."""
+
+  def setUp(self):
+    helpers.patch(self, ['time.sleep'])
+    for module, name, value in [(remote_zip, 'READ_AHEAD', 4096),
+                                (remote_zip, 'TAIL_SIZE', 1024),
+                                (downloader, 'RANGE_SIZE', 20000),
+                                (downloader, 'RANGE_WORKERS', 3)]:
+      patcher = mock.patch.object(module, name, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    self.content = make_zip()
+    self.archive = zipfile.ZipFile(StringIO.StringIO(self.content))
+
+  def get_fetched(self, server):
+    """Get the number of bytes fetched from the server."""
+    fetched = 0
+    for _, headers in server.requests:
+      start, end = headers['range'][len('bytes='):].split('-')
+      fetched += int(end) + 1 - int(start)
+    return fetched
+
+  def test_extract(self):
+    """Test extracting everything with permissions and symlinks, without
+      fetching any byte twice."""
+    with libs.FakeHttpServer({'/abc.zip': self.content}) as server:
+      remote = remote_zip.RemoteZip(
+          server.url('/abc.zip'), {}, len(self.content), 'abc')
+      self.assertEqual(22, len(remote.members))
+      remote.extract(remote.members.keys(), self.tmp_dir)
+
+    for i in xrange(20):
+      with open(os.path.join(self.tmp_dir, 'data/%d.pak' % i)) as f:
+        self.assertEqual(self.archive.read('abc/data/%d.pak' % i), f.read())
+
+    chrome_path = os.path.join(self.tmp_dir, 'chrome')
+    self.assertEqual(0755, stat.S_IMODE(os.stat(chrome_path).st_mode))
+    self.assertEqual(
+        'chrome', os.readlink(os.path.join(self.tmp_dir, 'lib.so')))
+    self.assertLessEqual(self.get_fetched(server), len(self.content))
+
+  def test_extract_some(self):
+    """Test fetching only the selected members."""
+    with libs.FakeHttpServer({'/abc.zip': self.content}) as server:
+      remote = remote_zip.RemoteZip(
+          server.url('/abc.zip'), {}, len(self.content), 'abc')
+      remote.extract(['chrome', 'data/7.pak'], self.tmp_dir)
+
+    self.assertEqual(['chrome', 'data'], sorted(os.listdir(self.tmp_dir)))
+    self.assertEqual(
+        ['7.pak'], os.listdir(os.path.join(self.tmp_dir, 'data')))
+    self.assertLess(self.get_fetched(server), 10000)
+
+  def test_extract_in_background(self):
+    """Test calling back after extracting in the background."""
+    callback = mock.Mock()
+    with libs.FakeHttpServer({'/abc.zip': self.content}) as server:
+      remote = remote_zip.RemoteZip(
+          server.url('/abc.zip'), {}, len(self.content), 'abc')
+      remote.extract_in_background(
+          ['data/1.pak'], self.tmp_dir, callback).join()
+
+    callback.assert_called_once_with()
+    self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, 'data/1.pak')))
+
+  def test_callback_failed(self):
+    """Test that what the callback raises is only logged."""
+    helpers.patch(self, ['clusterfuzz.remote_zip.logger'])
+    callback = mock.Mock(side_effect=OSError(2, 'No such file'))
+    with libs.FakeHttpServer({'/abc.zip': self.content}) as server:
+      remote = remote_zip.RemoteZip(
+          server.url('/abc.zip'), {}, len(self.content), 'abc')
+      remote.extract_in_background(
+          ['data/1.pak'], self.tmp_dir, callback).join()
+
+    callback.assert_called_once_with()
+    self.assertEqual('Background extraction of %s failed: %s',
+                     self.mock.logger.debug.call_args[0][0])
+
+  def test_corrupt(self):
+    """Test failing when a member doesn't match its crc."""
+    info = self.archive.getinfo('abc/data/3.pak')
+    offset = info.header_offset + 30 + len(info.filename) + 100
+    content = (self.content[:offset] + chr(ord(self.content[offset]) ^ 1) +
+               self.content[offset + 1:])
+
+    with libs.FakeHttpServer({'/abc.zip': content}) as server:
+      remote = remote_zip.RemoteZip(server.url('/abc.zip'), {}, len(content))
+      with self.assertRaises(zipfile.BadZipfile):
+        remote.extract(['abc/data/3.pak'], self.tmp_dir)
+
+
+class OpenGcsObjectTest(helpers.ExtendedTestCase):
+  """Test open_gcs_object."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.remote_zip.RemoteZip'])
+    self.url = 'https://storage.googleapis.com/bucket/abc.zip'
+    self.headers = {'Authorization': 'Bearer a'}
+
+  def test_open(self):
+    """Test opening a zip that supports ranges."""
+    self.assertEqual(
+        self.mock.RemoteZip.return_value,
+        remote_zip.open_gcs_object(
+            downloader.GcsObject(self.url, self.headers, 1000, None), 'abc'))
+
+    self.mock.RemoteZip.assert_called_once_with(
+        self.url, self.headers, 1000, 'abc')
+
+  def test_no_ranges(self):
+    """Test when ranges aren't supported."""
+    self.assertIsNone(remote_zip.open_gcs_object(
+        downloader.GcsObject(self.url, self.headers, None, None)))
+    self.assert_n_calls(0, [self.mock.RemoteZip])
+
+  def test_no_credentials(self):
+    """Test when there are no credentials."""
+    self.assertIsNone(remote_zip.open_gcs_object(
+        downloader.GcsObject(self.url, None, None, None)))
+    self.assert_n_calls(0, [self.mock.RemoteZip])
+
+
+class DownloadAndUnzipGcsObjectTest(helpers.ExtendedTestCase):
+  """Test download_and_unzip_gcs_object."""
+
+  def setUp(self):
+    helpers.patch(self, [
+        'clusterfuzz.common.execute',
+        'clusterfuzz.downloader.download_gcs_object',
+        'os.remove'])
+
+  def test_unzip(self):
+    """Test downloading and unzipping."""
+    saved_file = os.path.join(common.CLUSTERFUZZ_CACHE_DIR, 'abc.zip')
+
+    remote_zip.download_and_unzip_gcs_object(
+        'https://storage.cloud.google.com/bucket/abc.zip', '/builds/tmp')
+
+    self.mock.download_gcs_object.assert_called_once_with(
+        'https://storage.cloud.google.com/bucket/abc.zip', saved_file, None)
+    self.mock.execute.assert_called_once_with(
+        'unzip', '-q -o %s -d /builds/tmp' % saved_file,
+        cwd=common.CLUSTERFUZZ_DIR)
+    self.mock.remove.assert_called_once_with(saved_file)
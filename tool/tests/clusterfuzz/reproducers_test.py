@@ -15,6 +15,11 @@
 
 import os
 import json
+import shutil
+import signal
+import tempfile
+import threading
+import time
 import mock
 
 from clusterfuzz import common
@@ -275,6 +280,35 @@ class ReproduceCrashTest(helpers.ExtendedTestCase):
     self.assert_exact_calls(self.mock.run_gestures, [mock.call(
         reproducer, self.mock.start_execute.return_value, ':display')])
 
+  def test_chromium_user_data_dir(self):
+    """Test chromium's reproduce_crash with a fresh user-data-dir."""
+    patch_stacktrace_info(self)
+    self.mock.start_execute.return_value = mock.Mock()
+    self.mock.__enter__.return_value = ':display'
+    mocked_provider = mock.Mock()
+    mocked_provider.get_binary_path.return_value = '%s/d8' % self.app_directory
+    mocked_provider.get_build_directory.return_value = self.app_directory
+
+    reproducer = reproducers.LinuxChromeJobReproducer(
+        self.definition, mocked_provider, mock.Mock(
+            gestures=None, stacktrace_lines=[{'content': 'line'}],
+            job_type='job_type', environment={}),
+        'UBSAN', libs.make_options())
+    reproducer.args = '--repro --user-data-dir=%USER_DATA_DIR%'
+    with mock.patch('clusterfuzz.reproducers.UserDataDir') as user_data_dir:
+      user_data_dir.return_value.__enter__.return_value = '/tmp/profile'
+      user_data_dir.return_value.__exit__.return_value = False
+      reproducer.reproduce_crash()
+
+    user_data_dir.assert_called_once_with(
+        self.app_directory, '%s/d8' % self.app_directory,
+        {'DISPLAY': ':display'}, disable=False)
+    self.assertEqual(
+        '--repro --user-data-dir=/tmp/profile',
+        self.mock.start_execute.call_args[0][1])
+    self.assertEqual(
+        '--repro --user-data-dir=%USER_DATA_DIR%', reproducer.args)
+
 
 class SetupArgsTest(helpers.ExtendedTestCase):
   """Test setup_args."""
@@ -896,11 +930,6 @@ class IsSimilarTest(helpers.ExtendedTestCase):
 class EnsureUserDataDirIfNeededTest(helpers.ExtendedTestCase):
   """Test ensure_user_data_dir_if_needed."""
 
-  def setUp(self):
-    self.setup_fake_filesystem()
-    os.makedirs(reproducers.USER_DATA_DIR_PATH)
-    self.assertTrue(os.path.exists(reproducers.USER_DATA_DIR_PATH))
-
   def test_doing_nothing(self):
     """Test doing nothing."""
     self.assertEqual(
@@ -910,17 +939,289 @@ class EnsureUserDataDirIfNeededTest(helpers.ExtendedTestCase):
   def test_add_because_it_should(self):
     """Test adding arg because it should have."""
     self.assertEqual(
-        '--something --user-data-dir=%s' % reproducers.USER_DATA_DIR_PATH,
+        '--something --user-data-dir=%USER_DATA_DIR%',
         reproducers.ensure_user_data_dir_if_needed('--something', True))
-    self.assertFalse(os.path.exists(reproducers.USER_DATA_DIR_PATH))
 
   def test_add_because_of_previous_args(self):
     """Test replacing arg because it exists."""
     self.assertEqual(
-        '--something  --user-data-dir=%s' % reproducers.USER_DATA_DIR_PATH,
+        '--something  --user-data-dir=%USER_DATA_DIR%',
         reproducers.ensure_user_data_dir_if_needed(
             '--something --user-data-dir=/tmp/random', False))
-    self.assertFalse(os.path.exists(reproducers.USER_DATA_DIR_PATH))
+
+
+class CloneUserDataDirTest(helpers.ExtendedTestCase):
+  """Test clone_user_data_dir."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.common.execute'])
+
+  def test_clone(self):
+    """Test cloning with reflinks when possible."""
+    reproducers.clone_user_data_dir('/template', '/clone')
+    self.mock.execute.assert_called_once_with(
+        'cp', '-a --reflink=auto /template/. /clone',
+        reproducers.USER_DATA_DIRS_PATH, print_command=False,
+        print_output=False)
+
+
+class RemoveVolatileUserDataFilesTest(helpers.ExtendedTestCase):
+  """Test remove_volatile_user_data_files."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+    os.makedirs('/profile/Default/Sessions')
+    os.makedirs('/profile/Crashpad')
+    self.fs.CreateFile('/profile/Default/Current Session')
+    self.fs.CreateFile('/profile/Default/Preferences')
+    os.symlink('host-1234', '/profile/SingletonLock')
+
+  def test_remove(self):
+    """Test removing volatile files and keeping the rest."""
+    reproducers.remove_volatile_user_data_files('/profile')
+    self.assertEqual(['Default'], os.listdir('/profile'))
+    self.assertEqual(['Preferences'], os.listdir('/profile/Default'))
+
+
+class DeleteStaleUserDataDirsTest(helpers.ExtendedTestCase):
+  """Test delete_stale_user_data_dirs."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+    helpers.patch(self, ['psutil.pid_exists'])
+    self.mock.pid_exists.side_effect = lambda pid: pid == 10
+    for name in ['10-alive', '20-dead', 'unknown']:
+      os.makedirs(os.path.join(reproducers.USER_DATA_DIR_CLONES_PATH, name))
+
+  def test_delete(self):
+    """Test deleting clones of dead processes only."""
+    reproducers.delete_stale_user_data_dirs()
+    self.assertEqual(
+        ['10-alive'], os.listdir(reproducers.USER_DATA_DIR_CLONES_PATH))
+
+
+class UserDataDirTest(helpers.ExtendedTestCase):
+  """Test the UserDataDir context manager."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+    helpers.patch(self, [
+        'clusterfuzz.reproducers.clone_user_data_dir',
+        'clusterfuzz.reproducers.create_user_data_dir_template',
+        'clusterfuzz.reproducers.delete_evicted_user_data_dir_templates',
+        'clusterfuzz.reproducers.delete_stale_user_data_dirs',
+    ])
+    self.template_path = reproducers.get_user_data_dir_template_path(
+        '/build')
+
+  def test_disable(self):
+    """Test doing nothing when disabled."""
+    with reproducers.UserDataDir('/build', disable=True) as path:
+      self.assertIsNone(path)
+    self.assertFalse(os.path.exists(reproducers.USER_DATA_DIRS_PATH))
+
+  def test_create_template(self):
+    """Test creating the template before the first run."""
+    self.mock.create_user_data_dir_template.side_effect = (
+        lambda binary_path, build_directory, env: self.fs.CreateFile(
+            os.path.join(self.template_path, 'Local State')))
+
+    with reproducers.UserDataDir(
+        '/build', '/build/chrome', {'DISPLAY': ':1'}) as path:
+      self.assertTrue(path.startswith(os.path.join(
+          reproducers.USER_DATA_DIR_CLONES_PATH, '%d-' % os.getpid())))
+      self.fs.CreateFile(os.path.join(path, 'Local Storage'))
+
+    self.assertFalse(os.path.exists(path))
+    self.assertEqual(['Local State'], os.listdir(self.template_path))
+    self.mock.create_user_data_dir_template.assert_called_once_with(
+        '/build/chrome', '/build', {'DISPLAY': ':1'})
+    self.mock.clone_user_data_dir.assert_called_once_with(
+        self.template_path, path)
+    self.assert_exact_calls(
+        self.mock.delete_stale_user_data_dirs, [mock.call()])
+    self.assert_exact_calls(
+        self.mock.delete_evicted_user_data_dir_templates, [mock.call()])
+
+  def test_no_template(self):
+    """Test a fresh profile when the template cannot be created."""
+    with reproducers.UserDataDir('/build', '/build/chrome') as path:
+      self.assertEqual([], os.listdir(path))
+
+    self.assertFalse(os.path.exists(path))
+    self.assertFalse(os.path.exists(self.template_path))
+    self.assert_n_calls(1, [self.mock.create_user_data_dir_template])
+    self.assert_n_calls(0, [self.mock.clone_user_data_dir])
+
+  def test_failed_before(self):
+    """Test not trying again when the template couldn't be created for the
+      build."""
+    common.write_json(
+        reproducers.get_user_data_dir_template_meta_path(self.template_path),
+        {'build_directory': '/build', 'failed': True})
+
+    with reproducers.UserDataDir('/build', '/build/chrome') as path:
+      self.assertEqual([], os.listdir(path))
+    self.assert_n_calls(0, [
+        self.mock.create_user_data_dir_template,
+        self.mock.clone_user_data_dir])
+
+  def test_other_binary(self):
+    """Test not creating a template for binaries other than Chrome."""
+    with reproducers.UserDataDir('/build', '/build/content_shell') as path:
+      self.assertEqual([], os.listdir(path))
+    self.assert_n_calls(0, [self.mock.create_user_data_dir_template])
+
+  def test_clone_template(self):
+    """Test cloning the existing template and discarding the clone."""
+    self.fs.CreateFile(os.path.join(self.template_path, 'Local State'))
+
+    with reproducers.UserDataDir('/build', '/build/chrome') as path:
+      self.assertTrue(os.path.isdir(path))
+
+    self.assertFalse(os.path.exists(path))
+    self.assertEqual(['Local State'], os.listdir(self.template_path))
+    self.mock.clone_user_data_dir.assert_called_once_with(
+        self.template_path, path)
+    self.assert_n_calls(0, [self.mock.create_user_data_dir_template])
+
+
+class CreateUserDataDirTemplateTest(helpers.ExtendedTestCase):
+  """Test create_user_data_dir_template."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+    helpers.patch(self, [
+        'clusterfuzz.common.start_execute',
+        'clusterfuzz.common.wait_execute',
+        'clusterfuzz.reproducers.stop_user_data_dir_launch'])
+    os.makedirs(reproducers.USER_DATA_DIR_CLONES_PATH)
+    self.template_path = reproducers.get_user_data_dir_template_path(
+        '/build')
+    self.meta_path = reproducers.get_user_data_dir_template_meta_path(
+        self.template_path)
+    os.makedirs(reproducers.USER_DATA_DIR_TEMPLATES_PATH)
+
+  def launch(self, profile_files):
+    """Create the template, with Chrome creating profile_files."""
+    def wait_execute(*unused_args, **unused_kwargs):
+      path = self.mock.start_execute.call_args[0][1].split()[0].split('=')[1]
+      for name in profile_files:
+        self.fs.CreateFile(os.path.join(path, name))
+      return 0, ''
+    self.mock.wait_execute.side_effect = wait_execute
+    reproducers.create_user_data_dir_template(
+        '/build/chrome', '/build', {'DISPLAY': ':1'})
+
+  def test_create(self):
+    """Test saving the profile of a launch on about:blank."""
+    self.launch(['Local State', 'SingletonCookie'])
+
+    self.assertEqual(['Local State'], os.listdir(self.template_path))
+    self.assertEqual(
+        {'build_directory': '/build'}, common.read_json(self.meta_path))
+    self.assertEqual([], os.listdir(reproducers.USER_DATA_DIR_CLONES_PATH))
+    self.mock.start_execute.assert_called_once_with(
+        '/build/chrome', mock.ANY, '/build', env={'DISPLAY': ':1'},
+        print_command=False, stdin=mock.ANY)
+    self.assertTrue(self.mock.start_execute.call_args[0][1].endswith(
+        ' ' + reproducers.USER_DATA_DIR_TEMPLATE_ARGS))
+    self.mock.wait_execute.assert_called_once_with(
+        self.mock.start_execute.return_value, exit_on_error=False,
+        capture_output=False, print_output=False)
+    self.mock.stop_user_data_dir_launch.assert_called_once_with(
+        self.mock.start_execute.return_value, mock.ANY, mock.ANY)
+    self.assertTrue(
+        self.mock.stop_user_data_dir_launch.call_args[0][2].is_set())
+
+  def test_crashed(self):
+    """Test recording the failure when Chrome doesn't set the profile up."""
+    self.launch([])
+
+    self.assertFalse(os.path.exists(self.template_path))
+    self.assertEqual({'build_directory': '/build', 'failed': True},
+                     common.read_json(self.meta_path))
+    self.assertEqual([], os.listdir(reproducers.USER_DATA_DIR_CLONES_PATH))
+
+
+class StopUserDataDirLaunchTest(helpers.ExtendedTestCase):
+  """Test stop_user_data_dir_launch with a real process."""
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.proc = common.start_execute('sleep', '60', '.', print_command=False)
+    self.stopped = threading.Event()
+
+  def tearDown(self):
+    if self.proc.poll() is None:
+      os.killpg(self.proc.pid, signal.SIGKILL)
+      self.proc.wait()
+    shutil.rmtree(self.path)
+
+  def test_profile_written(self):
+    """Test stopping the launch as soon as Local State appears."""
+    with open(os.path.join(self.path, 'Local State'), 'w') as f:
+      f.write('{}')
+
+    start_time = time.time()
+    with mock.patch('clusterfuzz.reproducers.USER_DATA_DIR_TEMPLATE_TIMEOUT',
+                    60):
+      thread = threading.Thread(
+          target=reproducers.stop_user_data_dir_launch,
+          args=(self.proc, self.path, self.stopped))
+      thread.start()
+      self.proc.wait()
+      self.stopped.set()
+      thread.join()
+    self.assertLess(time.time() - start_time, 5)
+
+  def test_exited(self):
+    """Test returning without a signal when the launch has exited."""
+    self.stopped.set()
+    with mock.patch('os.killpg') as killpg:
+      reproducers.stop_user_data_dir_launch(
+          self.proc, self.path, self.stopped)
+    self.assert_n_calls(0, [killpg])
+
+
+class DeleteEvictedUserDataDirTemplatesTest(helpers.ExtendedTestCase):
+  """Test delete_evicted_user_data_dir_templates."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+    os.makedirs('/build')
+
+  def create_template(self, build_directory, meta, failed=False):
+    """Create the template of build_directory, with meta as its record."""
+    template_path = reproducers.get_user_data_dir_template_path(
+        build_directory)
+    if not failed:
+      self.fs.CreateFile(os.path.join(template_path, 'Local State'))
+    if meta is not None:
+      common.write_json(
+          reproducers.get_user_data_dir_template_meta_path(template_path),
+          meta)
+    return template_path
+
+  def test_delete(self):
+    """Test deleting the templates of evicted builds only."""
+    kept = self.create_template('/build', {'build_directory': '/build'})
+    evicted = self.create_template(
+        '/evicted', {'build_directory': '/evicted'})
+    unknown = self.create_template('/unknown', None)
+    self.create_template(
+        '/failed', {'build_directory': '/failed', 'failed': True}, True)
+
+    reproducers.delete_evicted_user_data_dir_templates()
+
+    self.assertTrue(os.path.isdir(kept))
+    self.assertFalse(os.path.exists(evicted))
+    self.assertFalse(os.path.exists(
+        reproducers.get_user_data_dir_template_meta_path(evicted)))
+    self.assertFalse(os.path.exists(unknown))
+    self.assertEqual(
+        [os.path.basename(kept), os.path.basename(kept) + '.json'],
+        sorted(os.listdir(reproducers.USER_DATA_DIR_TEMPLATES_PATH)))
 
 
 class UpdateTestcasePathInLayoutTestTest(helpers.ExtendedTestCase):
@@ -0,0 +1,214 @@
+"""Test the revisions module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import mock
+
+from clusterfuzz import common
+from clusterfuzz import git_batch
+from clusterfuzz import revisions
+from test_libs import helpers
+
+
+class BuildRevisionToShaUrlTest(helpers.ExtendedTestCase):
+  """Tests the build_revision_to_sha_url method."""
+
+  def test_correct_url_building(self):
+    """Tests if the SHA url is built correctly"""
+
+    result = revisions.build_revision_to_sha_url(12345, 'v8/v8')
+    self.assertEqual(result, ('https://cr-rev.appspot.com/_ah/api/crrev/v1'
+                              '/get_numbering?project=chromium&repo=v8%2Fv8'
+                              '&number=12345&numbering_type='
+                              'COMMIT_POSITION&numbering_identifier=refs'
+                              '%2Fheads%2Fmaster'))
+
+
+class FetchShaTest(helpers.ExtendedTestCase):
+  """Tests the fetch_sha method."""
+
+  def setUp(self):
+    helpers.patch(self, ['urlfetch.fetch'])
+
+  def test_get_sha_from_response_body(self):
+    """Tests to ensure that the sha is grabbed from the response correctly"""
+
+    self.mock.fetch.return_value = mock.Mock(body=json.dumps({
+        'id': 12345,
+        'git_sha': '1a2s3d4f',
+        'crash_type': 'Bad Crash'}))
+
+    result = revisions.fetch_sha(123456, 'v8/v8')
+    self.assertEqual(result, '1a2s3d4f')
+
+
+class ParseLogTest(helpers.ExtendedTestCase):
+  """Test parse_log."""
+
+  def test_parse(self):
+    """Test reading the commit positions from the footers."""
+    output = (
+        'aaa\0Title\n\nCr-Commit-Position: refs/heads/master@{#12}\n\0\n'
+        'bbb\0Roll\n\0\n'
+        'ccc\0Title\n\nCr-Commit-Position: refs/heads/main@{#10}\n\0\n')
+    self.assertEqual(
+        [('aaa', 12), ('bbb', None), ('ccc', 10)],
+        revisions.parse_log(output))
+
+
+class FindInCheckoutTest(helpers.ExtendedTestCase):
+  """Test find_in_checkout with a real git repository."""
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    scan = revisions.scan
+    helpers.patch(self, ['clusterfuzz.revisions.scan'])
+    self.mock.scan.side_effect = scan
+    self.source_dir = os.path.join(self.tmp_dir, 'src')
+    os.mkdir(self.source_dir)
+    self.git('init', '-q')
+    self.shas = {}
+    for position in xrange(1, 8):
+      self.commit(position)
+
+    for patcher in [
+        mock.patch.dict(git_batch.CAT_FILES, {}, clear=True),
+        mock.patch.multiple(
+            revisions, SCAN_CHUNK_SIZE=2,
+            COMMIT_POSITIONS_DIR=os.path.join(self.tmp_dir, 'positions'),
+            LOCK_FILE=os.path.join(self.tmp_dir, 'revisions.lock'))]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def git(self, *args):
+    """Run git in the checkout."""
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=a', '-c', 'user.email=a@b.c'] + list(args),
+        cwd=self.source_dir).strip()
+
+  def commit(self, position):
+    """Commit a revision."""
+    self.git('commit', '-q', '--allow-empty', '-m',
+             'r%d\n\nCr-Commit-Position: refs/heads/master@{#%d}' % (
+                 position, position))
+    self.shas[position] = self.git('rev-parse', 'HEAD')
+
+  def test_find(self):
+    """Test scanning only as far back as needed, and reusing the index."""
+    self.assertEqual(
+        self.shas[4], revisions.find_in_checkout(4, 'v8/v8', self.source_dir))
+    self.assert_n_calls(2, [self.mock.scan])
+
+    self.assertEqual(
+        self.shas[6], revisions.find_in_checkout(6, 'v8/v8', self.source_dir))
+    self.assert_n_calls(2, [self.mock.scan])
+
+  def test_new_commits(self):
+    """Test scanning the commits made since the last scan."""
+    revisions.find_in_checkout(7, 'v8/v8', self.source_dir)
+    self.commit(8)
+
+    self.assertEqual(
+        self.shas[8], revisions.find_in_checkout(8, 'v8/v8', self.source_dir))
+    self.assertEqual(
+        ['%s..%s' % (self.shas[7], self.shas[8])],
+        [call[0][1] for call in self.mock.scan.call_args_list[1:]])
+
+  def test_far_behind(self):
+    """Test starting over from head when too many commits have been made
+      since the last scan."""
+    revisions.find_in_checkout(7, 'v8/v8', self.source_dir)
+    for position in xrange(8, 11):
+      self.commit(position)
+    patcher = mock.patch.object(revisions, 'MAX_SCANNED_COMMITS', 2)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+    self.assertEqual(
+        self.shas[9], revisions.find_in_checkout(9, 'v8/v8', self.source_dir))
+    self.assertEqual(
+        [self.shas[10]],
+        [call[0][1] for call in self.mock.scan.call_args_list[1:]])
+
+  def test_too_far(self):
+    """Test not scanning for a revision that is too far back."""
+    patcher = mock.patch.object(revisions, 'MAX_SCANNED_COMMITS', 3)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+    self.assertIsNone(revisions.find_in_checkout(1, 'v8/v8', self.source_dir))
+    self.assert_n_calls(1, [self.mock.scan])
+
+  def test_missing(self):
+    """Test not scanning for a revision newer than the checkout."""
+    self.assertIsNone(revisions.find_in_checkout(9, 'v8/v8', self.source_dir))
+    self.assert_n_calls(1, [self.mock.scan])
+
+  def test_not_a_checkout(self):
+    """Test a directory that isn't a git checkout."""
+    self.assertIsNone(revisions.find_in_checkout(1, 'v8/v8', self.tmp_dir))
+
+
+class GetShaTest(helpers.ExtendedTestCase):
+  """Test get_sha."""
+
+  def setUp(self):
+    helpers.patch(self, ['clusterfuzz.revisions.fetch_sha',
+                         'clusterfuzz.revisions.find_in_checkout'])
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    patcher = mock.patch.multiple(
+        revisions, REVISIONS_FILE=os.path.join(self.tmp_dir, 'revisions.json'),
+        LOCK_FILE=os.path.join(self.tmp_dir, 'revisions.lock'))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.mock.fetch_sha.return_value = 'remote'
+
+  def test_stored(self):
+    """Test returning a stored revision."""
+    common.write_json(revisions.REVISIONS_FILE, {'v8/v8': {'12': 'stored'}})
+    self.assertEqual('stored', revisions.get_sha(12, 'v8/v8', '/src'))
+    self.assert_n_calls(0, [self.mock.fetch_sha, self.mock.find_in_checkout])
+
+  def test_checkout(self):
+    """Test finding a revision in the checkout, and storing it."""
+    self.mock.find_in_checkout.return_value = 'local'
+
+    self.assertEqual('local', revisions.get_sha(12, 'v8/v8', '/src'))
+    self.assert_exact_calls(
+        self.mock.find_in_checkout, [mock.call(12, 'v8/v8', '/src')])
+    self.assert_n_calls(0, [self.mock.fetch_sha])
+    self.assertEqual(
+        {'v8/v8': {'12': 'local'}},
+        common.read_json(revisions.REVISIONS_FILE))
+
+  def test_remote(self):
+    """Test asking cr-rev, and storing the answer."""
+    self.mock.find_in_checkout.return_value = None
+
+    self.assertEqual('remote', revisions.get_sha(12, 'v8/v8', '/src'))
+    self.assertEqual('remote', revisions.get_sha(12, 'v8/v8', '/src'))
+    self.assert_exact_calls(
+        self.mock.fetch_sha, [mock.call(12, 'v8/v8')])
+
+  def test_no_checkout(self):
+    """Test skipping the checkout when there is none."""
+    self.assertEqual('remote', revisions.get_sha(12, 'chromium/src'))
+    self.assert_n_calls(0, [self.mock.find_in_checkout])
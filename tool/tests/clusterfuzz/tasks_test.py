@@ -0,0 +1,111 @@
+"""Test the tasks module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from clusterfuzz import common
+from clusterfuzz import tasks
+from error import error
+from test_libs import helpers
+
+
+class RunTest(helpers.ExtendedTestCase):
+  """Test run."""
+
+  def setUp(self):
+    self.order = []
+
+  def record(self, name, wait_for=None):
+    """Return a function that records its name, after wait_for is set."""
+
+    def fn():
+      if wait_for:
+        self.assertTrue(wait_for.wait(5))
+      self.order.append(name)
+    return fn
+
+  def test_order(self):
+    """Test that tasks start after their dependencies, and that independent
+      tasks run at the same time."""
+    both_started = threading.Event()
+    first = tasks.Task('first', self.record('first'))
+    # b waits for c, so the test would time out if they ran one by one.
+    b = tasks.Task('b', self.record('b', both_started), [first])
+    c = tasks.Task('c', lambda: (both_started.set(), self.order.append('c')),
+                   [first])
+    last = tasks.Task('last', self.record('last'), [b, c])
+
+    tasks.run([last, b, c, first])
+    self.assertEqual(['first', 'c', 'b', 'last'], self.order)
+
+  def test_failure(self):
+    """Test that a failure stops the tasks after it, and is re-raised."""
+    def fail():
+      raise error.CommandFailedError('cmd', 1, 'stderr')
+
+    failing = tasks.Task('failing', fail)
+    after = tasks.Task('after', self.record('after'), [failing])
+
+    with self.assertRaises(error.CommandFailedError):
+      tasks.run([failing, after])
+    self.assertEqual([], self.order)
+    self.assertIsNone(after.start_time)
+
+  def test_cancel(self):
+    """Test that a failure terminates the commands of the running tasks."""
+    started = threading.Event()
+
+    def sleep():
+      proc = common.start_execute('sleep', '60', '.', print_command=False)
+      started.set()
+      common.wait_execute(proc, exit_on_error=True)
+
+    def fail():
+      started.wait(5)
+      raise Exception('failed')
+
+    start_time = time.time()
+    with self.assertRaises(Exception) as cm:
+      tasks.run([tasks.Task('sleep', sleep), tasks.Task('fail', fail)])
+    self.assertEqual('failed', cm.exception.message)
+    self.assertLess(time.time() - start_time, 30)
+
+  def test_cycle(self):
+    """Test tasks that can never start."""
+    a = tasks.Task('a', self.record('a'))
+    b = tasks.Task('b', self.record('b'), [a])
+    a.deps.append(b)
+
+    with self.assertRaises(ValueError):
+      tasks.run([a, b])
+
+
+class GetCriticalPathTest(helpers.ExtendedTestCase):
+  """Test get_critical_path."""
+
+  def test_path(self):
+    """Test following the dependency that ended last."""
+    sync = tasks.Task('sync', None)
+    hooks = tasks.Task('hooks', None, [sync])
+    deps = tasks.Task('deps', None, [sync])
+    gen = tasks.Task('gen', None, [hooks, deps])
+    for task, start_time, end_time in [
+        (sync, 0, 10), (hooks, 10, 30), (deps, 10, 15), (gen, 30, 31)]:
+      task.start_time = start_time
+      task.end_time = end_time
+
+    self.assertEqual(
+        [sync, hooks, gen], tasks.get_critical_path([sync, hooks, deps, gen]))
@@ -13,11 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
+import zipfile
 import mock
 
 from clusterfuzz import common
 from clusterfuzz import testcase
+from error import error
 from test_libs import helpers
 
 
@@ -123,6 +126,112 @@ class TestcaseSetupTest(helpers.ExtendedTestCase):
     self.assertEqual(result.gestures, [])
 
 
+class GetFilenameFromHeadersTest(helpers.ExtendedTestCase):
+  """Tests get_filename_from_headers."""
+
+  def test_quoted(self):
+    """Test a quoted filename."""
+    headers = {'Content-Disposition': 'attachment; filename="abcd.zip"'}
+    self.assertEqual('abcd.zip', testcase.get_filename_from_headers(headers))
+
+  def test_unquoted(self):
+    """Test an unquoted filename with a path."""
+    headers = {'Content-Disposition': 'attachment; filename=../dir/abcd.js'}
+    self.assertEqual('abcd.js', testcase.get_filename_from_headers(headers))
+
+  def test_missing(self):
+    """Test no Content-Disposition."""
+    self.assertEqual('testcase', testcase.get_filename_from_headers({}))
+
+
+class StoreObjectTest(helpers.ExtendedTestCase):
+  """Tests store_object."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+
+  def test_store(self):
+    """Test moving the file into the store by its sha256."""
+    path = os.path.join(testcase.TESTCASE_OBJECTS_DIR, '.download-12345')
+    self.fs.CreateFile(path, contents='Fake testcase')
+
+    digest = testcase.store_object(path)
+
+    self.assertEqual(
+        '574d17f7c5e9583e3ea9737a41b9a0448dad30e28f205cb8f7d16e1ab83c113f',
+        digest)
+    with open(testcase.get_object_path(digest)) as f:
+      self.assertEqual('Fake testcase', f.read())
+    self.assertEqual([digest], os.listdir(testcase.TESTCASE_OBJECTS_DIR))
+
+
+class ExtractObjectIfNeededTest(helpers.ExtendedTestCase):
+  """Tests extract_object_if_needed."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+    helpers.patch(self, ['zipfile.ZipFile'])
+    os.makedirs(testcase.TESTCASE_OBJECTS_DIR)
+    self.extracted_dir = '%s.d' % testcase.get_object_path('abcd')
+    self.zip_file = self.mock.ZipFile.return_value.__enter__.return_value
+
+  def test_extract(self):
+    """Test extracting the zip into a temporary dir and publishing it."""
+    def extractall(path):
+      self.fs.CreateFile(os.path.join(path, 'to', 'testcase.js'))
+    self.zip_file.extractall.side_effect = extractall
+
+    self.assertEqual(
+        self.extracted_dir, testcase.extract_object_if_needed('abcd'))
+    self.assertTrue(
+        os.path.isfile(os.path.join(self.extracted_dir, 'to', 'testcase.js')))
+    self.assertEqual(
+        ['abcd.d'], os.listdir(testcase.TESTCASE_OBJECTS_DIR))
+    self.mock.ZipFile.assert_called_once_with(
+        testcase.get_object_path('abcd'), 'r')
+
+  def test_extract_failed(self):
+    """Test removing the temporary dir when the zip is corrupt."""
+    self.zip_file.extractall.side_effect = zipfile.BadZipfile('corrupt')
+
+    with self.assertRaises(zipfile.BadZipfile):
+      testcase.extract_object_if_needed('abcd')
+    self.assertEqual([], os.listdir(testcase.TESTCASE_OBJECTS_DIR))
+    self.assert_n_calls(1, [self.mock.ZipFile.return_value.__exit__])
+
+  def test_already_extracted(self):
+    """Test not extracting twice."""
+    os.makedirs(self.extracted_dir)
+    self.assertEqual(
+        self.extracted_dir, testcase.extract_object_if_needed('abcd'))
+    self.assert_n_calls(0, [self.mock.ZipFile])
+
+
+class LinkObjectIfNeededTest(helpers.ExtendedTestCase):
+  """Tests link_object_if_needed."""
+
+  def setUp(self):
+    self.setup_fake_filesystem()
+    self.fs.CreateFile(testcase.get_object_path('abcd'), contents='test')
+    self.link_path = os.path.join(
+        '%s.d' % testcase.get_object_path('abcd'), 'testcase.js')
+
+  def test_link(self):
+    """Test linking the object with the right filename."""
+    self.assertEqual(
+        self.link_path, testcase.link_object_if_needed('abcd', 'testcase.js'))
+    with open(self.link_path) as f:
+      self.assertEqual('test', f.read())
+    self.assertEqual(['testcase.js'], os.listdir(os.path.dirname(
+        self.link_path)))
+
+  def test_already_linked(self):
+    """Test reusing the existing link."""
+    self.fs.CreateFile(self.link_path, contents='test')
+    self.assertEqual(
+        self.link_path, testcase.link_object_if_needed('abcd', 'testcase.js'))
+
+
 class GetTestcasePathTest(helpers.ExtendedTestCase):
   """Tests the get_testcase_path method."""
 
@@ -130,81 +239,125 @@ class GetTestcasePathTest(helpers.ExtendedTestCase):
     self.setup_fake_filesystem()
     helpers.patch(self, [
         'clusterfuzz.common.get_stored_auth_header',
-        'clusterfuzz.common.execute',
-        'clusterfuzz.common.delete_if_exists',
-        'os.listdir',
+        'clusterfuzz.downloader.download',
+        'clusterfuzz.testcase.store_object',
         'clusterfuzz.testcase.Testcase.get_true_testcase_path'])
     self.mock.get_stored_auth_header.return_value = 'Bearer 1a2s3d4f'
-    self.testcase_dir = os.path.join(
-        common.CLUSTERFUZZ_TESTCASES_DIR, '12345_testcase')
+    self.mock.store_object.return_value = 'abcd'
+    self.mock.get_true_testcase_path.return_value = '/path/testcase.js'
     self.test = build_base_testcase()
-
-  def test_downloading_testcase(self):
-    """Tests the creation of folders & downloading of the testcase"""
-
-    def do_wget(*unused_args):
-      path = os.path.join(
-          common.CLUSTERFUZZ_TESTCASES_DIR, '12345_testcase/testcase.js')
-      with open(path, 'w') as f:
-        f.write('Fake testcase')
-    self.mock.execute.side_effect = do_wget
-    file_path = os.path.join(self.testcase_dir, 'testcase.js')
-    self.mock.get_true_testcase_path.return_value = file_path
-    self.assertFalse(os.path.exists(self.testcase_dir))
-
-    result = self.test.get_testcase_path()
-
-    self.assertEqual(result, file_path)
-    self.assert_exact_calls(self.mock.get_stored_auth_header, [mock.call()])
-    self.assert_exact_calls(self.mock.execute, [
+    self.metadata_path = os.path.join(
+        common.CLUSTERFUZZ_TESTCASES_DIR, '12345_testcase.json')
+    self.dest = os.path.join(testcase.TESTCASE_OBJECTS_DIR, '.download-12345')
+
+  def assert_download(self, headers):
+    """Assert the download request."""
+    headers.update({
+        'Authorization': 'Bearer 1a2s3d4f',
+        'User-Agent': 'clusterfuzz-tools'})
+    self.assert_exact_calls(self.mock.download, [
         mock.call(
-            'wget',
-            ('--no-verbose --waitretry=%s --retry-connrefused '
-             '--content-disposition --header="Authorization: %s" "%s"' % (
-                 testcase.DOWNLOAD_TIMEOUT,
-                 self.mock.get_stored_auth_header.return_value,
-                 testcase.CLUSTERFUZZ_TESTCASE_URL % str(12345))),
-            self.testcase_dir)
-    ])
-    self.assertTrue(os.path.exists(self.testcase_dir))
+            testcase.CLUSTERFUZZ_TESTCASE_URL % '12345', self.dest,
+            headers=headers)])
+
+  def test_first_download(self):
+    """Test downloading a testcase for the first time."""
+    self.mock.download.return_value = {
+        'Content-Disposition': 'attachment; filename="abcd.js"',
+        'ETag': '"etag"'}
+
+    self.assertEqual('/path/testcase.js', self.test.get_testcase_path())
+
+    self.assert_download({})
+    self.mock.store_object.assert_called_once_with(self.dest)
+    self.mock.get_true_testcase_path.assert_called_once_with(
+        self.test, 'abcd', 'abcd.js')
+    with open(self.metadata_path) as f:
+      self.assertEqual(
+          {'sha256': 'abcd', 'filename': 'abcd.js', 'etag': '"etag"',
+           'last_modified': None},
+          json.load(f))
+
+  def test_not_modified(self):
+    """Test reusing the cached testcase without downloading it."""
+    self.fs.CreateFile(testcase.get_object_path('cached'))
+    self.fs.CreateFile(self.metadata_path, contents=json.dumps({
+        'sha256': 'cached', 'filename': 'abcd.zip', 'etag': '"etag"',
+        'last_modified': 'Tue, 01 Aug 2017 00:00:00 GMT'}))
+    self.mock.download.return_value = None
+
+    self.assertEqual('/path/testcase.js', self.test.get_testcase_path())
+
+    self.assert_download({
+        'If-None-Match': '"etag"',
+        'If-Modified-Since': 'Tue, 01 Aug 2017 00:00:00 GMT'})
+    self.assert_n_calls(0, [self.mock.store_object])
+    self.mock.get_true_testcase_path.assert_called_once_with(
+        self.test, 'cached', 'abcd.zip')
+
+  def test_object_missing(self):
+    """Test downloading unconditionally when the object is gone."""
+    self.fs.CreateFile(self.metadata_path, contents=json.dumps({
+        'sha256': 'gone', 'filename': 'abcd.js', 'etag': '"etag"',
+        'last_modified': None}))
+    self.mock.download.return_value = {}
+
+    self.test.get_testcase_path()
+
+    self.assert_download({})
+    self.mock.get_true_testcase_path.assert_called_once_with(
+        self.test, 'abcd', 'testcase')
+
+  def test_corrupt_metadata(self):
+    """Test downloading unconditionally when the metadata is corrupted."""
+    self.fs.CreateFile(testcase.get_object_path('cached'))
+    self.fs.CreateFile(self.metadata_path, contents='{"sha256": "cac')
+    self.mock.download.return_value = {}
+
+    self.assertEqual('/path/testcase.js', self.test.get_testcase_path())
+
+    self.assert_download({})
+    self.mock.get_true_testcase_path.assert_called_once_with(
+        self.test, 'abcd', 'testcase')
+    with open(self.metadata_path) as f:
+      self.assertEqual('abcd', json.load(f)['sha256'])
+
+  def test_error(self):
+    """Test not storing anything when the download fails."""
+    self.mock.download.side_effect = error.DownloadFailedError(
+        'url', 'HTTP 500', 500)
+
+    with self.assertRaises(error.DownloadFailedError):
+      self.test.get_testcase_path()
+    self.assert_n_calls(0, [self.mock.store_object])
+    self.assertFalse(os.path.exists(self.metadata_path))
 
 
 class GetTrueTestcasePathTest(helpers.ExtendedTestCase):
   """Tests the get_true_testcase_path method."""
 
   def setUp(self):
-    helpers.patch(self, ['zipfile.ZipFile',
-                         'os.rename'])
+    helpers.patch(self, [
+        'clusterfuzz.testcase.extract_object_if_needed',
+        'clusterfuzz.testcase.link_object_if_needed'])
     self.test = build_base_testcase()
-    self.mock.ZipFile.return_value = mock.Mock()
+    self.mock.extract_object_if_needed.return_value = '/objects/abcd.d'
+    self.mock.link_object_if_needed.return_value = '/objects/abcd.d/t.js'
 
   def test_zipfile(self):
     """Tests when the file is a zipfile."""
     self.test.absolute_path = 'to/testcase.js'
     self.assertEqual(
-        os.path.join(
-            common.CLUSTERFUZZ_TESTCASES_DIR, '12345_testcase', 'to',
-            'testcase.js'),
-        self.test.get_true_testcase_path('abcd.zip'))
-
-    self.mock.ZipFile.assert_has_calls([
-        mock.call(
-            os.path.join(
-                common.CLUSTERFUZZ_TESTCASES_DIR, '12345_testcase', 'abcd.zip'),
-            'r'),
-        mock.call().extractall(os.path.join(
-            common.CLUSTERFUZZ_TESTCASES_DIR, '12345_testcase'))
-    ])
+        '/objects/abcd.d/to/testcase.js',
+        self.test.get_true_testcase_path('abcd', 'abcd.zip'))
+    self.mock.extract_object_if_needed.assert_called_once_with('abcd')
+    self.assert_n_calls(0, [self.mock.link_object_if_needed])
 
   def test_no_zipfile(self):
     """Tests when the downloaded file is not zipped."""
-
-    self.test.absolute_path = '/absolute/path/to/wrong_testcase.js'
-    self.test.get_true_testcase_path('abcd.js')
-
-    self.assert_n_calls(0, [self.mock.ZipFile])
-    testcase_dir = os.path.join(
-        common.CLUSTERFUZZ_TESTCASES_DIR, '12345_testcase')
-    self.assert_exact_calls(self.mock.rename, [
-        mock.call(os.path.join(testcase_dir, 'abcd.js'),
-                  os.path.join(testcase_dir, 'testcase.js'))])
+    self.assertEqual(
+        '/objects/abcd.d/t.js',
+        self.test.get_true_testcase_path('abcd', 'abcd.js'))
+    self.mock.link_object_if_needed.assert_called_once_with(
+        'abcd', 'testcase.js')
+    self.assert_n_calls(0, [self.mock.extract_object_if_needed])
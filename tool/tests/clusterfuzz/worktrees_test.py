@@ -0,0 +1,124 @@
+"""Test the worktrees module."""
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import mock
+
+from clusterfuzz import git_batch
+from clusterfuzz import worktrees
+from test_libs import helpers
+
+
+class CheckoutTest(helpers.ExtendedTestCase):
+  """Test checkout with a real git repository."""
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    for patcher in [
+        mock.patch.dict(git_batch.CAT_FILES, {}, clear=True),
+        mock.patch.object(
+            worktrees, 'WORKTREES_DIR', os.path.join(self.tmp_dir, 'pool')),
+        mock.patch.object(worktrees, 'GCLIENT_CACHE_DIR', '/gclient_cache'),
+        mock.patch.dict(os.environ, {worktrees.POOL_SIZE_VARIABLE: '2'})]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+    self.source_dir = os.path.join(self.tmp_dir, 'chromium', 'src')
+    os.makedirs(self.source_dir)
+    with open(os.path.join(self.tmp_dir, 'chromium', '.gclient'), 'w') as f:
+      f.write('solutions = []\n')
+    self.git('init', '-q')
+    self.shas = []
+    for i in xrange(2):
+      self.git('commit', '-q', '--allow-empty', '-m', str(i))
+      self.shas.append(self.git('rev-parse', 'HEAD'))
+
+  def git(self, *args):
+    """Run git in the checkout."""
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=a', '-c', 'user.email=a@b.c'] + list(args),
+        cwd=self.source_dir).strip()
+
+  def checkout(self, sha, revision):
+    """Check out a sha, and release the worktree at the end of the test."""
+    path, lock_file = worktrees.checkout(self.source_dir, sha, revision)
+    self.addCleanup(lock_file.close)
+    self.assertEqual(sha, self.git('-C', path, 'rev-parse', 'HEAD'))
+    return path, lock_file
+
+  def test_add(self):
+    """Test adding a worktree, along with the .gclient."""
+    path, _ = self.checkout(self.shas[0], 100)
+
+    self.assertEqual('src', os.path.basename(path))
+    with open(os.path.join(os.path.dirname(path), '.gclient')) as f:
+      self.assertEqual(
+          "solutions = []\n\ncache_dir = '/gclient_cache'\n", f.read())
+    self.assertEqual(self.shas[1], self.git('rev-parse', 'HEAD'))
+
+  def test_own_cache_dir(self):
+    """Test keeping the cache_dir that the .gclient sets."""
+    with open(os.path.join(self.tmp_dir, 'chromium', '.gclient'), 'w') as f:
+      f.write("solutions = []\ncache_dir = '/cache'\n")
+    path, _ = self.checkout(self.shas[0], 100)
+
+    with open(os.path.join(os.path.dirname(path), '.gclient')) as f:
+      self.assertEqual("solutions = []\ncache_dir = '/cache'\n", f.read())
+
+  def test_reuse_near(self):
+    """Test reusing an idle worktree near the revision."""
+    path, lock_file = self.checkout(self.shas[0], 100)
+    lock_file.close()
+
+    self.assertEqual(path, self.checkout(self.shas[1], 101)[0])
+
+  def test_busy(self):
+    """Test adding another worktree while the near one is in use."""
+    path, _ = self.checkout(self.shas[0], 100)
+    self.assertNotEqual(path, self.checkout(self.shas[1], 101)[0])
+
+  def test_far(self):
+    """Test adding another worktree for a far revision while the pool has
+      room, and reusing the nearest idle one once it's full."""
+    near_path, lock_file = self.checkout(self.shas[0], 100)
+    lock_file.close()
+    far_path, lock_file = self.checkout(self.shas[1], 100000)
+    lock_file.close()
+    self.assertNotEqual(near_path, far_path)
+
+    self.assertEqual(near_path, self.checkout(self.shas[1], 50000)[0])
+    self.assertEqual(far_path, self.checkout(self.shas[0], 100)[0])
+
+  def test_evict(self):
+    """Test evicting the least recently used worktrees beyond the pool
+      size, once they're idle."""
+    locks = []
+    paths = []
+    for revision in [100, 101, 102]:
+      path, lock_file = self.checkout(self.shas[0], revision)
+      paths.append(path)
+      locks.append(lock_file)
+    self.assertEqual(3, len(set(paths)))
+    for lock_file in locks:
+      lock_file.close()
+
+    self.assertEqual(paths[0], self.checkout(self.shas[1], 100)[0])
+    self.assertFalse(os.path.exists(paths[1]))
+    self.assertNotIn(paths[1], self.git('worktree', 'list'))
+    self.assertTrue(os.path.exists(paths[2]))
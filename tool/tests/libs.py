@@ -3,6 +3,11 @@
 
 from __future__ import absolute_import
 
+import BaseHTTPServer
+import re
+import SocketServer
+import threading
+
 from clusterfuzz import common
 
 
@@ -19,7 +24,10 @@ def make_options(
     edit_mode=False,
     skip_deps=False,
     enable_debug=False,
-    goma_dir=None):
+    goma_dir=None,
+    worktree=False,
+    fast_build=False,
+    reuse_nearest=False):
   return common.Options(
       testcase_id=testcase_id,
       current=current,
@@ -33,4 +41,99 @@ def make_options(
       edit_mode=edit_mode,
       skip_deps=skip_deps,
       enable_debug=enable_debug,
-      goma_dir=goma_dir)
+      goma_dir=goma_dir,
+      worktree=worktree,
+      fast_build=fast_build,
+      reuse_nearest=reuse_nearest)
+
+
+class FakeHttpServer(object):
+  """A local stand-in for an HTTP file server. It serves `files` (a dict of
+    path to content), supports single Range requests (unless `ranges` is
+    False), answers 304 to an If-None-Match of its ETag header, and can drop
+    the connection after sending `drop_after` bytes for the first `drops`
+    responses."""
+
+  def __init__(self, files, headers=None, drop_after=None, drops=0,
+               ranges=True):
+    self.files = files
+    self.headers = headers or {}
+    self.ranges = ranges
+    self.drop_after = drop_after
+    self.drops = drops
+    self.requests = []
+    self.lock = threading.Lock()
+    self.server = None
+    self.thread = None
+
+  def __enter__(self):
+    fake = self
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      """Serve fake.files."""
+
+      def do_GET(self):  # pylint: disable=invalid-name
+        """Serve a file or a range of it."""
+        with fake.lock:
+          fake.requests.append((self.path, dict(self.headers)))
+          drop = fake.drops > 0
+          if drop:
+            fake.drops -= 1
+
+        content = fake.files.get(self.path)
+        if content is None:
+          self.send_error(404)
+          return
+        if (self.headers.get('If-None-Match') and
+            self.headers.get('If-None-Match') == fake.headers.get('ETag')):
+          self.send_response(304)
+          self.end_headers()
+          return
+
+        start, end = 0, len(content) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match and fake.ranges:
+          start = int(match.group(1))
+          end = int(match.group(2)) if match.group(2) else end
+          if start >= len(content):
+            self.send_error(416)
+            return
+          self.send_response(206)
+          self.send_header(
+              'Content-Range', 'bytes %d-%d/%d' % (start, end, len(content)))
+        else:
+          self.send_response(200)
+
+        body = content[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        for key, value in fake.headers.iteritems():
+          self.send_header(key, value)
+        self.end_headers()
+
+        if drop:
+          self.wfile.write(body[:fake.drop_after])
+          self.close_connection = 1
+          return
+        self.wfile.write(body)
+
+      def log_message(self, unused_format, *unused_args):
+        """Don't log requests."""
+        pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+      daemon_threads = True
+
+    self.server = Server(('127.0.0.1', 0), Handler)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def url(self, path):
+    """Return the url of path."""
+    return 'http://127.0.0.1:%d%s' % (self.server.server_address[1], path)